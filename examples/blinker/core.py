@@ -59,7 +59,10 @@ class USBBlinker(Elaboratable):
         # Configuration endpoint
         from config import descriptor_map, rom_init
         m.submodules.cfg_fsm = cfg_fsm = ConfigurationFSM(descriptor_map, rom_init)
-        m.d.comb += usb_dev.addr.eq(cfg_fsm.dev_addr)
+        m.d.comb += [
+            usb_dev.addr.eq(cfg_fsm.dev_addr),
+            cfg_fsm.halt.connect(usb_dev.halt),
+        ]
         usb_dev.add_endpoint(cfg_fsm.ep_in,  addr=0)
         usb_dev.add_endpoint(cfg_fsm.ep_out, addr=0)
 
@@ -0,0 +1,735 @@
+import enum
+
+from nmigen import *
+from nmigen.hdl.rec import *
+
+from ..lib import stream
+from ..usb.crc import CRC
+from ..usb.endpoint import *
+
+
+__all__ = ["RecordKind", "CaptureEngine", "CaptureCompressor", "EndpointAdapter", "decompress"]
+
+
+class RecordKind(enum.IntEnum):
+    """Capture record kind."""
+    PACKET  = 0
+    EVENT   = 1
+    WRAP    = 2
+    COMPACT = 3
+
+
+_header_layout = [
+    ("length",    16),
+    ("rx_error",   1),
+    ("truncated",  1),
+    ("reserved",   6),
+    ("dropped",    6),
+    ("kind",       2),
+]
+
+
+class CaptureEngine(Elaboratable):
+    """USB traffic capture engine.
+
+    Frames the bytes and RX CMDs received from an ULPI :class:`ulpi.Transceiver` into timestamped
+    records. It is meant to be clocked by the ULPI clock, and sustains one byte per cycle, which
+    is the full High-Speed line rate.
+
+    Each record starts with two 32-bit words:
+
+    * a header, holding the record kind in bits 31-30 (see :class:`RecordKind`), the number of
+      records dropped since the previous record in bits 29-24 (saturating at 63), and:
+
+      * for ``PACKET`` records, the truncation flag in bit 17, the RxError flag in bit 16, and
+        the number of captured bytes in bits 15-0 ;
+      * for ``EVENT`` records, the RX CMD byte in bits 7-0.
+
+    * the value of `timestamp` at the start of the packet or at the event.
+
+    ``PACKET`` records are followed by the packet bytes, packed in little-endian order and padded
+    with zeroes to a whole number of words. ``EVENT`` records are produced when the PHY reports a new line
+    state, VBUS state or host disconnect outside of packets. ``WRAP`` records are produced when
+    the timestamp wraps around.
+
+    Packet bytes are written to a deep data FIFO as they are received, and their record header
+    is written to a record FIFO at the end of the packet. If the record FIFO is full when
+    a packet starts, the whole packet is dropped. If the data FIFO becomes full during a packet,
+    the rest of the packet is dropped and the record is marked as truncated.
+
+    Parameters
+    ----------
+    depth : int
+        Depth of the data FIFO, in words.
+    n_records : int
+        Depth of the record FIFO.
+
+    Attributes
+    ----------
+    sink : stream.Endpoint([("data", 8), ("cmd", 1)])
+        ULPI receive stream, from :class:`ulpi.Transceiver`. Cannot be stalled.
+    source : stream.Endpoint([("data", 32), ("be", 4)])
+        Capture records. `be` is always 0b1111. `last` is asserted on the last word of a record
+        if no other record is ready, which can be used to flush the upstream buffers.
+    timestamp : Signal(32), out
+        Free-running timestamp, in clock cycles.
+    stats.packets : Signal(32), out
+        Number of captured packets.
+    stats.events : Signal(32), out
+        Number of captured events.
+    stats.dropped : Signal(32), out
+        Number of dropped records.
+    stats.truncated : Signal(32), out
+        Number of truncated packets.
+    stats.clr : Signal, in
+        Clear all counters. Counters saturate at their maximum value.
+    """
+    def __init__(self, *, depth=4096, n_records=512):
+        if not isinstance(depth, int) or depth <= 0:
+            raise ValueError("Data FIFO depth must be a positive integer, not {!r}"
+                             .format(depth))
+        if not isinstance(n_records, int) or n_records <= 0:
+            raise ValueError("Record FIFO depth must be a positive integer, not {!r}"
+                             .format(n_records))
+
+        self.sink   = stream.Endpoint([("data", 8), ("cmd", 1)])
+        self.source = stream.Endpoint([("data", 32), ("be", 4)])
+
+        self.timestamp = Signal(32)
+        self.stats = Record([
+            ("packets",   32, DIR_FANOUT),
+            ("events",    32, DIR_FANOUT),
+            ("dropped",   32, DIR_FANOUT),
+            ("truncated", 32, DIR_FANOUT),
+            ("clr",        1, DIR_FANIN),
+        ])
+
+        self.depth     = depth
+        self.n_records = n_records
+
+    def _count(self, m, counter, event):
+        with m.If(self.stats.clr):
+            m.d.sync += counter.eq(0)
+        with m.Elif(event & (counter != 2**len(counter) - 1)):
+            m.d.sync += counter.eq(counter + 1)
+
+    def elaborate(self, platform):
+        m = Module()
+
+        m.submodules.data_fifo = data_fifo = stream.SyncFIFO([("data", 32)], self.depth)
+        m.submodules.rec_fifo  = rec_fifo  = stream.SyncFIFO([("header", 32), ("timestamp", 32)],
+                                                             self.n_records)
+
+        m.d.comb += self.sink.ready.eq(1)
+
+        wrap = Signal()
+        m.d.sync += self.timestamp.eq(self.timestamp + 1)
+        m.d.comb += wrap.eq(self.timestamp == 2**32 - 1)
+
+        header = Record(_header_layout)
+        m.d.comb += rec_fifo.sink.header.eq(header)
+
+        # Framer
+
+        byte_stb = Signal()
+        cmd_stb  = Signal()
+        m.d.comb += [
+            byte_stb.eq(self.sink.valid & ~self.sink.cmd),
+            cmd_stb .eq(self.sink.valid &  self.sink.cmd),
+        ]
+
+        in_pkt    = Signal()
+        pkt_ts    = Signal(32)
+        pkt_len   = Signal(16)
+        pkt_err   = Signal()
+        pkt_trunc = Signal()
+        pkt_drop  = Signal()
+
+        # Packet bytes are gathered into `word`, which holds `word_len` bytes.
+        word      = Signal(32)
+        word_len  = Signal(range(4))
+
+        # The PHY ends a packet with an RX CMD, or by deasserting `dir`. In the latter case, the
+        # last byte and the end of the packet are seen in the same cycle.
+        last_r = Signal()
+        m.d.sync += last_r.eq(self.sink.last)
+
+        pkt_end = Signal()
+        m.d.comb += pkt_end.eq(in_pkt & (last_r | cmd_stb & ~self.sink.data[4]))
+
+        with m.If(in_pkt & cmd_stb & (self.sink.data[4:6] == 0b11)):
+            m.d.sync += pkt_err.eq(1)
+
+        # State of the current packet, including its first byte.
+        cur_len   = Signal.like(word_len)
+        cur_drop  = Signal()
+        m.d.comb += [
+            cur_len .eq(Mux(in_pkt, word_len, 0)),
+            cur_drop.eq(Mux(in_pkt, pkt_drop, ~rec_fifo.sink.ready)),
+        ]
+
+        push      = Signal()
+        push_data = Signal(32)
+        push_len  = Signal(range(5))
+        pushed    = Signal()
+        length    = Signal(17)
+        truncated = Signal()
+
+        with m.If(byte_stb):
+            word_next = Signal.like(word)
+            # Padding bytes are cleared, so that records can be compressed bit-exactly.
+            m.d.comb += [
+                word_next.eq(Mux(cur_len == 0, 0, word)),
+                word_next.word_select(cur_len, 8).eq(self.sink.data),
+            ]
+            m.d.sync += in_pkt.eq(1)
+            with m.If(~in_pkt):
+                m.d.sync += [
+                    pkt_ts.eq(self.timestamp),
+                    pkt_err.eq(0),
+                    pkt_trunc.eq(0),
+                    pkt_drop.eq(cur_drop),
+                    pkt_len.eq(0),
+                ]
+            with m.If(cur_len == 3):
+                m.d.comb += [
+                    push.eq(1),
+                    push_data.eq(word_next),
+                    push_len.eq(4),
+                ]
+                m.d.sync += word_len.eq(0)
+            with m.Else():
+                m.d.sync += [
+                    word.eq(word_next),
+                    word_len.eq(cur_len + 1),
+                ]
+
+        with m.If(pkt_end):
+            m.d.sync += [
+                in_pkt.eq(0),
+                word_len.eq(0),
+            ]
+            with m.If(word_len != 0):
+                m.d.comb += [
+                    push.eq(1),
+                    push_data.eq(word),
+                    push_len.eq(word_len),
+                ]
+
+        m.d.comb += [
+            length.eq(Mux(in_pkt, pkt_len, 0) + Mux(pushed, push_len, 0)),
+            truncated.eq(in_pkt & pkt_trunc | push & ~cur_drop & ~pushed),
+        ]
+        with m.If(push & ~cur_drop & ~(in_pkt & pkt_trunc)):
+            with m.If(data_fifo.sink.ready & ~(pkt_len + push_len)[16:].any()):
+                m.d.comb += [
+                    pushed.eq(1),
+                    data_fifo.sink.valid.eq(1),
+                    data_fifo.sink.data.eq(push_data),
+                ]
+                m.d.sync += pkt_len.eq(length)
+            with m.Else():
+                m.d.sync += pkt_trunc.eq(1)
+
+        # Records
+
+        rec_stb  = Signal()
+        drop_stb = Signal()
+        dropped  = Signal(6)
+
+        event_stb = Signal()
+        idle_cmd  = Signal(8)
+        m.d.comb += event_stb.eq(cmd_stb & ~in_pkt & ~self.sink.data[4]
+                                 & (self.sink.data != idle_cmd))
+        with m.If(cmd_stb & ~in_pkt & ~self.sink.data[4]):
+            m.d.sync += idle_cmd.eq(self.sink.data)
+
+        wrap_pend = Signal()
+        wrap_stb  = Signal()
+        with m.If(wrap):
+            m.d.sync += wrap_pend.eq(1)
+        m.d.comb += wrap_stb.eq(wrap_pend & ~in_pkt & ~byte_stb & ~event_stb
+                                & rec_fifo.sink.ready)
+
+        with m.If(pkt_end):
+            with m.If(pkt_drop):
+                m.d.comb += drop_stb.eq(1)
+            with m.Else():
+                # The record FIFO had room when the packet started.
+                m.d.comb += [
+                    rec_stb.eq(1),
+                    header.kind.eq(RecordKind.PACKET),
+                    header.length.eq(length),
+                    header.rx_error.eq(pkt_err),
+                    header.truncated.eq(truncated),
+                    rec_fifo.sink.timestamp.eq(pkt_ts),
+                ]
+        with m.Elif(event_stb):
+            with m.If(rec_fifo.sink.ready):
+                m.d.comb += [
+                    rec_stb.eq(1),
+                    header.kind.eq(RecordKind.EVENT),
+                    header.length.eq(self.sink.data),
+                    rec_fifo.sink.timestamp.eq(self.timestamp),
+                ]
+            with m.Else():
+                m.d.comb += drop_stb.eq(1)
+        with m.Elif(wrap_stb):
+            m.d.sync += wrap_pend.eq(0)
+            m.d.comb += [
+                rec_stb.eq(1),
+                header.kind.eq(RecordKind.WRAP),
+                rec_fifo.sink.timestamp.eq(self.timestamp),
+            ]
+
+        m.d.comb += [
+            header.dropped.eq(dropped),
+            rec_fifo.sink.valid.eq(rec_stb),
+        ]
+        with m.If(rec_stb):
+            m.d.sync += dropped.eq(0)
+        with m.Elif(drop_stb & (dropped != 2**len(dropped) - 1)):
+            m.d.sync += dropped.eq(dropped + 1)
+
+        self._count(m, self.stats.packets,   rec_stb & (header.kind == RecordKind.PACKET))
+        self._count(m, self.stats.events,    rec_stb & (header.kind == RecordKind.EVENT))
+        self._count(m, self.stats.dropped,   drop_stb)
+        self._count(m, self.stats.truncated, rec_stb & (header.kind == RecordKind.PACKET)
+                                             & header.truncated)
+
+        # Output
+
+        rd_header = Record.like(header)
+        m.d.comb += [
+            rd_header.eq(rec_fifo.source.header),
+            self.source.be.eq(0b1111),
+        ]
+
+        rd_words = Signal(range(2**16 // 4 + 1))
+
+        with m.FSM():
+            with m.State("HEADER"):
+                m.d.comb += [
+                    self.source.valid.eq(rec_fifo.source.valid),
+                    self.source.data.eq(rec_fifo.source.header),
+                ]
+                with m.If(self.source.valid & self.source.ready):
+                    m.d.sync += rd_words.eq(Mux(rd_header.kind == RecordKind.PACKET,
+                                                (rd_header.length + 3) >> 2, 0))
+                    m.next = "TIMESTAMP"
+
+            with m.State("TIMESTAMP"):
+                m.d.comb += [
+                    self.source.valid.eq(1),
+                    self.source.data.eq(rec_fifo.source.timestamp),
+                    self.source.last.eq((rd_words == 0) & (rec_fifo.level == 1)),
+                    rec_fifo.source.ready.eq(self.source.ready),
+                ]
+                with m.If(self.source.ready):
+                    with m.If(rd_words == 0):
+                        m.next = "HEADER"
+                    with m.Else():
+                        m.next = "PAYLOAD"
+
+            with m.State("PAYLOAD"):
+                m.d.comb += [
+                    self.source.valid.eq(data_fifo.source.valid),
+                    self.source.data.eq(data_fifo.source.data),
+                    self.source.last.eq((rd_words == 1) & ~rec_fifo.source.valid),
+                    data_fifo.source.ready.eq(self.source.ready),
+                ]
+                with m.If(self.source.valid & self.source.ready):
+                    m.d.sync += rd_words.eq(rd_words - 1)
+                    with m.If(rd_words == 1):
+                        m.next = "HEADER"
+
+        return m
+
+
+class CaptureCompressor(Elaboratable):
+    """Capture record compressor.
+
+    Compresses the records of a :class:`CaptureEngine` by replacing the most frequent packets of
+    an idle bus with single-word ``COMPACT`` records:
+
+    * a SOF packet whose frame number is the same as, or follows, the frame number of the previous
+      SOF packet is replaced with a frame number increment ;
+    * an IN or PING token that repeats the previous uncompressed IN or PING token, followed by
+      a NAK handshake, is replaced by their timestamps. Runs of NAKed polling transactions are
+      therefore sent as one word per transaction, instead of six.
+
+    ``COMPACT`` records hold the record kind in bits 31-30, and their type in bit 29:
+
+    * SOF records (type 0) hold the frame number increment in bit 28, and the difference between
+      the timestamp of the packet and the timestamp of the previous record in bits 26-0 ;
+    * NAK records (type 1) hold the difference between the timestamp of the token and the
+      timestamp of the previous record in bits 28-13, and the difference between the timestamps
+      of the handshake and the token in bits 12-0.
+
+    Packets are only compressed if they have no error flags, were not preceded by dropped
+    records, and can be reconstructed bit-exactly with :func:`decompress`. Other records are
+    forwarded unmodified. A repeated token is held until the next record is received.
+
+    Attributes
+    ----------
+    sink : stream.Endpoint([("data", 32), ("be", 4)])
+        Capture records, from :class:`CaptureEngine`.
+    source : stream.Endpoint([("data", 32), ("be", 4)])
+        Compressed capture records.
+    """
+    def __init__(self):
+        self.sink   = stream.Endpoint([("data", 32), ("be", 4)])
+        self.source = stream.Endpoint([("data", 32), ("be", 4)])
+
+    def elaborate(self, platform):
+        m = Module()
+
+        m.submodules.crc = crc = CRC(poly=0b00101, size=5, dw=11, init=0x1f)
+
+        # State shared with the decompressor, which is only updated by records that are sent.
+        prev_ts   = Signal(32)
+        last_fn   = Signal(11)
+        fn_valid  = Signal()
+        run_token = Signal(24)
+        run_valid = Signal()
+
+        # Held token.
+        pend      = Signal()
+        pend_ts   = Signal(32)
+
+        # Buffered record. Records that may be compressed have a single payload word.
+        rec_valid  = Signal()
+        rec_header = Record(_header_layout)
+        rec_ts     = Signal(32)
+        rec_data   = Signal(32)
+        rec_last   = Signal()
+
+        sink_header = Record(_header_layout)
+        m.d.comb += sink_header.eq(self.sink.data)
+
+        candidate = Signal()
+        m.d.comb += candidate.eq((sink_header.kind == RecordKind.PACKET)
+                                 & (sink_header[16:30] == 0)
+                                 & ((sink_header.length == 1) | (sink_header.length == 3)))
+
+        pid = Signal(8)
+        fn  = Signal(11)
+        m.d.comb += [
+            pid.eq(rec_data[:8]),
+            fn.eq(rec_data[8:19]),
+            crc.val.eq(fn),
+        ]
+
+        is_sof   = Signal()
+        is_token = Signal()
+        is_nak   = Signal()
+        m.d.comb += [
+            is_sof  .eq((rec_header.length == 3) & (pid == 0xa5) & (rec_data[24:] == 0)),
+            is_token.eq((rec_header.length == 3) & ((pid == 0x69) | (pid == 0xb4))
+                        & (rec_data[24:] == 0)),
+            is_nak  .eq((rec_header.length == 1) & (rec_data == 0x5a)),
+        ]
+
+        ts_delta    = Signal(32)
+        token_delta = Signal(32)
+        nak_delta   = Signal(32)
+        m.d.comb += [
+            ts_delta   .eq(rec_ts  - prev_ts),
+            token_delta.eq(pend_ts - prev_ts),
+            nak_delta  .eq(rec_ts  - pend_ts),
+        ]
+
+        fn_inc = Signal()
+        sof_ok = Signal()
+        nak_ok = Signal()
+        hold   = Signal()
+        m.d.comb += [
+            fn_inc.eq(fn != last_fn),
+            sof_ok.eq(is_sof & fn_valid & (crc.res == rec_data[19:24])
+                      & ((fn == last_fn) | (fn == (last_fn + 1)[:11]))
+                      & (ts_delta[27:] == 0)),
+            nak_ok.eq(is_nak & pend & (token_delta[16:] == 0) & (nak_delta[13:] == 0)),
+            hold  .eq(is_token & run_valid & (rec_data[:24] == run_token)),
+        ]
+
+        n_words = Signal(range(2**16 // 4 + 1))
+
+        with m.FSM():
+            with m.State("HEADER"):
+                with m.If(self.sink.valid & candidate):
+                    m.d.comb += self.sink.ready.eq(1)
+                    m.d.sync += rec_header.eq(self.sink.data)
+                    m.next = "RECORD-TIMESTAMP"
+                with m.Elif(self.sink.valid & pend):
+                    m.next = "FLUSH-HEADER"
+                with m.Else():
+                    m.d.comb += self.sink.connect(self.source)
+                    with m.If(self.sink.valid & self.sink.ready):
+                        m.d.sync += n_words.eq(Mux(sink_header.kind == RecordKind.PACKET,
+                                                   (sink_header.length + 3) >> 2, 0))
+                        m.next = "TIMESTAMP"
+
+            with m.State("TIMESTAMP"):
+                m.d.comb += self.sink.connect(self.source)
+                with m.If(self.sink.valid & self.sink.ready):
+                    m.d.sync += prev_ts.eq(self.sink.data)
+                    with m.If(n_words == 0):
+                        m.next = "HEADER"
+                    with m.Else():
+                        m.next = "PAYLOAD"
+
+            with m.State("PAYLOAD"):
+                m.d.comb += self.sink.connect(self.source)
+                with m.If(self.sink.valid & self.sink.ready):
+                    m.d.sync += n_words.eq(n_words - 1)
+                    with m.If(n_words == 1):
+                        m.next = "HEADER"
+
+            with m.State("RECORD-TIMESTAMP"):
+                m.d.comb += self.sink.ready.eq(1)
+                with m.If(self.sink.valid):
+                    m.d.sync += rec_ts.eq(self.sink.data)
+                    m.next = "RECORD-PAYLOAD"
+
+            with m.State("RECORD-PAYLOAD"):
+                m.d.comb += self.sink.ready.eq(1)
+                with m.If(self.sink.valid):
+                    m.d.sync += [
+                        rec_valid.eq(1),
+                        rec_data.eq(self.sink.data),
+                        rec_last.eq(self.sink.last),
+                    ]
+                    m.next = "COMPRESS"
+
+            with m.State("COMPRESS"):
+                with m.If(pend & ~nak_ok):
+                    m.next = "FLUSH-HEADER"
+                with m.Elif(nak_ok):
+                    m.d.comb += [
+                        self.source.valid.eq(1),
+                        self.source.data.eq(Cat(nak_delta[:13], token_delta[:16], C(1, 1),
+                                                C(RecordKind.COMPACT, 2))),
+                        self.source.last.eq(rec_last),
+                    ]
+                    with m.If(self.source.ready):
+                        m.d.sync += [
+                            prev_ts.eq(rec_ts),
+                            pend.eq(0),
+                            rec_valid.eq(0),
+                        ]
+                        m.next = "HEADER"
+                with m.Elif(sof_ok):
+                    m.d.comb += [
+                        self.source.valid.eq(1),
+                        self.source.data.eq(Cat(ts_delta[:27], C(0, 1), fn_inc, C(0, 1),
+                                                C(RecordKind.COMPACT, 2))),
+                        self.source.last.eq(rec_last),
+                    ]
+                    with m.If(self.source.ready):
+                        m.d.sync += [
+                            prev_ts.eq(rec_ts),
+                            last_fn.eq(fn),
+                            rec_valid.eq(0),
+                        ]
+                        m.next = "HEADER"
+                with m.Elif(hold):
+                    m.d.sync += [
+                        pend.eq(1),
+                        pend_ts.eq(rec_ts),
+                        rec_valid.eq(0),
+                    ]
+                    m.next = "HEADER"
+                with m.Else():
+                    m.next = "RECORD-0"
+
+            with m.State("RECORD-0"):
+                m.d.comb += [
+                    self.source.valid.eq(1),
+                    self.source.data.eq(rec_header),
+                ]
+                with m.If(self.source.ready):
+                    m.next = "RECORD-1"
+
+            with m.State("RECORD-1"):
+                m.d.comb += [
+                    self.source.valid.eq(1),
+                    self.source.data.eq(rec_ts),
+                ]
+                with m.If(self.source.ready):
+                    m.next = "RECORD-2"
+
+            with m.State("RECORD-2"):
+                m.d.comb += [
+                    self.source.valid.eq(1),
+                    self.source.data.eq(rec_data),
+                    self.source.last.eq(rec_last),
+                ]
+                with m.If(self.source.ready):
+                    m.d.sync += [
+                        prev_ts.eq(rec_ts),
+                        rec_valid.eq(0),
+                    ]
+                    with m.If(is_sof):
+                        m.d.sync += [
+                            last_fn.eq(fn),
+                            fn_valid.eq(1),
+                        ]
+                    with m.If(is_token):
+                        m.d.sync += [
+                            run_token.eq(rec_data[:24]),
+                            run_valid.eq(1),
+                        ]
+                    m.next = "HEADER"
+
+            # Send the held token as an uncompressed record.
+            with m.State("FLUSH-HEADER"):
+                m.d.comb += [
+                    self.source.valid.eq(1),
+                    self.source.data.eq(3),
+                ]
+                with m.If(self.source.ready):
+                    m.next = "FLUSH-TIMESTAMP"
+
+            with m.State("FLUSH-TIMESTAMP"):
+                m.d.comb += [
+                    self.source.valid.eq(1),
+                    self.source.data.eq(pend_ts),
+                ]
+                with m.If(self.source.ready):
+                    m.next = "FLUSH-PAYLOAD"
+
+            with m.State("FLUSH-PAYLOAD"):
+                m.d.comb += [
+                    self.source.valid.eq(1),
+                    self.source.data.eq(run_token),
+                ]
+                with m.If(self.source.ready):
+                    m.d.sync += [
+                        prev_ts.eq(pend_ts),
+                        pend.eq(0),
+                    ]
+                    with m.If(rec_valid):
+                        m.next = "COMPRESS"
+                    with m.Else():
+                        m.next = "HEADER"
+
+        m.d.comb += self.source.be.eq(0b1111)
+
+        return m
+
+
+class EndpointAdapter(Elaboratable):
+    """Stream to input endpoint adapter.
+
+    Splits a stream of 32-bit words into packets of up to `ep.max_size` bytes, and sends them
+    to an input endpoint. A packet also ends with a word that has `sink.last` asserted. The
+    endpoint must be added to the device with a buffer, as its `ack` signal is ignored.
+
+    Parameters
+    ----------
+    ep : :class:`usb.endpoint.InputEndpoint`
+        Input endpoint, with a data width of 32 bits.
+
+    Attributes
+    ----------
+    sink : stream.Endpoint([("data", 32), ("be", 4)])
+        Data stream. Only the last word of a packet may be partial.
+    """
+    def __init__(self, ep):
+        if not isinstance(ep, InputEndpoint):
+            raise TypeError("Endpoint must be an InputEndpoint, not {!r}".format(ep))
+        if ep.data_width != 32:
+            raise ValueError("Endpoint data width must be 32, not {!r}".format(ep.data_width))
+        if ep.max_size % 4 != 0:
+            raise ValueError("Endpoint maximum packet size must be a multiple of 4, not {!r}"
+                             .format(ep.max_size))
+
+        self.sink = stream.Endpoint([("data", 32), ("be", 4)])
+        self.ep   = ep
+
+    def elaborate(self, platform):
+        m = Module()
+
+        n_words = self.ep.max_size // 4
+        ctr = Signal(range(n_words))
+
+        m.d.comb += [
+            self.ep.stb.eq(self.sink.valid),
+            self.ep.lst.eq(self.sink.last | (ctr == n_words - 1)),
+            self.ep.data.eq(self.sink.data),
+            self.ep.be.eq(self.sink.be),
+            self.sink.ready.eq(self.ep.rdy),
+        ]
+        with m.If(self.ep.stb & self.ep.rdy):
+            m.d.sync += ctr.eq(Mux(self.ep.lst, 0, ctr + 1))
+
+        return m
+
+
+def _crc5(val):
+    crc = 0x1f
+    for i in range(11):
+        if (val >> i & 1) ^ (crc >> 4 & 1):
+            crc = (crc << 1 ^ 0b00101) & 0x1f
+        else:
+            crc = crc << 1 & 0x1f
+    return int("{:05b}".format(~crc & 0x1f)[::-1], 2)
+
+
+def decompress(words):
+    """Decompress capture records.
+
+    Expands the ``COMPACT`` records produced by a :class:`CaptureCompressor`. The result is
+    identical to the output of the :class:`CaptureEngine` that fed the compressor.
+
+    Parameters
+    ----------
+    words : list of int
+        Compressed capture records, as 32-bit words. The first word must be the header of
+        a record.
+
+    Returns a list of 32-bit words.
+    """
+    result    = []
+    prev_ts   = 0
+    last_fn   = None
+    run_token = None
+
+    i = 0
+    while i < len(words):
+        header = words[i]
+        kind   = RecordKind(header >> 30)
+        if kind == RecordKind.COMPACT:
+            if header >> 29 & 1 == 0:
+                if last_fn is None:
+                    raise ValueError("SOF record at word {} has no reference frame".format(i))
+                last_fn = last_fn + (header >> 28 & 1) & 0x7ff
+                prev_ts = prev_ts + (header & 0x7ffffff) & 0xffffffff
+                result += [3, prev_ts, 0xa5 | last_fn << 8 | _crc5(last_fn) << 19]
+            else:
+                if run_token is None:
+                    raise ValueError("NAK record at word {} has no reference token".format(i))
+                token_ts = prev_ts  + (header >> 13 & 0xffff) & 0xffffffff
+                prev_ts  = token_ts + (header & 0x1fff) & 0xffffffff
+                result += [3, token_ts, run_token, 1, prev_ts, 0x5a]
+            i += 1
+            continue
+
+        length  = header & 0xffff
+        n_words = (length + 3) // 4 if kind == RecordKind.PACKET else 0
+        record  = words[i:i + 2 + n_words]
+        if len(record) < 2 + n_words:
+            raise ValueError("Record at word {} is incomplete".format(i))
+        result += record
+        prev_ts = record[1]
+
+        # Mirror the state of the compressor, which only tracks packets it could compress.
+        if kind == RecordKind.PACKET and header & 0x3fff0000 == 0 and length == 3:
+            data = record[2]
+            if data >> 24 == 0 and data & 0xff == 0xa5:
+                last_fn = data >> 8 & 0x7ff
+            if data >> 24 == 0 and data & 0xff in (0x69, 0xb4):
+                run_token = data
+        i += len(record)
+
+    return result
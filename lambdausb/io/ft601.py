@@ -0,0 +1,140 @@
+from nmigen import *
+from nmigen.hdl.rec import *
+
+from ..lib import stream
+
+
+__all__ = ["FT601"]
+
+
+class FT601(Elaboratable):
+    """FT601 bridge, for the 245 synchronous FIFO mode.
+
+    Moves 32-bit words between the `sync` domain and the host, through an FT601 USB 3.0 FIFO. The
+    FT601 bus runs in a local clock domain, clocked by the FT601, and is connected to the `sync`
+    domain through asynchronous FIFOs.
+
+    Writes to the host are scheduled in bursts, as the FT601 forwards its buffer to the host more
+    efficiently when it is filled in large chunks. A burst starts once `burst` words are ready to
+    be sent, or once the last word of a packet is ready. Reads from the host are only started if
+    no burst is ready.
+
+    Parameters
+    ----------
+    pins : Record
+        FT601 pins.
+    rx_depth : int
+        Depth of the receive FIFO, in words.
+    tx_depth : int
+        Depth of the transmit FIFO, in words.
+    burst : int
+        Write burst size, in words.
+
+    Attributes
+    ----------
+    sink : stream.Endpoint([("data", 32), ("be", 4)])
+        Data to the host. Setting `sink.last` ends a packet, and sends it without waiting for
+        a full burst.
+    source : stream.Endpoint([("data", 32)])
+        Data from the host. As the byte enables of the FT601 are not connected as inputs, words
+        received from the host are always full.
+    """
+    def __init__(self, *, pins, rx_depth=512, tx_depth=512, burst=64):
+        if not isinstance(burst, int) or burst <= 0:
+            raise ValueError("Burst size must be a positive integer, not {!r}".format(burst))
+
+        self.sink   = stream.Endpoint([("data", 32), ("be", 4)])
+        self.source = stream.Endpoint([("data", 32)])
+
+        self.rx_depth = rx_depth
+        self.tx_depth = tx_depth
+        self.burst    = burst
+        self._pins    = pins
+
+    def elaborate(self, platform):
+        m = Module()
+
+        m.domains += ClockDomain("ft601", local=True)
+        m.d.comb += ClockSignal("ft601").eq(self._pins.clk.i)
+
+        rx_fifo = stream.AsyncFIFO(self.source.description, self.rx_depth,
+                                   w_domain="ft601", r_domain="sync")
+        tx_fifo = stream.AsyncFIFO(self.sink.description, self.tx_depth,
+                                   w_domain="sync", r_domain="ft601")
+        m.submodules.rx_fifo = rx_fifo
+        m.submodules.tx_fifo = tx_fifo
+
+        # Words are staged on the FT601 side, to know when a burst is ready.
+        tx_stage = stream.SyncFIFO(self.sink.description, self.burst)
+        m.submodules.tx_stage = DomainRenamer("ft601")(tx_stage)
+
+        m.d.comb += [
+            rx_fifo.source.connect(self.source),
+            self.sink.connect(tx_fifo.sink),
+            tx_fifo.source.connect(tx_stage.sink),
+        ]
+
+        # Number of packet ends in the staging FIFO.
+        tx_lasts = Signal(range(self.burst + 1))
+        tx_lst_in  = Signal()
+        tx_lst_out = Signal()
+        m.d.comb += [
+            tx_lst_in .eq(tx_stage.sink.valid & tx_stage.sink.ready & tx_stage.sink.last),
+            tx_lst_out.eq(tx_stage.source.valid & tx_stage.source.ready & tx_stage.source.last),
+        ]
+        m.d.ft601 += tx_lasts.eq(tx_lasts + tx_lst_in - tx_lst_out)
+
+        burst_rdy = Signal()
+        m.d.comb += burst_rdy.eq((tx_stage.level == self.burst) | (tx_lasts != 0))
+
+        m.d.comb += [
+            # RESET_N and SIWU_N are active low.
+            self._pins.rst.o.eq(1),
+            self._pins.siwua.o.eq(1),
+            self._pins.rd_n.o.eq(1),
+            self._pins.wr_n.o.eq(1),
+            self._pins.oe_n.o.eq(1),
+        ]
+
+        burst_ctr = Signal(range(self.burst))
+
+        with m.FSM(domain="ft601"):
+            with m.State("IDLE"):
+                with m.If(burst_rdy & ~self._pins.txe_n.i):
+                    m.d.ft601 += burst_ctr.eq(0)
+                    m.next = "WRITE"
+                with m.Elif(~self._pins.rxf_n.i & rx_fifo.sink.ready):
+                    m.next = "READ-0"
+
+            with m.State("WRITE"):
+                m.d.comb += [
+                    self._pins.data.o.eq(tx_stage.source.data),
+                    self._pins.data.oe.eq(1),
+                    self._pins.be.o.eq(tx_stage.source.be),
+                    self._pins.wr_n.o.eq(~tx_stage.source.valid),
+                    tx_stage.source.ready.eq(~self._pins.txe_n.i),
+                ]
+                with m.If(tx_stage.source.valid & ~self._pins.txe_n.i):
+                    m.d.ft601 += burst_ctr.eq(burst_ctr + 1)
+                    with m.If(burst_ctr == self.burst - 1):
+                        # Give reads a chance to run between bursts.
+                        m.next = "IDLE"
+                with m.If(~tx_stage.source.valid | self._pins.txe_n.i):
+                    m.next = "IDLE"
+
+            with m.State("READ-0"):
+                # Bus turnaround. The FT601 drives the bus one cycle after OE_N is asserted.
+                m.d.comb += self._pins.oe_n.o.eq(0)
+                m.next = "READ-1"
+
+            with m.State("READ-1"):
+                m.d.comb += [
+                    self._pins.oe_n.o.eq(0),
+                    self._pins.rd_n.o.eq(~rx_fifo.sink.ready),
+                    rx_fifo.sink.valid.eq(~self._pins.rxf_n.i),
+                    rx_fifo.sink.data.eq(self._pins.data.i),
+                ]
+                with m.If(self._pins.rxf_n.i | ~rx_fifo.sink.ready):
+                    m.next = "IDLE"
+
+        return m
@@ -0,0 +1,183 @@
+from nmigen import *
+from nmigen.hdl.rec import *
+from nmigen.lib.cdc import FFSynchronizer
+
+from ..lib import stream
+from ..lib.cdc import PulseSynchronizer
+from .capture import CaptureEngine, CaptureCompressor
+from .ulpi import Transceiver, _Timer
+
+
+__all__ = ["Sniffer"]
+
+
+class Sniffer(Elaboratable):
+    """USB sniffer.
+
+    Puts an ULPI PHY in non-driving mode, and captures the traffic seen on the bus with
+    a :class:`capture.CaptureEngine`. The PHY and the capture engine run in a local clock domain,
+    clocked by the PHY. Capture records are moved to the `sync` domain through an asynchronous
+    FIFO, and can be sent upstream by connecting `source` to an :class:`ft601.FT601` bridge, or to
+    a :class:`capture.EndpointAdapter`.
+
+    Parameters
+    ----------
+    pins : Record
+        ULPI pins.
+    depth : int
+        Depth of the capture data FIFO, in words.
+    n_records : int
+        Depth of the capture record FIFO.
+    fifo_depth : int
+        Depth of the asynchronous FIFO to the `sync` domain, in words.
+    compress : bool
+        Compress capture records with a :class:`capture.CaptureCompressor`.
+
+    Attributes
+    ----------
+    source : stream.Endpoint([("data", 32), ("be", 4)])
+        Capture records. See :class:`capture.CaptureEngine` and :class:`capture.CaptureCompressor`
+        for their format.
+    hs : Signal, in
+        Capture High-Speed traffic. Otherwise, capture Full-Speed traffic. The PHY is reconfigured
+        when `hs` changes, and traffic is lost while it is.
+    stats.packets : Signal(32), out
+        Number of captured packets.
+    stats.events : Signal(32), out
+        Number of captured events.
+    stats.dropped : Signal(32), out
+        Number of dropped records.
+    stats.truncated : Signal(32), out
+        Number of truncated packets.
+    stats.clr : Signal, in
+        Clear all counters.
+    """
+    def __init__(self, *, pins, depth=4096, n_records=512, fifo_depth=512, compress=True):
+        self.source = stream.Endpoint([("data", 32), ("be", 4)])
+        self.hs     = Signal(reset=1)
+        self.stats  = Record([
+            ("packets",   32, DIR_FANOUT),
+            ("events",    32, DIR_FANOUT),
+            ("dropped",   32, DIR_FANOUT),
+            ("truncated", 32, DIR_FANOUT),
+            ("clr",        1, DIR_FANIN),
+        ])
+
+        self.depth      = depth
+        self.n_records  = n_records
+        self.fifo_depth = fifo_depth
+        self.compress   = compress
+        self._pins      = pins
+
+    def elaborate(self, platform):
+        m = Module()
+
+        m.domains += ClockDomain("ulpi", local=True)
+
+        m.submodules.xcvr  = xcvr  = Transceiver(domain="ulpi", pins=self._pins)
+        m.submodules.timer = timer = _Timer()
+
+        engine = CaptureEngine(depth=self.depth, n_records=self.n_records)
+        m.submodules.engine = DomainRenamer({"sync": "ulpi"})(engine)
+
+        fifo = stream.AsyncFIFO(self.source.description, self.fifo_depth,
+                                w_domain="ulpi", r_domain="sync")
+        m.submodules.fifo = fifo
+        m.d.comb += fifo.source.connect(self.source)
+
+        if self.compress:
+            compressor = CaptureCompressor()
+            m.submodules.compressor = DomainRenamer({"sync": "ulpi"})(compressor)
+            m.d.comb += [
+                engine.source.connect(compressor.sink),
+                compressor.source.connect(fifo.sink),
+            ]
+        else:
+            m.d.comb += engine.source.connect(fifo.sink)
+
+        # Count events in the `sync` domain. Counters of the capture engine increase by at most
+        # one per packet, which is slow enough for a pulse synchronizer.
+        events = [
+            (engine.stats.packets,   self.stats.packets),
+            (engine.stats.events,    self.stats.events),
+            (engine.stats.dropped,   self.stats.dropped),
+            (engine.stats.truncated, self.stats.truncated),
+        ]
+        for i, (engine_counter, counter) in enumerate(events):
+            engine_counter_r = Signal.like(engine_counter)
+            m.d.ulpi += engine_counter_r.eq(engine_counter)
+            event_sync = PulseSynchronizer(i_domain="ulpi", o_domain="sync")
+            m.submodules["event_sync_{}".format(i)] = event_sync
+            m.d.comb += event_sync.i.eq(engine_counter != engine_counter_r)
+            with m.If(self.stats.clr):
+                m.d.sync += counter.eq(0)
+            with m.Elif(event_sync.o & (counter != 2**len(counter) - 1)):
+                m.d.sync += counter.eq(counter + 1)
+
+        hs = Signal.like(self.hs)
+        m.submodules.hs_sync = FFSynchronizer(self.hs, hs, o_domain="ulpi")
+        hs_mode = Signal()
+
+        with m.FSM(domain="ulpi"):
+            with m.State("RESET-0"):
+                m.d.comb += xcvr.rst.eq(1)
+                m.d.comb += timer.cnt25ns.eq(1)
+                with m.If(timer.done):
+                    m.next = "RESET-1"
+
+            with m.State("RESET-1"):
+                m.d.comb += timer.cnt25ns.eq(1)
+                with m.If(timer.done):
+                    m.next = "INIT-0"
+
+            with m.State("INIT-0"):
+                # Write Function Control register.
+                m.d.comb += [
+                    xcvr.sink.data.eq(0x80 | 0x4),
+                    xcvr.sink.valid.eq(1)
+                ]
+                with m.If(xcvr.sink.ready):
+                    m.d.ulpi += hs_mode.eq(hs)
+                    m.next = "INIT-1"
+
+            with m.State("INIT-1"):
+                # XcvrSelect = 00 (Enable HS transceiver) or 01 (Enable FS transceiver)
+                # TermSelect =  0
+                # OpMode     = 01 (Non-driving)
+                # Reset      =  0
+                # SuspendM   =  1 (Powered)
+                # Reserved   =  0
+                m.d.comb += [
+                    xcvr.sink.data.eq(Mux(hs_mode, 0b01001000, 0b01001001)),
+                    xcvr.sink.last.eq(1),
+                    xcvr.sink.valid.eq(1),
+                ]
+                with m.If(xcvr.sink.ready):
+                    m.next = "INIT-2"
+
+            with m.State("INIT-2"):
+                # Write OTG Control register.
+                m.d.comb += [
+                    xcvr.sink.data.eq(0x80 | 0xa),
+                    xcvr.sink.valid.eq(1)
+                ]
+                with m.If(xcvr.sink.ready):
+                    m.next = "INIT-3"
+
+            with m.State("INIT-3"):
+                # DpPullDown = 0 (Disable D+ pull-down resistor)
+                # DmPullDown = 0 (Disable D- pull-down resistor)
+                m.d.comb += [
+                    xcvr.sink.data.eq(0b00000000),
+                    xcvr.sink.last.eq(1),
+                    xcvr.sink.valid.eq(1)
+                ]
+                with m.If(xcvr.sink.ready):
+                    m.next = "CAPTURE"
+
+            with m.State("CAPTURE"):
+                m.d.comb += xcvr.source.connect(engine.sink)
+                with m.If((hs != hs_mode) & ~xcvr.dir):
+                    m.next = "INIT-0"
+
+        return m
@@ -1,49 +1,125 @@
 from nmigen import *
 from nmigen.hdl.rec import *
-from nmigen.lib.cdc import AsyncFFSynchronizer
+from nmigen.lib.cdc import FFSynchronizer
 
 from ..lib import stream
+from ..lib.cdc import AsyncFFSynchronizer, PulseSynchronizer
+from ..usb.endpoint import _check_data_width
 
 
 __all__ = ["PHY", "Transceiver"]
 
 
 class PHY(Elaboratable):
-    def __init__(self, *, pins, rx_depth=32, tx_depth=32):
+    """ULPI PHY.
+
+    Parameters
+    ----------
+    pins : Record
+        ULPI pins.
+    rx_depth : int
+        Depth of the receive FIFO. Only used if `domain` is ``"ulpi"``.
+    tx_depth : int
+        Depth of the transmit FIFO. Only used if `domain` is ``"ulpi"``.
+    data_width : int
+        Data width of the `rx` and `tx` interfaces, in bits. Must be 8, 16 or 32.
+    domain : str
+        Clock domain of the ULPI logic. Must be ``"ulpi"`` or ``"sync"``. If ``"ulpi"``, the ULPI
+        logic runs in a local clock domain, and crosses to the `sync` domain through asynchronous
+        FIFOs. If ``"sync"``, the `sync` domain is clocked by the ULPI clock, and the ULPI logic
+        is connected to the `rx` and `tx` interfaces through skid buffers, which saves the
+        latency of the clock domain crossing. As the PHY then runs in the `sync` domain,
+        `dev_reset` must not be used to reset the `sync` domain itself.
+
+    Attributes
+    ----------
+    rx.err : Signal, out
+        Receive error. Asserted with `rx.lst` if the packet was aborted, either because the PHY
+        reported an RxError or because the receive FIFO overflowed. The packet must be dropped.
+    line_state : Signal(2), out
+        Line state, as reported by the last RX CMD.
+    vbus_state : Signal(2), out
+        VBUS state, as reported by the last RX CMD.
+    stats.rx_packets : Signal(32), out
+        Number of received packets, including aborted packets.
+    stats.rx_overflows : Signal(32), out
+        Number of packets aborted because the receive FIFO was full.
+    stats.rx_errors : Signal(32), out
+        Number of packets aborted because of an RxError.
+    stats.vbus_changes : Signal(32), out
+        Number of VBUS state changes.
+    stats.clr : Signal, in
+        Clear all counters. Counters saturate at their maximum value.
+    """
+    def __init__(self, *, pins, rx_depth=32, tx_depth=32, data_width=8, domain="ulpi"):
+        _check_data_width(data_width)
+        if domain not in {"ulpi", "sync"}:
+            raise ValueError("Domain must be 'ulpi' or 'sync', not {!r}".format(domain))
+
+        be_width = data_width // 8 if data_width > 8 else 0
         self.rx = Record([
             ("stb",  1, DIR_FANOUT),
             ("lst",  1, DIR_FANOUT),
-            ("data", 8, DIR_FANOUT),
+            ("data", data_width, DIR_FANOUT),
+            ("be",   be_width, DIR_FANOUT),
+            ("err",  1, DIR_FANOUT),
             ("rdy",  1, DIR_FANIN),
         ])
         self.tx = Record([
             ("stb",  1, DIR_FANIN),
             ("lst",  1, DIR_FANIN),
-            ("data", 8, DIR_FANIN),
+            ("data", data_width, DIR_FANIN),
+            ("be",   be_width, DIR_FANIN),
             ("rdy",  1, DIR_FANOUT),
         ])
 
         self.dev_reset = Signal()
 
+        self.line_state = Signal(2)
+        self.vbus_state = Signal(2)
+        self.stats = Record([
+            ("rx_packets",   32, DIR_FANOUT),
+            ("rx_overflows", 32, DIR_FANOUT),
+            ("rx_errors",    32, DIR_FANOUT),
+            ("vbus_changes", 32, DIR_FANOUT),
+            ("clr",           1, DIR_FANIN),
+        ])
+
         self.rx_depth = rx_depth
         self.tx_depth = tx_depth
+        self.data_width = data_width
+        self.domain = domain
         self._pins = pins
 
     def elaborate(self, platform):
         m = Module()
 
-        m.domains += ClockDomain("ulpi", local=True)
+        if self.domain == "ulpi":
+            m.domains += ClockDomain("ulpi", local=True)
 
         m.submodules.xcvr = xcvr = Transceiver(domain="ulpi", pins=self._pins)
         m.submodules.timer = timer = _Timer()
         m.submodules.splitter = splitter = _Splitter()
         m.submodules.sender = sender = _Sender()
+        m.submodules.rx_guard = rx_guard = _RxGuard(self.data_width)
 
         usb_reset = Signal()
-        m.submodules.usb_reset_sync = AsyncFFSynchronizer(usb_reset, self.dev_reset, domain="sync")
-
-        rx_fifo = stream.AsyncFIFO([("data", 8)], self.rx_depth, w_domain="ulpi", r_domain="sync")
-        tx_fifo = stream.AsyncFIFO([("data", 8)], self.tx_depth, w_domain="sync", r_domain="ulpi")
+        tx_layout = [("data", self.data_width)]
+        if self.data_width > 8:
+            tx_layout.append(("be", len(self.tx.be)))
+        rx_layout = rx_guard.sink.description.payload_layout
+
+        if self.domain == "ulpi":
+            m.submodules.usb_reset_sync = AsyncFFSynchronizer(usb_reset, self.dev_reset,
+                                                              domain="sync")
+            rx_fifo = stream.AsyncFIFO(rx_layout, self.rx_depth,
+                                       w_domain="ulpi", r_domain="sync")
+            tx_fifo = stream.AsyncFIFO(tx_layout, self.tx_depth,
+                                       w_domain="sync", r_domain="ulpi")
+        else:
+            m.d.comb += self.dev_reset.eq(usb_reset)
+            rx_fifo = _SkidBuffer(rx_layout)
+            tx_fifo = _SkidBuffer(tx_layout)
         m.submodules.rx_fifo = rx_fifo
         m.submodules.tx_fifo = tx_fifo
 
@@ -51,17 +127,38 @@ class PHY(Elaboratable):
             self.rx.stb.eq(rx_fifo.source.valid),
             self.rx.lst.eq(rx_fifo.source.last),
             self.rx.data.eq(rx_fifo.source.data),
+            self.rx.err.eq(rx_fifo.source.err),
             rx_fifo.source.ready.eq(self.rx.rdy),
 
             tx_fifo.sink.valid.eq(self.tx.stb),
             tx_fifo.sink.last.eq(self.tx.lst),
             tx_fifo.sink.data.eq(self.tx.data),
             self.tx.rdy.eq(tx_fifo.sink.ready),
-
-            splitter.source.connect(rx_fifo.sink),
-            tx_fifo.source.connect(sender.sink),
         ]
 
+        if self.data_width > 8:
+            m.d.comb += [
+                self.rx.be.eq(rx_fifo.source.be),
+                tx_fifo.sink.be.eq(self.tx.be),
+            ]
+            # Pack bytes into words on the ULPI side of the FIFOs, so that the device can run at
+            # a lower clock frequency.
+            m.submodules.rx_gearbox = rx_gearbox = _RxGearbox(self.data_width)
+            m.submodules.tx_gearbox = tx_gearbox = _TxGearbox(self.data_width)
+            m.d.comb += [
+                splitter.source.connect(rx_gearbox.sink),
+                rx_gearbox.source.connect(rx_guard.sink),
+                tx_fifo.source.connect(tx_gearbox.sink),
+                tx_gearbox.source.connect(sender.sink),
+            ]
+        else:
+            m.d.comb += [
+                splitter.source.connect(rx_guard.sink),
+                tx_fifo.source.connect(sender.sink),
+            ]
+
+        m.d.comb += rx_guard.source.connect(rx_fifo.sink)
+
         rx_cmd = Record([
             ("line_state", 2),
             ("vbus_state", 2),
@@ -73,6 +170,38 @@ class PHY(Elaboratable):
         with m.If(xcvr.source.valid & xcvr.source.cmd):
             m.d.ulpi += rx_cmd.eq(xcvr.source.data)
 
+        vbus_change = Signal()
+        vbus_state  = Signal.like(rx_cmd.vbus_state)
+        m.d.ulpi += vbus_state.eq(rx_cmd.vbus_state)
+        m.d.comb += vbus_change.eq(vbus_state != rx_cmd.vbus_state)
+
+        # Export the events and the RX CMD fields to the `sync` domain, and count events.
+        events = [
+            (rx_guard.packet,   self.stats.rx_packets),
+            (rx_guard.overflow, self.stats.rx_overflows),
+            (splitter.rx_error, self.stats.rx_errors),
+            (vbus_change,       self.stats.vbus_changes),
+        ]
+        for i, (event, counter) in enumerate(events):
+            if self.domain == "ulpi":
+                event_sync = PulseSynchronizer(i_domain="ulpi", o_domain="sync")
+                m.submodules["event_sync_{}".format(i)] = event_sync
+                m.d.comb += event_sync.i.eq(event)
+                event = event_sync.o
+            with m.If(self.stats.clr):
+                m.d.sync += counter.eq(0)
+            with m.Elif(event & (counter != 2**len(counter) - 1)):
+                m.d.sync += counter.eq(counter + 1)
+
+        if self.domain == "ulpi":
+            m.submodules.line_state_sync = FFSynchronizer(rx_cmd.line_state, self.line_state)
+            m.submodules.vbus_state_sync = FFSynchronizer(rx_cmd.vbus_state, self.vbus_state)
+        else:
+            m.d.comb += [
+                self.line_state.eq(rx_cmd.line_state),
+                self.vbus_state.eq(rx_cmd.vbus_state),
+            ]
+
         hs_mode = Signal()
 
         with m.FSM(domain="ulpi") as fsm:
@@ -240,6 +369,8 @@ class PHY(Elaboratable):
                     m.d.ulpi += hs_mode.eq(1)
                     m.next = "IDLE"
 
+        if self.domain == "sync":
+            return DomainRenamer({"ulpi": "sync"})(m)
         return m
 
 
@@ -336,7 +467,9 @@ class _Timer(Elaboratable):
 class _Splitter(Elaboratable):
     def __init__(self):
         self.sink   = stream.Endpoint([('data', 8), ('cmd', 1)])
-        self.source = stream.Endpoint([('data', 8)])
+        self.source = stream.Endpoint([('data', 8), ('err', 1)])
+
+        self.rx_error = Signal()
 
     def elaborate(self, platform):
         m = Module()
@@ -344,28 +477,49 @@ class _Splitter(Elaboratable):
         buf_data  = Signal(8)
         buf_valid = Signal()
 
+        # Set once a packet has been aborted, until the PHY deasserts RxActive.
+        flush = Signal()
+
         m.d.ulpi += self.source.valid.eq(0)
 
         with m.If(self.sink.valid):
             with m.If(~self.sink.cmd):
-                m.d.ulpi += [
-                    buf_data.eq(self.sink.data),
-                    buf_valid.eq(1),
-                ]
+                with m.If(~flush):
+                    m.d.ulpi += [
+                        buf_data.eq(self.sink.data),
+                        buf_valid.eq(1),
+                    ]
+                    with m.If(buf_valid):
+                        m.d.ulpi += [
+                            self.source.valid.eq(1),
+                            self.source.data.eq(buf_data),
+                            self.source.last.eq(0),
+                            self.source.err.eq(0),
+                        ]
+            with m.Elif(self.sink.data[4:6] == 0b11):
+                # RxError. End the packet early, and ignore its remaining bytes.
+                m.d.comb += self.rx_error.eq(~flush)
+                m.d.ulpi += flush.eq(1)
                 with m.If(buf_valid):
                     m.d.ulpi += [
                         self.source.valid.eq(1),
+                        self.source.last.eq(1),
                         self.source.data.eq(buf_data),
-                        self.source.last.eq(0),
+                        self.source.err.eq(1),
+                        buf_valid.eq(0),
                     ]
             with m.Elif(self.sink.data & 0x38 == 0x08):
+                m.d.ulpi += flush.eq(0)
                 with m.If(buf_valid):
                     m.d.ulpi += [
                         self.source.valid.eq(1),
                         self.source.last.eq(1),
                         self.source.data.eq(buf_data),
+                        self.source.err.eq(0),
                         buf_valid.eq(0),
                     ]
+            with m.Elif(~self.sink.data[4]):
+                m.d.ulpi += flush.eq(0)
 
         return m
 
@@ -397,3 +551,177 @@ class _Sender(Elaboratable):
             ]
 
         return m
+
+
+class _SkidBuffer(Elaboratable):
+    def __init__(self, layout):
+        self.sink   = stream.Endpoint(layout)
+        self.source = stream.Endpoint(layout)
+
+    def elaborate(self, platform):
+        m = Module()
+
+        # Holds the word that was accepted while the source was stalled, so that `sink.ready`
+        # can be registered without adding a bubble.
+        skid = stream.Endpoint(self.sink.description)
+
+        m.d.comb += self.sink.ready.eq(~skid.valid)
+
+        with m.If(self.source.ready | ~self.source.valid):
+            with m.If(skid.valid):
+                m.d.ulpi += [
+                    self.source.valid.eq(1),
+                    self.source.last.eq(skid.last),
+                    self.source.payload.eq(skid.payload),
+                    skid.valid.eq(0),
+                ]
+            with m.Else():
+                m.d.ulpi += [
+                    self.source.valid.eq(self.sink.valid),
+                    self.source.last.eq(self.sink.last),
+                    self.source.payload.eq(self.sink.payload),
+                ]
+        with m.Elif(self.sink.valid & self.sink.ready):
+            m.d.ulpi += [
+                skid.valid.eq(1),
+                skid.last.eq(self.sink.last),
+                skid.payload.eq(self.sink.payload),
+            ]
+
+        return m
+
+
+class _RxGuard(Elaboratable):
+    def __init__(self, data_width):
+        layout = [("data", data_width), ("err", 1)]
+        if data_width > 8:
+            layout.append(("be", data_width // 8))
+        self.sink   = stream.Endpoint(layout)
+        self.source = stream.Endpoint(layout)
+
+        self.packet   = Signal()
+        self.overflow = Signal()
+
+    def elaborate(self, platform):
+        m = Module()
+
+        # The receive path cannot be stalled. If the receive FIFO is full, the rest of the packet
+        # is dropped, and a word with `err` set is sent to terminate it once the FIFO has room.
+        drop = Signal()
+        term = Signal()
+
+        m.d.comb += self.packet.eq(self.sink.valid & self.sink.last)
+
+        with m.If(self.sink.valid & self.sink.last):
+            m.d.ulpi += drop.eq(0)
+
+        with m.If(term):
+            m.d.comb += [
+                self.source.valid.eq(1),
+                self.source.last.eq(1),
+                self.source.err.eq(1),
+            ]
+            with m.If(self.source.ready):
+                m.d.ulpi += term.eq(0)
+            with m.If(self.sink.valid & ~drop):
+                # The next packet started before the FIFO had room. Drop it too.
+                m.d.comb += self.overflow.eq(1)
+                m.d.ulpi += drop.eq(~self.sink.last)
+        with m.Elif(~drop):
+            m.d.comb += self.sink.connect(self.source)
+            with m.If(self.sink.valid & ~self.source.ready):
+                m.d.comb += self.overflow.eq(1)
+                m.d.ulpi += [
+                    drop.eq(~self.sink.last),
+                    term.eq(1),
+                ]
+
+        return m
+
+
+class _RxGearbox(Elaboratable):
+    def __init__(self, data_width):
+        self.sink   = stream.Endpoint([("data", 8), ("err", 1)])
+        self.source = stream.Endpoint([("data", data_width), ("err", 1), ("be", data_width // 8)])
+
+        self.data_width = data_width
+
+    def elaborate(self, platform):
+        m = Module()
+
+        n_bytes = self.data_width // 8
+
+        # The PID is sent alone, in its own word.
+        pid   = Signal(reset=1)
+        index = Signal(range(n_bytes))
+        data  = Signal(self.data_width)
+        be    = Signal(n_bytes)
+
+        m.d.ulpi += self.source.valid.eq(0)
+
+        with m.If(self.sink.valid):
+            with m.If(pid):
+                m.d.ulpi += [
+                    self.source.valid.eq(1),
+                    self.source.last.eq(self.sink.last),
+                    self.source.data.eq(self.sink.data),
+                    self.source.err.eq(self.sink.err),
+                    self.source.be.eq(0b1),
+                    pid.eq(self.sink.last),
+                ]
+            with m.Else():
+                data_next = Signal.like(data)
+                be_next   = Signal.like(be)
+                m.d.comb += [
+                    data_next.eq(data),
+                    data_next.word_select(index, 8).eq(self.sink.data),
+                    be_next.eq(be | (1 << index)),
+                ]
+                with m.If(self.sink.last | (index == n_bytes - 1)):
+                    m.d.ulpi += [
+                        self.source.valid.eq(1),
+                        self.source.last.eq(self.sink.last),
+                        self.source.data.eq(data_next),
+                        self.source.err.eq(self.sink.err),
+                        self.source.be.eq(be_next),
+                        index.eq(0),
+                        be.eq(0),
+                        pid.eq(self.sink.last),
+                    ]
+                with m.Else():
+                    m.d.ulpi += [
+                        data.eq(data_next),
+                        be.eq(be_next),
+                        index.eq(index + 1),
+                    ]
+
+        return m
+
+
+class _TxGearbox(Elaboratable):
+    def __init__(self, data_width):
+        self.sink   = stream.Endpoint([("data", data_width), ("be", data_width // 8)])
+        self.source = stream.Endpoint([("data", 8)])
+
+        self.data_width = data_width
+
+    def elaborate(self, platform):
+        m = Module()
+
+        n_bytes = self.data_width // 8
+
+        index = Signal(range(n_bytes))
+        word_end = Signal()
+        m.d.comb += word_end.eq((index == n_bytes - 1) | ~self.sink.be.bit_select(index + 1, 1))
+
+        m.d.comb += [
+            self.source.valid.eq(self.sink.valid),
+            self.source.last.eq(self.sink.last & word_end),
+            self.source.data.eq(self.sink.data.word_select(index, 8)),
+            self.sink.ready.eq(self.source.ready & word_end),
+        ]
+
+        with m.If(self.source.valid & self.source.ready):
+            m.d.ulpi += index.eq(Mux(word_end, 0, index + 1))
+
+        return m
@@ -0,0 +1,87 @@
+from nmigen import *
+from nmigen.lib.cdc import FFSynchronizer
+
+
+__all__ = ["AsyncFFSynchronizer", "PulseSynchronizer"]
+
+
+class PulseSynchronizer(Elaboratable):
+    """Pulse synchronizer.
+
+    Each cycle where `i` is asserted in `i_domain` produces a one-cycle pulse on `o` in
+    `o_domain`. The input is turned into a toggle, which crosses to `o_domain` through a
+    :class:`nmigen.lib.cdc.FFSynchronizer`, and is then turned back into pulses. Input pulses
+    must be spaced by more than `stages + 1` cycles of `o_domain`, or they may be lost.
+
+    Parameters
+    ----------
+    i_domain : str
+        Input clock domain.
+    o_domain : str
+        Output clock domain.
+    stages : int
+        Number of synchronization stages. Optional. Defaults to 2.
+
+    Attributes
+    ----------
+    i : Signal, in
+        Input pulse.
+    o : Signal, out
+        Output pulse.
+    """
+    def __init__(self, *, i_domain, o_domain, stages=2):
+        self.i = Signal()
+        self.o = Signal()
+
+        self._i_domain = i_domain
+        self._o_domain = o_domain
+        self._stages   = stages
+
+    def elaborate(self, platform):
+        m = Module()
+
+        i_toggle = Signal()
+        o_toggle = Signal()
+        o_toggle_r = Signal()
+
+        m.d[self._i_domain] += i_toggle.eq(i_toggle ^ self.i)
+        m.submodules.toggle_sync = FFSynchronizer(i_toggle, o_toggle, o_domain=self._o_domain,
+                                                  stages=self._stages)
+        m.d[self._o_domain] += o_toggle_r.eq(o_toggle)
+        m.d.comb += self.o.eq(o_toggle ^ o_toggle_r)
+
+        return m
+
+
+try:
+    from nmigen.lib.cdc import AsyncFFSynchronizer
+except ImportError:
+    # nMigen 0.2 does not provide AsyncFFSynchronizer.
+    class AsyncFFSynchronizer(Elaboratable):
+        """Synchronize the deassertion of an asynchronous signal.
+
+        `o` is asserted asynchronously when `i` is asserted, and deasserted synchronously to
+        `domain`, `stages` cycles after `i` is deasserted.
+        """
+        def __init__(self, i, o, *, domain="sync", stages=2):
+            self.i = i
+            self.o = o
+
+            self._domain = domain
+            self._stages = stages
+
+        def elaborate(self, platform):
+            m = Module()
+
+            m.domains += ClockDomain("async_ff", async_reset=True, local=True)
+            flops = [Signal(1, name="stage{}".format(index), reset=1)
+                     for index in range(self._stages)]
+            for i, o in zip((0, *flops), flops):
+                m.d.async_ff += o.eq(i)
+            m.d.comb += [
+                ClockSignal("async_ff").eq(ClockSignal(self._domain)),
+                ResetSignal("async_ff").eq(self.i),
+                self.o.eq(flops[-1]),
+            ]
+
+            return m
@@ -0,0 +1,103 @@
+from collections import deque
+
+from nmigen import *
+from nmigen.back.pysim import *
+
+
+__all__ = ["FT601Model"]
+
+
+class FT601Model:
+    """FT601 bus-functional model, in 245 synchronous FIFO mode.
+
+    Drives the pins of a :class:`io.ft601.FT601` bridge from a synchronous simulation process.
+    The FT601 clock is toggled on every `sync` clock cycle, and therefore runs at half the
+    frequency of the `sync` domain.
+
+    Words written by the bridge are sent to the host. The FT601 accepts up to `tx_buffer` words,
+    then deasserts TXE_N for `tx_drain` cycles while the host empties its buffer. Words queued
+    with :meth:`send` are presented to the bridge as soon as it asserts OE_N.
+
+    Parameters
+    ----------
+    tx_buffer : int
+        Size of the transmit buffer, in words.
+    tx_drain : int
+        Number of FT601 clock cycles needed by the host to empty the transmit buffer.
+
+    Attributes
+    ----------
+    pins : Record
+        FT601 pins, with the same layout as the ``ft601`` resource of the usbsniffer platform.
+    received : list of (int, int)
+        Words sent to the host, as `(data, be)` tuples.
+    cycles : int
+        Number of elapsed FT601 clock cycles.
+    """
+    def __init__(self, *, tx_buffer=1024, tx_drain=16):
+        self.pins = Record([
+            ("clk",   [("i", 1)]),
+            ("rst",   [("o", 1)]),
+            ("data",  [("i", 32), ("o", 32), ("oe", 1)]),
+            ("be",    [("o", 4)]),
+            ("rxf_n", [("i", 1)]),
+            ("txe_n", [("i", 1)]),
+            ("rd_n",  [("o", 1)]),
+            ("wr_n",  [("o", 1)]),
+            ("oe_n",  [("o", 1)]),
+            ("siwua", [("o", 1)]),
+        ])
+        self.tx_buffer = tx_buffer
+        self.tx_drain  = tx_drain
+
+        self.received = []
+        self.cycles   = 0
+
+        self._tx_space = tx_buffer
+        self._tx_wait  = 0
+        self._rx_queue = deque()
+
+    def send(self, words):
+        """Queue `words` to be read by the bridge."""
+        self._rx_queue.extend(words)
+
+    def process(self):
+        pins = self.pins
+        yield Passive()
+        yield pins.rxf_n.i.eq(1)
+        while True:
+            # Sample the outputs of the bridge before the rising edge of the FT601 clock.
+            yield Settle()
+            write = not (yield pins.wr_n.o) and self._tx_space > 0
+            if write:
+                assert (yield pins.data.oe)
+                word = (yield pins.data.o), (yield pins.be.o)
+            read = (not (yield pins.rd_n.o) and not (yield pins.oe_n.o)
+                    and len(self._rx_queue) > 0)
+            if read:
+                assert not (yield pins.data.oe)
+
+            yield pins.clk.i.eq(1)
+            yield Settle()
+            self.cycles += 1
+
+            if write:
+                self.received.append(word)
+                self._tx_space -= 1
+                if self._tx_space == 0:
+                    self._tx_wait = self.tx_drain
+            elif self._tx_space == 0:
+                if self._tx_wait == 0:
+                    self._tx_space = self.tx_buffer
+                else:
+                    self._tx_wait -= 1
+            if read:
+                self._rx_queue.popleft()
+
+            yield pins.txe_n.i.eq(self._tx_space == 0)
+            yield pins.rxf_n.i.eq(len(self._rx_queue) == 0)
+            yield pins.data.i.eq(self._rx_queue[0] if self._rx_queue else 0)
+            yield
+
+            yield pins.clk.i.eq(0)
+            yield
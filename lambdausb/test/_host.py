@@ -0,0 +1,388 @@
+from collections import defaultdict
+
+from nmigen.back.pysim import *
+
+from ..usb.defs import *
+
+
+def crc5(val, n_bits=11):
+    crc = 0x1f
+    for i in range(n_bits):
+        if (val >> i & 1) ^ (crc >> 4 & 1):
+            crc = (crc << 1 ^ 0b00101) & 0x1f
+        else:
+            crc = crc << 1 & 0x1f
+    # The CRC is sent MSb first, and inverted.
+    return int("{:05b}".format(~crc & 0x1f)[::-1], 2)
+
+
+def crc16(payload):
+    crc = 0xffff
+    for byte in payload:
+        for i in range(8):
+            if (byte >> i & 1) ^ (crc >> 15 & 1):
+                crc = (crc << 1 ^ 0x8005) & 0xffff
+            else:
+                crc = crc << 1 & 0xffff
+    return int("{:016b}".format(crc)[::-1], 2) ^ 0xffff
+
+
+def pid_byte(pid):
+    return pid | (~pid & 0xf) << 4
+
+
+def token_packet(pid, addr, ep):
+    val = addr | ep << 7
+    crc = crc5(val)
+    return [pid_byte(pid), val & 0xff, val >> 8 | crc << 3]
+
+
+def sof_packet(frame):
+    val = frame & 0x7ff
+    crc = crc5(val)
+    return [pid_byte(PacketID.SOF), val & 0xff, val >> 8 | crc << 3]
+
+
+def data_packet(pid, payload):
+    crc = crc16(payload)
+    return [pid_byte(pid), *payload, crc & 0xff, crc >> 8]
+
+
+def handshake_packet(pid):
+    return [pid_byte(pid)]
+
+
+class EndpointStats:
+    """Transaction statistics of an endpoint, as seen by the host.
+
+    Attributes
+    ----------
+    transactions : int
+        Number of IN, OUT and PING transactions.
+    packets : int
+        Number of data packets that were successfully transferred.
+    bytes : int
+        Number of payload bytes that were successfully transferred.
+    naks : int
+        Number of NAK handshakes received.
+    nyets : int
+        Number of NYET handshakes received.
+    pings : int
+        Number of PING transactions.
+    retried_bytes : int
+        Number of payload bytes sent in OUT transactions that weren't accepted by the device.
+    """
+    def __init__(self):
+        self.transactions  = 0
+        self.packets       = 0
+        self.bytes         = 0
+        self.naks          = 0
+        self.nyets         = 0
+        self.pings         = 0
+        self.retried_bytes = 0
+
+    @property
+    def nak_ratio(self):
+        if self.transactions == 0:
+            return 0.
+        return self.naks / self.transactions
+
+
+class Host:
+    """USB host model.
+
+    Drives the `rx` and `tx` interfaces of a :class:`usb.device.Device` from a synchronous
+    simulation process. All methods are generators, and must be called with `yield from`.
+
+    The host keeps track of the data toggles of each endpoint, sends a SOF packet at the start of
+    each microframe, and waits for `turnaround` cycles between packets. Bulk OUT transfers follow
+    the high-speed PING protocol: after receipt of a NAK or NYET handshake, the host sends PING
+    tokens until the endpoint is ready to accept a data packet.
+
+    Parameters
+    ----------
+    dut : :class:`usb.device.Device`
+        Device under test.
+    addr : int
+        Device address.
+    sof_interval : int
+        Microframe period, in clock cycles. Defaults to 7500, i.e. 125 µs at 60 MHz.
+    turnaround : int
+        Number of idle cycles between two packets.
+    timeout : int
+        Number of cycles to wait for a response from the device.
+    """
+    def __init__(self, dut, *, addr=0, sof_interval=7500, turnaround=8, timeout=32):
+        self.dut          = dut
+        self.addr         = addr
+        self.sof_interval = sof_interval
+        self.turnaround   = turnaround
+        self.timeout      = timeout
+
+        self.data_width = len(dut.rx.data)
+        self.cycles     = 0
+        self.microframe = 0
+        self.stats      = defaultdict(EndpointStats)
+
+        self._next_sof = 0
+        self._rx_seq   = defaultdict(int)
+        self._tx_seq   = defaultdict(int)
+        self._ping     = set()
+        self._rx_busy  = False
+
+    def _words(self, packet):
+        # The PID is always sent alone, in its own word.
+        n_bytes = self.data_width // 8
+        yield packet[:1], len(packet) == 1
+        rest = packet[1:]
+        for i in range(0, len(rest), n_bytes):
+            yield rest[i:i + n_bytes], i + n_bytes >= len(rest)
+
+    def tick(self, cycles=1):
+        rx = self.dut.rx
+        for i in range(cycles):
+            accepted = False
+            if self._rx_busy:
+                yield Settle()
+                accepted = yield rx.rdy
+            yield
+            self.cycles += 1
+            if accepted:
+                yield rx.stb.eq(0)
+                yield rx.lst.eq(0)
+                yield rx.err.eq(0)
+                self._rx_busy = False
+
+    def send(self, packet, *, err=False):
+        """Send a packet to the device. If `err` is true, the packet is aborted by the PHY."""
+        rx = self.dut.rx
+        while self._rx_busy:
+            yield from self.tick()
+        for chunk, lst in self._words(packet):
+            yield rx.stb.eq(1)
+            yield rx.lst.eq(lst)
+            yield rx.err.eq(err and lst)
+            yield rx.data.eq(sum(byte << 8 * i for i, byte in enumerate(chunk)))
+            if self.data_width > 8:
+                yield rx.be.eq((1 << len(chunk)) - 1)
+            self._rx_busy = True
+            if lst:
+                # The device may only consume the last word of a packet after replying to it,
+                # like it would from the receive FIFO of a PHY.
+                break
+            while self._rx_busy:
+                yield from self.tick()
+        yield from self.tick(self.turnaround)
+
+    def receive(self):
+        """Receive a packet from the device. Returns `None` on timeout."""
+        tx = self.dut.tx
+        packet  = []
+        waiting = 0
+        yield tx.rdy.eq(1)
+        while True:
+            yield Settle()
+            if (yield tx.stb):
+                data = yield tx.data
+                be   = (yield tx.be) if self.data_width > 8 else 1
+                packet += [data >> 8 * i & 0xff for i in range(self.data_width // 8)
+                           if be >> i & 1]
+                lst = yield tx.lst
+                yield from self.tick()
+                if lst:
+                    break
+            elif not packet and waiting == self.timeout:
+                packet = None
+                break
+            else:
+                waiting += 1
+                yield from self.tick()
+        yield tx.rdy.eq(0)
+        yield from self.tick(self.turnaround)
+        return packet
+
+    def _handshake(self, packet):
+        if packet is None or len(packet) != 1:
+            return None
+        pid = PacketID(packet[0] & 0xf)
+        assert packet[0] == pid_byte(pid)
+        return pid
+
+    def sof(self):
+        """Send a SOF packet if a new microframe has started."""
+        if self.cycles >= self._next_sof:
+            yield from self.send(sof_packet(self.microframe // 8))
+            self.microframe += 1
+            self._next_sof  += self.sof_interval
+
+    def idle(self, cycles):
+        """Wait for `cycles` cycles, while still sending SOF packets."""
+        end = self.cycles + cycles
+        while self.cycles < end:
+            yield from self.sof()
+            yield from self.tick()
+
+    def ping(self, ep):
+        """Send a PING token. Returns the handshake PID."""
+        yield from self.send(token_packet(PacketID.PING, self.addr, ep))
+        handshake = self._handshake((yield from self.receive()))
+        stats = self.stats[ep, "out"]
+        stats.transactions += 1
+        stats.pings += 1
+        if handshake == PacketID.NAK:
+            stats.naks += 1
+        return handshake
+
+    def out_transaction(self, ep, payload, *, setup=False):
+        """Send a data packet to an output endpoint. Returns the handshake PID."""
+        if setup:
+            self._rx_seq[ep] = 0
+            self._tx_seq[ep] = 1
+        data_pid = PacketID.DATA1 if self._rx_seq[ep] else PacketID.DATA0
+        token_pid = PacketID.SETUP if setup else PacketID.OUT
+        yield from self.send(token_packet(token_pid, self.addr, ep))
+        yield from self.send(data_packet(data_pid, payload))
+        handshake = self._handshake((yield from self.receive()))
+
+        stats = self.stats[ep, "out"]
+        stats.transactions += 1
+        if handshake in (PacketID.ACK, PacketID.NYET):
+            self._rx_seq[ep] ^= 1
+            stats.packets += 1
+            stats.bytes   += len(payload)
+        else:
+            stats.retried_bytes += len(payload)
+        if handshake == PacketID.NAK:
+            stats.naks += 1
+        if handshake == PacketID.NYET:
+            stats.nyets += 1
+        return handshake
+
+    def in_transaction(self, ep):
+        """Request a data packet from an input endpoint.
+
+        Returns a tuple `(pid, payload)`. `payload` is `None` if the device didn't send a valid
+        data packet.
+        """
+        yield from self.send(token_packet(PacketID.IN, self.addr, ep))
+        packet = yield from self.receive()
+
+        stats = self.stats[ep, "in"]
+        stats.transactions += 1
+        if packet is None:
+            return None, None
+        pid = PacketID(packet[0] & 0xf)
+        if len(packet) == 1:
+            if pid == PacketID.NAK:
+                stats.naks += 1
+            return pid, None
+        payload = packet[1:-2]
+        if data_packet(pid, payload) != packet:
+            # Bad CRC. Do not send a handshake.
+            return pid, None
+        yield from self.send(handshake_packet(PacketID.ACK))
+        expected_pid = PacketID.DATA1 if self._tx_seq[ep] else PacketID.DATA0
+        if pid != expected_pid:
+            # Our previous ACK was lost. Discard the retransmitted packet.
+            return pid, None
+        self._tx_seq[ep] ^= 1
+        stats.packets += 1
+        stats.bytes   += len(payload)
+        return pid, payload
+
+    def _out_transaction(self, ep, payload):
+        """Send `payload` to an output endpoint, until it is accepted. Each attempt starts a new
+        microframe.
+
+        After a NAK or NYET, the endpoint is polled with PING until it has room for a packet.
+        Returns the PID of the handshake that ended the transaction, either ACK, NYET or STALL.
+        """
+        while True:
+            yield from self.sof()
+            if ep in self._ping:
+                handshake = yield from self.ping(ep)
+                if handshake == PacketID.ACK:
+                    self._ping.discard(ep)
+                elif handshake == PacketID.STALL:
+                    self._ping.discard(ep)
+                    return handshake
+                continue
+            handshake = yield from self.out_transaction(ep, payload)
+            if handshake in (PacketID.NAK, PacketID.NYET):
+                self._ping.add(ep)
+            if handshake in (PacketID.ACK, PacketID.NYET, PacketID.STALL):
+                return handshake
+
+    def bulk_out(self, ep, payload, *, max_size):
+        """Send `payload` to a bulk output endpoint, split into packets of `max_size` bytes."""
+        packets = [payload[i:i + max_size] for i in range(0, len(payload), max_size)] or [[]]
+        for packet in packets:
+            handshake = yield from self._out_transaction(ep, packet)
+            if handshake == PacketID.STALL:
+                return handshake
+
+    def bulk_in(self, ep, size, *, max_size):
+        """Receive up to `size` bytes from a bulk input endpoint."""
+        received = []
+        while len(received) < size:
+            yield from self.sof()
+            pid, payload = yield from self.in_transaction(ep)
+            if payload is None:
+                continue
+            received += payload
+            if len(payload) < max_size:
+                break
+        return received
+
+    def control_read(self, ep, setup, *, max_size=64, retries=16):
+        """Perform a control read transfer.
+
+        Returns the payload of the data stage, or `None` if the device stalled it, or NAKed it for
+        `retries` consecutive transactions.
+        """
+        while (yield from self.out_transaction(ep, setup, setup=True)) != PacketID.ACK:
+            yield from self.sof()
+        length = setup[6] | setup[7] << 8
+        received = []
+        naks = 0
+        while True:
+            yield from self.sof()
+            pid, payload = yield from self.in_transaction(ep)
+            if pid == PacketID.STALL:
+                return None
+            if pid == PacketID.NAK:
+                naks += 1
+                if naks == retries:
+                    return None
+            if payload is None:
+                continue
+            naks = 0
+            received += payload
+            if len(payload) < max_size or len(received) >= length:
+                break
+        # Status stage.
+        self._rx_seq[ep] = 1
+        while (yield from self.out_transaction(ep, [])) != PacketID.ACK:
+            yield from self.sof()
+        return received
+
+    def control_write(self, ep, setup, payload, *, max_size=64):
+        """Perform a control write transfer.
+
+        Returns the PID of the status stage response, or STALL if the device stalled the data
+        stage.
+        """
+        while (yield from self.out_transaction(ep, setup, setup=True)) != PacketID.ACK:
+            yield from self.sof()
+        packets = [payload[i:i + max_size] for i in range(0, len(payload), max_size)]
+        for packet in packets:
+            handshake = yield from self._out_transaction(ep, packet)
+            if handshake == PacketID.STALL:
+                return handshake
+        self._ping.discard(ep)
+        # Status stage.
+        while True:
+            yield from self.sof()
+            pid, _ = yield from self.in_transaction(ep)
+            if pid in (PacketID.DATA1, PacketID.STALL):
+                return pid
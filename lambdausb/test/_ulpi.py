@@ -0,0 +1,147 @@
+from collections import deque
+
+from nmigen import *
+from nmigen.back.pysim import *
+
+
+__all__ = ["ULPIModel"]
+
+
+class ULPIModel:
+    """ULPI PHY bus-functional model.
+
+    Drives the pins of a :class:`io.ulpi.PHY` link. If `period` is `None`, the model runs in
+    a synchronous simulation process, and toggles the ULPI clock on every `sync` clock cycle; the
+    ULPI clock then runs at half the frequency of the `sync` domain. Otherwise, the model runs in
+    an asynchronous simulation process, and generates the ULPI clock itself. This allows the
+    `sync` domain to be clocked by the ULPI clock.
+
+    Transmit commands issued by the link are acknowledged by asserting NXT until STP. Register
+    writes are applied to :attr:`registers`, and answered with an RX CMD. Packets are appended to
+    :attr:`transmitted`. RX CMDs and packets queued with :meth:`send_rx_cmd` and
+    :meth:`send_packet` are sent to the link, each in its own bus turnaround.
+
+    Parameters
+    ----------
+    line_state : int
+        Line state reported by RX CMDs. Defaults to J, as a reset would be detected on SE0.
+    vbus_state : int
+        VBUS state reported by RX CMDs. Defaults to VbusValid.
+    period : float or None
+        ULPI clock period, in seconds.
+
+    Attributes
+    ----------
+    pins : Record
+        ULPI pins, with the same layout as the ``ulpi`` resource of the usbsniffer platform.
+    registers : dict of int to int
+        PHY registers written by the link, by address.
+    transmitted : list of list of int
+        Packets sent by the link, starting with their PID.
+    """
+    def __init__(self, *, line_state=0b01, vbus_state=0b11, period=None):
+        self.pins = Record([
+            ("clk",  [("i", 1)]),
+            ("rst",  [("o", 1)]),
+            ("dir",  [("i", 1)]),
+            ("nxt",  [("i", 1)]),
+            ("stp",  [("o", 1)]),
+            ("data", [("i", 8), ("o", 8), ("oe", 1)]),
+        ])
+        self.line_state = line_state
+        self.vbus_state = vbus_state
+        self.period     = period
+
+        self.registers   = {}
+        self.transmitted = []
+
+        self._dir       = 0
+        self._nxt       = 0
+        self._data      = 0
+        self._tx        = None
+        self._rx_queue  = deque()
+        self._rx_items  = deque()
+
+    def rx_cmd(self, event=0b00):
+        """Return an RX CMD byte reporting `event`, with the current line and VBUS states."""
+        return self.line_state | self.vbus_state << 2 | event << 4
+
+    def send_rx_cmd(self, event=0b00):
+        """Queue an RX CMD reporting `event`."""
+        self._rx_queue.append([(self.rx_cmd(event), 0)])
+
+    def send_packet(self, data, *, error_at=None):
+        """Queue a received packet.
+
+        If `error_at` is not `None`, an RxError is reported before the byte at this index. The
+        rest of the packet is still sent, as a PHY would do.
+        """
+        items = []
+        for i, byte in enumerate(data):
+            if i == error_at:
+                items.append((self.rx_cmd(0b11), 0))
+            elif i > 0 and i % 4 == 0:
+                items.append((self.rx_cmd(0b01), 0))
+            items.append((byte, 1))
+        items.append((self.rx_cmd(0b00), 0))
+        self._rx_queue.append(items)
+
+    def _end_transmit(self, data):
+        cmd = data[0]
+        if cmd >> 6 == 0b10:
+            self.registers[cmd & 0x3f] = data[1]
+            self.send_rx_cmd()
+        elif cmd >> 6 == 0b01:
+            pid = cmd & 0xf
+            self.transmitted.append([pid | (~pid & 0xf) << 4, *data[1:]])
+
+    def _step(self, data_o, data_oe, stp):
+        if self._dir:
+            if self._rx_items:
+                self._data, self._nxt = self._rx_items.popleft()
+            else:
+                # Turnaround, back to the link.
+                self._dir, self._nxt, self._data = 0, 0, 0
+        elif self._tx is not None:
+            if stp:
+                self._end_transmit(self._tx)
+                self._tx  = None
+                self._nxt = 0
+            elif self._nxt:
+                self._tx.append(data_o)
+        elif data_oe and data_o != 0:
+            # Transmit command. Acknowledge it, and every following byte, until STP.
+            self._tx  = []
+            self._nxt = 1
+        elif self._rx_queue:
+            # Turnaround, to the PHY.
+            self._rx_items = deque(self._rx_queue.popleft())
+            self._dir = 1
+
+    def _half_period(self):
+        if self.period is None:
+            yield
+        else:
+            yield Delay(self.period / 2)
+
+    def process(self):
+        pins = self.pins
+        yield Passive()
+        while True:
+            # Sample the outputs of the link before the rising edge of the ULPI clock.
+            yield Settle()
+            data_o  = yield pins.data.o
+            data_oe = yield pins.data.oe
+            stp     = yield pins.stp.o
+
+            yield pins.clk.i.eq(1)
+            yield Settle()
+
+            self._step(data_o, data_oe, stp)
+            yield pins.dir.i.eq(self._dir)
+            yield pins.nxt.i.eq(self._nxt)
+            yield pins.data.i.eq(self._data)
+            yield from self._half_period()
+
+            yield pins.clk.i.eq(0)
+            yield from self._half_period()
@@ -1,12 +1,154 @@
+import inspect
+import os
+import sys
+import time
+import unittest
+from collections import Counter
+
 from nmigen.back.pysim import *
 
 
-def simulation_test(dut, process, sync=True):
-    sim = Simulator(dut)
-    if sync:
-        sim.add_clock(1e-6)
-        sim.add_sync_process(process)
-    else:
-        sim.add_process(process)
-    with sim.write_vcd("test.vcd"):
-        sim.run()
+# If set, VCD files are written to the directory named by this environment variable.
+VCD_DIR_ENV = "LAMBDAUSB_VCD"
+# If set, the simulation speed of each run is printed to stderr.
+REPORT_ENV = "LAMBDAUSB_SIM_REPORT"
+
+_trace_names = Counter()
+
+
+def _test_name():
+    # Name traces after the test case that is running the simulation, if any.
+    for frame_info in inspect.stack():
+        test = frame_info.frame.f_locals.get("self")
+        if isinstance(test, unittest.TestCase):
+            return test.id()
+    return "simulation"
+
+
+class SimulationReport:
+    """Simulation statistics.
+
+    Attributes
+    ----------
+    name : str
+        Simulation name.
+    cycles : int
+        Number of simulated clock cycles. Always 0 for asynchronous simulations.
+    seconds : float
+        Wall-clock time spent running the simulation.
+    """
+    def __init__(self, name, cycles, seconds):
+        self.name    = name
+        self.cycles  = cycles
+        self.seconds = seconds
+
+    @property
+    def cycles_per_second(self):
+        if self.seconds == 0:
+            return 0.
+        return self.cycles / self.seconds
+
+    def __str__(self):
+        return "{}: {} cycles in {:.3f} s ({:.0f} cycles/s)".format(
+                self.name, self.cycles, self.seconds, self.cycles_per_second)
+
+
+class SimulationHarness:
+    """Reusable simulation harness.
+
+    The design is elaborated and compiled once. Each call to :meth:`run` runs a new batch of
+    stimulus processes against it, concurrently. The design is not reset between batches, which
+    start where the previous batch stopped.
+
+    A single VCD file covers all batches. It is complete once the harness is closed, either by
+    calling :meth:`close` or by using the harness as a context manager.
+
+    Parameters
+    ----------
+    dut : Elaboratable
+        Design under test.
+    sync : bool
+        Run processes as synchronous processes, clocked by the `sync` domain. Otherwise, run them
+        as asynchronous processes.
+    period : float
+        Clock period, in seconds. Only used if `sync` is true.
+    vcd : bool or None
+        Write a VCD file. If `None`, a VCD file is only written if the
+        ``LAMBDAUSB_VCD`` environment variable is set.
+    name : str or None
+        Trace file name, without extension. If `None`, the name of the running test is used.
+    vcd_dir : str or None
+        Directory of the VCD file. If `None`, the directory named by the ``LAMBDAUSB_VCD``
+        environment variable is used, or the current directory if it is not set.
+    """
+    def __init__(self, dut, *, sync=True, period=1e-6, vcd=None, name=None, vcd_dir=None):
+        self.sync = sync
+        self.name = name or _test_name()
+
+        env_dir = os.environ.get(VCD_DIR_ENV)
+        if vcd is None:
+            vcd = bool(env_dir)
+        self.vcd     = vcd
+        self.vcd_dir = vcd_dir or env_dir or "."
+
+        self._sim    = Simulator(dut)
+        self._cycles = 0
+        self._vcd    = None
+        if sync:
+            self._sim.add_clock(period)
+            self._sim.add_sync_process(self._count_cycles)
+
+    def _count_cycles(self):
+        yield Passive()
+        while True:
+            yield
+            self._cycles += 1
+
+    def _trace_file(self):
+        n = _trace_names[self.name]
+        _trace_names[self.name] += 1
+        filename = self.name if n == 0 else "{}.{}".format(self.name, n)
+        os.makedirs(self.vcd_dir, exist_ok=True)
+        return os.path.join(self.vcd_dir, filename + ".vcd")
+
+    def run(self, *processes):
+        """Run `processes` concurrently, until all of them have returned.
+
+        Returns a :class:`SimulationReport`.
+        """
+        for process in processes:
+            if self.sync:
+                self._sim.add_sync_process(process)
+            else:
+                self._sim.add_process(process)
+
+        if self.vcd and self._vcd is None:
+            self._vcd = self._sim.write_vcd(self._trace_file())
+            self._vcd.__enter__()
+
+        start_cycles = self._cycles
+        start = time.perf_counter()
+        self._sim.run()
+        report = SimulationReport(self.name, self._cycles - start_cycles,
+                                  time.perf_counter() - start)
+
+        if os.environ.get(REPORT_ENV):
+            print(report, file=sys.stderr)
+        return report
+
+    def close(self):
+        """Finish writing the VCD file, if any."""
+        if self._vcd is not None:
+            self._vcd.__exit__(None, None, None)
+            self._vcd = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def simulation_test(dut, *processes, sync=True, vcd=None):
+    with SimulationHarness(dut, sync=sync, vcd=vcd) as harness:
+        return harness.run(*processes)
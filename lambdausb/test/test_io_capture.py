@@ -0,0 +1,381 @@
+#nmigen: UnusedElaboratable=no
+
+import random
+import unittest
+
+from nmigen import *
+from nmigen.back.pysim import *
+
+from ._host import *
+from ._util import *
+from ..io.capture import *
+from ..usb.defs import *
+from ..usb.endpoint import *
+
+
+# RX CMDs, with RxActive set or cleared.
+_RX_ACTIVE = 0x10
+_RX_IDLE   = 0x01
+_RX_ERROR  = 0x30
+
+
+def _decode(words):
+    # Split a stream of capture words into (kind, dropped, flags, value, timestamp, payload)
+    # tuples.
+    records = []
+    while words:
+        header, timestamp, *words = words
+        kind    = RecordKind(header >> 30)
+        dropped = (header >> 24) & 0x3f
+        flags   = (header >> 16) & 0x3
+        value   = header & 0xffff
+        payload = []
+        if kind == RecordKind.PACKET:
+            n_words = (value + 3) // 4
+            data    = b"".join(word.to_bytes(4, "little") for word in words[:n_words])
+            payload = list(data[:value])
+            words   = words[n_words:]
+        records.append((kind, dropped, flags, value, timestamp, payload))
+    return records
+
+
+def _packet(payload, *, end_cmd=True):
+    # Bytes of a packet, as seen on the `source` of an ULPI transceiver: (data, cmd, last).
+    stream = [(_RX_ACTIVE, 1, 0)]
+    stream += [(byte, 0, 0) for byte in payload]
+    if end_cmd:
+        stream += [(_RX_IDLE, 1, 1)]
+    else:
+        stream[-1] = (*stream[-1][:2], 1)
+    return stream
+
+
+class CaptureEngineTestCase(unittest.TestCase):
+    def _run(self, dut, stream, *, ready=lambda cycle: True):
+        received = []
+
+        def drive():
+            for item in stream:
+                if item is None:
+                    yield dut.sink.valid.eq(0)
+                    yield
+                    continue
+                data, cmd, last = item
+                yield dut.sink.valid.eq(1)
+                yield dut.sink.data.eq(data)
+                yield dut.sink.cmd.eq(cmd)
+                yield dut.sink.last.eq(last)
+                yield
+                if last:
+                    # Turnaround.
+                    yield dut.sink.valid.eq(0)
+                    yield dut.sink.last.eq(0)
+                    yield
+            yield dut.sink.valid.eq(0)
+
+        def collect():
+            yield Passive()
+            cycle = 0
+            while True:
+                yield dut.source.ready.eq(ready(cycle))
+                yield Settle()
+                if (yield dut.source.valid) and (yield dut.source.ready):
+                    self.assertEqual((yield dut.source.be), 0b1111)
+                    received.append(((yield dut.source.data), (yield dut.source.last)))
+                yield
+                cycle += 1
+
+        def process():
+            yield from drive()
+            for i in range(64):
+                yield
+
+        simulation_test(dut, process, collect)
+        return received
+
+    def test_wrong_depth(self):
+        with self.assertRaisesRegex(ValueError,
+                r"Data FIFO depth must be a positive integer, not 0"):
+            dut = CaptureEngine(depth=0)
+
+    def test_wrong_n_records(self):
+        with self.assertRaisesRegex(ValueError,
+                r"Record FIFO depth must be a positive integer, not 0"):
+            dut = CaptureEngine(n_records=0)
+
+    def test_packets(self):
+        dut = CaptureEngine(depth=64, n_records=8)
+        payloads = [[0x69, 0x82, 0x18], [0xc3, *range(8), 0x94, 0x6b], [0xd2]]
+        stream  = _packet(payloads[0])
+        # A new line state is an event, but repeated RX CMDs are not.
+        stream += [(0x02, 1, 0), (0x02, 1, 0), (_RX_IDLE, 1, 0)]
+        stream += _packet(payloads[1], end_cmd=False)
+        stream += _packet(payloads[2])
+
+        received = self._run(dut, stream)
+        records  = _decode([data for data, last in received])
+
+        self.assertEqual([(kind, value, payload) for kind, _, _, value, _, payload in records], [
+            (RecordKind.PACKET, len(payloads[0]), payloads[0]),
+            (RecordKind.EVENT,  0x02,             []),
+            (RecordKind.EVENT,  _RX_IDLE,         []),
+            (RecordKind.PACKET, len(payloads[1]), payloads[1]),
+            (RecordKind.PACKET, len(payloads[2]), payloads[2]),
+        ])
+        self.assertTrue(all(dropped == 0 and flags == 0 for _, dropped, flags, *_ in records))
+        timestamps = [timestamp for *_, timestamp, _ in records]
+        self.assertEqual(timestamps, sorted(timestamps))
+        # The stream is flushed once the last record has been sent.
+        self.assertEqual(received[-1][1], 1)
+
+    def test_rx_error(self):
+        dut = CaptureEngine(depth=64, n_records=8)
+        stream = _packet([0x69, 0x82, 0x18])
+        stream.insert(3, (_RX_ERROR, 1, 0))
+        records = _decode([data for data, last in self._run(dut, stream)])
+        self.assertEqual(records[0][0], RecordKind.PACKET)
+        self.assertEqual(records[0][2], 0b01)
+        self.assertEqual(records[0][5], [0x69, 0x82, 0x18])
+
+    def test_backpressure(self):
+        # The upstream is stalled while packets are received: the data FIFO overflows, then the
+        # record FIFO does.
+        dut = CaptureEngine(depth=4, n_records=2)
+        stream  = _packet([*range(24)])
+        stream += _packet([0xd2])
+        stream += _packet([0x5a])
+        stream += _packet([0xa5])
+        stream += [None] * 64
+        stream += _packet([0x4b])
+
+        received = self._run(dut, stream, ready=lambda cycle: cycle > 60)
+        records  = _decode([data for data, last in received])
+
+        self.assertEqual([(kind, dropped, flags, value, payload)
+                          for kind, dropped, flags, value, _, payload in records], [
+            # The first packet is truncated to the size of the data FIFO.
+            (RecordKind.PACKET, 0, 0b10, 16, [*range(16)]),
+            (RecordKind.PACKET, 0, 0b10,  0, []),
+            # The next packets are dropped, as the record FIFO is full.
+            (RecordKind.PACKET, 2, 0b00,  1, [0x4b]),
+        ])
+
+    def test_stats(self):
+        dut = CaptureEngine(depth=4, n_records=2)
+        stream  = _packet([*range(24)])
+        stream += [(0x02, 1, 0)]
+        stream += _packet([0xd2])
+
+        def process():
+            for data, cmd, last in stream:
+                yield dut.sink.valid.eq(1)
+                yield dut.sink.data.eq(data)
+                yield dut.sink.cmd.eq(cmd)
+                yield dut.sink.last.eq(last)
+                yield
+            yield dut.sink.valid.eq(0)
+            yield dut.sink.last.eq(0)
+            yield; yield
+            self.assertEqual((yield dut.stats.packets),   1)
+            self.assertEqual((yield dut.stats.events),    1)
+            self.assertEqual((yield dut.stats.dropped),   1)
+            self.assertEqual((yield dut.stats.truncated), 1)
+            yield dut.stats.clr.eq(1)
+            yield
+            yield dut.stats.clr.eq(0)
+            yield
+            self.assertEqual((yield dut.stats.packets), 0)
+
+        simulation_test(dut, process)
+
+
+def _records(packets):
+    # Capture records of a list of (timestamp, packet) tuples, as produced by a CaptureEngine.
+    words = []
+    for timestamp, packet in packets:
+        data = bytes(packet) + bytes(-len(packet) % 4)
+        words += [len(packet), timestamp & 0xffffffff]
+        words += [int.from_bytes(data[i:i + 4], "little") for i in range(0, len(data), 4)]
+    return words
+
+
+def _trace(*, microframes, polls=0, bulk=0, seed=0):
+    # Synthetic High-Speed bus trace: a SOF every microframe, `polls` NAKed IN transactions per
+    # microframe, and `bulk` bulk OUT transactions of 512 bytes per microframe.
+    rng = random.Random(seed)
+    packets = []
+    for i in range(microframes):
+        timestamp = 1000 + i * 7500 + rng.randrange(-2, 3)
+        packets.append((timestamp, sof_packet(i // 8)))
+        for j in range(polls):
+            timestamp += rng.randrange(50, 7000 // (polls + bulk))
+            packets.append((timestamp, token_packet(PacketID.IN, 3, 1)))
+            timestamp += rng.randrange(16, 40)
+            packets.append((timestamp, handshake_packet(PacketID.NAK)))
+        for j in range(bulk):
+            timestamp += rng.randrange(50, 100)
+            packets.append((timestamp, token_packet(PacketID.OUT, 3, 2)))
+            timestamp += 8
+            packets.append((timestamp, data_packet(PacketID.DATA0, [rng.getrandbits(8)
+                                                                   for k in range(512)])))
+            timestamp += 600
+            packets.append((timestamp, handshake_packet(PacketID.ACK)))
+    return packets
+
+
+# Benchmark traces, as keyword arguments of `_trace`.
+TRACES = {
+    "idle":      dict(microframes=64),
+    "polling":   dict(microframes=64, polls=8),
+    "bulk":      dict(microframes=16, bulk=10),
+    "mixed":     dict(microframes=32, polls=4, bulk=4),
+}
+
+
+def run_benchmark(*, stall=0, **trace):
+    """Compress a synthetic trace with a :class:`CaptureCompressor`.
+
+    The upstream is stalled one cycle out of `stall`, if `stall` is non-zero.
+
+    Returns a tuple `(records, compressed)`, where `records` and `compressed` are the capture
+    records of the trace, before and after compression.
+    """
+    records = _records(_trace(**trace))
+    dut = CaptureCompressor()
+    compressed = []
+
+    def source():
+        yield Passive()
+        cycle = 0
+        while True:
+            yield dut.source.ready.eq(stall == 0 or cycle % stall != 0)
+            yield Settle()
+            if (yield dut.source.valid) and (yield dut.source.ready):
+                compressed.append((yield dut.source.data))
+            yield
+            cycle += 1
+
+    def sink():
+        for word in records:
+            yield dut.sink.valid.eq(1)
+            yield dut.sink.data.eq(word)
+            yield Settle()
+            while not (yield dut.sink.ready):
+                yield
+                yield Settle()
+            yield
+        yield dut.sink.valid.eq(0)
+        for i in range(16):
+            yield
+
+    with SimulationHarness(dut) as harness:
+        harness.run(sink, source)
+    return records, compressed
+
+
+class CaptureCompressorTestCase(unittest.TestCase):
+    def assertCompression(self, ratio, **trace):
+        records, compressed = run_benchmark(**trace)
+        self.assertEqual(decompress(compressed), records)
+        self.assertGreaterEqual(len(records) / len(compressed), ratio)
+
+    def test_idle(self):
+        self.assertCompression(2.5, microframes=16)
+
+    def test_polling(self):
+        self.assertCompression(4, microframes=4, polls=8, stall=3)
+
+    def test_mixed(self):
+        self.assertCompression(1, microframes=2, polls=2, bulk=1)
+
+    def test_uncompressed(self):
+        # Frame number gaps, corrupted SOFs, errors and tokens that are not followed by a NAK
+        # are not compressed.
+        sof = sof_packet(5)
+        packets = [
+            (100, sof_packet(1)),
+            (200, sof_packet(3)),
+            (300, [*sof[:2], sof[2] ^ 0x80]),
+            (400, token_packet(PacketID.IN, 3, 1)),
+            (420, handshake_packet(PacketID.NAK)),
+            (500, token_packet(PacketID.IN, 3, 1)),
+            (520, data_packet(PacketID.DATA0, [1, 2, 3])),
+            (540, handshake_packet(PacketID.ACK)),
+            (600, token_packet(PacketID.IN, 3, 1)),
+            (620, token_packet(PacketID.IN, 3, 1)),
+            (640, handshake_packet(PacketID.NAK)),
+        ]
+        records = _records(packets)
+        # A truncated SOF.
+        records[_records(packets[:1]).__len__()] |= 1 << 17
+        dut = CaptureCompressor()
+        compressed = []
+
+        def process():
+            yield dut.source.ready.eq(1)
+            for word in records:
+                yield dut.sink.valid.eq(1)
+                yield dut.sink.data.eq(word)
+                yield Settle()
+                while not (yield dut.sink.ready):
+                    if (yield dut.source.valid):
+                        compressed.append((yield dut.source.data))
+                    yield
+                    yield Settle()
+                if (yield dut.source.valid):
+                    compressed.append((yield dut.source.data))
+                yield
+            yield dut.sink.valid.eq(0)
+            for i in range(8):
+                yield Settle()
+                if (yield dut.source.valid):
+                    compressed.append((yield dut.source.data))
+                yield
+
+        simulation_test(dut, process)
+        self.assertEqual(decompress(compressed), records)
+        # Only the last token and its handshake are compressed.
+        self.assertEqual(len(compressed), len(records) - 5)
+
+
+class EndpointAdapterTestCase(unittest.TestCase):
+    def test_wrong_endpoint(self):
+        with self.assertRaisesRegex(TypeError,
+                r"Endpoint must be an InputEndpoint, not 'foo'"):
+            dut = EndpointAdapter("foo")
+
+    def test_wrong_data_width(self):
+        ep = InputEndpoint(xfer=Transfer.BULK, max_size=512)
+        with self.assertRaisesRegex(ValueError,
+                r"Endpoint data width must be 32, not 8"):
+            dut = EndpointAdapter(ep)
+
+    def test_packets(self):
+        ep  = InputEndpoint(xfer=Transfer.BULK, max_size=8, data_width=32)
+        dut = EndpointAdapter(ep)
+        words = [*range(5)]
+
+        def process():
+            yield ep.rdy.eq(1)
+            lst = []
+            for i, word in enumerate(words):
+                yield dut.sink.valid.eq(1)
+                yield dut.sink.last.eq(i == len(words) - 1)
+                yield dut.sink.data.eq(word)
+                yield dut.sink.be.eq(0b1111)
+                yield Settle()
+                self.assertEqual((yield ep.data), word)
+                lst.append((yield ep.lst))
+                yield
+            self.assertEqual(lst, [0, 1, 0, 1, 1])
+
+        simulation_test(dut, process)
+
+
+if __name__ == "__main__":
+    print("{:<10} {:>10} {:>10} {:>8}".format("trace", "words", "compressed", "ratio"))
+    for name, trace in TRACES.items():
+        records, compressed = run_benchmark(**trace)
+        assert decompress(compressed) == records
+        print("{:<10} {:>10} {:>10} {:>8.2f}".format(name, len(records), len(compressed),
+                                                     len(records) / len(compressed)))
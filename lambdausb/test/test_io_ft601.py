@@ -0,0 +1,89 @@
+#nmigen: UnusedElaboratable=no
+
+import random
+import unittest
+
+from nmigen import *
+from nmigen.back.pysim import *
+
+from ._ft601 import *
+from ._util import *
+from ..io.ft601 import *
+
+
+class FT601TestCase(unittest.TestCase):
+    def test_wrong_burst(self):
+        with self.assertRaisesRegex(ValueError,
+                r"Burst size must be a positive integer, not 0"):
+            dut = FT601(pins=FT601Model().pins, burst=0)
+
+    def test_write(self):
+        model = FT601Model(tx_buffer=100, tx_drain=10)
+        dut = FT601(pins=model.pins, tx_depth=32, burst=16)
+
+        rng   = random.Random(0)
+        words = [(rng.getrandbits(32), rng.choice((0b0001, 0b0011, 0b1111))) for i in range(300)]
+
+        def process():
+            for i, (data, be) in enumerate(words):
+                yield dut.sink.valid.eq(1)
+                yield dut.sink.last.eq(i == len(words) - 1)
+                yield dut.sink.data.eq(data)
+                yield dut.sink.be.eq(be)
+                yield Settle()
+                while not (yield dut.sink.ready):
+                    yield
+                    yield Settle()
+                yield
+            yield dut.sink.valid.eq(0)
+            for i in range(400):
+                yield
+            self.assertEqual(model.received, words)
+
+        simulation_test(dut, process, model.process)
+
+    def test_write_burst(self):
+        model = FT601Model()
+        dut = FT601(pins=model.pins, burst=16)
+
+        def process():
+            for i in range(15):
+                yield dut.sink.valid.eq(1)
+                yield dut.sink.data.eq(i)
+                yield
+            yield dut.sink.valid.eq(0)
+            for i in range(50):
+                yield
+            # Not enough words for a burst.
+            self.assertEqual(model.received, [])
+
+            yield dut.sink.valid.eq(1)
+            yield dut.sink.last.eq(1)
+            yield dut.sink.data.eq(15)
+            yield
+            yield dut.sink.valid.eq(0)
+            for i in range(50):
+                yield
+            self.assertEqual(model.received, [(i, 0) for i in range(16)])
+
+        simulation_test(dut, process, model.process)
+
+    def test_read(self):
+        model = FT601Model()
+        dut = FT601(pins=model.pins, rx_depth=16)
+
+        words = [random.Random(1).getrandbits(32) for i in range(100)]
+        model.send(words)
+
+        def process():
+            received = []
+            for i in range(1000):
+                # Stall the source now and then, to let the receive FIFO fill up.
+                yield dut.source.ready.eq(i % 50 > 30)
+                yield Settle()
+                if (yield dut.source.valid) and (yield dut.source.ready):
+                    received.append((yield dut.source.data))
+                yield
+            self.assertEqual(received, words)
+
+        simulation_test(dut, process, model.process)
@@ -0,0 +1,80 @@
+#nmigen: UnusedElaboratable=no
+
+import unittest
+
+from nmigen import *
+from nmigen.back.pysim import *
+
+from ._ulpi import *
+from ._util import *
+from ..io.sniffer import *
+
+
+# Function Control register values: non-driving, with the HS or FS transceiver enabled.
+_FUNC_CTRL_HS = 0b01001000
+_FUNC_CTRL_FS = 0b01001001
+
+
+class SnifferTestCase(unittest.TestCase):
+    def test_capture(self):
+        model = ULPIModel()
+        dut = Sniffer(pins=model.pins, depth=64, n_records=8, fifo_depth=16, compress=False)
+
+        def wait_init():
+            while 0xa not in model.registers:
+                yield
+            for i in range(20):
+                yield
+
+        def capture(payload):
+            packets = yield dut.stats.packets
+            model.send_packet(payload)
+            for i in range(100):
+                yield
+                if (yield dut.stats.packets) == packets + 1:
+                    break
+            else:
+                self.fail("packet was not captured")
+
+        def process():
+            yield dut.source.ready.eq(1)
+
+            # INIT -> CAPTURE, with the HS transceiver.
+            yield from wait_init()
+            self.assertEqual(model.registers[0x4], _FUNC_CTRL_HS)
+            self.assertEqual(model.registers[0xa], 0b00000000)
+            yield from capture([0xa5, 0x12, 0x34])
+
+            # Switching to FS re-initializes the PHY, then resumes capture.
+            model.registers.clear()
+            yield dut.hs.eq(0)
+            yield from wait_init()
+            self.assertEqual(model.registers[0x4], _FUNC_CTRL_FS)
+            yield from capture([0x2d, 0x00, 0x10])
+
+            # And back to HS.
+            model.registers.clear()
+            yield dut.hs.eq(1)
+            yield from wait_init()
+            self.assertEqual(model.registers[0x4], _FUNC_CTRL_HS)
+            yield from capture([0x69, 0x81, 0x58])
+
+            self.assertEqual((yield dut.stats.packets), 3)
+            self.assertEqual((yield dut.stats.truncated), 0)
+
+        simulation_test(dut, process, model.process)
+
+    def test_hs_unchanged(self):
+        model = ULPIModel()
+        dut = Sniffer(pins=model.pins, depth=64, n_records=8, fifo_depth=16, compress=False)
+
+        def process():
+            while 0xa not in model.registers:
+                yield
+            # The PHY is not re-initialized if `hs` does not change.
+            model.registers.clear()
+            for i in range(200):
+                yield
+            self.assertEqual(model.registers, {})
+
+        simulation_test(dut, process, model.process)
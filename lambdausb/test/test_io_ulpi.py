@@ -0,0 +1,351 @@
+#nmigen: UnusedElaboratable=no
+
+import unittest
+
+from nmigen import *
+from nmigen.back.pysim import *
+
+from ._ulpi import *
+from ._util import *
+from ..io.ulpi import *
+from ..io.ulpi import _RxGearbox, _TxGearbox
+
+
+# Helpers use explicit `Tick()` commands, so that they can run either as synchronous processes,
+# or as asynchronous processes if the `sync` domain is clocked by the ULPI clock.
+
+
+def _wait_init(model):
+    while 0xa not in model.registers:
+        yield Tick()
+
+
+def _recv(dut, n_packets, *, timeout=1000):
+    packets = []
+    packet  = []
+    yield dut.rx.rdy.eq(1)
+    for i in range(timeout):
+        yield Tick()
+        if (yield dut.rx.stb):
+            data = yield dut.rx.data
+            be   = (yield dut.rx.be) if len(dut.rx.be) else 1
+            packet += [data >> 8 * i & 0xff for i in range(len(dut.rx.data) // 8) if be >> i & 1]
+            if (yield dut.rx.lst):
+                packets.append((packet, (yield dut.rx.err)))
+                packet = []
+                if len(packets) == n_packets:
+                    break
+    yield dut.rx.rdy.eq(0)
+    return packets
+
+
+def _send(dut, packet):
+    # If the data width is greater than 8, the PID is sent alone, in its own word.
+    n_bytes = len(dut.tx.data) // 8
+    words = [packet[:1], *(packet[i:i + n_bytes] for i in range(1, len(packet), n_bytes))]
+    for i, word in enumerate(words):
+        yield dut.tx.stb.eq(1)
+        yield dut.tx.lst.eq(i == len(words) - 1)
+        yield dut.tx.data.eq(sum(byte << 8 * j for j, byte in enumerate(word)))
+        if n_bytes > 1:
+            yield dut.tx.be.eq((1 << len(word)) - 1)
+        yield Settle()
+        while not (yield dut.tx.rdy):
+            yield Tick()
+            yield Settle()
+        yield Tick()
+    yield dut.tx.stb.eq(0)
+
+
+class PHYTestCase(unittest.TestCase):
+    def test_wrong_data_width(self):
+        with self.assertRaisesRegex(ValueError,
+                r"Data width must be 8, 16 or 32, not 12"):
+            dut = PHY(pins=ULPIModel().pins, data_width=12)
+
+    def test_wrong_domain(self):
+        with self.assertRaisesRegex(ValueError,
+                r"Domain must be 'ulpi' or 'sync', not 'usb'"):
+            dut = PHY(pins=ULPIModel().pins, domain="usb")
+
+    def test_init(self):
+        model = ULPIModel()
+        dut = PHY(pins=model.pins)
+
+        def process():
+            yield from _wait_init(model)
+            # Function Control: FS transceiver, peripheral FS termination, PHY reset.
+            self.assertEqual(model.registers[0x4], 0b01100101)
+            # OTG Control: pull-downs disabled.
+            self.assertEqual(model.registers[0xa], 0b00000000)
+            for i in range(20):
+                yield
+            self.assertEqual((yield dut.line_state), 0b01)
+            self.assertEqual((yield dut.vbus_state), 0b11)
+
+        simulation_test(dut, process, model.process)
+
+    def test_rx(self):
+        model = ULPIModel()
+        dut = PHY(pins=model.pins)
+
+        packets = [
+            [0x2d, 0x00, 0x10],
+            [0xc3, 0x80, 0x06, 0x00, 0x01, 0x00, 0x00, 0x40, 0x00, 0xdd, 0x94],
+        ]
+
+        def process():
+            yield from _wait_init(model)
+            for packet in packets:
+                model.send_packet(packet)
+            received = yield from _recv(dut, len(packets))
+            self.assertEqual(received, [(packet, 0) for packet in packets])
+            for i in range(10):
+                yield
+            self.assertEqual((yield dut.stats.rx_packets), 2)
+            self.assertEqual((yield dut.stats.rx_errors), 0)
+            self.assertEqual((yield dut.stats.rx_overflows), 0)
+
+        simulation_test(dut, process, model.process)
+
+    def test_tx(self):
+        model = ULPIModel()
+        dut = PHY(pins=model.pins)
+
+        packets = [
+            [0xd2],
+            [0x4b, 0x12, 0x01, 0x00, 0x02, 0xff, 0xff],
+        ]
+
+        def process():
+            yield from _wait_init(model)
+            for packet in packets:
+                yield from _send(dut, packet)
+            for i in range(100):
+                yield
+            self.assertEqual(model.transmitted, packets)
+
+        simulation_test(dut, process, model.process)
+
+    def test_rx_error(self):
+        model = ULPIModel()
+        dut = PHY(pins=model.pins)
+
+        def process():
+            yield from _wait_init(model)
+            # The RxError is reported before the 4th byte. The packet ends early, with `err` set,
+            # and its remaining bytes are flushed until the PHY deasserts RxActive.
+            model.send_packet([0xc3, 0x01, 0x02, 0x03, 0x04, 0x05, 0x06, 0x07, 0x08], error_at=3)
+            model.send_packet([0x4b, 0x11, 0x22])
+            received = yield from _recv(dut, 2)
+            self.assertEqual(received, [
+                ([0xc3, 0x01, 0x02], 1),
+                ([0x4b, 0x11, 0x22], 0),
+            ])
+            for i in range(10):
+                yield
+            self.assertEqual((yield dut.stats.rx_packets), 2)
+            self.assertEqual((yield dut.stats.rx_errors), 1)
+            self.assertEqual((yield dut.stats.rx_overflows), 0)
+
+            yield dut.stats.clr.eq(1)
+            yield
+            yield dut.stats.clr.eq(0)
+            yield
+            self.assertEqual((yield dut.stats.rx_packets), 0)
+            self.assertEqual((yield dut.stats.rx_errors), 0)
+
+        simulation_test(dut, process, model.process)
+
+    def test_rx_overflow(self):
+        model = ULPIModel()
+        dut = PHY(pins=model.pins, rx_depth=4)
+
+        def process():
+            yield from _wait_init(model)
+            # The receive FIFO is not read while the first packet is received. It is truncated,
+            # and terminated by a word with `err` set once the FIFO has room. The second packet
+            # is received after the FIFO was drained.
+            model.send_packet([0xc3, *range(1, 12)])
+            for i in range(100):
+                yield
+            received = yield from _recv(dut, 1)
+            self.assertEqual(len(received), 1)
+            data, err = received[0]
+            # The 4 bytes that fit in the FIFO, then the terminating word.
+            self.assertEqual(data[:4], [0xc3, 0x01, 0x02, 0x03])
+            self.assertEqual(len(data), 5)
+            self.assertEqual(err, 1)
+
+            model.send_packet([0x4b, 0x11, 0x22])
+            received = yield from _recv(dut, 1)
+            self.assertEqual(received, [([0x4b, 0x11, 0x22], 0)])
+            for i in range(10):
+                yield
+            self.assertEqual((yield dut.stats.rx_packets), 2)
+            self.assertEqual((yield dut.stats.rx_overflows), 1)
+            self.assertEqual((yield dut.stats.rx_errors), 0)
+
+        simulation_test(dut, process, model.process)
+
+    def test_vbus_change(self):
+        model = ULPIModel()
+        dut = PHY(pins=model.pins)
+
+        def process():
+            yield from _wait_init(model)
+            for i in range(20):
+                yield
+            # The first RX CMD reports that VBUS became valid.
+            self.assertEqual((yield dut.stats.vbus_changes), 1)
+            model.vbus_state = 0b00
+            model.send_rx_cmd()
+            for i in range(20):
+                yield
+            self.assertEqual((yield dut.vbus_state), 0b00)
+            self.assertEqual((yield dut.stats.vbus_changes), 2)
+
+        simulation_test(dut, process, model.process)
+
+    def _run_streams(self, *, domain, data_width):
+        # Send and receive packets, and return what was seen on both sides of the PHY.
+        if domain == "sync":
+            # The ULPI clock is generated by the model, and clocks the `sync` domain.
+            model = ULPIModel(period=1e-6)
+        else:
+            model = ULPIModel()
+        dut = PHY(pins=model.pins, data_width=data_width, domain=domain)
+        result = {}
+
+        def process():
+            yield from _wait_init(model)
+            model.send_packet([0x2d, 0x00, 0x10])
+            model.send_packet([0xc3, *range(1, 12)], error_at=6)
+            model.send_packet([0xc3, *range(20, 31), 0x12, 0x34])
+            model.send_packet([0xd2])
+            result["rx"] = yield from _recv(dut, 4)
+
+            for packet in ([0xd2], [0x4b, *range(9), 0xab, 0xcd], [0xc3, 0x00, 0x00]):
+                yield from _send(dut, packet)
+            for i in range(100):
+                yield Tick()
+            result["tx"] = model.transmitted
+            result["stats"] = ((yield dut.stats.rx_packets), (yield dut.stats.rx_errors),
+                               (yield dut.stats.rx_overflows))
+
+        simulation_test(dut, process, model.process, sync=domain == "ulpi")
+        return result
+
+    def test_sync_domain(self):
+        for data_width in (8, 32):
+            with self.subTest(data_width=data_width):
+                ulpi = self._run_streams(domain="ulpi", data_width=data_width)
+                sync = self._run_streams(domain="sync", data_width=data_width)
+                self.assertEqual(ulpi["rx"], [
+                    ([0x2d, 0x00, 0x10], 0),
+                    ([0xc3, *range(1, 6)], 1),
+                    ([0xc3, *range(20, 31), 0x12, 0x34], 0),
+                    ([0xd2], 0),
+                ])
+                self.assertEqual(ulpi["tx"], [
+                    [0xd2],
+                    [0x4b, *range(9), 0xab, 0xcd],
+                    [0xc3, 0x00, 0x00],
+                ])
+                self.assertEqual(ulpi["stats"], (4, 1, 0))
+                self.assertEqual(sync, ulpi)
+
+
+class RxGearboxTestCase(unittest.TestCase):
+    def test_packets(self):
+        for data_width in (16, 32):
+            n_bytes = data_width // 8
+            dut = _RxGearbox(data_width)
+            received = []
+
+            def monitor():
+                yield Passive()
+                while True:
+                    yield
+                    if (yield dut.source.valid):
+                        # Bytes that are not enabled have an undefined value.
+                        data = yield dut.source.data
+                        be   = yield dut.source.be
+                        mask = sum(0xff << 8 * i for i in range(n_bytes) if be >> i & 1)
+                        received.append((data & mask, be, (yield dut.source.last),
+                                         (yield dut.source.err)))
+
+            def process():
+                for length in range(6):
+                    packet = [0xc3, *range(1, length + 1)]
+                    for i, byte in enumerate(packet):
+                        yield dut.sink.valid.eq(1)
+                        yield dut.sink.last.eq(i == len(packet) - 1)
+                        yield dut.sink.data.eq(byte)
+                        yield dut.sink.err.eq(i == len(packet) - 1 and length % 2)
+                        yield
+                        # Bytes are not received on every cycle.
+                        yield dut.sink.valid.eq(0)
+                        yield
+                    for i in range(4):
+                        yield
+
+                    # The PID is sent alone, in its own word.
+                    words = [packet[:1]]
+                    words += [packet[i:i + n_bytes] for i in range(1, len(packet), n_bytes)]
+                    self.assertEqual(received, [
+                        (sum(byte << 8 * j for j, byte in enumerate(word)),
+                         (1 << len(word)) - 1,
+                         int(i == len(words) - 1),
+                         int(i == len(words) - 1 and length % 2))
+                        for i, word in enumerate(words)
+                    ], msg="data_width={}, length={}".format(data_width, length))
+                    received.clear()
+
+            simulation_test(DomainRenamer({"ulpi": "sync"})(dut), process, monitor)
+
+
+class TxGearboxTestCase(unittest.TestCase):
+    def test_packets(self):
+        for data_width in (16, 32):
+            n_bytes = data_width // 8
+            dut = _TxGearbox(data_width)
+            transmitted = []
+
+            def sink():
+                yield Passive()
+                cycle = 0
+                while True:
+                    # The PHY does not accept a byte on every cycle.
+                    ready = cycle % 3 != 1
+                    yield dut.source.ready.eq(ready)
+                    yield
+                    if ready and (yield dut.source.valid):
+                        transmitted.append(((yield dut.source.data), (yield dut.source.last)))
+                    cycle += 1
+
+            def process():
+                for length in range(6):
+                    packet = [0x4b, *range(1, length + 1)]
+                    words  = [packet[:1]]
+                    words += [packet[i:i + n_bytes] for i in range(1, len(packet), n_bytes)]
+                    for i, word in enumerate(words):
+                        yield dut.sink.valid.eq(1)
+                        yield dut.sink.last.eq(i == len(words) - 1)
+                        yield dut.sink.data.eq(sum(byte << 8 * j for j, byte in enumerate(word)))
+                        yield dut.sink.be.eq((1 << len(word)) - 1)
+                        yield Settle()
+                        while not (yield dut.sink.ready):
+                            yield
+                            yield Settle()
+                        yield
+                    yield dut.sink.valid.eq(0)
+                    for i in range(4):
+                        yield
+
+                    self.assertEqual(transmitted, [
+                        (byte, int(i == len(packet) - 1)) for i, byte in enumerate(packet)
+                    ], msg="data_width={}, length={}".format(data_width, length))
+                    transmitted.clear()
+
+            simulation_test(DomainRenamer({"ulpi": "sync"})(dut), process, sink)
@@ -0,0 +1,146 @@
+#nmigen: UnusedElaboratable=no
+
+import importlib.util
+import io
+import os
+import struct
+import unittest
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from ._host import *
+from .test_io_capture import _records, _trace, run_benchmark
+from ..io.capture import *
+from ..usb.defs import *
+
+
+def _load_tool():
+    path = os.path.join(os.path.dirname(__file__), "..", "..", "tools", "capture2pcapng.py")
+    spec = importlib.util.spec_from_file_location("capture2pcapng", path)
+    tool = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(tool)
+    return tool
+
+
+def _chunks(words, chunk_size):
+    data = b"".join(word.to_bytes(4, "little") for word in words)
+    for i in range(0, len(data), chunk_size):
+        yield data[i:i + chunk_size]
+
+
+@unittest.skipIf(np is None, "NumPy is not installed")
+class CaptureDecoderTestCase(unittest.TestCase):
+    CHUNK_SIZES = (1, 3, 4, 7, 64, 1 << 20)
+
+    def setUp(self):
+        self.tool = _load_tool()
+
+    def decode(self, words, chunk_size):
+        # Returns a list of (timestamp, packet, flags) tuples, and the decoder.
+        decoder = self.tool.CaptureDecoder()
+        packets = []
+        for chunk in _chunks(words, chunk_size):
+            batch = decoder.decode(chunk)
+            data  = batch.words.view(np.uint8)
+            for i in range(len(batch)):
+                start = int(batch.start[i]) * 4
+                packets.append((int(batch.timestamp[i]),
+                                list(data[start:start + int(batch.length[i])]),
+                                int(batch.flags[i])))
+        return packets, decoder
+
+    def test_raw(self):
+        bad_crc = data_packet(PacketID.DATA1, [1, 2, 3, 4, 5])
+        bad_crc[-1] ^= 0x01
+        packets = [
+            (100, sof_packet(0x123)),
+            (200, token_packet(PacketID.OUT, 3, 2)),
+            (210, data_packet(PacketID.DATA0, [*range(37)])),
+            (250, handshake_packet(PacketID.ACK)),
+            (300, token_packet(PacketID.IN, 3, 1)),
+            (310, bad_crc),
+            (400, data_packet(PacketID.DATA0, [])),
+            (500, data_packet(PacketID.DATA0, [0xaa, 0xbb])),
+            # The timestamp wraps around.
+            (0xfffffff0, token_packet(PacketID.SETUP, 0, 0)),
+            (0x1_0000_0010, data_packet(PacketID.DATA0, [*range(8)])),
+        ]
+        records = _records(packets)
+        # The PHY reported a receive error during the 2-byte data packet. Its CRC is valid.
+        offset = len(_records(packets[:7]))
+        records[offset] |= 1 << 16
+        # An event record, between two packets.
+        offset = len(_records(packets[:2]))
+        records[offset:offset] = [RecordKind.EVENT << 30 | 0b01, 205]
+
+        tool = self.tool
+        expected = [(timestamp, packet, 0) for timestamp, packet in packets]
+        expected[5] = (*expected[5][:2], tool.EPB_FLAG_CRC_ERROR)
+        expected[7] = (*expected[7][:2], tool.EPB_FLAG_SYMBOL_ERROR)
+
+        for chunk_size in self.CHUNK_SIZES:
+            with self.subTest(chunk_size=chunk_size):
+                decoded, decoder = self.decode(records, chunk_size)
+                self.assertEqual(decoded, expected)
+                self.assertEqual(decoder.n_packets, len(packets))
+                self.assertEqual(decoder.n_errors, 2)
+                self.assertEqual(decoder.n_events, 1)
+
+    def test_compressed(self):
+        trace = _trace(microframes=24, polls=3, bulk=1)
+        records, compressed = run_benchmark(microframes=24, polls=3, bulk=1)
+        self.assertEqual(decompress(compressed), records)
+        self.assertLess(len(compressed), len(records))
+
+        expected = [(timestamp, packet, 0) for timestamp, packet in trace]
+        for chunk_size in self.CHUNK_SIZES:
+            with self.subTest(chunk_size=chunk_size):
+                decoded, decoder = self.decode(compressed, chunk_size)
+                self.assertEqual(decoded, expected)
+                self.assertEqual(decoder.n_errors, 0)
+
+    def test_dropped(self):
+        records = _records([(100, handshake_packet(PacketID.ACK))])
+        records[0] |= 5 << 24
+        decoded, decoder = self.decode(records, 4)
+        self.assertEqual(decoded, [(100, handshake_packet(PacketID.ACK), 0)])
+        self.assertEqual(decoder.n_dropped, 5)
+
+    def test_no_reference(self):
+        # A compressed SOF record, without a previous SOF packet.
+        decoder = self.tool.CaptureDecoder()
+        with self.assertRaisesRegex(ValueError,
+                r"Compressed record without a reference packet"):
+            decoder.decode((RecordKind.COMPACT << 30 | 7500).to_bytes(4, "little"))
+
+    def test_pcapng(self):
+        packets = [
+            (60, token_packet(PacketID.IN, 3, 1)),
+            (120, data_packet(PacketID.DATA1, [1, 2, 3])),
+            (180, handshake_packet(PacketID.ACK)),
+        ]
+        decoder = self.tool.CaptureDecoder()
+        file = io.BytesIO()
+        writer = self.tool.PcapngWriter(file, clock=60_000_000)
+        writer.write(decoder.decode(b"".join(_chunks(_records(packets), 1 << 20))))
+
+        data = file.getvalue()
+        blocks = []
+        offset = 0
+        while offset < len(data):
+            block_type, length = struct.unpack_from("<II", data, offset)
+            self.assertEqual(struct.unpack_from("<I", data, offset + length - 4)[0], length)
+            blocks.append((block_type, data[offset + 8:offset + length - 4]))
+            offset += length
+
+        self.assertEqual([block_type for block_type, _ in blocks],
+                         [0x0a0d0d0a, 0x00000001, 6, 6, 6])
+        for (timestamp, packet), (_, body) in zip(packets, blocks[2:]):
+            _, ts_high, ts_low, captured, length = struct.unpack_from("<IIIII", body)
+            # Nanoseconds, at 60 MHz.
+            self.assertEqual(ts_high << 32 | ts_low, timestamp * 1000 // 60)
+            self.assertEqual((captured, length), (len(packet), len(packet)))
+            self.assertEqual(list(body[20:20 + len(packet)]), packet)
@@ -0,0 +1,470 @@
+#nmigen: UnusedElaboratable=no
+
+import re
+import sys
+import unittest
+
+from nmigen import *
+from nmigen.back import rtlil
+from nmigen.back.pysim import *
+
+from ._host import *
+from ._util import *
+from ..usb.config import *
+from ..usb.defs import *
+from ..usb.device import *
+from ..usb.endpoint import *
+
+
+def _descriptors(n_types, n_indices, *, max_size=30):
+    # Build a descriptor ROM with `n_types * n_indices` descriptors of various sizes.
+    descriptor_map = {}
+    rom_init = []
+    for desc_type in range(3, 3 + n_types):
+        for desc_index in range(n_indices):
+            size = 2 + (desc_type * 7 + desc_index) % max_size
+            descriptor = [size, desc_type, *((desc_index + i) & 0xff for i in range(size - 2))]
+            descriptor_map.setdefault(desc_type, {})[desc_index] = len(rom_init), size
+            rom_init += descriptor
+    return descriptor_map, rom_init
+
+
+def _get_descriptor(desc_type, desc_index, length):
+    return [0x80, 0x06, desc_index, desc_type, 0x00, 0x00, length & 0xff, length >> 8]
+
+
+class _Handler(RequestHandler):
+    # Signals are driven by the testbench.
+    def elaborate(self, platform):
+        return Module()
+
+
+class _CountHandler(RequestHandler):
+    # Sends `wValue` bytes, counting from `wIndex`. Requests with `wValue >= 0x8000` are stalled.
+    def elaborate(self, platform):
+        m = Module()
+        count = Signal(16)
+        data  = Signal(8)
+        with m.If(self.start):
+            m.d.sync += [
+                count.eq(self.setup.wValue),
+                data.eq(self.setup.wIndex),
+            ]
+        with m.Elif(self.data_in.stb & self.data_in.rdy):
+            m.d.sync += [
+                count.eq(count - 1),
+                data.eq(data + 1),
+            ]
+        m.d.comb += [
+            self.data_in.stb.eq(count != 0),
+            self.data_in.lst.eq(count == 1),
+            self.data_in.data.eq(data),
+            self.stall.eq(self.setup.wValue[15]),
+        ]
+        return m
+
+
+def _configured_device(descriptor_map, rom_init, **kwargs):
+    dut = Device()
+    cfg = ConfigurationFSM(descriptor_map, rom_init, **kwargs)
+    dut.add_endpoint(cfg.ep_in,  addr=0)
+    dut.add_endpoint(cfg.ep_out, addr=0)
+
+    m = Module()
+    m.submodules.dut = dut
+    m.submodules.cfg = cfg
+    m.d.comb += cfg.halt.connect(dut.halt)
+    return m, dut, cfg
+
+
+class ConfigurationFSMTestCase(unittest.TestCase):
+    def test_wrong_lookup(self):
+        with self.assertRaisesRegex(ValueError,
+                r"Lookup must be 'switch' or 'table', not 'foo'"):
+            dut = ConfigurationFSM({}, [0], lookup="foo")
+
+    def _test_get_descriptor(self, descriptor_map, rom_init, requests, *, lookup):
+        m, dut, cfg = _configured_device(descriptor_map, rom_init, lookup=lookup)
+        host = Host(dut)
+
+        def process():
+            for desc_type, desc_index, length in requests:
+                setup = _get_descriptor(desc_type, desc_index, length)
+                received = yield from host.control_read(0, setup)
+                try:
+                    offset, size = descriptor_map[desc_type][desc_index]
+                except KeyError:
+                    self.assertIsNone(received)
+                else:
+                    expected = rom_init[offset:offset + min(size, length)]
+                    self.assertEqual(received, expected)
+
+        simulation_test(m, process)
+
+    def test_get_descriptor(self):
+        descriptor_map, rom_init = _descriptors(2, 4)
+        requests = [
+            (3, 0, 64), (3, 3, 64), (4, 1, 64), (4, 2, 3),
+            (3, 4, 64), (5, 0, 64), (2, 3, 64),
+        ]
+        for lookup in ("switch", "table"):
+            with self.subTest(lookup=lookup):
+                self._test_get_descriptor(descriptor_map, rom_init, requests, lookup=lookup)
+
+    def test_many_descriptors(self):
+        descriptor_map, rom_init = _descriptors(3, 100, max_size=4)
+        requests = [
+            (3, 0, 64), (3, 99, 64), (4, 0, 64), (4, 57, 64), (5, 99, 64), (5, 60, 2),
+            (3, 100, 64), (4, 255, 64), (6, 0, 64), (0, 0, 64),
+        ]
+        # The simulator compiles memory reads to a chain of `elif` statements, one per word, which
+        # is deeper than the default recursion limit of the Python compiler.
+        recursion_limit = sys.getrecursionlimit()
+        sys.setrecursionlimit(max(recursion_limit, 4000))
+        try:
+            self._test_get_descriptor(descriptor_map, rom_init, requests, lookup="table")
+        finally:
+            sys.setrecursionlimit(recursion_limit)
+
+    def test_table_size(self):
+        # The lookup logic must not depend on the number of descriptors.
+        def n_statements(n_indices):
+            dut = ConfigurationFSM(*_descriptors(3, n_indices), lookup="table")
+            output = rtlil.convert(dut, ports=[dut.dev_addr])
+            return len(re.findall(r"^\s*(cell|process|switch|case)\b", output, re.M))
+
+        self.assertEqual(n_statements(4), n_statements(100))
+
+    def test_multi_packet(self):
+        descriptor_map = {0x02: {0: (0, 200), 1: (200, 128)}}
+        rom_init = [i & 0xff for i in range(328)]
+        m, dut, cfg = _configured_device(descriptor_map, rom_init)
+        host = Host(dut)
+
+        def process():
+            stats = host.stats[0, "in"]
+            for desc_index, length, n_packets in [
+                    # 64 + 64 + 64 + 8 bytes.
+                    (0, 255, 4),
+                    (0, 130, 3),
+                    # A zero-length packet ends the data stage, as the descriptor is shorter
+                    # than wLength.
+                    (1, 255, 3),
+                    (1, 128, 2)]:
+                packets = stats.packets
+                offset, size = descriptor_map[0x02][desc_index]
+                setup = _get_descriptor(0x02, desc_index, length)
+                self.assertEqual((yield from host.control_read(0, setup)),
+                                 rom_init[offset:offset + min(size, length)])
+                # The status stage is a zero-length OUT transaction.
+                self.assertEqual(stats.packets - packets, n_packets)
+
+        simulation_test(m, process)
+
+    def test_multi_packet_retry(self):
+        descriptor_map = {0x02: {0: (0, 100)}}
+        rom_init = [i & 0xff for i in range(100)]
+        m, dut, cfg = _configured_device(descriptor_map, rom_init)
+        host = Host(dut)
+
+        def process():
+            setup = _get_descriptor(0x02, 0, 255)
+            yield from host.sof()
+            self.assertEqual((yield from host.out_transaction(0, setup, setup=True)),
+                             PacketID.ACK)
+            self.assertEqual((yield from host.in_transaction(0)), (PacketID.DATA1, rom_init[:64]))
+            # The second data packet is received, but its handshake is lost.
+            yield from host.send(token_packet(PacketID.IN, host.addr, 0))
+            self.assertEqual((yield from host.receive()),
+                             data_packet(PacketID.DATA0, rom_init[64:]))
+            yield from host.idle(dut.handshake_timeout + host.turnaround)
+            self.assertEqual((yield from host.in_transaction(0)), (PacketID.DATA0, rom_init[64:]))
+            self.assertEqual((yield from host.out_transaction(0, [])), PacketID.ACK)
+            # The next transfer starts from a clean state.
+            self.assertEqual((yield from host.control_read(0, setup)), rom_init)
+
+            # The host ends the data stage after the first packet.
+            yield from host.sof()
+            self.assertEqual((yield from host.out_transaction(0, setup, setup=True)),
+                             PacketID.ACK)
+            self.assertEqual((yield from host.in_transaction(0)), (PacketID.DATA1, rom_init[:64]))
+            host._rx_seq[0] = 1
+            self.assertEqual((yield from host.out_transaction(0, [])), PacketID.ACK)
+            self.assertEqual((yield from host.control_read(0, setup)), rom_init)
+
+        simulation_test(m, process)
+
+    def test_control_write(self):
+        m, dut, cfg = _configured_device({}, [0])
+        handler = _Handler()
+        cfg.add_handler(handler, request_type=0x40, request=0x01)
+        host = Host(dut)
+        payload  = [(i * 7) & 0xff for i in range(150)]
+        received = []
+
+        def sink():
+            yield Passive()
+            cycle = 0
+            while True:
+                # Stall the data stage every other cycle.
+                yield handler.data_out.rdy.eq(cycle % 3 != 0)
+                yield Settle()
+                if (yield handler.data_out.stb) and (yield handler.data_out.rdy):
+                    received.append(((yield handler.data_out.data),
+                                     (yield handler.data_out.lst)))
+                    yield handler.done.eq((yield handler.data_out.lst))
+                yield
+                cycle += 1
+
+        def process():
+            # Vendor request, host-to-device.
+            setup = [0x40, 0x01, 0x34, 0x12, 0x00, 0x00, len(payload) & 0xff, len(payload) >> 8]
+            self.assertEqual((yield from host.control_write(0, setup, payload)), PacketID.DATA1)
+            self.assertEqual([data for data, lst in received], payload)
+            self.assertEqual([lst for data, lst in received], [0] * 149 + [1])
+            self.assertEqual((yield handler.setup.wValue), 0x1234)
+
+            # Standard requests still work afterwards.
+            yield from host.sof()
+            self.assertEqual((yield from host.control_write(0, [0x00, 0x05, 0x12, 0x00,
+                                                                0x00, 0x00, 0x00, 0x00], [])),
+                             PacketID.DATA1)
+            self.assertEqual((yield cfg.dev_addr), 0x12)
+
+        simulation_test(m, process, sink)
+
+    def test_control_write_short(self):
+        m, dut, cfg = _configured_device({}, [0])
+        handler = _Handler()
+        cfg.add_handler(handler, request_type=0x40, request=0x01)
+        host = Host(dut)
+        received = []
+
+        def sink():
+            yield Passive()
+            yield handler.data_out.rdy.eq(1)
+            while True:
+                yield Settle()
+                if (yield handler.data_out.stb):
+                    received.append(((yield handler.data_out.data),
+                                     (yield handler.data_out.lst)))
+                    yield handler.done.eq((yield handler.data_out.lst))
+                yield
+
+        def process():
+            setup = [0x40, 0x01, 0x00, 0x00, 0x00, 0x00, 150, 0x00]
+
+            # A short packet ends the data stage before wLength bytes.
+            payload = [*range(100)]
+            self.assertEqual((yield from host.control_write(0, setup, payload)), PacketID.DATA1)
+            self.assertEqual([data for data, lst in received], payload)
+            self.assertEqual([lst for data, lst in received], [0] * 99 + [1])
+            yield handler.done.eq(0)
+
+            # So does a zero-length packet.
+            received.clear()
+            payload = [*range(64)]
+            yield from host.sof()
+            self.assertEqual((yield from host.out_transaction(0, setup, setup=True)),
+                             PacketID.ACK)
+            self.assertIn((yield from host.out_transaction(0, payload)),
+                          (PacketID.ACK, PacketID.NYET))
+            while (yield from host.out_transaction(0, [])) not in (PacketID.ACK, PacketID.NYET):
+                yield from host.sof()
+            self.assertEqual([data for data, lst in received], payload)
+            yield handler.done.eq(1)
+            self.assertEqual((yield from host.in_transaction(0)), (PacketID.DATA1, []))
+
+        simulation_test(m, process, sink)
+
+    def test_get_dev_status(self):
+        m, dut, cfg = _configured_device({}, [0])
+        host = Host(dut)
+
+        def process():
+            setup = [0x80, 0x00, 0x00, 0x00, 0x00, 0x00, 0x02, 0x00]
+            yield from host.sof()
+            self.assertEqual((yield from host.out_transaction(0, setup, setup=True)),
+                             PacketID.ACK)
+            # The data packet is received, but its handshake is lost.
+            yield from host.send(token_packet(PacketID.IN, host.addr, 0))
+            self.assertEqual((yield from host.receive()), data_packet(PacketID.DATA1, [0, 0]))
+            yield from host.idle(dut.handshake_timeout + host.turnaround)
+            self.assertEqual((yield from host.in_transaction(0)), (PacketID.DATA1, [0, 0]))
+            self.assertEqual((yield from host.out_transaction(0, [])), PacketID.ACK)
+            self.assertEqual((yield from host.control_read(0, setup)), [0, 0])
+
+        simulation_test(m, process)
+
+    def test_add_handler_wrong(self):
+        dut = ConfigurationFSM({}, [0])
+        handler = _Handler()
+        with self.assertRaisesRegex(TypeError,
+                r"Handler must be an instance of RequestHandler, not 'foo'"):
+            dut.add_handler("foo", request_type=0x40)
+        with self.assertRaisesRegex(ValueError,
+                r"Request type must be an integer between 0 and 255, or a pattern of 8 '0', "
+                r"'1' or '-' characters, not '-01'"):
+            dut.add_handler(handler, request_type="-01")
+        with self.assertRaisesRegex(ValueError,
+                r"Request must be an integer between 0 and 255, or a pattern of 8 '0', '1' or "
+                r"'-' characters, not 256"):
+            dut.add_handler(handler, request_type=0x40, request=256)
+        dut.add_handler(handler, request_type=0x40)
+        with self.assertRaisesRegex(ValueError,
+                r"Handler <.*> has already been added"):
+            dut.add_handler(handler, request_type=0xc0)
+
+    def test_handler_in(self):
+        m, dut, cfg = _configured_device({}, [0])
+        cfg.add_handler(_CountHandler(), request_type="1 10 00000", request=0x01)
+        host = Host(dut)
+
+        def request(count, start, length):
+            return [0xc0, 0x01, count & 0xff, count >> 8, start, 0x00, length & 0xff, length >> 8]
+
+        def process():
+            stats = host.stats[0, "in"]
+            for count, start, length, n_packets in [
+                    (10, 0x20, 64, 1),
+                    (150, 0x00, 255, 3),
+                    # A zero-length packet ends the data stage, as it is shorter than wLength.
+                    (128, 0x80, 255, 3),
+                    # The data stage ends after wLength bytes.
+                    (100, 0x00, 20, 1),
+                    (3, 0x40, 255, 1)]:
+                packets = stats.packets
+                self.assertEqual((yield from host.control_read(0, request(count, start, length))),
+                                 [(start + i) & 0xff for i in range(min(count, length))])
+                self.assertEqual(stats.packets - packets, n_packets)
+
+            # The handler rejects the request.
+            self.assertIsNone((yield from host.control_read(0, request(0x8000, 0, 64))))
+            self.assertEqual((yield from host.control_read(0, request(2, 0, 64))), [0, 1])
+
+        simulation_test(m, process)
+
+    def test_handler_stall(self):
+        m, dut, cfg = _configured_device({}, [0])
+        handler = _Handler()
+        cfg.add_handler(handler, request_type="0-100001")
+        host = Host(dut)
+
+        def process():
+            # Unclaimed requests are stalled.
+            setup = [0xc0, 0x02, 0x00, 0x00, 0x00, 0x00, 0x40, 0x00]
+            yield from host.sof()
+            self.assertEqual((yield from host.out_transaction(0, setup, setup=True)),
+                             PacketID.ACK)
+            self.assertEqual((yield from host.in_transaction(0)), (PacketID.STALL, None))
+            self.assertEqual((yield from host.in_transaction(0)), (PacketID.STALL, None))
+            self.assertEqual((yield from host.out_transaction(0, [])), PacketID.STALL)
+            self.assertEqual((yield from host.ping(0)), PacketID.STALL)
+            # Unknown descriptors too.
+            self.assertIsNone((yield from host.control_read(0, _get_descriptor(0x01, 0, 64))))
+
+            # The next SETUP packet clears the stall.
+            self.assertEqual((yield from host.control_read(0, [0x80, 0x00, 0x00, 0x00,
+                                                               0x00, 0x00, 0x02, 0x00])),
+                             [0, 0])
+
+            # A class request to an interface, with no data stage, is completed once the handler
+            # is done.
+            setup = [0x21, 0x0a, 0x00, 0x00, 0x01, 0x00, 0x00, 0x00]
+            yield from host.sof()
+            self.assertEqual((yield from host.out_transaction(0, setup, setup=True)),
+                             PacketID.ACK)
+            self.assertEqual((yield handler.setup.wIndex), 0x0001)
+            self.assertEqual((yield from host.in_transaction(0)), (PacketID.NAK, None))
+            yield handler.done.eq(1)
+            self.assertEqual((yield from host.in_transaction(0)), (PacketID.DATA1, []))
+            yield handler.done.eq(0)
+
+            # The handler rejects the data stage of a request.
+            yield handler.stall.eq(1)
+            self.assertEqual((yield from host.control_write(0, [0x21, 0x09, 0x00, 0x02,
+                                                                0x00, 0x00, 0x04, 0x00],
+                                                            [1, 2, 3, 4])),
+                             PacketID.STALL)
+            yield handler.stall.eq(0)
+            self.assertEqual((yield from host.control_write(0, [0x00, 0x05, 0x12, 0x00,
+                                                                0x00, 0x00, 0x00, 0x00], [])),
+                             PacketID.DATA1)
+            self.assertEqual((yield cfg.dev_addr), 0x12)
+
+        simulation_test(m, process)
+
+    def test_endpoint_halt(self):
+        m, dut, cfg = _configured_device({}, [0])
+        ep1_in  = InputEndpoint(xfer=Transfer.BULK, max_size=8)
+        ep2_out = OutputEndpoint(xfer=Transfer.BULK, max_size=8)
+        ep3_in  = InputEndpoint(xfer=Transfer.ISOCHRONOUS, max_size=8)
+        dut.add_endpoint(ep1_in,  addr=1, buffered=True)
+        dut.add_endpoint(ep2_out, addr=2)
+        dut.add_endpoint(ep3_in,  addr=3)
+        host = Host(dut)
+
+        def feature(request, ep, feature=0):
+            return [0x02, request, feature, 0x00, ep, 0x00, 0x00, 0x00]
+
+        def get_status(ep):
+            return host.control_read(0, [0x82, 0x00, 0x00, 0x00, ep, 0x00, 0x02, 0x00])
+
+        def process():
+            yield ep1_in.stb.eq(1)
+            yield ep1_in.lst.eq(1)
+            yield ep1_in.data.eq(0xab)
+            yield ep2_out.rdy.eq(1)
+
+            self.assertEqual((yield from get_status(0x81)), [0, 0])
+            yield from host.sof()
+            self.assertEqual((yield from host.in_transaction(1)), (PacketID.DATA0, [0xab]))
+
+            # SET_FEATURE(ENDPOINT_HALT)
+            self.assertEqual((yield from host.control_write(0, feature(0x03, 0x81), [])),
+                             PacketID.DATA1)
+            self.assertEqual((yield ep1_in.halted), 1)
+            self.assertEqual((yield from get_status(0x81)), [1, 0])
+            yield from host.sof()
+            self.assertEqual((yield from host.in_transaction(1)), (PacketID.STALL, None))
+
+            # CLEAR_FEATURE(ENDPOINT_HALT) resets the data toggle.
+            self.assertEqual((yield from host.control_write(0, feature(0x01, 0x81), [])),
+                             PacketID.DATA1)
+            self.assertEqual((yield ep1_in.halted), 0)
+            self.assertEqual((yield from get_status(0x81)), [0, 0])
+            host._tx_seq[1] = 0
+            yield from host.sof()
+            self.assertEqual((yield from host.in_transaction(1)), (PacketID.DATA0, [0xab]))
+
+            # The endpoint halts itself.
+            yield from host.sof()
+            self.assertEqual((yield from host.out_transaction(2, [1])), PacketID.ACK)
+            yield ep2_out.halt.eq(1)
+            yield
+            yield ep2_out.halt.eq(0)
+            self.assertEqual((yield from host.out_transaction(2, [2])), PacketID.STALL)
+            self.assertEqual((yield from host.ping(2)), PacketID.STALL)
+            self.assertEqual((yield from get_status(0x02)), [1, 0])
+            self.assertEqual((yield from host.control_write(0, feature(0x01, 0x02), [])),
+                             PacketID.DATA1)
+            host._rx_seq[2] = 0
+            yield from host.sof()
+            self.assertEqual((yield from host.out_transaction(2, [3])), PacketID.ACK)
+
+            # EP0 cannot be halted, but its status can be read.
+            self.assertEqual((yield from get_status(0x80)), [0, 0])
+            self.assertEqual((yield from host.control_write(0, feature(0x01, 0x00), [])),
+                             PacketID.DATA1)
+            self.assertEqual((yield from host.control_write(0, feature(0x03, 0x00), [])),
+                             PacketID.STALL)
+            # Unknown endpoints, isochronous endpoints and unknown features.
+            self.assertIsNone((yield from get_status(0x84)))
+            self.assertIsNone((yield from get_status(0x01)))
+            self.assertEqual((yield from host.control_write(0, feature(0x03, 0x83), [])),
+                             PacketID.STALL)
+            self.assertEqual((yield from host.control_write(0, feature(0x03, 0x81, 1), [])),
+                             PacketID.STALL)
+            self.assertEqual((yield ep1_in.halted), 0)
+
+        simulation_test(m, process)
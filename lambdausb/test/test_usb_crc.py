@@ -1,3 +1,6 @@
+#nmigen: UnusedElaboratable=no
+
+import random
 import unittest
 
 from nmigen import *
@@ -7,6 +10,21 @@ from ..usb.crc import *
 from ._util import *
 
 
+def crc_model(poly, size, init, bits):
+    # Bit-serial software model.
+    crc = init
+    for bit in bits:
+        inv = bit ^ (crc >> (size - 1)) & 1
+        crc = (crc << 1) & ((1 << size) - 1)
+        if inv:
+            crc ^= poly & ((1 << size) - 1)
+    return int("{:0{}b}".format(crc, size)[::-1], 2) ^ init
+
+
+def to_bits(value, width):
+    return [(value >> i) & 1 for i in range(width)]
+
+
 class CRCTestCase(unittest.TestCase):
     def test_basic(self):
         dut = CRC(poly=0b11000000000000101, size=16, dw=8, init=0xffff)
@@ -44,3 +62,108 @@ class CRCTestCase(unittest.TestCase):
             self.assertEqual((yield dut.res), 0xf4e0)
 
         simulation_test(dut, process, sync=True)
+
+    def test_byte_enable(self):
+        dut = CRC(poly=0b11000000000000101, size=16, dw=32, init=0xffff, byte_enable=True)
+
+        def process():
+            yield dut.clr.eq(1)
+            yield
+
+            yield dut.clr.eq(0)
+            yield dut.en.eq(1)
+            yield dut.val.eq(0x01000680)
+            yield dut.be.eq(0b1111)
+            yield
+
+            yield dut.val.eq(0x55000000)
+            yield dut.be.eq(0b0011)
+            yield
+
+            yield dut.val.eq(0xaa550012)
+            yield dut.be.eq(0b0011)
+            yield
+
+            self.assertEqual((yield dut.res), 0xf4e0)
+
+        simulation_test(dut, process, sync=True)
+
+    def test_byte_enable_wrong(self):
+        with self.assertRaisesRegex(ValueError,
+                r"Data width must be a multiple of 8 to use byte enables, not 11"):
+            dut = CRC(poly=0b00101, size=5, dw=11, init=0x1f, byte_enable=True)
+
+    def test_crc5_exhaustive(self):
+        dut = CRC(poly=0b00101, size=5, dw=11, init=0x1f)
+
+        def process():
+            yield dut.clr.eq(1)
+            for value in range(2**11):
+                yield dut.val.eq(value)
+                yield Delay()
+                self.assertEqual((yield dut.res),
+                                 crc_model(0b00101, 5, 0x1f, to_bits(value, 11)))
+                yield
+
+        simulation_test(dut, process, sync=True)
+
+    def test_crc16_exhaustive(self):
+        dut = CRC(poly=0b11000000000000101, size=16, dw=8, init=0xffff)
+
+        def process():
+            bits = []
+            yield dut.en.eq(1)
+            for value in range(2**8):
+                yield dut.val.eq(value)
+                yield Delay()
+                bits += to_bits(value, 8)
+                self.assertEqual((yield dut.res),
+                                 crc_model(0b11000000000000101, 16, 0xffff, bits))
+                yield
+
+        simulation_test(dut, process, sync=True)
+
+    def test_crc16_byte_enable_random(self):
+        dut = CRC(poly=0b11000000000000101, size=16, dw=32, init=0xffff, byte_enable=True)
+
+        def process():
+            rng = random.Random(0)
+            yield dut.en.eq(1)
+            for _ in range(64):
+                payload = [rng.randrange(256) for _ in range(rng.randrange(1, 20))]
+                words = [payload[i:i+4] for i in range(0, len(payload), 4)]
+                for i, word in enumerate(words):
+                    yield dut.val.eq(sum(byte << 8*j for j, byte in enumerate(word))
+                                     | rng.randrange(2**32) << 8*len(word) & 0xffffffff)
+                    yield dut.be.eq((1 << len(word)) - 1)
+                    yield dut.clr.eq(i == len(words) - 1)
+                    yield
+                bits = sum((to_bits(byte, 8) for byte in payload), [])
+                self.assertEqual((yield dut.res),
+                                 crc_model(0b11000000000000101, 16, 0xffff, bits))
+
+        simulation_test(dut, process, sync=True)
+
+    def test_pipeline(self):
+        dut = CRC(poly=0b11000000000000101, size=16, dw=16, init=0xffff, pipeline=True)
+
+        def process():
+            rng = random.Random(1)
+            bits = []
+            expected = []
+            yield dut.en.eq(1)
+            for i in range(64):
+                value = rng.randrange(2**16)
+                yield dut.val.eq(value)
+                yield dut.clr.eq(i % 16 == 15)
+                yield Delay()
+                bits += to_bits(value, 16)
+                expected.append(crc_model(0b11000000000000101, 16, 0xffff, bits))
+                if i % 16 == 15:
+                    bits = []
+                yield
+                # The result is available one cycle later.
+                yield Delay()
+                self.assertEqual((yield dut.res), expected[i])
+
+        simulation_test(dut, process, sync=True)
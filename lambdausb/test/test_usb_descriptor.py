@@ -0,0 +1,243 @@
+#nmigen: UnusedElaboratable=no
+
+import unittest
+
+from nmigen import *
+from nmigen.hdl.ir import Fragment
+
+from ._host import *
+from ._util import *
+from ..usb.config import *
+from ..usb.descriptor import *
+from ..usb.device import *
+from ..usb.endpoint import *
+
+
+def _blinker(**kwargs):
+    # The descriptors of `examples/blinker`.
+    endpoint = EndpointDescriptor(addr=1, direction="out", xfer=Transfer.BULK, max_size=512)
+    return DeviceDescriptor(
+        vendor_id=0x05ac, product_id=0x5678,
+        manufacturer="LambdaConcept", product="blinker demo", serial_number="123",
+        configurations=[
+            ConfigurationDescriptor(
+                max_power=96, self_powered=True, remote_wakeup=True,
+                interfaces=[InterfaceDescriptor(endpoints=[endpoint])],
+            ),
+        ],
+        **kwargs)
+
+
+def _descriptor(descriptor_map, rom_init, desc_type, desc_index=0):
+    offset, size = descriptor_map[desc_type][desc_index]
+    return rom_init[offset:offset + size]
+
+
+class DescriptorTestCase(unittest.TestCase):
+    def test_blinker(self):
+        descriptor_map, rom_init = build_descriptors(_blinker())
+        self.assertEqual(_descriptor(descriptor_map, rom_init, 0x01), [
+            0x12, 0x01, 0x00, 0x02, 0x00, 0x00, 0x00, 0x40,
+            0xac, 0x05, 0x78, 0x56, 0x00, 0x01, 0x01, 0x02,
+            0x03, 0x01,
+        ])
+        self.assertEqual(_descriptor(descriptor_map, rom_init, 0x02), [
+            0x09, 0x02, 0x19, 0x00, 0x01, 0x01, 0x00, 0xe0,
+            0x30, 0x09, 0x04, 0x00, 0x00, 0x01, 0xff, 0x00,
+            0x00, 0x00, 0x07, 0x05, 0x01, 0x02, 0x00, 0x02,
+            0x00,
+        ])
+        self.assertEqual(_descriptor(descriptor_map, rom_init, 0x03, 0), [0x04, 0x03, 0x09, 0x04])
+        self.assertEqual(_descriptor(descriptor_map, rom_init, 0x03, 1),
+                         [0x1c, 0x03, *b"L\0a\0m\0b\0d\0a\0C\0o\0n\0c\0e\0p\0t\0"])
+        self.assertEqual(_descriptor(descriptor_map, rom_init, 0x03, 3),
+                         [0x08, 0x03, *b"1\x002\x003\x00"])
+        self.assertEqual(_descriptor(descriptor_map, rom_init, 0x06), [
+            0x0a, 0x06, 0x00, 0x02, 0x00, 0x00, 0x00, 0x40,
+            0x01, 0x00,
+        ])
+
+    def test_usb_1_1(self):
+        descriptor_map, rom_init = build_descriptors(_blinker(bcd_usb=0x0110))
+        self.assertNotIn(0x06, descriptor_map)
+
+    def test_strings(self):
+        device = DeviceDescriptor(
+            vendor_id=0x1234, product_id=0x5678,
+            manufacturer="foo", product="foo", serial_number="bar",
+            configurations=[
+                ConfigurationDescriptor(string="bar", interfaces=[
+                    InterfaceDescriptor(string="baz"),
+                ]),
+            ])
+        descriptor_map, rom_init = build_descriptors(device)
+        # Identical strings share the same descriptor.
+        self.assertEqual(_descriptor(descriptor_map, rom_init, 0x01)[14:17], [1, 1, 2])
+        self.assertEqual(_descriptor(descriptor_map, rom_init, 0x02)[6], 2)
+        self.assertEqual(_descriptor(descriptor_map, rom_init, 0x02)[17], 3)
+        self.assertEqual(sorted(descriptor_map[0x03]), [0, 1, 2, 3])
+        self.assertEqual(_descriptor(descriptor_map, rom_init, 0x03, 3),
+                         [0x08, 0x03, *b"b\0a\0z\0"])
+
+    def test_packing(self):
+        interface = InterfaceDescriptor(endpoints=[
+            EndpointDescriptor(addr=1, direction="in", xfer=Transfer.INTERRUPT, max_size=64,
+                               interval=4),
+        ])
+        configuration = ConfigurationDescriptor(interfaces=[interface])
+        device = DeviceDescriptor(vendor_id=0x1234, product_id=0x5678,
+                                  configurations=[configuration, configuration])
+        descriptor_map, rom_init = build_descriptors(device)
+        config_0 = _descriptor(descriptor_map, rom_init, 0x02, 0)
+        config_1 = _descriptor(descriptor_map, rom_init, 0x02, 1)
+        self.assertEqual(config_0[5], 1)
+        self.assertEqual(config_1[5], 2)
+        self.assertEqual(config_0[18:], [0x07, 0x05, 0x81, 0x03, 0x40, 0x00, 0x04])
+        # Descriptors are packed without padding, and may share ROM bytes.
+        self.assertLessEqual(len(rom_init), sum(size for index_map in descriptor_map.values()
+                                                for offset, size in index_map.values()))
+
+    def test_high_bandwidth(self):
+        endpoint = EndpointDescriptor(addr=2, direction="in", xfer=Transfer.ISOCHRONOUS,
+                                      max_size=1024, transactions=3)
+        self.assertEqual(endpoint.to_bytes(), bytes([0x07, 0x05, 0x82, 0x01, 0x00, 0x14, 0x01]))
+
+    def test_alternate(self):
+        device = DeviceDescriptor(
+            vendor_id=0x1234, product_id=0x5678,
+            configurations=[
+                ConfigurationDescriptor(interfaces=[
+                    InterfaceDescriptor(),
+                    InterfaceDescriptor(number=0, alternate=1),
+                    InterfaceDescriptor(),
+                ]),
+            ])
+        descriptor_map, rom_init = build_descriptors(device)
+        config = _descriptor(descriptor_map, rom_init, 0x02)
+        self.assertEqual(config[4], 2)
+        self.assertEqual([config[9 + 9 * i + 2:9 + 9 * i + 4] for i in range(3)],
+                         [[0, 0], [0, 1], [1, 0]])
+
+    def test_cache(self):
+        descriptor_map, rom_init = build_descriptors(_blinker())
+        rom_init[0] = 0
+        descriptor_map[0x01][0] = (0, 0)
+        self.assertEqual(build_descriptors(_blinker()),
+                         build_descriptors(_blinker()))
+        self.assertNotEqual(build_descriptors(_blinker())[1], rom_init)
+        self.assertNotEqual(build_descriptors(_blinker(bcd_device=0x0200)),
+                            build_descriptors(_blinker()))
+
+    def test_wrong_endpoint(self):
+        with self.assertRaisesRegex(ValueError,
+                r"Endpoint address must be an integer between 1 and 15, not 0"):
+            EndpointDescriptor(addr=0, direction="in", xfer=Transfer.BULK, max_size=512)
+        with self.assertRaisesRegex(ValueError,
+                r"Direction must be 'in' or 'out', not 'foo'"):
+            EndpointDescriptor(addr=1, direction="foo", xfer=Transfer.BULK, max_size=512)
+        with self.assertRaisesRegex(ValueError,
+                r"Invalid maximum packet size 513; must be lesser than or equal to 512 for a "
+                r"bulk endpoint"):
+            EndpointDescriptor(addr=1, direction="in", xfer=Transfer.BULK, max_size=513)
+        with self.assertRaisesRegex(ValueError,
+                r"Invalid number of transactions per microframe 2; must be 1 for a bulk "
+                r"endpoint"):
+            EndpointDescriptor(addr=1, direction="in", xfer=Transfer.BULK, max_size=512,
+                               transactions=2)
+        with self.assertRaisesRegex(ValueError,
+                r"Interval must be an integer between 1 and 16 for an interrupt endpoint, "
+                r"not 0"):
+            EndpointDescriptor(addr=1, direction="in", xfer=Transfer.INTERRUPT, max_size=64,
+                               interval=0)
+
+    def test_wrong_endpoint_twice(self):
+        endpoint = EndpointDescriptor(addr=1, direction="in", xfer=Transfer.BULK, max_size=512)
+        device = DeviceDescriptor(vendor_id=0x1234, product_id=0x5678, configurations=[
+            ConfigurationDescriptor(interfaces=[
+                InterfaceDescriptor(endpoints=[endpoint, endpoint]),
+            ]),
+        ])
+        with self.assertRaisesRegex(ValueError,
+                r"Endpoint IN 1 is used twice in interface 0"):
+            build_descriptors(device)
+
+    def test_wrong_device(self):
+        with self.assertRaisesRegex(ValueError,
+                r"Maximum packet size of endpoint 0 must be 8, 16, 32 or 64, not 128"):
+            _blinker(max_size0=128)
+        with self.assertRaisesRegex(ValueError,
+                r"Vendor ID must be an integer between 0 and 65535, not -1"):
+            DeviceDescriptor(vendor_id=-1, product_id=0, configurations=[])
+        with self.assertRaisesRegex(ValueError,
+                r"Device must have at least one configuration"):
+            DeviceDescriptor(vendor_id=0, product_id=0, configurations=[])
+        with self.assertRaisesRegex(ValueError,
+                r"Product string must be at most 126 characters long, not 127"):
+            DeviceDescriptor(vendor_id=0, product_id=0, product="a" * 127,
+                             configurations=[ConfigurationDescriptor(interfaces=[])])
+        with self.assertRaisesRegex(TypeError,
+                r"Device must be a DeviceDescriptor, not 'foo'"):
+            build_descriptors("foo")
+
+    def test_get_descriptor(self):
+        descriptor_map, rom_init = build_descriptors(_blinker())
+
+        dut = Device()
+        cfg = ConfigurationFSM(descriptor_map, rom_init)
+        dut.add_endpoint(cfg.ep_in,  addr=0)
+        dut.add_endpoint(cfg.ep_out, addr=0)
+
+        m = Module()
+        m.submodules.dut = dut
+        m.submodules.cfg = cfg
+
+        host = Host(dut)
+
+        def process():
+            for desc_type, desc_index in [(0x01, 0), (0x02, 0), (0x03, 2)]:
+                setup = [0x80, 0x06, desc_index, desc_type, 0x00, 0x00, 0xff, 0x00]
+                self.assertEqual((yield from host.control_read(0, setup)),
+                                 _descriptor(descriptor_map, rom_init, desc_type, desc_index))
+
+        simulation_test(m, process)
+
+    def test_from_device(self):
+        dut = Device()
+        ep1_out = OutputEndpoint(xfer=Transfer.BULK, max_size=512)
+        ep2_in  = InputEndpoint(xfer=Transfer.ISOCHRONOUS, max_size=1024, transactions=3,
+                                interval=4)
+        ep3_in  = InputEndpoint(xfer=Transfer.INTERRUPT, max_size=64, interval=8)
+        dut.add_endpoint(ep1_out, addr=1)
+        dut.add_endpoint(ep2_in,  addr=2, buffered=True)
+        dut.add_endpoint(ep3_in,  addr=3)
+
+        cfg = ConfigurationFSM.from_device(dut, vendor_id=0x1234, product_id=0x5678,
+                                           product="foo", interface={"string": "bar"})
+        dut.add_endpoint(cfg.ep_in,  addr=0)
+        dut.add_endpoint(cfg.ep_out, addr=0)
+
+        # Endpoints may still be added until the handler is elaborated.
+        ep3_out = OutputEndpoint(xfer=Transfer.BULK, max_size=512, interval=16)
+        dut.add_endpoint(ep3_out, addr=3)
+
+        m = Module()
+        m.submodules.dut = dut
+        m.submodules.cfg = cfg
+
+        Fragment.get(m, platform=None)
+        device = _descriptor(cfg.descriptor_map, cfg.rom_init, 0x01)
+        self.assertEqual(device[7], 64)
+        config = _descriptor(cfg.descriptor_map, cfg.rom_init, 0x02)
+        self.assertEqual(config[2:5], [9 + 9 + 4 * 7, 0, 1])
+        self.assertEqual(config[9:18], [0x09, 0x04, 0x00, 0x00, 0x04, 0xff, 0x00, 0x00, 0x02])
+        self.assertEqual(config[18:], [
+            0x07, 0x05, 0x01, 0x02, 0x00, 0x02, 0x00,
+            0x07, 0x05, 0x82, 0x01, 0x00, 0x14, 0x04,
+            0x07, 0x05, 0x83, 0x03, 0x40, 0x00, 0x08,
+            0x07, 0x05, 0x03, 0x02, 0x00, 0x02, 0x10,
+        ])
+
+    def test_from_device_wrong(self):
+        with self.assertRaisesRegex(TypeError,
+                r"Device must be an instance of Device, not 'foo'"):
+            DeviceDescriptor.from_device("foo", vendor_id=0, product_id=0)
@@ -0,0 +1,360 @@
+#nmigen: UnusedElaboratable=no
+
+import unittest
+
+from nmigen import *
+from nmigen.back.pysim import *
+
+from ._host import *
+from ._util import *
+from ..usb.defs import *
+from ..usb.device import *
+from ..usb.endpoint import *
+from ..usb.stats import *
+
+
+def _in_latency(dut, ep):
+    # Send an IN token, and return the number of cycles between its last byte and the DATA PID
+    # and first payload byte of the response.
+    packet = token_packet(PacketID.IN, 0, ep)
+    for i, byte in enumerate(packet):
+        yield dut.rx.stb.eq(1)
+        yield dut.rx.lst.eq(i == len(packet) - 1)
+        yield dut.rx.data.eq(byte)
+        yield Settle()
+        if i < len(packet) - 1:
+            while not (yield dut.rx.rdy):
+                yield
+                yield Settle()
+            yield
+    yield dut.tx.rdy.eq(1)
+    latency = []
+    cycles  = 0
+    while len(latency) < 2:
+        yield Settle()
+        if (yield dut.tx.stb):
+            latency.append(cycles)
+        yield
+        cycles += 1
+    # Let the device send the rest of the packet, then consume the last byte of the token.
+    while not (yield dut.tx.lst):
+        yield
+        yield Settle()
+    yield
+    yield dut.tx.rdy.eq(0)
+    yield dut.rx.stb.eq(0)
+    yield dut.rx.lst.eq(0)
+    yield
+    return latency
+
+
+def _fill(ep, packets):
+    # Write `packets` to an input endpoint, one byte per word.
+    for packet in packets:
+        for i, byte in enumerate(packet):
+            yield ep.stb.eq(1)
+            yield ep.lst.eq(i == len(packet) - 1)
+            yield ep.data.eq(byte)
+            yield Settle()
+            while not (yield ep.rdy):
+                yield
+                yield Settle()
+            yield
+    yield ep.stb.eq(0)
+
+
+class DeviceTestCase(unittest.TestCase):
+    def test_wrong_handshake_timeout(self):
+        with self.assertRaisesRegex(ValueError,
+                r"Handshake timeout must be a positive integer, not 0"):
+            dut = Device(handshake_timeout=0)
+
+    def test_wrong_phy_latency(self):
+        with self.assertRaisesRegex(ValueError,
+                r"PHY latency must be a non-negative integer, not -1"):
+            dut = Device(phy_latency=-1)
+
+    def test_handshake_limit(self):
+        dut = Device()
+        ep = InputEndpoint(xfer=Transfer.BULK, max_size=8)
+        dut.add_endpoint(ep, addr=1, buffered=True)
+
+        host = Host(dut)
+
+        def process():
+            yield from _fill(ep, [[*range(8)], [*range(8, 16)]])
+
+            # The host replies 816 bit times after the end of the data packet, which is the
+            # High-Speed device timeout. The handshake reaches the device after the round-trip
+            # latency of the PHY, and must still be accepted.
+            yield from host.sof()
+            yield from host.send(token_packet(PacketID.IN, host.addr, 1))
+            self.assertEqual((yield from host.receive()), data_packet(PacketID.DATA0, [*range(8)]))
+            yield from host.idle(816 // 8 + dut.phy_latency - host.turnaround)
+            yield from host.send(handshake_packet(PacketID.ACK))
+            yield from host.send(token_packet(PacketID.IN, host.addr, 1))
+            self.assertEqual((yield from host.receive()),
+                             data_packet(PacketID.DATA1, [*range(8, 16)]))
+
+        simulation_test(dut, process)
+
+    def test_handshake_timeout(self):
+        dut = Device(stats=True)
+        ep = InputEndpoint(xfer=Transfer.BULK, max_size=8)
+        dut.add_endpoint(ep, addr=1, buffered=True)
+
+        host = Host(dut)
+
+        def process():
+            yield from _fill(ep, [[*range(8)], [*range(8, 16)]])
+
+            # The data packet is received, but the handshake is lost.
+            yield from host.sof()
+            yield from host.send(token_packet(PacketID.IN, host.addr, 1))
+            self.assertEqual((yield from host.receive()), data_packet(PacketID.DATA0, [*range(8)]))
+            yield from host.idle(dut.handshake_timeout + host.turnaround)
+
+            # A late handshake is ignored, and the same packet is sent again.
+            yield from host.send(handshake_packet(PacketID.ACK))
+            self.assertEqual((yield from host.in_transaction(1)), (PacketID.DATA0, [*range(8)]))
+            self.assertEqual((yield from host.in_transaction(1)),
+                             (PacketID.DATA1, [*range(8, 16)]))
+
+            yield dut.stats.rd.addr.eq(Cat(Const(Counter.TIMEOUT, 4), Const(1, 1), Const(1, 4)))
+            yield; yield Delay()
+            self.assertEqual((yield dut.stats.rd.data), 1)
+
+        simulation_test(dut, process)
+
+    def test_foreign_tokens(self):
+        dut = Device(stats=True)
+        ep = InputEndpoint(xfer=Transfer.BULK, max_size=8)
+        dut.add_endpoint(ep, addr=1, buffered=True)
+
+        host = Host(dut)
+
+        def process():
+            yield from _fill(ep, [[*range(8)], [*range(8, 16)]])
+
+            yield from host.sof()
+            yield from host.send(token_packet(PacketID.IN, host.addr, 1))
+            self.assertEqual((yield from host.receive()), data_packet(PacketID.DATA0, [*range(8)]))
+            # A token sent to another device must not change the endpoint that the handshake is
+            # attributed to.
+            yield from host.send(token_packet(PacketID.OUT, host.addr + 1, 3))
+            yield from host.send(handshake_packet(PacketID.ACK))
+            yield from host.send(token_packet(PacketID.IN, host.addr, 1))
+            self.assertEqual((yield from host.receive()),
+                             data_packet(PacketID.DATA1, [*range(8, 16)]))
+
+            yield dut.stats.rd.addr.eq(Cat(Const(Counter.ACK, 4), Const(1, 1), Const(1, 4)))
+            yield; yield Delay()
+            self.assertEqual((yield dut.stats.rd.data), 1)
+
+        simulation_test(dut, process)
+
+    def test_stall(self):
+        dut = Device(stats=True)
+        ep_in  = InputEndpoint(xfer=Transfer.CONTROL, max_size=64)
+        ep_out = OutputEndpoint(xfer=Transfer.CONTROL, max_size=64)
+        dut.add_endpoint(ep_in,  addr=0)
+        dut.add_endpoint(ep_out, addr=0)
+
+        host = Host(dut)
+
+        def process():
+            yield ep_in.stall.eq(1)
+            yield ep_out.stall.eq(1)
+            yield ep_out.rdy.eq(1)
+            yield from host.sof()
+            self.assertEqual((yield from host.in_transaction(0)), (PacketID.STALL, None))
+            self.assertEqual((yield from host.out_transaction(0, [1, 2])), PacketID.STALL)
+            self.assertEqual((yield from host.ping(0)), PacketID.STALL)
+            # SETUP packets are still accepted.
+            self.assertEqual((yield from host.out_transaction(0, [*range(8)], setup=True)),
+                             PacketID.ACK)
+
+            yield dut.stats.rd.addr.eq(Cat(Const(Counter.STALL, 4), Const(0, 1), Const(0, 4)))
+            yield; yield Delay()
+            self.assertEqual((yield dut.stats.rd.data), 2)
+
+        simulation_test(dut, process)
+
+    def test_sof(self):
+        dut = Device()
+        ep = InputEndpoint(xfer=Transfer.ISOCHRONOUS, max_size=8)
+        dut.add_endpoint(ep, addr=1)
+
+        host = Host(dut)
+        interval = 200
+        missing  = {52, 57, 58}
+        received = []
+
+        def monitor():
+            yield Passive()
+            while True:
+                yield Settle()
+                if (yield dut.sof):
+                    self.assertEqual((yield ep.sof), 1)
+                    self.assertEqual((yield ep.frame), (yield dut.frame))
+                    self.assertEqual((yield ep.microframe), (yield dut.microframe))
+                    received.append(((yield dut.frame), (yield dut.microframe),
+                                     (yield dut.sof_missed)))
+                yield
+
+        def process():
+            timestamps = {}
+            for microframe in range(46, 66):
+                while host.cycles < (microframe - 46) * interval:
+                    yield from host.tick()
+                if microframe == 52:
+                    # The SOF packet is corrupted.
+                    yield from host.send(sof_packet(microframe // 8), err=True)
+                elif microframe not in missing:
+                    yield from host.send(sof_packet(microframe // 8))
+                    timestamps[microframe] = yield dut.sof_timestamp
+            yield from host.tick(interval * 6)
+
+            self.assertEqual(timestamps[51] - timestamps[50], interval)
+            # The microframe index is only valid once the frame number has changed. Up to 3
+            # consecutive microframes are extrapolated.
+            self.assertEqual(received[2:], [
+                (microframe // 8, microframe % 8, microframe in missing or microframe >= 66)
+                for microframe in range(48, 69)
+            ])
+
+        simulation_test(dut, process, monitor)
+
+    def assertNYET(self, n_packets, *, shared_packets=0, **kwargs):
+        # The endpoint can hold `n_packets` packets of 8 bytes.
+        dut = Device(shared_packets=shared_packets)
+        ep = OutputEndpoint(xfer=Transfer.BULK, max_size=8)
+        dut.add_endpoint(ep, addr=1, **kwargs)
+
+        host = Host(dut)
+
+        def process():
+            yield from host.sof()
+            # Packets are acknowledged with ACK while the endpoint has room for another packet,
+            # and with NYET once it does not.
+            for i in range(n_packets):
+                self.assertEqual((yield from host.out_transaction(1, [i] * 8)),
+                                 PacketID.ACK if i < n_packets - 1 else PacketID.NYET)
+            # PING tokens are answered with NAK until the endpoint is drained.
+            for i in range(3):
+                yield from host.idle(16)
+                self.assertEqual((yield from host.ping(1)), PacketID.NAK)
+            yield ep.rdy.eq(1)
+            yield from host.idle(8 * n_packets)
+            self.assertEqual((yield from host.ping(1)), PacketID.ACK)
+            self.assertEqual((yield from host.out_transaction(1, [0xff] * 8)), PacketID.ACK)
+
+        simulation_test(dut, process)
+
+    def test_nyet_buffered(self):
+        self.assertNYET(2, buffered=True)
+
+    def test_nyet_ring(self):
+        self.assertNYET(4, buffered=4)
+
+    def test_nyet_shared(self):
+        self.assertNYET(3, shared_packets=2, buffered=1, shared=True)
+
+    def test_nyet_cut_through(self):
+        # The buffer of a cut-through endpoint has 16 entries.
+        self.assertNYET(2, cut_through=True)
+
+    def test_cut_through(self):
+        dut = Device()
+        ep = OutputEndpoint(xfer=Transfer.BULK, max_size=64)
+        dut.add_endpoint(ep, addr=1, cut_through=True)
+
+        host = Host(dut)
+        received = []
+
+        def sink():
+            yield Passive()
+            yield ep.rdy.eq(1)
+            packet = []
+            while True:
+                yield
+                if (yield ep.stb):
+                    packet.append((yield ep.data))
+                    if (yield ep.lst):
+                        received.append(packet)
+                        packet = []
+
+        def process():
+            payload = [i & 0xff for i in range(200)]
+            yield from host.sof()
+            # An idle cut-through endpoint can accept a packet.
+            self.assertEqual((yield from host.ping(1)), PacketID.ACK)
+            self.assertIsNone((yield from host.bulk_out(1, payload, max_size=64)))
+            yield from host.idle(8)
+            self.assertEqual(received, [payload[i:i + 64] for i in range(0, 200, 64)])
+            self.assertEqual(host.stats[1, "out"].nyets, 0)
+            self.assertEqual(host.stats[1, "out"].naks, 0)
+
+        simulation_test(dut, process, sink)
+
+    def test_rx_err(self):
+        for data_width in (8, 32):
+            dut = Device(data_width=data_width)
+            ep = OutputEndpoint(xfer=Transfer.BULK, max_size=8, data_width=data_width)
+            dut.add_endpoint(ep, addr=1, buffered=True)
+
+            host = Host(dut)
+            received = []
+
+            def sink():
+                yield Passive()
+                yield ep.rdy.eq(1)
+                while True:
+                    yield Settle()
+                    if (yield ep.stb) and not (yield ep.zlp):
+                        received.append((yield ep.data))
+                    yield
+
+            def process():
+                payload = [*range(8)]
+                yield from host.sof()
+                # A packet aborted by the PHY is dropped, even if its CRC is valid.
+                yield from host.send(token_packet(PacketID.OUT, host.addr, 1))
+                yield from host.send(data_packet(PacketID.DATA0, payload), err=True)
+                self.assertIsNone((yield from host.receive()))
+                self.assertEqual((yield from host.out_transaction(1, payload)), PacketID.ACK)
+                yield from host.idle(8)
+                n_bytes = data_width // 8
+                words = [payload[i:i + n_bytes] for i in range(0, len(payload), n_bytes)]
+                self.assertEqual(received, [int.from_bytes(bytes(word), "little")
+                                            for word in words])
+
+            simulation_test(dut, process, sink)
+
+    def test_prefetch_latency(self):
+        for buffered, shared in ((True, False), (2, False), (False, False), (True, True)):
+            for prefetch in (False, True):
+                dut = Device(shared_packets=2 if shared else 0, prefetch=prefetch)
+                eps = [InputEndpoint(xfer=Transfer.BULK, max_size=8) for addr in (1, 2)]
+                for addr, ep in enumerate(eps, 1):
+                    dut.add_endpoint(ep, addr=addr, buffered=buffered, shared=shared)
+
+                def fill():
+                    yield Passive()
+                    while True:
+                        for ep in eps:
+                            yield ep.stb.eq(1)
+                            yield ep.lst.eq(1)
+                            yield ep.data.eq(0xa5)
+                        yield
+
+                def process():
+                    yield from Host(dut).idle(32)
+                    # Alternate between endpoints, to let shared endpoints switch queues.
+                    for addr in (1, 2, 1):
+                        self.assertEqual((yield from _in_latency(dut, addr)),
+                                         [1, 2] if prefetch else [2, 3],
+                                         msg="buffered={}, shared={}, prefetch={}"
+                                             .format(buffered, shared, prefetch))
+
+                simulation_test(dut, process, fill)
@@ -47,6 +47,52 @@ class InputEndpointTestCase(unittest.TestCase):
             ep = InputEndpoint(xfer=Transfer.INTERRUPT, max_size=1025)
 
 
+    def test_interval(self):
+        self.assertEqual(InputEndpoint(xfer=Transfer.BULK, max_size=512).interval, 0)
+        self.assertEqual(InputEndpoint(xfer=Transfer.INTERRUPT, max_size=64).interval, 1)
+        ep = InputEndpoint(xfer=Transfer.ISOCHRONOUS, max_size=1024, interval=4)
+        self.assertEqual(ep.interval, 4)
+
+    def test_wrong_interval(self):
+        with self.assertRaisesRegex(ValueError,
+                r"Interval must be an integer between 1 and 16 for an isochronous endpoint, "
+                r"not 0"):
+            ep = InputEndpoint(xfer=Transfer.ISOCHRONOUS, max_size=1024, interval=0)
+        with self.assertRaisesRegex(ValueError,
+                r"Interval must be an integer between 0 and 255 for a bulk endpoint, not 256"):
+            ep = InputEndpoint(xfer=Transfer.BULK, max_size=512, interval=256)
+
+    def test_transactions(self):
+        ep = InputEndpoint(xfer=Transfer.ISOCHRONOUS, max_size=1024, transactions=3)
+        self.assertEqual(ep.transactions, 3)
+
+    def test_wrong_transactions(self):
+        with self.assertRaisesRegex(ValueError,
+                r"Number of transactions per microframe must be 1, 2 or 3, not 4"):
+            ep = InputEndpoint(xfer=Transfer.ISOCHRONOUS, max_size=1024, transactions=4)
+        with self.assertRaisesRegex(ValueError,
+                r"Invalid number of transactions per microframe 2; must be 1 for a bulk "
+                r"endpoint"):
+            ep = InputEndpoint(xfer=Transfer.BULK, max_size=512, transactions=2)
+
+    def test_data_width(self):
+        ep = InputEndpoint(xfer=Transfer.BULK, max_size=512, data_width=32)
+        self.assertEqual(ep.data_width, 32)
+        self.assertEqual(len(ep.data), 32)
+        self.assertEqual(len(ep.be), 4)
+
+    def test_data_width_8(self):
+        ep = InputEndpoint(xfer=Transfer.BULK, max_size=512)
+        self.assertEqual(ep.data_width, 8)
+        self.assertEqual(len(ep.data), 8)
+        self.assertEqual(len(ep.be), 0)
+
+    def test_wrong_data_width(self):
+        with self.assertRaisesRegex(ValueError,
+                r"Data width must be 8, 16 or 32, not 12"):
+            ep = InputEndpoint(xfer=Transfer.BULK, max_size=512, data_width=12)
+
+
 class OutputEndpointTestCase(unittest.TestCase):
     def test_simple(self):
         ep = OutputEndpoint(xfer=Transfer.CONTROL, max_size=64)
@@ -95,3 +141,33 @@ class OutputEndpointTestCase(unittest.TestCase):
         ep_1 = OutputEndpoint(xfer=Transfer.BULK,    max_size=64)
         self.assertEqual(ep_0.setup.width, 1)
         self.assertEqual(ep_1.setup.width, 0)
+
+    def test_transactions(self):
+        ep = OutputEndpoint(xfer=Transfer.INTERRUPT, max_size=1024, transactions=2)
+        self.assertEqual(ep.transactions, 2)
+
+    def test_wrong_transactions(self):
+        with self.assertRaisesRegex(ValueError,
+                r"Number of transactions per microframe must be 1, 2 or 3, not 0"):
+            ep = OutputEndpoint(xfer=Transfer.ISOCHRONOUS, max_size=1024, transactions=0)
+        with self.assertRaisesRegex(ValueError,
+                r"Invalid number of transactions per microframe 3; must be 1 for a control "
+                r"endpoint"):
+            ep = OutputEndpoint(xfer=Transfer.CONTROL, max_size=64, transactions=3)
+
+    def test_data_width(self):
+        ep = OutputEndpoint(xfer=Transfer.BULK, max_size=512, data_width=32)
+        self.assertEqual(ep.data_width, 32)
+        self.assertEqual(len(ep.data), 32)
+        self.assertEqual(len(ep.be), 4)
+
+    def test_data_width_8(self):
+        ep = OutputEndpoint(xfer=Transfer.BULK, max_size=512)
+        self.assertEqual(ep.data_width, 8)
+        self.assertEqual(len(ep.data), 8)
+        self.assertEqual(len(ep.be), 0)
+
+    def test_wrong_data_width(self):
+        with self.assertRaisesRegex(ValueError,
+                r"Data width must be 8, 16 or 32, not 12"):
+            ep = OutputEndpoint(xfer=Transfer.BULK, max_size=512, data_width=12)
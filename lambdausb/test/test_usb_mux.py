@@ -44,6 +44,21 @@ class DoubleBufferTestCase(unittest.TestCase):
 
         simulation_test(dut, process)
 
+    def test_w_avail(self):
+        dut = DoubleBuffer(depth=64, width=8)
+
+        def process():
+            self.assertTrue((yield dut.w_avail))
+            yield from self.write(dut, [0x01])
+            self.assertTrue((yield dut.w_avail))
+            yield
+            yield from self.write(dut, [0x02])
+            self.assertFalse((yield dut.w_avail))
+            self.assertEqual((yield from self.read(dut)), [0x01])
+            self.assertTrue((yield dut.w_avail))
+
+        simulation_test(dut, process)
+
     def test_r_ack(self):
         dut = DoubleBuffer(depth=64, width=8, read_ack=True)
 
@@ -141,6 +156,431 @@ class DoubleBufferTestCase(unittest.TestCase):
         simulation_test(dut, process)
 
 
+    def test_w_bank_overflow_pow2(self):
+        dut = DoubleBuffer(depth=4, width=8)
+
+        def process():
+            yield from self.write(dut, [0xa0, 0xb0, 0xc0, 0xd0, 0xe0])
+            yield; yield Delay()
+            self.assertEqual((yield dut.r_stb), 0)
+
+        simulation_test(dut, process)
+
+
+class PacketRingTestCase(unittest.TestCase):
+    write = DoubleBufferTestCase.write
+    read  = DoubleBufferTestCase.read
+
+    def test_wrong_n_packets(self):
+        with self.assertRaisesRegex(ValueError,
+                r"Number of packets must be a positive integer, not 0"):
+            dut = PacketRing(depth=64, width=8, n_packets=0)
+
+    def test_rw_simple(self):
+        dut = PacketRing(depth=64, width=8, n_packets=3)
+
+        def process():
+            data = [0x80, 0x06, 0x00, 0x01, 0x00, 0x00, 0x40, 0x00]
+            yield from self.write(dut, data)
+            self.assertEqual((yield from self.read(dut)), data)
+
+        simulation_test(dut, process)
+
+    def test_w_avail(self):
+        dut = PacketRing(depth=64, width=8, n_packets=3)
+
+        def process():
+            for i in range(3):
+                self.assertTrue((yield dut.w_avail))
+                yield from self.write(dut, [i])
+            self.assertFalse((yield dut.w_avail))
+            self.assertEqual((yield from self.read(dut)), [0])
+            self.assertTrue((yield dut.w_avail))
+
+        simulation_test(dut, process)
+
+    def test_r_ack(self):
+        dut = PacketRing(depth=64, width=8, n_packets=3, read_ack=True)
+
+        def process():
+            data = [0x12, 0x01, 0x00, 0x00, 0x02, 0x00, 0x00, 0x40]
+            yield from self.write(dut, data)
+            self.assertEqual((yield from self.read(dut)), data)
+            self.assertEqual((yield from self.read(dut)), data)
+            self.assertTrue((yield dut.r_stb))
+            yield dut.r_rdy.eq(1)
+            yield dut.r_ack.eq(1)
+            yield
+            yield dut.r_rdy.eq(0)
+            yield
+            self.assertFalse((yield dut.r_stb))
+
+        simulation_test(dut, process)
+
+    def test_w_overflow(self):
+        dut = PacketRing(depth=4, width=8, n_packets=2)
+
+        def process():
+            yield from self.write(dut, [0xa0, 0xb0, 0xc0, 0xd0, 0xe0])
+            yield; yield Delay()
+            self.assertEqual((yield dut.r_stb), 0)
+            yield from self.write(dut, [0xa1, 0xb1, 0xc1, 0xd1])
+            self.assertEqual((yield from self.read(dut)), [0xa1, 0xb1, 0xc1, 0xd1])
+
+        simulation_test(dut, process)
+
+    def test_w_full(self):
+        dut = PacketRing(depth=1, width=8, n_packets=3)
+
+        def process():
+            for i in range(3):
+                yield Delay()
+                self.assertEqual((yield dut.w_rdy), 1)
+                yield from self.write(dut, [i])
+            yield Delay()
+            self.assertEqual((yield dut.w_rdy), 0)
+            self.assertEqual((yield dut.r_stb), 1)
+            self.assertEqual((yield from self.read(dut)), [0])
+            yield Delay()
+            self.assertEqual((yield dut.w_rdy), 1)
+
+        simulation_test(dut, process)
+
+    def test_w_drop(self):
+        dut = PacketRing(depth=2, width=8, n_packets=2)
+
+        def process():
+            yield dut.w_stb.eq(1)
+            yield dut.w_data.eq(0xaa)
+            yield
+            yield dut.w_lst.eq(1)
+            yield dut.w_drop.eq(1)
+            yield dut.w_data.eq(0xbb)
+            yield
+            yield dut.w_stb.eq(0)
+            yield dut.w_lst.eq(0)
+            yield dut.w_drop.eq(0)
+            yield; yield Delay()
+            self.assertEqual((yield dut.r_stb), 0)
+            yield from self.write(dut, [0xcc])
+            self.assertEqual((yield from self.read(dut)), [0xcc])
+
+        simulation_test(dut, process)
+
+    def test_rw_interleaved(self):
+        dut = PacketRing(depth=4, width=8, n_packets=3)
+
+        def process():
+            data = [[0xa0 + i, 0xb0 + i, 0xc0 + i, 0xd0 + i][:i + 1] for i in range(6)]
+            yield from self.write(dut, data[0])
+            yield from self.write(dut, data[1])
+            yield from self.write(dut, data[2])
+            self.assertEqual((yield from self.read(dut)), data[0])
+            yield from self.write(dut, data[3])
+            self.assertEqual((yield from self.read(dut)), data[1])
+            yield from self.write(dut, data[4])
+            for i in range(2, 5):
+                self.assertEqual((yield from self.read(dut)), data[i])
+
+        simulation_test(dut, process)
+
+class PacketPoolTestCase(unittest.TestCase):
+    def write(self, dut, sel, data):
+        yield dut.w_sel.eq(sel)
+        yield Delay()
+        yield from DoubleBufferTestCase.write(self, dut, data)
+
+    def read(self, dut, sel):
+        yield dut.r_sel.eq(sel)
+        yield; yield
+        return (yield from DoubleBufferTestCase.read(self, dut))
+
+    def test_wrong_reserved(self):
+        with self.assertRaisesRegex(ValueError,
+                r"Number of reserved packets must be a non-negative integer, not -1"):
+            dut = PacketPool(depth=64, width=8, reserved=[1, -1])
+
+    def test_wrong_n_shared(self):
+        with self.assertRaisesRegex(ValueError,
+                r"Number of shared packets must be a non-negative integer, not -1"):
+            dut = PacketPool(depth=64, width=8, reserved=[1], n_shared=-1)
+
+    def test_empty(self):
+        with self.assertRaisesRegex(ValueError,
+                r"Packet pool must have at least one slot"):
+            dut = PacketPool(depth=64, width=8, reserved=[0, 0])
+
+    def test_rw_queues(self):
+        dut = PacketPool(depth=4, width=8, reserved=[2, 2])
+
+        def process():
+            yield from self.write(dut, 0, [0xa0, 0xa1])
+            yield from self.write(dut, 1, [0xb0])
+            yield from self.write(dut, 0, [0xa2, 0xa3, 0xa4])
+            self.assertEqual((yield from self.read(dut, 1)), [0xb0])
+            self.assertEqual((yield from self.read(dut, 0)), [0xa0, 0xa1])
+            yield from self.write(dut, 1, [0xb1, 0xb2])
+            self.assertEqual((yield from self.read(dut, 0)), [0xa2, 0xa3, 0xa4])
+            self.assertEqual((yield from self.read(dut, 1)), [0xb1, 0xb2])
+            yield Delay()
+            self.assertEqual((yield dut.r_avail), 0b00)
+
+        simulation_test(dut, process)
+
+    def test_reserved(self):
+        dut = PacketPool(depth=1, width=8, reserved=[2, 1])
+
+        def process():
+            yield from self.write(dut, 0, [0xa0])
+            yield from self.write(dut, 0, [0xa1])
+            yield Delay()
+            # Queue 0 has used its reservation, but queue 1 has not.
+            self.assertEqual((yield dut.w_avail), 0b10)
+            yield from self.write(dut, 1, [0xb0])
+            yield Delay()
+            self.assertEqual((yield dut.w_avail), 0b00)
+            self.assertEqual((yield from self.read(dut, 0)), [0xa0])
+            yield Delay()
+            self.assertEqual((yield dut.w_avail), 0b01)
+
+        simulation_test(dut, process)
+
+    def test_shared(self):
+        dut = PacketPool(depth=1, width=8, reserved=[1, 1], n_shared=2)
+
+        def process():
+            for i in range(3):
+                yield from self.write(dut, 0, [0xa0 + i])
+            yield Delay()
+            # Queue 0 has used all shared slots.
+            self.assertEqual((yield dut.w_avail), 0b10)
+            yield dut.w_sel.eq(0)
+            yield dut.w_stb.eq(1)
+            yield Delay()
+            self.assertEqual((yield dut.w_rdy), 0)
+            yield dut.w_stb.eq(0)
+            yield from self.write(dut, 1, [0xb0])
+            yield Delay()
+            self.assertEqual((yield dut.w_avail), 0b00)
+            self.assertEqual((yield from self.read(dut, 0)), [0xa0])
+            yield Delay()
+            self.assertEqual((yield dut.w_avail), 0b11)
+            for i in range(1, 3):
+                self.assertEqual((yield from self.read(dut, 0)), [0xa0 + i])
+            self.assertEqual((yield from self.read(dut, 1)), [0xb0])
+            yield Delay()
+            self.assertEqual((yield dut.w_avail), 0b11)
+
+        simulation_test(dut, process)
+
+    def test_r_ack(self):
+        dut = PacketPool(depth=4, width=8, reserved=[1, 1], read_ack=[True, False])
+
+        def process():
+            yield from self.write(dut, 0, [0xa0, 0xa1])
+            yield from self.write(dut, 1, [0xb0])
+            self.assertEqual((yield from self.read(dut, 0)), [0xa0, 0xa1])
+            # Without an acknowledgement, the packet is kept in its queue.
+            self.assertEqual((yield from self.read(dut, 1)), [0xb0])
+            self.assertEqual((yield from self.read(dut, 0)), [0xa0, 0xa1])
+            self.assertTrue((yield dut.r_stb))
+            yield dut.r_rdy.eq(1)
+            yield dut.r_ack.eq(1)
+            yield
+            yield dut.r_rdy.eq(0)
+            yield dut.r_ack.eq(0)
+            yield; yield Delay()
+            self.assertEqual((yield dut.r_avail), 0b00)
+
+        simulation_test(dut, process)
+
+    def test_w_drop(self):
+        dut = PacketPool(depth=2, width=8, reserved=[1])
+
+        def process():
+            yield dut.w_stb.eq(1)
+            yield dut.w_data.eq(0xaa)
+            yield
+            yield dut.w_lst.eq(1)
+            yield dut.w_drop.eq(1)
+            yield dut.w_data.eq(0xbb)
+            yield
+            yield dut.w_stb.eq(0)
+            yield dut.w_lst.eq(0)
+            yield dut.w_drop.eq(0)
+            yield; yield Delay()
+            self.assertEqual((yield dut.r_avail), 0)
+            self.assertEqual((yield dut.w_avail), 1)
+            yield from self.write(dut, 0, [0xcc])
+            self.assertEqual((yield from self.read(dut, 0)), [0xcc])
+
+        simulation_test(dut, process)
+
+    def test_w_overflow(self):
+        dut = PacketPool(depth=2, width=8, reserved=[1])
+
+        def process():
+            yield from self.write(dut, 0, [0xa0, 0xa1, 0xa2])
+            yield Delay()
+            self.assertEqual((yield dut.r_avail), 0)
+            self.assertEqual((yield dut.w_avail), 1)
+            yield from self.write(dut, 0, [0xb0, 0xb1])
+            self.assertEqual((yield from self.read(dut, 0)), [0xb0, 0xb1])
+
+        simulation_test(dut, process)
+
+
+class CutThroughBufferTestCase(unittest.TestCase):
+    def write(self, dut, data, drop=False):
+        yield dut.w_stb.eq(1)
+        for i, byte in enumerate(data):
+            yield dut.w_lst.eq(i == len(data) - 1)
+            yield dut.w_drop.eq(drop and i == len(data) - 1)
+            yield dut.w_data.eq(byte)
+            yield
+        yield dut.w_stb.eq(0)
+        yield dut.w_drop.eq(0)
+
+    def read(self, dut):
+        data = []
+        end = False
+        yield dut.r_rdy.eq(1)
+        while not end:
+            yield
+            self.assertTrue((yield dut.r_stb))
+            data.append(((yield dut.r_data), (yield dut.r_drop)))
+            end = (yield dut.r_lst)
+        yield dut.r_rdy.eq(0)
+        yield
+        return data
+
+    def test_wrong_depth(self):
+        with self.assertRaisesRegex(ValueError,
+                r"Depth must be a power of 2 greater than 1, not 6"):
+            dut = CutThroughBuffer(depth=6, width=8)
+
+    def test_cut_through(self):
+        dut = CutThroughBuffer(depth=4, width=8)
+
+        def process():
+            yield dut.w_stb.eq(1)
+            yield dut.w_data.eq(0xaa)
+            yield
+            yield dut.w_stb.eq(0)
+            yield Delay()
+            # The first byte can be read before the end of the packet.
+            self.assertEqual((yield dut.r_stb), 1)
+            self.assertEqual((yield dut.r_data), 0xaa)
+            self.assertEqual((yield dut.r_lst), 0)
+            yield from self.write(dut, [0xbb])
+            self.assertEqual((yield from self.read(dut)), [(0xaa, 0), (0xbb, 0)])
+
+        simulation_test(dut, process)
+
+    def test_drop_unread(self):
+        dut = CutThroughBuffer(depth=4, width=8)
+
+        def process():
+            yield from self.write(dut, [0xa0, 0xa1])
+            yield from self.write(dut, [0xb0, 0xb1, 0xb2], drop=True)
+            yield from self.write(dut, [0xc0])
+            self.assertEqual((yield from self.read(dut)), [(0xa0, 0), (0xa1, 0)])
+            self.assertEqual((yield from self.read(dut)), [(0xc0, 0)])
+            yield Delay()
+            self.assertEqual((yield dut.r_stb), 0)
+
+        simulation_test(dut, process)
+
+    def test_drop_partially_read(self):
+        dut = CutThroughBuffer(depth=4, width=8)
+
+        def process():
+            yield dut.w_stb.eq(1)
+            yield dut.w_data.eq(0xa0)
+            yield
+            yield dut.w_data.eq(0xa1)
+            yield dut.r_rdy.eq(1)
+            yield
+            yield dut.r_rdy.eq(0)
+            yield dut.w_lst.eq(1)
+            yield dut.w_drop.eq(1)
+            yield dut.w_data.eq(0xa2)
+            yield
+            yield dut.w_stb.eq(0)
+            yield dut.w_lst.eq(0)
+            yield dut.w_drop.eq(0)
+            yield Delay()
+            # 0xa0 was read. Unread bytes are replaced with a terminator.
+            self.assertEqual((yield dut.r_stb), 1)
+            self.assertEqual((yield dut.r_lst), 1)
+            self.assertEqual((yield dut.r_drop), 1)
+            self.assertEqual((yield dut.r_data), 0)
+            yield dut.r_rdy.eq(1)
+            yield
+            yield dut.r_rdy.eq(0)
+            yield Delay()
+            self.assertEqual((yield dut.r_stb), 0)
+            yield from self.write(dut, [0xb0])
+            self.assertEqual((yield from self.read(dut)), [(0xb0, 0)])
+
+        simulation_test(dut, process)
+
+    def test_w_full(self):
+        dut = CutThroughBuffer(depth=2, width=8)
+
+        def process():
+            yield dut.w_stb.eq(1)
+            for byte in [0xa0, 0xa1, 0xa2]:
+                yield dut.w_data.eq(byte)
+                yield Delay()
+                self.assertEqual((yield dut.w_rdy), byte != 0xa2)
+                yield
+            yield dut.w_lst.eq(1)
+            yield dut.w_data.eq(0xa3)
+            yield
+            yield dut.w_stb.eq(0)
+            yield dut.w_lst.eq(0)
+            yield Delay()
+            # The packet was dropped.
+            self.assertEqual((yield dut.r_stb), 0)
+            yield from self.write(dut, [0xb0, 0xb1])
+            self.assertEqual((yield from self.read(dut)), [(0xb0, 0), (0xb1, 0)])
+
+        simulation_test(dut, process)
+
+    def test_w_avail(self):
+        dut = CutThroughBuffer(depth=2, width=8)
+
+        def process():
+            # Available while idle, even if no entry is being written.
+            yield Delay()
+            self.assertEqual((yield dut.w_avail), 1)
+            yield from self.write(dut, [0xa0, 0xa1])
+            yield Delay()
+            self.assertEqual((yield dut.w_avail), 0)
+            self.assertEqual((yield from self.read(dut)), [(0xa0, 0), (0xa1, 0)])
+            yield Delay()
+            self.assertEqual((yield dut.w_avail), 1)
+
+            # Not available while the rest of a packet is being refused.
+            yield dut.w_stb.eq(1)
+            yield dut.w_lst.eq(0)
+            for byte in [0xb0, 0xb1, 0xb2]:
+                yield dut.w_data.eq(byte)
+                yield
+            yield dut.w_stb.eq(0)
+            yield dut.r_rdy.eq(1)
+            yield
+            yield dut.r_rdy.eq(0)
+            yield Delay()
+            self.assertEqual((yield dut.w_avail), 0)
+            yield from self.write(dut, [0xb3])
+            yield Delay()
+            self.assertEqual((yield dut.w_avail), 1)
+
+        simulation_test(dut, process)
+
+
 class InputMultiplexerTestCase(unittest.TestCase):
     def test_add_endpoint_wrong(self):
         dut = InputMultiplexer()
@@ -187,6 +627,16 @@ class InputMultiplexerTestCase(unittest.TestCase):
                 r"Invalid transfer type BULK for endpoint 0; must be CONTROL"):
             dut.add_endpoint(ep, addr=0)
 
+    def test_add_endpoint_buffered_wrong(self):
+        dut = InputMultiplexer()
+        ep  = InputEndpoint(xfer=Transfer.BULK, max_size=512)
+        with self.assertRaisesRegex(TypeError,
+                r"Endpoint buffering must be a boolean or an integer, not 'foo'"):
+            dut.add_endpoint(ep, addr=1, buffered="foo")
+        with self.assertRaisesRegex(ValueError,
+                r"Number of buffered packets must be a positive integer, not 0"):
+            dut.add_endpoint(ep, addr=1, buffered=0)
+
     def test_simple(self):
         dut = InputMultiplexer()
         ep0 = InputEndpoint(xfer=Transfer.CONTROL, max_size=64)
@@ -340,6 +790,44 @@ class InputMultiplexerTestCase(unittest.TestCase):
 
         simulation_test(dut, process)
 
+    def test_buffered_ring(self):
+        dut = InputMultiplexer()
+        ep  = InputEndpoint(xfer=Transfer.BULK, max_size=2)
+        dut.add_endpoint(ep, addr=1, buffered=3)
+
+        def process():
+            # Write three packets
+
+            yield ep.stb.eq(1)
+            for i in range(3):
+                yield Delay()
+                self.assertEqual((yield ep.rdy), 1)
+                yield ep.lst.eq(1)
+                yield ep.data.eq(0xa0 + i)
+                yield
+            yield ep.stb.eq(0)
+            yield; yield Delay()
+            self.assertEqual((yield ep.rdy), 0)
+
+            # Read packets, in order
+
+            yield dut.sel.addr.eq(1)
+            for i in range(3):
+                yield; yield Delay()
+                self.assertEqual((yield dut.pkt.stb), 1)
+                self.assertEqual((yield dut.pkt.lst), 1)
+                self.assertEqual((yield dut.pkt.data), 0xa0 + i)
+                yield dut.pkt.rdy.eq(1)
+                yield dut.pkt.ack.eq(1)
+                yield
+                yield dut.pkt.rdy.eq(0)
+                yield dut.pkt.ack.eq(0)
+            yield; yield Delay()
+
+            self.assertEqual((yield dut.pkt.stb), 0)
+
+        simulation_test(dut, process)
+
     def test_buffered_isochronous(self):
         dut = InputMultiplexer()
         ep  = InputEndpoint(xfer=Transfer.ISOCHRONOUS, max_size=2)
@@ -386,6 +874,254 @@ class InputMultiplexerTestCase(unittest.TestCase):
 
         simulation_test(dut, process)
 
+    def test_add_endpoint_high_bandwidth_unbuffered(self):
+        dut = InputMultiplexer()
+        ep  = InputEndpoint(xfer=Transfer.ISOCHRONOUS, max_size=1024, transactions=2)
+        with self.assertRaisesRegex(ValueError,
+                r"High-bandwidth isochronous endpoint \(rec .+\) must be buffered"):
+            dut.add_endpoint(ep, addr=1)
+
+    def test_buffered_high_bandwidth(self):
+        dut = InputMultiplexer()
+        ep  = InputEndpoint(xfer=Transfer.ISOCHRONOUS, max_size=2, transactions=3)
+        dut.add_endpoint(ep, addr=1, buffered=True)
+
+        def process():
+            # Write a 5-byte payload, which is sent as 3 packets
+
+            data = [0xa0, 0xa1, 0xa2, 0xa3, 0xa4]
+            yield ep.stb.eq(1)
+            for i, byte in enumerate(data):
+                self.assertEqual((yield ep.rdy), 1)
+                yield ep.lst.eq(i == len(data) - 1)
+                yield ep.data.eq(byte)
+                yield; yield Delay()
+            yield ep.stb.eq(0)
+            yield
+
+            # Read packets
+
+            yield dut.sel.addr.eq(1)
+            yield dut.pkt.rdy.eq(1)
+            yield
+
+            for seq, pkt_data in ((2, [0xa0, 0xa1]), (1, [0xa2, 0xa3]), (0, [0xa4])):
+                for i, byte in enumerate(pkt_data):
+                    self.assertEqual((yield dut.pkt.stb), 1)
+                    self.assertEqual((yield dut.pkt.seq), seq)
+                    self.assertEqual((yield dut.pkt.lst), i == len(pkt_data) - 1)
+                    self.assertEqual((yield dut.pkt.data), byte)
+                    yield
+            yield
+
+            self.assertEqual((yield dut.pkt.stb), 0)
+
+        simulation_test(dut, process)
+
+    def test_buffered_high_bandwidth_skipped(self):
+        dut = InputMultiplexer()
+        ep  = InputEndpoint(xfer=Transfer.ISOCHRONOUS, max_size=2, transactions=3)
+        dut.add_endpoint(ep, addr=1, buffered=True)
+
+        def write(data):
+            yield ep.stb.eq(1)
+            for i, byte in enumerate(data):
+                yield ep.lst.eq(i == len(data) - 1)
+                yield ep.data.eq(byte)
+                yield Settle()
+                while not (yield ep.rdy):
+                    yield
+                    yield Settle()
+                yield
+            yield ep.stb.eq(0)
+            yield
+
+        def read(seq, pkt_data):
+            yield dut.pkt.rdy.eq(1)
+            for i, byte in enumerate(pkt_data):
+                yield Delay()
+                self.assertEqual((yield dut.pkt.stb), 1)
+                self.assertEqual((yield dut.pkt.seq), seq)
+                self.assertEqual((yield dut.pkt.lst), i == len(pkt_data) - 1)
+                self.assertEqual((yield dut.pkt.data), byte)
+                yield
+            yield dut.pkt.rdy.eq(0)
+            yield
+
+        def process():
+            yield from write([0xa0, 0xa1, 0xa2, 0xa3, 0xa4])
+            yield from write([0xb0, 0xb1, 0xb2, 0xb3, 0xb4])
+            yield dut.sel.addr.eq(1)
+            yield
+
+            # Only the first packet of the payload is requested during this microframe.
+            yield from read(2, [0xa0, 0xa1])
+
+            # The rest of the payload is dropped when the next microframe starts, and the next
+            # payload is sent from its first packet.
+            yield dut.sof.eq(1)
+            yield
+            yield dut.sof.eq(0)
+            for i in range(8):
+                yield
+            yield from read(2, [0xb0, 0xb1])
+            yield from read(1, [0xb2, 0xb3])
+            yield from read(0, [0xb4])
+            yield Delay()
+            self.assertEqual((yield dut.pkt.stb), 0)
+
+        simulation_test(dut, process)
+
+    def test_add_endpoint_shared_wrong(self):
+        dut = InputMultiplexer()
+        ep  = InputEndpoint(xfer=Transfer.BULK, max_size=512)
+        with self.assertRaisesRegex(TypeError,
+                r"Endpoint sharing must be a boolean, not 'foo'"):
+            dut.add_endpoint(ep, addr=1, shared="foo")
+        with self.assertRaisesRegex(ValueError,
+                r"Endpoint \(rec .+\) has no reserved packets and the shared packet pool is "
+                r"empty"):
+            dut.add_endpoint(ep, addr=1, shared=True)
+
+    def test_add_endpoint_shared_high_bandwidth(self):
+        dut = InputMultiplexer(shared_packets=4)
+        ep  = InputEndpoint(xfer=Transfer.ISOCHRONOUS, max_size=1024, transactions=3)
+        with self.assertRaisesRegex(ValueError,
+                r"High-bandwidth isochronous endpoint \(rec .+\) cannot use the shared "
+                r"packet pool"):
+            dut.add_endpoint(ep, addr=1, buffered=True, shared=True)
+
+    def test_wrong_shared_packets(self):
+        with self.assertRaisesRegex(ValueError,
+                r"Number of shared packets must be a non-negative integer, not -1"):
+            dut = InputMultiplexer(shared_packets=-1)
+
+    def test_shared(self):
+        dut = InputMultiplexer(shared_packets=1)
+        ep1 = InputEndpoint(xfer=Transfer.BULK, max_size=2)
+        ep2 = InputEndpoint(xfer=Transfer.BULK, max_size=2)
+        dut.add_endpoint(ep1, addr=1, buffered=1, shared=True)
+        dut.add_endpoint(ep2, addr=2, shared=True)
+
+        def process():
+            # Both endpoints try to write a packet; ep1 is granted access first.
+
+            yield ep1.stb.eq(1)
+            yield ep1.data.eq(0xa0)
+            yield ep2.stb.eq(1)
+            yield ep2.lst.eq(1)
+            yield ep2.data.eq(0xb0)
+            yield Delay()
+            self.assertEqual((yield ep1.rdy), 1)
+            self.assertEqual((yield ep2.rdy), 0)
+            yield
+            yield ep1.lst.eq(1)
+            yield ep1.data.eq(0xa1)
+            yield Delay()
+            self.assertEqual((yield ep1.rdy), 1)
+            self.assertEqual((yield ep2.rdy), 0)
+            yield
+            yield ep1.stb.eq(0)
+            yield Delay()
+            self.assertEqual((yield ep2.rdy), 1)
+            yield
+            yield ep2.stb.eq(0)
+
+            # ep1 used its reserved packet, and ep2 used the shared one.
+
+            yield ep1.stb.eq(1)
+            yield ep1.data.eq(0xa2)
+            yield Delay()
+            self.assertEqual((yield ep1.rdy), 0)
+
+            # Read packets
+
+            for addr, data in ((2, [0xb0]), (1, [0xa0, 0xa1])):
+                yield dut.sel.addr.eq(addr)
+                yield; yield
+                for i, byte in enumerate(data):
+                    yield Delay()
+                    self.assertEqual((yield dut.pkt.stb), 1)
+                    self.assertEqual((yield dut.pkt.lst), i == len(data) - 1)
+                    self.assertEqual((yield dut.pkt.data), byte)
+                    yield dut.pkt.rdy.eq(1)
+                    yield
+                yield dut.pkt.ack.eq(1)
+                yield
+                yield dut.pkt.rdy.eq(0)
+                yield dut.pkt.ack.eq(0)
+
+            yield Delay()
+            self.assertEqual((yield ep1.rdy), 1)
+            yield
+            yield ep1.stb.eq(0)
+
+        simulation_test(dut, process)
+
+    def test_wrong_data_width(self):
+        with self.assertRaisesRegex(ValueError,
+                r"Data width must be 8, 16 or 32, not 64"):
+            dut = InputMultiplexer(data_width=64)
+
+    def test_add_endpoint_data_width_wrong(self):
+        dut = InputMultiplexer(data_width=32)
+        ep  = InputEndpoint(xfer=Transfer.BULK, max_size=512, data_width=16)
+        with self.assertRaisesRegex(ValueError,
+                r"Endpoint \(rec .+\) has a data width of 16, but the multiplexer has a data "
+                r"width of 32"):
+            dut.add_endpoint(ep, addr=1)
+
+    def test_add_endpoint_data_width_high_bandwidth_wrong(self):
+        dut = InputMultiplexer(data_width=32)
+        ep  = InputEndpoint(xfer=Transfer.ISOCHRONOUS, max_size=1022, transactions=2,
+                            data_width=32)
+        with self.assertRaisesRegex(ValueError,
+                r"Invalid maximum packet size 1022 for high-bandwidth isochronous endpoint "
+                r"\(rec .+\); must be a multiple of 4 bytes"):
+            dut.add_endpoint(ep, addr=1, buffered=True)
+
+    def test_buffered_wide(self):
+        dut = InputMultiplexer(data_width=32)
+        ep  = InputEndpoint(xfer=Transfer.BULK, max_size=8, data_width=32)
+        dut.add_endpoint(ep, addr=1, buffered=True)
+
+        def process():
+            # Write a 6-byte packet
+
+            yield ep.stb.eq(1)
+            yield ep.data.eq(0x03020100)
+            yield ep.be.eq(0b1111)
+            yield
+            yield ep.lst.eq(1)
+            yield ep.data.eq(0x0504)
+            yield ep.be.eq(0b0011)
+            yield
+            yield ep.stb.eq(0)
+            yield
+
+            # Read packet
+
+            yield dut.sel.addr.eq(1)
+            yield; yield Delay()
+            self.assertEqual((yield dut.pkt.stb), 1)
+            self.assertEqual((yield dut.pkt.lst), 0)
+            self.assertEqual((yield dut.pkt.data), 0x03020100)
+            self.assertEqual((yield dut.pkt.be), 0b1111)
+            yield dut.pkt.rdy.eq(1)
+            yield; yield Delay()
+            self.assertEqual((yield dut.pkt.stb), 1)
+            self.assertEqual((yield dut.pkt.lst), 1)
+            self.assertEqual((yield dut.pkt.data), 0x0504)
+            self.assertEqual((yield dut.pkt.be), 0b0011)
+            yield dut.pkt.ack.eq(1)
+            yield
+            yield dut.pkt.rdy.eq(0)
+            yield dut.pkt.ack.eq(0)
+            yield; yield Delay()
+            self.assertEqual((yield dut.pkt.stb), 0)
+
+        simulation_test(dut, process)
+
     def test_sof_broadcast(self):
         dut = InputMultiplexer()
         ep0 = InputEndpoint(xfer=Transfer.CONTROL,     max_size=1)
@@ -450,6 +1186,16 @@ class OutputMultiplexerTestCase(unittest.TestCase):
                 r"Invalid transfer type BULK for endpoint 0; must be CONTROL"):
             dut.add_endpoint(ep, addr=0)
 
+    def test_add_endpoint_buffered_wrong(self):
+        dut = OutputMultiplexer()
+        ep  = OutputEndpoint(xfer=Transfer.BULK, max_size=512)
+        with self.assertRaisesRegex(TypeError,
+                r"Endpoint buffering must be a boolean or an integer, not 'foo'"):
+            dut.add_endpoint(ep, addr=1, buffered="foo")
+        with self.assertRaisesRegex(ValueError,
+                r"Number of buffered packets must be a positive integer, not 0"):
+            dut.add_endpoint(ep, addr=1, buffered=0)
+
     def test_simple(self):
         dut = OutputMultiplexer()
         ep0 = OutputEndpoint(xfer=Transfer.CONTROL, max_size=64)
@@ -581,6 +1327,211 @@ class OutputMultiplexerTestCase(unittest.TestCase):
 
         simulation_test(dut, process)
 
+    def test_add_endpoint_high_bandwidth_unbuffered(self):
+        dut = OutputMultiplexer()
+        ep  = OutputEndpoint(xfer=Transfer.ISOCHRONOUS, max_size=1024, transactions=3)
+        with self.assertRaisesRegex(ValueError,
+                r"High-bandwidth isochronous endpoint \(rec .+\) must be buffered"):
+            dut.add_endpoint(ep, addr=1)
+
+    def test_buffered_high_bandwidth(self):
+        dut = OutputMultiplexer()
+        ep  = OutputEndpoint(xfer=Transfer.ISOCHRONOUS, max_size=2, transactions=2)
+        dut.add_endpoint(ep, addr=1, buffered=True)
+
+        def write(data, last=True):
+            yield dut.pkt.stb.eq(1)
+            for i, byte in enumerate(data):
+                self.assertEqual((yield dut.pkt.rdy), 1)
+                yield dut.pkt.lst.eq(last and i == len(data) - 1)
+                yield dut.pkt.data.eq(byte)
+                yield; yield Delay()
+            yield dut.pkt.stb.eq(0)
+            yield dut.pkt.lst.eq(0)
+            yield
+
+        def process():
+            yield dut.sel.addr.eq(1)
+            yield Delay()
+            self.assertEqual((yield dut.sel.transactions), 2)
+
+            # Write an incomplete payload, which is discarded at the start of the next microframe
+
+            yield from write([0xaa, 0xbb], last=False)
+            yield dut.sof.eq(1)
+            yield
+            yield dut.sof.eq(0)
+            yield; yield Delay()
+            self.assertEqual((yield ep.stb), 0)
+
+            # Write a complete payload
+
+            yield from write([0xa0, 0xa1, 0xa2])
+            yield; yield Delay()
+
+            yield ep.rdy.eq(1)
+            for i, byte in enumerate([0xa0, 0xa1, 0xa2]):
+                self.assertEqual((yield ep.stb), 1)
+                self.assertEqual((yield ep.lst), i == 2)
+                self.assertEqual((yield ep.data), byte)
+                yield; yield Delay()
+            self.assertEqual((yield ep.stb), 0)
+
+        simulation_test(dut, process)
+
+    def test_add_endpoint_shared_wrong(self):
+        dut = OutputMultiplexer()
+        ep  = OutputEndpoint(xfer=Transfer.BULK, max_size=512)
+        with self.assertRaisesRegex(TypeError,
+                r"Endpoint sharing must be a boolean, not 'foo'"):
+            dut.add_endpoint(ep, addr=1, shared="foo")
+        with self.assertRaisesRegex(ValueError,
+                r"Endpoint \(rec .+\) has no reserved packets and the shared packet pool is "
+                r"empty"):
+            dut.add_endpoint(ep, addr=1, shared=True)
+
+    def test_shared(self):
+        dut = OutputMultiplexer(shared_packets=1)
+        ep1 = OutputEndpoint(xfer=Transfer.BULK, max_size=2)
+        ep2 = OutputEndpoint(xfer=Transfer.BULK, max_size=2)
+        dut.add_endpoint(ep1, addr=1, buffered=1, shared=True)
+        dut.add_endpoint(ep2, addr=2, buffered=1, shared=True)
+
+        def write(addr, data, rdy=1):
+            yield dut.sel.addr.eq(addr)
+            yield dut.pkt.stb.eq(1)
+            for i, byte in enumerate(data):
+                yield dut.pkt.lst.eq(i == len(data) - 1)
+                yield dut.pkt.data.eq(byte)
+                yield Delay()
+                self.assertEqual((yield dut.pkt.rdy), rdy)
+                yield
+            yield dut.pkt.stb.eq(0)
+            yield
+
+        def process():
+            # Write packets. ep1 uses its reserved packet and the shared one.
+
+            yield from write(1, [0xa0, 0xa1])
+            yield from write(1, [0xa2])
+            yield from write(1, [0xa3], rdy=0)
+            yield from write(2, [0xb0])
+
+            # Read packets
+
+            yield ep1.rdy.eq(1)
+            yield ep2.rdy.eq(1)
+            data = {ep1: [], ep2: []}
+            for _ in range(16):
+                yield
+                for ep in (ep1, ep2):
+                    if (yield ep.stb):
+                        data[ep].append(((yield ep.data), (yield ep.lst)))
+            self.assertEqual(data[ep1], [(0xa0, 0), (0xa1, 1), (0xa2, 1)])
+            self.assertEqual(data[ep2], [(0xb0, 1)])
+
+        simulation_test(dut, process)
+
+    def test_add_endpoint_data_width_wrong(self):
+        dut = OutputMultiplexer(data_width=16)
+        ep  = OutputEndpoint(xfer=Transfer.BULK, max_size=512)
+        with self.assertRaisesRegex(ValueError,
+                r"Endpoint \(rec .+\) has a data width of 8, but the multiplexer has a data "
+                r"width of 16"):
+            dut.add_endpoint(ep, addr=1)
+
+    def test_buffered_wide(self):
+        dut = OutputMultiplexer(data_width=16)
+        ep  = OutputEndpoint(xfer=Transfer.BULK, max_size=4, data_width=16)
+        dut.add_endpoint(ep, addr=1, buffered=True)
+
+        def process():
+            # Write a 3-byte packet
+
+            yield dut.sel.addr.eq(1)
+            yield dut.pkt.stb.eq(1)
+            yield dut.pkt.data.eq(0x0100)
+            yield dut.pkt.be.eq(0b11)
+            yield
+            yield dut.pkt.lst.eq(1)
+            yield dut.pkt.data.eq(0x02)
+            yield dut.pkt.be.eq(0b01)
+            yield
+            yield dut.pkt.stb.eq(0)
+            yield; yield
+
+            # Read packet
+
+            self.assertEqual((yield ep.stb), 1)
+            self.assertEqual((yield ep.lst), 0)
+            self.assertEqual((yield ep.data), 0x0100)
+            self.assertEqual((yield ep.be), 0b11)
+            yield ep.rdy.eq(1)
+            yield; yield Delay()
+            self.assertEqual((yield ep.stb), 1)
+            self.assertEqual((yield ep.lst), 1)
+            self.assertEqual((yield ep.data), 0x02)
+            self.assertEqual((yield ep.be), 0b01)
+            yield; yield Delay()
+            self.assertEqual((yield ep.stb), 0)
+
+        simulation_test(dut, process)
+
+    def test_add_endpoint_cut_through_wrong(self):
+        dut = OutputMultiplexer()
+        ep  = OutputEndpoint(xfer=Transfer.BULK, max_size=512)
+        with self.assertRaisesRegex(TypeError,
+                r"Endpoint cut-through mode must be a boolean, not 'foo'"):
+            dut.add_endpoint(ep, addr=1, cut_through="foo")
+        with self.assertRaisesRegex(ValueError,
+                r"Endpoint \(rec .+\) cannot be both buffered and cut-through"):
+            dut.add_endpoint(ep, addr=1, buffered=True, cut_through=True)
+
+    def test_cut_through(self):
+        dut = OutputMultiplexer()
+        ep  = OutputEndpoint(xfer=Transfer.BULK, max_size=64)
+        dut.add_endpoint(ep, addr=1, cut_through=True)
+
+        def process():
+            yield dut.sel.addr.eq(1)
+            yield ep.rdy.eq(1)
+
+            # The endpoint is available while no packet is being received.
+            yield Delay()
+            self.assertEqual((yield dut.sel.avail), 1)
+
+            # Bytes are forwarded before the end of the packet.
+
+            yield dut.pkt.stb.eq(1)
+            yield dut.pkt.data.eq(0xaa)
+            yield Delay()
+            self.assertEqual((yield dut.pkt.rdy), 1)
+            yield
+            yield dut.pkt.stb.eq(0)
+            yield Delay()
+            self.assertEqual((yield ep.stb), 1)
+            self.assertEqual((yield ep.lst), 0)
+            self.assertEqual((yield ep.data), 0xaa)
+            yield
+
+            # The packet is invalidated.
+
+            yield dut.pkt.stb.eq(1)
+            yield dut.pkt.lst.eq(1)
+            yield dut.pkt.drop.eq(1)
+            yield dut.pkt.data.eq(0xbb)
+            yield
+            yield dut.pkt.stb.eq(0)
+            yield Delay()
+            self.assertEqual((yield ep.stb), 1)
+            self.assertEqual((yield ep.lst), 1)
+            self.assertEqual((yield ep.drop), 1)
+            yield
+            yield Delay()
+            self.assertEqual((yield ep.stb), 0)
+
+        simulation_test(dut, process)
+
     def test_sof_broadcast(self):
         dut = OutputMultiplexer()
         ep0 = OutputEndpoint(xfer=Transfer.CONTROL,     max_size=1)
@@ -0,0 +1,92 @@
+#nmigen: UnusedElaboratable=no
+
+import unittest
+
+from nmigen import *
+from nmigen.back.pysim import *
+
+from ._util import *
+from ..usb.stats import *
+from ..usb.endpoint import *
+
+
+class DeviceStatsTestCase(unittest.TestCase):
+    def read(self, dut, kind, *, ep, direction):
+        yield dut.rd.addr.eq(kind | direction << 4 | ep << 5)
+        yield; yield Delay()
+        return (yield dut.rd.data)
+
+    def test_wrong_width(self):
+        with self.assertRaisesRegex(ValueError,
+                r"Counter width must be a positive integer, not 0"):
+            dut = DeviceStats(width=0)
+
+    def test_add_endpoint_wrong(self):
+        dut = DeviceStats()
+        with self.assertRaisesRegex(TypeError,
+                r"Endpoint must be an InputEndpoint or an OutputEndpoint, not 'foo'"):
+            dut.add_endpoint("foo", addr=1)
+        ep = InputEndpoint(xfer=Transfer.BULK, max_size=64)
+        with self.assertRaisesRegex(ValueError,
+                r"Endpoint address must be between 0 and 15, not 16"):
+            dut.add_endpoint(ep, addr=16)
+        dut.add_endpoint(ep, addr=1)
+        with self.assertRaisesRegex(ValueError,
+                r"Endpoint address 1 has already been assigned"):
+            dut.add_endpoint(ep, addr=1)
+
+    def test_count(self):
+        dut = DeviceStats()
+        dut.add_endpoint(InputEndpoint (xfer=Transfer.BULK, max_size=64), addr=1)
+        dut.add_endpoint(OutputEndpoint(xfer=Transfer.BULK, max_size=64), addr=1)
+
+        def process():
+            yield dut.event.ep.eq(1)
+            yield dut.event.dir.eq(1)
+            yield dut.event.ack.eq(1)
+            yield dut.event.bytes.eq(1)
+            yield dut.event.sof.eq(1)
+            for i in range(3):
+                yield
+            yield dut.event.dir.eq(0)
+            yield dut.event.ack.eq(0)
+            yield dut.event.nak.eq(1)
+            yield
+            yield dut.event.nak.eq(0)
+            yield dut.event.bytes.eq(0)
+            yield dut.event.sof.eq(0)
+            yield
+
+            self.assertEqual((yield from self.read(dut, Counter.ACK,   ep=1, direction=1)), 3)
+            self.assertEqual((yield from self.read(dut, Counter.BYTES, ep=1, direction=1)), 3)
+            self.assertEqual((yield from self.read(dut, Counter.NAK,   ep=1, direction=1)), 0)
+            self.assertEqual((yield from self.read(dut, Counter.NAK,   ep=1, direction=0)), 1)
+            self.assertEqual((yield from self.read(dut, Counter.BYTES, ep=1, direction=0)), 1)
+            self.assertEqual((yield from self.read(dut, Counter.SOF,   ep=7, direction=0)), 4)
+            # Endpoint 2 wasn't added.
+            self.assertEqual((yield from self.read(dut, Counter.NAK,   ep=2, direction=0)), 0)
+
+            yield dut.clr.eq(1)
+            yield
+            yield dut.clr.eq(0)
+            self.assertEqual((yield from self.read(dut, Counter.ACK,   ep=1, direction=1)), 0)
+            self.assertEqual((yield from self.read(dut, Counter.SOF,   ep=1, direction=1)), 0)
+
+        simulation_test(dut, process)
+
+    def test_saturate(self):
+        dut = DeviceStats(width=4, data_width=32)
+        dut.add_endpoint(OutputEndpoint(xfer=Transfer.BULK, max_size=64, data_width=32), addr=0)
+
+        def process():
+            yield dut.event.bytes.eq(4)
+            for i in range(4):
+                yield
+            yield Delay()
+            self.assertEqual((yield from self.read(dut, Counter.BYTES, ep=0, direction=0)), 15)
+            for i in range(3):
+                yield
+            yield Delay()
+            self.assertEqual((yield from self.read(dut, Counter.BYTES, ep=0, direction=0)), 15)
+
+        simulation_test(dut, process)
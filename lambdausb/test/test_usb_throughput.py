@@ -0,0 +1,195 @@
+#nmigen: UnusedElaboratable=no
+
+import unittest
+
+from nmigen import *
+from nmigen.back.pysim import *
+
+from ._host import *
+from ._util import *
+from ..usb.defs import *
+from ..usb.device import *
+from ..usb.endpoint import *
+
+
+# Benchmark configurations, as keyword arguments of `run_benchmark`.
+CONFIGS = {
+    "bulk-out":             dict(direction="out"),
+    "bulk-out-slow":        dict(direction="out", period=2),
+    "bulk-out-ring":        dict(direction="out", buffered=4, period=2),
+    "bulk-out-shared":      dict(direction="out", shared=True),
+    "bulk-out-32":          dict(direction="out", data_width=32),
+    "bulk-out-cut-through": dict(direction="out", buffered=False, cut_through=True),
+    "bulk-in":              dict(direction="in"),
+    "bulk-in-slow":         dict(direction="in", period=2),
+    "bulk-in-unbuffered":   dict(direction="in", buffered=False),
+    "bulk-in-32":           dict(direction="in", data_width=32),
+}
+
+
+def _producer(ep, max_size, period):
+    def process():
+        yield Passive()
+        n_bytes = len(ep.data) // 8
+        while True:
+            for offset in range(0, max_size, n_bytes):
+                for i in range(period - 1):
+                    yield ep.stb.eq(0)
+                    yield
+                yield ep.stb.eq(1)
+                yield ep.lst.eq(offset + n_bytes >= max_size)
+                yield ep.data.eq(offset)
+                if n_bytes > 1:
+                    yield ep.be.eq((1 << n_bytes) - 1)
+                yield Settle()
+                # The `ack` strobe of unbuffered endpoints doesn't consume data.
+                while not (yield ep.rdy) or (yield ep.ack):
+                    yield
+                    yield Settle()
+                yield
+            yield ep.stb.eq(0)
+    return process
+
+
+def _consumer(ep, period):
+    def process():
+        yield Passive()
+        while True:
+            for i in range(period - 1):
+                yield ep.rdy.eq(0)
+                yield
+            yield ep.rdy.eq(1)
+            yield
+    return process
+
+
+def run_benchmark(*, direction, cycles=2000, data_width=8, max_size=512, buffered=True,
+                  shared=False, cut_through=False, period=1, hs=True, sof_interval=None):
+    """Run a bulk transfer benchmark between a :class:`_host.Host` and a device endpoint.
+
+    The host keeps the endpoint busy for `cycles` clock cycles. The endpoint consumes or produces
+    one word every `period` cycles. Measurements start once the endpoint had enough time to fill
+    (or drain) two packets.
+
+    Unless `sof_interval` is given, the device is assumed to run at 60 MHz for an 8-bit data
+    width (as with an ULPI PHY), and proportionally slower for wider data paths.
+
+    Returns a tuple `(stats, bytes_per_microframe, report)`, where `stats` is the
+    :class:`_host.EndpointStats` instance of the endpoint and `report` is the
+    :class:`_util.SimulationReport` of the simulation.
+    """
+    if sof_interval is None:
+        sof_interval = 7500 * 8 // data_width
+
+    dut = Device(data_width=data_width, shared_packets=2 if shared else 0)
+    if direction == "in":
+        ep = InputEndpoint(xfer=Transfer.BULK, max_size=max_size, data_width=data_width)
+        endpoint_process = _producer(ep, max_size, period)
+    else:
+        ep = OutputEndpoint(xfer=Transfer.BULK, max_size=max_size, data_width=data_width)
+        endpoint_process = _consumer(ep, period)
+    dut.add_endpoint(ep, addr=1, buffered=buffered, shared=shared, cut_through=cut_through)
+
+    host = Host(dut, sof_interval=sof_interval)
+    payload = [i & 0xff for i in range(max_size)]
+
+    warmup = 2 * max_size // (data_width // 8) * period
+    start  = warmup
+
+    def host_process():
+        yield dut.hs.eq(hs)
+        yield from host.idle(warmup)
+        host.stats.clear()
+        while host.cycles - start < cycles:
+            if direction == "in":
+                yield from host.bulk_in(1, max_size, max_size=max_size)
+            else:
+                yield from host.bulk_out(1, payload, max_size=max_size)
+
+    with SimulationHarness(dut, period=1 / 60e6) as harness:
+        report = harness.run(host_process, endpoint_process)
+
+    stats = host.stats[1, direction]
+    return stats, stats.bytes * sof_interval / (host.cycles - start), report
+
+
+class HostTestCase(unittest.TestCase):
+    def test_bulk(self):
+        dut = Device()
+        ep_in  = InputEndpoint (xfer=Transfer.BULK, max_size=16)
+        ep_out = OutputEndpoint(xfer=Transfer.BULK, max_size=16)
+        dut.add_endpoint(ep_in,  addr=1, buffered=True)
+        dut.add_endpoint(ep_out, addr=1, buffered=True)
+
+        host = Host(dut)
+        received = []
+
+        def sink():
+            yield Passive()
+            yield ep_out.rdy.eq(1)
+            while True:
+                yield Settle()
+                if (yield ep_out.stb) and not (yield ep_out.zlp):
+                    received.append((yield ep_out.data))
+                yield
+
+        def process():
+            payload = list(range(40))
+            yield from host.bulk_out(1, payload, max_size=16)
+            yield from host.idle(8)
+            self.assertEqual(received, payload)
+
+            self.assertEqual((yield from host.in_transaction(1)), (PacketID.NAK, None))
+            for i in range(16):
+                yield ep_in.stb.eq(1)
+                yield ep_in.lst.eq(i == 15)
+                yield ep_in.data.eq(i)
+                yield
+            yield ep_in.stb.eq(0)
+            self.assertEqual((yield from host.bulk_in(1, 16, max_size=16)), list(range(16)))
+
+            stats = host.stats[1, "out"]
+            self.assertEqual(stats.packets, 3)
+            self.assertEqual(stats.bytes, 40)
+            stats = host.stats[1, "in"]
+            self.assertEqual(stats.naks, 1)
+            self.assertEqual(stats.bytes, 16)
+
+        simulation_test(dut, process, sink)
+
+
+class ThroughputTestCase(unittest.TestCase):
+    def assertThroughput(self, config, bytes_per_microframe, nak_ratio, **kwargs):
+        stats, result, _ = run_benchmark(**CONFIGS[config], **kwargs)
+        self.assertGreaterEqual(result, bytes_per_microframe)
+        self.assertLessEqual(stats.nak_ratio, nak_ratio)
+
+    # Short runs, to keep the test suite fast. Run this module to get a full report.
+    def test_bulk_out(self):
+        self.assertThroughput("bulk-out", 5000, 0, max_size=64, cycles=1000)
+
+    def test_bulk_in(self):
+        self.assertThroughput("bulk-in", 5000, 0, max_size=64, cycles=1000)
+
+    def test_bulk_out_nyet(self):
+        stats_nyet, _, _ = run_benchmark(**CONFIGS["bulk-out-slow"], max_size=64, cycles=1000)
+        stats_nak,  _, _ = run_benchmark(**CONFIGS["bulk-out-slow"], max_size=64, cycles=1000,
+                                         hs=False)
+        self.assertGreater(stats_nyet.nyets, 0)
+        self.assertEqual(stats_nak.nyets, 0)
+        self.assertLess(stats_nyet.retried_bytes, stats_nak.retried_bytes)
+
+    def test_bulk_out_32(self):
+        self.assertThroughput("bulk-out-32", 2500, 0, max_size=64, cycles=1000)
+
+    def test_bulk_out_cut_through(self):
+        self.assertThroughput("bulk-out-cut-through", 5000, 0, max_size=64, cycles=1000)
+
+
+if __name__ == "__main__":
+    print("{:<22} {:>16} {:>10} {:>10}".format("configuration", "bytes/microframe", "NAK ratio",
+                                               "cycles/s"))
+    for name, config in CONFIGS.items():
+        stats, result, report = run_benchmark(**config)
+        print("{:<22} {:>16.0f} {:>10.2f} {:>10.0f}".format(name, result, stats.nak_ratio,
+                                                            report.cycles_per_second))
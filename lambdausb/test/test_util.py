@@ -0,0 +1,83 @@
+#nmigen: UnusedElaboratable=no
+
+import os
+import tempfile
+import unittest
+
+from nmigen import *
+from nmigen.back.pysim import *
+
+from ._util import *
+
+
+class _Counter(Elaboratable):
+    def __init__(self):
+        self.en  = Signal()
+        self.ctr = Signal(8)
+
+    def elaborate(self, platform):
+        m = Module()
+        with m.If(self.en):
+            m.d.sync += self.ctr.eq(self.ctr + 1)
+        return m
+
+
+class SimulationHarnessTestCase(unittest.TestCase):
+    def test_run_twice(self):
+        dut = _Counter()
+        harness = SimulationHarness(dut, vcd=False)
+
+        def process():
+            yield dut.en.eq(1)
+            for i in range(5):
+                yield
+            yield dut.en.eq(0)
+
+        for i in range(2):
+            report = harness.run(process)
+            self.assertGreaterEqual(report.cycles, 5)
+            self.assertGreater(report.cycles_per_second, 0)
+
+        def check():
+            yield Settle()
+            self.assertEqual((yield dut.ctr), 10)
+
+        harness.run(check)
+
+    def test_processes(self):
+        dut = _Counter()
+        harness = SimulationHarness(dut, vcd=False)
+        log = []
+
+        def enable():
+            yield dut.en.eq(1)
+            yield
+            yield dut.en.eq(0)
+
+        def check():
+            yield; yield
+            yield Settle()
+            log.append((yield dut.ctr))
+
+        harness.run(enable, check)
+        harness.run(enable)
+        harness.run(check)
+        self.assertEqual(log, [1, 2])
+
+    def test_vcd(self):
+        dut = _Counter()
+
+        def process():
+            yield
+
+        with tempfile.TemporaryDirectory() as vcd_dir:
+            for i in range(2):
+                with SimulationHarness(dut, vcd=True, name="counter",
+                                       vcd_dir=vcd_dir) as harness:
+                    harness.run(process)
+                    harness.run(process)
+            self.assertEqual(sorted(os.listdir(vcd_dir)), ["counter.1.vcd", "counter.vcd"])
+
+    def test_vcd_default_name(self):
+        harness = SimulationHarness(_Counter(), vcd=False)
+        self.assertEqual(harness.name, self.id())
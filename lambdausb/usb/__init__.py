@@ -1,3 +1,5 @@
 from .config import *
+from .descriptor import *
 from .device import *
 from .endpoint import *
+from .stats import *
@@ -1,151 +1,570 @@
 import enum
 
 from nmigen import *
+from nmigen.hdl.rec import *
 
+from .descriptor import DeviceDescriptor, build_descriptors
 from .endpoint import *
 
 
-__all__ = ["ConfigurationFSM"]
+__all__ = ["RequestHandler", "ConfigurationFSM"]
 
 
 class Request(enum.IntEnum):
-    GET_DESCRIPTOR = 0x8006
-    GET_DEV_STATUS = 0x8000
-    SET_ADDRESS    = 0x0005
-    SET_CONFIG     = 0x0009
+    GET_DESCRIPTOR   = 0x8006
+    GET_DEV_STATUS   = 0x8000
+    GET_EP_STATUS    = 0x8200
+    CLEAR_EP_FEATURE = 0x0201
+    SET_EP_FEATURE   = 0x0203
+    SET_ADDRESS      = 0x0005
+    SET_CONFIG       = 0x0009
+
+
+class Feature(enum.IntEnum):
+    ENDPOINT_HALT = 0
+
+
+_setup_layout = [
+    ("bmRequestType", [("rcpt", 5), ("type", 2), ("dir", 1)]),
+    ("bRequest",       8),
+    ("wValue",        16),
+    ("wIndex",        16),
+    ("wLength",       16),
+]
+
+
+_data_in_layout = [
+    ("stb",  1, DIR_FANOUT),
+    ("lst",  1, DIR_FANOUT),
+    ("data", 8, DIR_FANOUT),
+    ("rdy",  1, DIR_FANIN),
+]
+
+
+_data_out_layout = [
+    ("rdy",  1, DIR_FANOUT),
+    ("stb",  1, DIR_FANIN),
+    ("lst",  1, DIR_FANIN),
+    ("data", 8, DIR_FANIN),
+]
+
+
+class RequestHandler(Elaboratable):
+    """Control request handler.
+
+    Base class of the handlers of class and vendor requests (or of standard requests that aren't
+    answered by :class:`ConfigurationFSM`). Subclasses must implement :meth:`elaborate`. A handler
+    is added to a :class:`ConfigurationFSM` with :meth:`ConfigurationFSM.add_handler`, which
+    elaborates it as a submodule.
+
+    A request is claimed by a handler when `start` is asserted. Its data stage is then either
+    sent on `data_in` (device-to-host requests), or received on `data_out` (host-to-device
+    requests). The request may be rejected at any time by asserting `stall`.
+
+    Attributes
+    ----------
+    setup : Record, in
+        Setup packet of the current request.
+    start : Signal, in
+        Request start. Asserted for one cycle when the handler claims a request. Data left from
+        a previous request must be discarded.
+    data_in.stb : Signal, out
+        Data stage strobe, for device-to-host requests.
+    data_in.lst : Signal, out
+        Data stage last. Asserted when `data_in.data` holds the last byte of the data stage.
+        The data stage also ends after `setup.wLength` bytes.
+    data_in.data : Signal(8), out
+        Data stage data.
+    data_in.rdy : Signal, in
+        Data stage ready.
+    data_out.rdy : Signal, out
+        Data stage ready, for host-to-device requests.
+    data_out.stb : Signal, in
+        Data stage strobe.
+    data_out.lst : Signal, in
+        Data stage last. Asserted when `data_out.data` holds the last byte of the data stage.
+        The data stage ends after `setup.wLength` bytes, or after a packet shorter than the
+        maximum packet size. It is not asserted if the data stage ends with a zero-length packet.
+    data_out.data : Signal(8), in
+        Data stage data.
+    done : Signal, out
+        Request done. Host-to-device requests are completed once `done` is asserted after their
+        data stage. Unused by device-to-host requests.
+    stall : Signal, out
+        Request stall. Asserted to reject the current request, which is answered with STALL
+        handshakes until the next SETUP packet.
+    """
+    def __init__(self):
+        self.setup    = Record(_setup_layout)
+        self.start    = Signal()
+        self.data_in  = Record(_data_in_layout)
+        self.data_out = Record(_data_out_layout)
+        self.done     = Signal()
+        self.stall    = Signal()
+
+    def elaborate(self, platform):
+        raise NotImplementedError
+
+
+def _check_pattern(name, pattern):
+    if isinstance(pattern, int):
+        if pattern in range(256):
+            return
+    elif isinstance(pattern, str):
+        bits = "".join(pattern.split())
+        if len(bits) == 8 and set(bits) <= set("01-"):
+            return
+    raise ValueError("{} must be an integer between 0 and 255, or a pattern of 8 '0', '1' or "
+                     "'-' characters, not {!r}".format(name, pattern))
 
 
 class ConfigurationFSM(Elaboratable):
-    def __init__(self, descriptor_map, rom_init):
+    """Control endpoint handler.
+
+    Answers standard requests on EP0, and sends descriptors from a ROM.
+
+    The data stage of a control transfer is split into packets of `ep_in.max_size` bytes. If a
+    descriptor is shorter than `wLength` and its size is a multiple of `ep_in.max_size`, the data
+    stage ends with a zero-length packet. If a packet isn't acknowledged by the host, it is sent
+    again from its first byte.
+
+    Other requests are dispatched to the handlers added with :meth:`add_handler`. The data stage
+    of a host-to-device request is received through a packet buffer, so that packets with an
+    invalid CRC can be dropped, and the data stage of a device-to-host request is sent from the
+    same buffer, so that packets can be sent again. Requests that aren't claimed by any handler,
+    or that fail (e.g. an unknown descriptor), are answered with STALL handshakes until the next
+    SETUP packet.
+
+    Parameters
+    ----------
+    descriptor_map : dict
+        Descriptors, as a dict of dicts. ``descriptor_map[type][index]`` is the `(offset, size)`
+        tuple of a descriptor in `rom_init`.
+    rom_init : list of int
+        Descriptor ROM contents.
+    lookup : str
+        Descriptor lookup method. If ``"switch"``, descriptors are selected by a multiplexer
+        whose size grows with the number of descriptors. If ``"table"``, a sorted table of
+        descriptors is appended to the ROM, and searched by bisection. The lookup logic then
+        has a constant size, at the cost of a few cycles per descriptor request.
+
+    Attributes
+    ----------
+    ep_in : :class:`endpoint.InputEndpoint`
+        EP0 input endpoint.
+    ep_out : :class:`endpoint.OutputEndpoint`
+        EP0 output endpoint.
+    dev_addr : Signal(7), out
+        Device address.
+    halt : Record, out
+        Endpoint halt control. Must be connected to the `halt` record of the device, with
+        ``cfg.halt.connect(device.halt)``. It is used by the SET_FEATURE, CLEAR_FEATURE and
+        GET_STATUS requests to endpoints.
+    setup : Record, out
+        Setup packet of the current control transfer.
+    """
+    def __init__(self, descriptor_map, rom_init, *, lookup="switch"):
+        if lookup not in ("switch", "table"):
+            raise ValueError("Lookup must be 'switch' or 'table', not {!r}".format(lookup))
+
         self.ep_in  = InputEndpoint(xfer=Transfer.CONTROL, max_size=64)
         self.ep_out = OutputEndpoint(xfer=Transfer.CONTROL, max_size=64)
         self.dev_addr  = Signal(7)
+        self.halt      = Record([
+            ("ep",     4, DIR_FANOUT),
+            ("dir",    1, DIR_FANOUT),
+            ("set",    1, DIR_FANOUT),
+            ("clr",    1, DIR_FANOUT),
+            ("status", 1, DIR_FANIN),
+            ("err",    1, DIR_FANIN),
+        ])
+        self.setup     = Record(_setup_layout)
 
         self.descriptor_map = descriptor_map
         self.rom_init = rom_init
+        self.lookup   = lookup
+
+        self._device  = None
+        self._handlers = []
+
+    @classmethod
+    def from_device(cls, device, *, lookup="switch", **kwargs):
+        """Create a control endpoint handler whose descriptors are derived from `device`.
+
+        Descriptors are built by :meth:`descriptor.DeviceDescriptor.from_device` when the handler
+        is elaborated, and therefore match the endpoints added to `device` until then. Keyword
+        arguments are passed to :meth:`descriptor.DeviceDescriptor.from_device`.
+        """
+        # Check arguments early, even though endpoints may still be added to the device.
+        DeviceDescriptor.from_device(device, **kwargs)
+        fsm = cls(None, None, lookup=lookup)
+        fsm._device = device
+        fsm._device_kwargs = kwargs
+        return fsm
+
+    def add_handler(self, handler, *, request_type, request=None):
+        """Add a control request handler.
+
+        Requests are matched against handlers in the order they were added, and claimed by the
+        first matching handler.
+
+        Parameters
+        ----------
+        handler : :class:`RequestHandler`
+            Request handler.
+        request_type : int or str
+            bmRequestType value. Patterns are allowed, with ``"-"`` for don't care bits (e.g.
+            ``"-0100001"`` for class requests to an interface, in both directions).
+        request : int or str
+            bRequest value or pattern. Optional. Defaults to any request.
+        """
+        if not isinstance(handler, RequestHandler):
+            raise TypeError("Handler must be an instance of RequestHandler, not {!r}"
+                            .format(handler))
+        if any(handler is h for h, _, _ in self._handlers):
+            raise ValueError("Handler {!r} has already been added".format(handler))
+        _check_pattern("Request type", request_type)
+        if request is not None:
+            _check_pattern("Request", request)
+        self._handlers.append((handler, request_type, request))
+
+    def _table(self):
+        # Descriptor table entries are 6 bytes long, in big-endian order: (type, index), offset
+        # and size. Entries are sorted by (type, index).
+        table = []
+        for desc_type, index_map in sorted(self.descriptor_map.items()):
+            for desc_index, (offset, size) in sorted(index_map.items()):
+                key = desc_type << 8 | desc_index
+                for value in (key, offset, size):
+                    table += [value >> 8 & 0xff, value & 0xff]
+        return table
 
     def elaborate(self, platform):
         m = Module()
 
-        rom = Memory(width=8, depth=len(self.rom_init), init=self.rom_init)
+        if self._device is not None:
+            device_desc = DeviceDescriptor.from_device(self._device, **self._device_kwargs)
+            self.descriptor_map, self.rom_init = build_descriptors(device_desc)
+
+        rom_init = list(self.rom_init)
+        if self.lookup == "table":
+            table_base = len(rom_init)
+            table = self._table()
+            n_entries = len(table) // 6
+            rom_init += table
+
+        rom = Memory(width=8, depth=len(rom_init), init=rom_init)
         m.submodules.rom_rp = rom_rp = rom.read_port(transparent=False)
         rom_rp.en.reset = 0
 
-        rom_offset = Signal(range(len(self.rom_init)), reset_less=True)
+        rom_offset = Signal(range(len(rom_init)), reset_less=True)
         desc_size  = Signal(16, reset_less=True)
 
-        setup = Record([
-            ("bmRequestType", [("rcpt", 5), ("type", 2), ("dir", 1)]),
-            ("bRequest",       8),
-            ("wValue",        16),
-            ("wIndex",        16),
-            ("wLength",       16),
-        ])
+        setup = self.setup
 
         dev_addr_next = Signal.like(self.dev_addr)
+        # First byte of a GET_STATUS reply.
+        status = Signal(8)
+
+        m.d.comb += [
+            self.halt.ep.eq(setup.wIndex[:4]),
+            self.halt.dir.eq(setup.wIndex[7]),
+        ]
+
+        # Data stage of control reads. `xfer_offset` is the number of bytes acknowledged by the
+        # host, and `pkt_size` the size of the packet being sent.
+        max_size    = self.ep_in.max_size
+        xfer_size   = Signal(16)
+        xfer_offset = Signal(16)
+        pkt_size    = Signal(range(max_size + 1))
+        m.d.comb += [
+            xfer_size.eq(Mux(desc_size < setup.wLength, desc_size, setup.wLength)),
+            pkt_size.eq(Mux(xfer_size - xfer_offset < max_size, xfer_size - xfer_offset,
+                            max_size)),
+        ]
+
+        # Data stage of control writes. Packets are received in a buffer, so that they can be
+        # dropped if their CRC is invalid.
+        buf = Memory(width=8, depth=self.ep_out.max_size)
+        m.submodules.buf_wp = buf_wp = buf.write_port()
+        m.submodules.buf_rp = buf_rp = buf.read_port(domain="comb")
+        buf_level = Signal(range(self.ep_out.max_size + 1))
+        data_ctr  = Signal(16)
+
+        # Asserted when a data packet was sent, until the host acknowledges it.
+        tx_sent = Signal()
+
+        rx_ctr = Signal(range(8))
+
+        # Requests dispatched to a handler. `data_in` and `data_out` are connected to the handler
+        # selected by `handler_sel`.
+        handler_sel = Signal(range(max(1, len(self._handlers))))
+        data_in     = Record(_data_in_layout)
+        data_out    = Record(_data_out_layout)
+        data_end    = Signal()
+        done        = Signal()
+        stall       = Signal()
+
+        for i, (handler, _, _) in enumerate(self._handlers):
+            m.submodules["handler_{}".format(i)] = handler
+            m.d.comb += handler.setup.eq(setup)
+            with m.If(handler_sel == i):
+                m.d.comb += [
+                    handler.data_in.connect(data_in),
+                    handler.data_out.connect(data_out),
+                    done.eq(handler.done),
+                    stall.eq(handler.stall),
+                ]
+
+        def receive_setup():
+            m.d.sync += setup.eq(Cat(setup[8:], self.ep_out.data))
+            with m.If(rx_ctr == 7):
+                with m.If(self.ep_out.lst):
+                    with m.If(~self.ep_out.drop):
+                        m.next = "DECODE-REQUEST"
+                with m.Else():
+                    # Overflow. Flush remaining bytes.
+                    m.next = "FLUSH"
+                m.d.sync += rx_ctr.eq(0)
+            with m.Else():
+                m.d.sync += rx_ctr.eq(Mux(self.ep_out.lst, 0, rx_ctr + 1))
 
         with m.FSM() as fsm:
             with m.State("RECEIVE"):
-                rx_ctr = Signal(range(8))
                 m.d.comb += self.ep_out.rdy.eq(1)
                 with m.If(self.ep_out.stb):
-                    m.d.sync += setup.eq(Cat(setup[8:], self.ep_out.data))
-                    with m.If(rx_ctr == 7):
-                        with m.If(self.ep_out.lst):
-                            with m.If(~self.ep_out.drop):
-                                m.next = "DECODE-REQUEST"
-                        with m.Else():
-                            # Overflow. Flush remaining bytes.
-                            m.next = "FLUSH"
-                        m.d.sync += rx_ctr.eq(0)
-                    with m.Else():
-                        m.d.sync += rx_ctr.eq(Mux(self.ep_out.lst, 0, rx_ctr + 1))
+                    receive_setup()
 
             with m.State("DECODE-REQUEST"):
+                # The halt feature of EP0 isn't implemented. Its status is always 0.
+                ep0     = setup.wIndex[:4] == 0
+                halt_ok = (setup.wValue == Feature.ENDPOINT_HALT) & ~self.halt.err
                 with m.Switch(Cat(setup.bRequest, setup.bmRequestType)):
                     with m.Case(Request.GET_DESCRIPTOR):
                         m.next = "GET-DESCRIPTOR"
                     with m.Case(Request.GET_DEV_STATUS):
-                        m.next = "SEND-DEV-STATUS-0"
+                        m.d.sync += status.eq(0)
+                        m.next = "SEND-STATUS"
+                    with m.Case(Request.GET_EP_STATUS):
+                        with m.If(ep0 | ~self.halt.err):
+                            m.d.sync += status.eq(self.halt.status)
+                            m.next = "SEND-STATUS"
+                        with m.Else():
+                            m.next = "STALL"
+                    with m.Case(Request.CLEAR_EP_FEATURE):
+                        with m.If(ep0 & (setup.wValue == Feature.ENDPOINT_HALT)):
+                            m.next = "SEND-ZLP"
+                        with m.Elif(halt_ok):
+                            m.d.comb += self.halt.clr.eq(1)
+                            m.next = "SEND-ZLP"
+                        with m.Else():
+                            m.next = "STALL"
+                    with m.Case(Request.SET_EP_FEATURE):
+                        with m.If(halt_ok):
+                            m.d.comb += self.halt.set.eq(1)
+                            m.next = "SEND-ZLP"
+                        with m.Else():
+                            m.next = "STALL"
                     with m.Case(Request.SET_ADDRESS):
                         m.d.sync += dev_addr_next.eq(setup.wValue[:7])
                         m.next = "SEND-ZLP"
                     with m.Case(Request.SET_CONFIG):
                         m.next = "SEND-ZLP"
                     with m.Default():
-                        # Unsupported request. Ignore.
-                        m.next = "RECEIVE"
+                        m.d.sync += [
+                            buf_level.eq(0),
+                            data_ctr.eq(0),
+                            data_end.eq(0),
+                        ]
+                        m.next = "STALL"
+                        for i, (handler, request_type, request) in enumerate(self._handlers):
+                            matches = setup.bmRequestType.matches(request_type)
+                            if request is not None:
+                                matches &= setup.bRequest.matches(request)
+                            with (m.If if i == 0 else m.Elif)(matches):
+                                m.d.comb += handler.start.eq(1)
+                                m.d.sync += handler_sel.eq(i)
+                                with m.If(setup.bmRequestType.dir):
+                                    m.next = "HANDLER-IN-0"
+                                with m.Elif(setup.wLength != 0):
+                                    m.next = "RECEIVE-DATA-0"
+                                with m.Else():
+                                    m.next = "HANDLER-DONE"
 
-            with m.State("GET-DESCRIPTOR"):
-                with m.Switch(setup.wValue[8:]):
-                    for desc_type, index_map in self.descriptor_map.items():
-                        with m.Case(desc_type):
-                            with m.Switch(setup.wValue[:8]):
-                                for desc_index, (offset, size) in index_map.items():
-                                    with m.Case(desc_index):
-                                        m.d.sync += [
-                                            rom_offset.eq(offset),
-                                            desc_size.eq(size)
-                                        ]
-                                        m.next = "SEND-DESCRIPTOR-0"
-                                with m.Default():
-                                    m.next = "RECEIVE"
-                    with m.Default():
-                        m.next = "RECEIVE"
+            if self.lookup == "switch":
+                with m.State("GET-DESCRIPTOR"):
+                    m.d.sync += xfer_offset.eq(0)
+                    with m.Switch(setup.wValue[8:]):
+                        for desc_type, index_map in self.descriptor_map.items():
+                            with m.Case(desc_type):
+                                with m.Switch(setup.wValue[:8]):
+                                    for desc_index, (offset, size) in index_map.items():
+                                        with m.Case(desc_index):
+                                            m.d.sync += [
+                                                rom_offset.eq(offset),
+                                                desc_size.eq(size)
+                                            ]
+                                            m.next = "SEND-DESCRIPTOR-0"
+                                    with m.Default():
+                                        m.next = "STALL"
+                        with m.Default():
+                            m.next = "STALL"
+            else:
+                lo  = Signal(range(n_entries + 1))
+                hi  = Signal(range(n_entries + 1))
+                mid = Signal(range(n_entries + 1))
+                table_addr = Signal.like(rom_offset)
+                key_hi = Signal(8)
+
+                with m.State("GET-DESCRIPTOR"):
+                    m.d.sync += [
+                        xfer_offset.eq(0),
+                        lo.eq(0),
+                        hi.eq(n_entries),
+                    ]
+                    m.next = "LOOKUP-0"
+
+                with m.State("LOOKUP-0"):
+                    m.d.sync += [
+                        mid.eq((lo + hi) >> 1),
+                        table_addr.eq(table_base + ((lo + hi) >> 1) * 6),
+                    ]
+                    with m.If(lo >= hi):
+                        # Descriptor not found.
+                        m.next = "STALL"
+                    with m.Else():
+                        m.next = "LOOKUP-1"
+
+                # Table entries are read one byte per cycle, from `table_addr`.
+                with m.State("LOOKUP-1"):
+                    m.d.comb += [
+                        rom_rp.addr.eq(table_addr),
+                        rom_rp.en.eq(1),
+                    ]
+                    m.d.sync += table_addr.eq(table_addr + 1)
+                    m.next = "LOOKUP-2"
+
+                with m.State("LOOKUP-2"):
+                    m.d.comb += [
+                        rom_rp.addr.eq(table_addr),
+                        rom_rp.en.eq(1),
+                    ]
+                    m.d.sync += [
+                        table_addr.eq(table_addr + 1),
+                        key_hi.eq(rom_rp.data),
+                    ]
+                    m.next = "LOOKUP-3"
+
+                with m.State("LOOKUP-3"):
+                    key = Cat(rom_rp.data, key_hi)
+                    with m.If(key == setup.wValue):
+                        m.d.comb += [
+                            rom_rp.addr.eq(table_addr),
+                            rom_rp.en.eq(1),
+                        ]
+                        m.d.sync += table_addr.eq(table_addr + 1)
+                        m.next = "LOOKUP-4"
+                    with m.Elif(key < setup.wValue):
+                        m.d.sync += lo.eq(mid + 1)
+                        m.next = "LOOKUP-0"
+                    with m.Else():
+                        m.d.sync += hi.eq(mid)
+                        m.next = "LOOKUP-0"
+
+                for i, (field, next_state) in enumerate([
+                        (rom_offset[8:], "LOOKUP-5"),
+                        (rom_offset[:8], "LOOKUP-6"),
+                        (desc_size[8:],  "LOOKUP-7"),
+                        (desc_size[:8],  "SEND-DESCRIPTOR-0")]):
+                    with m.State("LOOKUP-{}".format(4 + i)):
+                        if next_state != "SEND-DESCRIPTOR-0":
+                            m.d.comb += [
+                                rom_rp.addr.eq(table_addr),
+                                rom_rp.en.eq(1),
+                            ]
+                            m.d.sync += table_addr.eq(table_addr + 1)
+                        m.d.sync += field.eq(rom_rp.data)
+                        m.next = next_state
 
             with m.State("SEND-DESCRIPTOR-0"):
                 m.d.comb += [
-                    rom_rp.addr.eq(rom_offset),
+                    rom_rp.addr.eq(rom_offset + xfer_offset),
                     rom_rp.en.eq(1),
                 ]
                 m.next = "SEND-DESCRIPTOR-1"
 
             with m.State("SEND-DESCRIPTOR-1"):
-                tx_ctr = Signal(16)
+                tx_ctr = Signal(range(max_size))
                 m.d.comb += [
                     self.ep_in.stb.eq(1),
-                    self.ep_in.data.eq(rom_rp.data)
+                    self.ep_in.data.eq(rom_rp.data),
                 ]
-                with m.If(desc_size < setup.wLength):
-                    m.d.comb += self.ep_in.lst.eq(tx_ctr == (desc_size - 1))
+                with m.If(pkt_size == 0):
+                    m.d.comb += [
+                        self.ep_in.zlp.eq(1),
+                        self.ep_in.lst.eq(1),
+                    ]
                 with m.Else():
-                    m.d.comb += self.ep_in.lst.eq(tx_ctr == (setup.wLength - 1))
-                m.d.comb += rom_rp.addr.eq(rom_offset + tx_ctr + 1)
+                    m.d.comb += self.ep_in.lst.eq(tx_ctr == pkt_size - 1)
+                m.d.comb += rom_rp.addr.eq(rom_offset + xfer_offset + tx_ctr + 1)
                 with m.If(self.ep_in.rdy):
-                    with m.If(self.ep_in.lst):
-                        m.d.sync += tx_ctr.eq(0)
-                        m.next = "SEND-DESCRIPTOR-2"
+                    with m.If(tx_sent & self.ep_in.ack):
+                        m.d.sync += [
+                            tx_sent.eq(0),
+                            xfer_offset.eq(xfer_offset + pkt_size),
+                        ]
+                        with m.If((pkt_size < max_size)
+                                | (xfer_offset + pkt_size == setup.wLength)):
+                            m.next = "RECEIVE"
+                        with m.Else():
+                            m.next = "SEND-DESCRIPTOR-0"
+                    with m.Elif(self.ep_in.lst):
+                        # Keep the packet until it is acknowledged. If its handshake is lost,
+                        # it is sent again on the next IN token.
+                        m.d.sync += [
+                            tx_ctr.eq(0),
+                            tx_sent.eq(1),
+                        ]
+                        m.d.comb += [
+                            rom_rp.addr.eq(rom_offset + xfer_offset),
+                            rom_rp.en.eq(1),
+                        ]
                     with m.Else():
                         m.d.sync += tx_ctr.eq(tx_ctr + 1)
                         m.d.comb += rom_rp.en.eq(1)
-
-            with m.State("SEND-DESCRIPTOR-2"):
-                with m.If(self.ep_in.rdy):
-                    with m.If(self.ep_in.ack):
+                with m.Elif(tx_ctr == 0):
+                    # The host may end the data stage early, and start the status stage (or
+                    # another control transfer) instead of sending an IN token.
+                    m.d.comb += self.ep_out.rdy.eq(1)
+                    with m.If(self.ep_out.stb):
+                        m.d.sync += tx_sent.eq(0)
                         m.next = "RECEIVE"
-                    with m.Else():
-                        m.next = "SEND-DESCRIPTOR-0"
+                        receive_setup()
 
-            with m.State("SEND-DEV-STATUS-0"):
+            with m.State("SEND-STATUS"):
                 tx_last = Signal()
                 m.d.comb += [
                     self.ep_in.stb.eq(1),
-                    self.ep_in.data.eq(0x00),
+                    self.ep_in.data.eq(Mux(tx_last, 0x00, status)),
                     self.ep_in.lst.eq(tx_last),
                 ]
                 with m.If(self.ep_in.rdy):
-                    with m.If(tx_last):
-                        m.d.sync += tx_last.eq(0)
-                        m.next = "SEND-DEV-STATUS-1"
+                    with m.If(tx_sent & self.ep_in.ack):
+                        m.d.sync += tx_sent.eq(0)
+                        m.next = "RECEIVE"
+                    with m.Elif(tx_last):
+                        m.d.sync += [
+                            tx_last.eq(0),
+                            tx_sent.eq(1),
+                        ]
                     with m.Else():
                         m.d.sync += tx_last.eq(1)
-
-            with m.State("SEND-DEV-STATUS-1"):
-                with m.If(self.ep_in.rdy):
-                    with m.If(self.ep_in.ack):
+                with m.Elif(~tx_last):
+                    m.d.comb += self.ep_out.rdy.eq(1)
+                    with m.If(self.ep_out.stb):
+                        m.d.sync += tx_sent.eq(0)
                         m.next = "RECEIVE"
-                    with m.Else():
-                        m.next = "SEND-DEV-STATUS-0"
+                        receive_setup()
 
             with m.State("SEND-ZLP"):
                 m.d.comb += [
@@ -157,6 +576,144 @@ class ConfigurationFSM(Elaboratable):
                     m.d.sync += self.dev_addr.eq(dev_addr_next)
                     m.next = "RECEIVE"
 
+            with m.State("RECEIVE-DATA-0"):
+                m.d.comb += self.ep_out.rdy.eq(1)
+                m.d.comb += [
+                    buf_wp.addr.eq(buf_level),
+                    buf_wp.data.eq(self.ep_out.data),
+                ]
+                with m.If(stall & (buf_level == 0)):
+                    m.next = "STALL"
+                with m.Elif(self.ep_out.stb):
+                    with m.If(self.ep_out.setup):
+                        # The host aborted this transfer, and started a new one.
+                        m.next = "RECEIVE"
+                        receive_setup()
+                    with m.Else():
+                        with m.If(~self.ep_out.zlp & (buf_level != self.ep_out.max_size)):
+                            m.d.comb += buf_wp.en.eq(1)
+                            m.d.sync += buf_level.eq(buf_level + 1)
+                        with m.If(self.ep_out.lst):
+                            with m.If(self.ep_out.drop):
+                                m.d.sync += buf_level.eq(0)
+                            with m.Elif(self.ep_out.zlp):
+                                # A zero-length packet ends the data stage early.
+                                m.d.sync += buf_level.eq(0)
+                                m.next = "HANDLER-DONE"
+                            with m.Else():
+                                m.next = "RECEIVE-DATA-1"
+
+            with m.State("RECEIVE-DATA-1"):
+                rd_ptr = Signal.like(buf_level)
+                # The data stage ends after `wLength` bytes, or after a short packet. See section
+                # 8.5.3.2 of the USB 2.0 specification.
+                short = Signal()
+                m.d.comb += short.eq(buf_level != self.ep_out.max_size)
+                m.d.comb += [
+                    buf_rp.addr.eq(rd_ptr),
+                    data_out.stb.eq(1),
+                    data_out.lst.eq((data_ctr == setup.wLength - 1)
+                                    | short & (rd_ptr == buf_level - 1)),
+                    data_out.data.eq(buf_rp.data),
+                ]
+                with m.If(stall):
+                    m.d.sync += rd_ptr.eq(0)
+                    m.next = "STALL"
+                with m.Elif(data_out.rdy):
+                    m.d.sync += [
+                        rd_ptr.eq(rd_ptr + 1),
+                        data_ctr.eq(data_ctr + 1),
+                    ]
+                    with m.If(data_out.lst):
+                        m.d.sync += rd_ptr.eq(0)
+                        m.next = "HANDLER-DONE"
+                    with m.Elif(rd_ptr == buf_level - 1):
+                        m.d.sync += [
+                            rd_ptr.eq(0),
+                            buf_level.eq(0),
+                        ]
+                        m.next = "RECEIVE-DATA-0"
+
+            with m.State("HANDLER-DONE"):
+                with m.If(stall):
+                    m.next = "STALL"
+                with m.Elif(done):
+                    m.next = "SEND-ZLP"
+
+            with m.State("HANDLER-IN-0"):
+                # Receive a packet from the handler. The transfer ends after `wLength` bytes.
+                m.d.comb += [
+                    buf_wp.addr.eq(buf_level),
+                    buf_wp.data.eq(data_in.data),
+                ]
+                with m.If(stall):
+                    m.next = "STALL"
+                with m.Elif(data_end | (data_ctr == setup.wLength)
+                            | (buf_level == self.ep_in.max_size)):
+                    m.next = "HANDLER-IN-1"
+                with m.Else():
+                    m.d.comb += data_in.rdy.eq(1)
+                    with m.If(data_in.stb):
+                        m.d.comb += buf_wp.en.eq(1)
+                        m.d.sync += [
+                            buf_level.eq(buf_level + 1),
+                            data_ctr.eq(data_ctr + 1),
+                            data_end.eq(data_in.lst),
+                        ]
+
+            with m.State("HANDLER-IN-1"):
+                tx_ptr = Signal.like(buf_level)
+                m.d.comb += [
+                    buf_rp.addr.eq(tx_ptr),
+                    self.ep_in.stb.eq(1),
+                    self.ep_in.data.eq(buf_rp.data),
+                ]
+                with m.If(buf_level == 0):
+                    m.d.comb += [
+                        self.ep_in.zlp.eq(1),
+                        self.ep_in.lst.eq(1),
+                    ]
+                with m.Else():
+                    m.d.comb += self.ep_in.lst.eq(tx_ptr == buf_level - 1)
+                with m.If(self.ep_in.rdy):
+                    with m.If(tx_sent & self.ep_in.ack):
+                        m.d.sync += [
+                            tx_sent.eq(0),
+                            buf_level.eq(0),
+                        ]
+                        with m.If((buf_level < self.ep_in.max_size)
+                                | (data_ctr == setup.wLength)):
+                            m.next = "RECEIVE"
+                        with m.Else():
+                            m.next = "HANDLER-IN-0"
+                    with m.Elif(self.ep_in.lst):
+                        # Keep the packet until it is acknowledged.
+                        m.d.sync += [
+                            tx_ptr.eq(0),
+                            tx_sent.eq(1),
+                        ]
+                    with m.Else():
+                        m.d.sync += tx_ptr.eq(tx_ptr + 1)
+                with m.Elif(tx_ptr == 0):
+                    # The host may end the data stage early.
+                    m.d.comb += self.ep_out.rdy.eq(1)
+                    with m.If(self.ep_out.stb):
+                        m.d.sync += tx_sent.eq(0)
+                        m.next = "RECEIVE"
+                        receive_setup()
+
+            with m.State("STALL"):
+                # Answer IN, OUT and PING tokens with STALL handshakes until the host sends
+                # a SETUP packet. See section 8.5.3.4 of the USB 2.0 specification.
+                m.d.comb += [
+                    self.ep_in.stall.eq(1),
+                    self.ep_out.stall.eq(1),
+                    self.ep_out.rdy.eq(1),
+                ]
+                with m.If(self.ep_out.stb):
+                    m.next = "RECEIVE"
+                    receive_setup()
+
             with m.State("FLUSH"):
                 m.d.comb += self.ep_out.rdy.eq(1)
                 with m.If(self.ep_out.stb & self.ep_out.lst):
@@ -4,39 +4,146 @@ from nmigen import *
 __all__ = ["CRC"]
 
 
+def _crc_matrix(poly, size, n_bits):
+    """Compute the next-state equations of a CRC after `n_bits` data bits.
+
+    Returns a list of `size` bitmasks. Bit `i` of the bitmask of `next[j]` is set if `next[j]`
+    depends on bit `i` of the concatenation of the current state and the data word.
+    """
+    state = [1 << j for j in range(size)]
+    for i in range(n_bits):
+        inv = (1 << size + i) ^ state[size - 1]
+        tmp = [inv]
+        for j in range(size - 1):
+            if (poly >> (j + 1)) & 1:
+                tmp.append(state[j] ^ inv)
+            else:
+                tmp.append(state[j])
+        state = tmp
+    return state
+
+
 class CRC(Elaboratable):
-    def __init__(self, poly, size, dw, init=0xffff):
+    """Parallel CRC generator.
+
+    The next state of the CRC register is computed from the current state and a `dw`-bit data
+    word in a single step. Its XOR equations are derived ahead of time, by running a serial
+    LFSR symbolically.
+
+    Parameters
+    ----------
+    poly : int
+        Generator polynomial.
+    size : int
+        CRC width, in bits.
+    dw : int
+        Data width, in bits.
+    init : int
+        Initial value of the CRC register.
+    byte_enable : bool
+        Use byte enables. Optional. If true, only the bytes of `val` whose bit in `be` is asserted
+        are used. Valid bytes must be contiguous, starting from the least significant byte.
+    pipeline : bool
+        Pipeline the data path. Optional. If true, the contribution of the data word is computed
+        and registered one cycle ahead, which removes it from the critical path. `res` is then
+        delayed by one cycle, and so is the effect of `clr`.
+
+    Attributes
+    ----------
+    clr : Signal, in
+        Clear. Resets the CRC register to `init`. Has priority over `en`.
+    en : Signal, in
+        Enable. Updates the CRC register with `val`.
+    val : Signal(dw), in
+        Data word.
+    be : Signal(dw // 8), in
+        Byte enable. Only present if `byte_enable` is true.
+    res : Signal(size), out
+        CRC of the data received so far, including `val`.
+    """
+    def __init__(self, poly, size, dw, init=0xffff, byte_enable=False, pipeline=False):
+        if byte_enable and dw % 8 != 0:
+            raise ValueError("Data width must be a multiple of 8 to use byte enables, not {!r}"
+                             .format(dw))
+
         self.dw   = dw
         self.size = size
         self.init = init
         self.poly = poly
+        self.byte_enable = byte_enable
+        self.pipeline    = pipeline
 
         self.clr  = Signal()
         self.en   = Signal()
         self.val  = Signal(dw)
+        self.be   = Signal(dw // 8 if byte_enable else 0)
         self.res  = Signal(size)
 
     def elaborate(self, platform):
         m = Module()
 
-        crcreg = [Signal(self.size, reset=self.init) for i in range(self.dw+1)]
-
-        for i in range(self.dw):
-            inv = self.val[i] ^ crcreg[i][self.size-1]
-            tmp = []
-            tmp.append(inv)
-            for j in range(self.size -1):
-                if((self.poly >> (j + 1)) & 1):
-                    tmp.append(crcreg[i][j] ^ inv)
-                else:
-                    tmp.append(crcreg[i][j])
-            m.d.comb += crcreg[i+1].eq(Cat(*tmp))
-
-        with m.If(self.clr):
-            m.d.sync += crcreg[0].eq(self.init)
-        with m.Elif(self.en):
-            m.d.sync += crcreg[0].eq(crcreg[self.dw])
-
-        m.d.comb += self.res.eq(crcreg[self.dw][::-1] ^ self.init)
+        if self.byte_enable:
+            n_bits = [8 * (i + 1) for i in range(self.dw // 8)]
+        else:
+            n_bits = [self.dw]
+
+        # Each entry of `terms` computes the contribution of `val` to the next state, after
+        # `n_bits[i]` bits.
+        state_masks = []
+        terms = []
+        for k, n in enumerate(n_bits):
+            matrix = _crc_matrix(self.poly, self.size, n)
+            state_masks.append([mask & ((1 << self.size) - 1) for mask in matrix])
+            data_masks = [mask >> self.size for mask in matrix]
+            term = Signal(self.size, name="data_term_{}".format(k))
+            m.d.comb += term.eq(Cat(
+                Cat(self.val[i] for i in range(n) if mask >> i & 1).xor() if mask else C(0, 1)
+                for mask in data_masks
+            ))
+            terms.append(term)
+
+        # Select the number of valid bits.
+        sel = Signal(range(len(n_bits)))
+        if self.byte_enable:
+            for i in range(1, len(n_bits)):
+                with m.If(self.be[i]):
+                    m.d.comb += sel.eq(i)
+
+        data_term = Signal(self.size)
+        m.d.comb += data_term.eq(Array(terms)[sel])
+
+        if self.pipeline:
+            clr_r = Signal()
+            en_r  = Signal()
+            sel_r = Signal.like(sel)
+            data_term_r = Signal.like(data_term)
+            m.d.sync += [
+                clr_r.eq(self.clr),
+                en_r.eq(self.en),
+                sel_r.eq(sel),
+                data_term_r.eq(data_term),
+            ]
+            clr, en, sel, data_term = clr_r, en_r, sel_r, data_term_r
+        else:
+            clr, en = self.clr, self.en
+
+        crcreg = Signal(self.size, reset=self.init)
+
+        crc_next = Signal(self.size)
+        with m.Switch(sel):
+            for k, masks in enumerate(state_masks):
+                with m.Case(k):
+                    m.d.comb += crc_next.eq(data_term ^ Cat(
+                        Cat(crcreg[j] for j in range(self.size) if mask >> j & 1).xor()
+                        if mask else C(0, 1)
+                        for mask in masks
+                    ))
+
+        with m.If(clr):
+            m.d.sync += crcreg.eq(self.init)
+        with m.Elif(en):
+            m.d.sync += crcreg.eq(crc_next)
+
+        m.d.comb += self.res.eq(crc_next[::-1] ^ self.init)
 
         return m
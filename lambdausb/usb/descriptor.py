@@ -0,0 +1,445 @@
+import enum
+import hashlib
+import struct
+
+from .device import Device
+from .endpoint import *
+from .endpoint import (_check_max_size, _check_transactions, _check_interval,
+                       _default_interval)
+
+
+__all__ = [
+    "DescriptorType", "DeviceDescriptor", "ConfigurationDescriptor", "InterfaceDescriptor",
+    "EndpointDescriptor", "build_descriptors",
+]
+
+
+class DescriptorType(enum.IntEnum):
+    """Descriptor type.
+
+    See USB 2.0 specification section 9.4 for details.
+    """
+    DEVICE           = 0x01
+    CONFIGURATION    = 0x02
+    STRING           = 0x03
+    INTERFACE        = 0x04
+    ENDPOINT         = 0x05
+    DEVICE_QUALIFIER = 0x06
+
+
+# Encoding of transfer types in the bmAttributes field of endpoint descriptors.
+_xfer_attributes = {
+    Transfer.CONTROL:     0b00,
+    Transfer.ISOCHRONOUS: 0b01,
+    Transfer.BULK:        0b10,
+    Transfer.INTERRUPT:   0b11,
+}
+
+
+def _check_byte(name, value):
+    if not isinstance(value, int) or value not in range(256):
+        raise ValueError("{} must be an integer between 0 and 255, not {!r}".format(name, value))
+
+
+def _check_word(name, value):
+    if not isinstance(value, int) or value not in range(65536):
+        raise ValueError("{} must be an integer between 0 and 65535, not {!r}"
+                         .format(name, value))
+
+
+def _check_string(name, value):
+    if value is None:
+        return
+    if not isinstance(value, str):
+        raise TypeError("{} must be a string, not {!r}".format(name, value))
+    if len(value.encode("utf-16-le")) > 253:
+        raise ValueError("{} must be at most 126 characters long, not {}"
+                         .format(name, len(value)))
+
+
+class EndpointDescriptor:
+    """Endpoint descriptor.
+
+    Parameters
+    ----------
+    addr : int
+        Endpoint number, between 1 and 15.
+    direction : str
+        Endpoint direction, from the host point of view. Either ``"in"`` or ``"out"``.
+    xfer : :class:`endpoint.Transfer`
+        Transfer type.
+    max_size : int
+        Maximum packet size. It is checked against the same limits as the `max_size` of an
+        :class:`endpoint.InputEndpoint` or :class:`endpoint.OutputEndpoint`.
+    transactions : int
+        Number of transactions per microframe, for high-bandwidth isochronous and interrupt
+        endpoints.
+    interval : int
+        Polling interval. For isochronous and interrupt endpoints, the endpoint is polled every
+        ``2 ** (interval - 1)`` microframes, and `interval` must be between 1 and 16. For bulk and
+        control endpoints, it is the maximum NAK rate of the endpoint. Optional. Defaults to 1 for
+        isochronous and interrupt endpoints, and 0 otherwise.
+    """
+    def __init__(self, *, addr, direction, xfer, max_size, transactions=1, interval=None):
+        if not isinstance(addr, int) or addr not in range(1, 16):
+            raise ValueError("Endpoint address must be an integer between 1 and 15, not {!r}"
+                             .format(addr))
+        if direction not in ("in", "out"):
+            raise ValueError("Direction must be 'in' or 'out', not {!r}".format(direction))
+        if not isinstance(xfer, Transfer):
+            raise TypeError("Transfer type must be an instance of Transfer, not {!r}"
+                            .format(xfer))
+        _check_max_size(xfer, max_size)
+        _check_transactions(xfer, transactions)
+
+        if interval is None:
+            interval = _default_interval(xfer)
+        _check_interval(xfer, interval)
+
+        self.addr         = addr
+        self.direction    = direction
+        self.xfer         = xfer
+        self.max_size     = max_size
+        self.transactions = transactions
+        self.interval     = interval
+
+    @classmethod
+    def from_endpoint(cls, ep, *, addr):
+        """Build the descriptor of an :class:`endpoint.InputEndpoint` or
+        :class:`endpoint.OutputEndpoint` with address `addr`."""
+        if isinstance(ep, InputEndpoint):
+            direction = "in"
+        elif isinstance(ep, OutputEndpoint):
+            direction = "out"
+        else:
+            raise TypeError("Endpoint must be an InputEndpoint or an OutputEndpoint, not {!r}"
+                            .format(ep))
+        return cls(addr=addr, direction=direction, xfer=ep.xfer, max_size=ep.max_size,
+                   transactions=ep.transactions, interval=ep.interval)
+
+    def to_bytes(self):
+        return bytes([
+            7, DescriptorType.ENDPOINT,
+            self.addr | (0x80 if self.direction == "in" else 0x00),
+            _xfer_attributes[self.xfer],
+            *struct.pack("<H", self.max_size | (self.transactions - 1) << 11),
+            self.interval,
+        ])
+
+
+class InterfaceDescriptor:
+    """Interface descriptor.
+
+    Parameters
+    ----------
+    endpoints : list of :class:`EndpointDescriptor`
+        Endpoints of the interface, excluding endpoint 0.
+    number : int
+        Interface number. Optional. Interfaces are numbered in the order of the configuration,
+        and alternate settings must be given the number of their interface.
+    alternate : int
+        Alternate setting.
+    cls : int
+        Interface class. Defaults to 0xff (vendor-specific).
+    subclass : int
+        Interface subclass.
+    protocol : int
+        Interface protocol.
+    string : str
+        Interface string. Optional.
+    extra : bytes
+        Class-specific descriptors, inserted after the interface descriptor.
+    """
+    def __init__(self, *, endpoints=(), number=None, alternate=0, cls=0xff, subclass=0,
+                 protocol=0, string=None, extra=b""):
+        for endpoint in endpoints:
+            if not isinstance(endpoint, EndpointDescriptor):
+                raise TypeError("Endpoint must be an EndpointDescriptor, not {!r}"
+                                .format(endpoint))
+        if number is not None:
+            _check_byte("Interface number", number)
+        _check_byte("Alternate setting", alternate)
+        _check_byte("Interface class", cls)
+        _check_byte("Interface subclass", subclass)
+        _check_byte("Interface protocol", protocol)
+        _check_string("Interface string", string)
+
+        self.endpoints = list(endpoints)
+        self.number    = number
+        self.alternate = alternate
+        self.cls       = cls
+        self.subclass  = subclass
+        self.protocol  = protocol
+        self.string    = string
+        self.extra     = bytes(extra)
+
+
+class ConfigurationDescriptor:
+    """Configuration descriptor.
+
+    Parameters
+    ----------
+    interfaces : list of :class:`InterfaceDescriptor`
+        Interfaces of the configuration.
+    max_power : int
+        Maximum power consumption from the bus, in mA. Must be at most 500.
+    self_powered : bool
+        The device has a local power source.
+    remote_wakeup : bool
+        The device supports remote wakeup.
+    string : str
+        Configuration string. Optional.
+    """
+    def __init__(self, *, interfaces, max_power=100, self_powered=False, remote_wakeup=False,
+                 string=None):
+        for interface in interfaces:
+            if not isinstance(interface, InterfaceDescriptor):
+                raise TypeError("Interface must be an InterfaceDescriptor, not {!r}"
+                                .format(interface))
+        if not isinstance(max_power, int) or max_power not in range(501):
+            raise ValueError("Maximum power must be an integer between 0 and 500, not {!r}"
+                             .format(max_power))
+        _check_string("Configuration string", string)
+
+        self.interfaces    = list(interfaces)
+        self.max_power     = max_power
+        self.self_powered  = bool(self_powered)
+        self.remote_wakeup = bool(remote_wakeup)
+        self.string        = string
+
+
+class DeviceDescriptor:
+    """Device descriptor.
+
+    Parameters
+    ----------
+    vendor_id : int
+        Vendor ID.
+    product_id : int
+        Product ID.
+    configurations : list of :class:`ConfigurationDescriptor`
+        Configurations of the device.
+    bcd_device : int
+        Device release number, in binary-coded decimal.
+    bcd_usb : int
+        USB specification release number, in binary-coded decimal. If it is 0x0200 or greater,
+        a device qualifier descriptor is also built.
+    cls : int
+        Device class. Defaults to 0 (defined at the interface level).
+    subclass : int
+        Device subclass.
+    protocol : int
+        Device protocol.
+    max_size0 : int
+        Maximum packet size of endpoint 0. Must be 8, 16, 32 or 64.
+    manufacturer : str
+        Manufacturer string. Optional.
+    product : str
+        Product string. Optional.
+    serial_number : str
+        Serial number string. Optional.
+    """
+    def __init__(self, *, vendor_id, product_id, configurations, bcd_device=0x0100,
+                 bcd_usb=0x0200, cls=0, subclass=0, protocol=0, max_size0=64,
+                 manufacturer=None, product=None, serial_number=None):
+        _check_word("Vendor ID", vendor_id)
+        _check_word("Product ID", product_id)
+        if not configurations:
+            raise ValueError("Device must have at least one configuration")
+        for configuration in configurations:
+            if not isinstance(configuration, ConfigurationDescriptor):
+                raise TypeError("Configuration must be a ConfigurationDescriptor, not {!r}"
+                                .format(configuration))
+        _check_word("Device release number", bcd_device)
+        _check_word("USB release number", bcd_usb)
+        _check_byte("Device class", cls)
+        _check_byte("Device subclass", subclass)
+        _check_byte("Device protocol", protocol)
+        if max_size0 not in {8, 16, 32, 64}:
+            raise ValueError("Maximum packet size of endpoint 0 must be 8, 16, 32 or 64, not {!r}"
+                             .format(max_size0))
+        _check_string("Manufacturer string", manufacturer)
+        _check_string("Product string", product)
+        _check_string("Serial number string", serial_number)
+
+        self.vendor_id      = vendor_id
+        self.product_id     = product_id
+        self.configurations = list(configurations)
+        self.bcd_device     = bcd_device
+        self.bcd_usb        = bcd_usb
+        self.cls            = cls
+        self.subclass       = subclass
+        self.protocol       = protocol
+        self.max_size0      = max_size0
+        self.manufacturer   = manufacturer
+        self.product        = product
+        self.serial_number  = serial_number
+
+    @classmethod
+    def from_device(cls, device, *, configuration=None, interface=None, **kwargs):
+        """Derive a device descriptor from the endpoints added to a :class:`device.Device`.
+
+        The device has a single configuration, with a single interface holding the descriptors
+        of all its endpoints except endpoint 0. These are built with
+        :meth:`EndpointDescriptor.from_endpoint`, and follow any later change to the endpoints of
+        the device if this method is called again.
+
+        Parameters
+        ----------
+        device : :class:`device.Device`
+            USB device.
+        configuration : dict
+            Keyword arguments of the :class:`ConfigurationDescriptor`. Optional.
+        interface : dict
+            Keyword arguments of the :class:`InterfaceDescriptor`. Optional.
+        **kwargs
+            Keyword arguments of the :class:`DeviceDescriptor`. If `max_size0` is not given, the
+            maximum packet size of the input endpoint 0 of the device is used.
+        """
+        if not isinstance(device, Device):
+            raise TypeError("Device must be an instance of Device, not {!r}".format(device))
+        endpoints = []
+        for addr, ep in device.endpoints():
+            if addr == 0:
+                if isinstance(ep, InputEndpoint):
+                    kwargs.setdefault("max_size0", ep.max_size)
+            else:
+                endpoints.append(EndpointDescriptor.from_endpoint(ep, addr=addr))
+        interface = InterfaceDescriptor(endpoints=endpoints, **(interface or {}))
+        configuration = ConfigurationDescriptor(interfaces=[interface], **(configuration or {}))
+        return cls(configurations=[configuration], **kwargs)
+
+
+def _serialize(device, lang_id):
+    # Returns a list of (type, index, bytes) tuples, one per descriptor.
+    strings = {}
+
+    def string_index(string):
+        # Identical strings share the same descriptor.
+        if string is None:
+            return 0
+        if string not in strings:
+            if len(strings) == 255:
+                raise ValueError("Device must have at most 255 distinct strings")
+            strings[string] = len(strings) + 1
+        return strings[string]
+
+    descriptors = []
+
+    device_strings = (string_index(device.manufacturer), string_index(device.product),
+                      string_index(device.serial_number))
+    descriptors.append((DescriptorType.DEVICE, 0, bytes([
+        18, DescriptorType.DEVICE,
+        *struct.pack("<H", device.bcd_usb),
+        device.cls, device.subclass, device.protocol, device.max_size0,
+        *struct.pack("<HHH", device.vendor_id, device.product_id, device.bcd_device),
+        *device_strings,
+        len(device.configurations),
+    ])))
+
+    for config_index, configuration in enumerate(device.configurations):
+        body = bytearray()
+        numbers = set()
+        next_number = 0
+        for interface in configuration.interfaces:
+            number = interface.number
+            if number is None:
+                number = next_number
+            next_number = number + 1
+            numbers.add(number)
+            body += bytes([
+                9, DescriptorType.INTERFACE,
+                number, interface.alternate, len(interface.endpoints),
+                interface.cls, interface.subclass, interface.protocol,
+                string_index(interface.string),
+            ])
+            body += interface.extra
+            seen = set()
+            for endpoint in interface.endpoints:
+                key = endpoint.addr, endpoint.direction
+                if key in seen:
+                    raise ValueError("Endpoint {} {} is used twice in interface {}"
+                                     .format(endpoint.direction.upper(), endpoint.addr, number))
+                seen.add(key)
+                body += endpoint.to_bytes()
+        total_length = 9 + len(body)
+        if total_length > 65535:
+            raise ValueError("Configuration {} is {} bytes long; must be at most 65535 bytes"
+                             .format(config_index, total_length))
+        attributes = 0x80 | configuration.self_powered << 6 | configuration.remote_wakeup << 5
+        descriptors.append((DescriptorType.CONFIGURATION, config_index, bytes([
+            9, DescriptorType.CONFIGURATION,
+            *struct.pack("<H", total_length),
+            len(numbers), config_index + 1, string_index(configuration.string),
+            attributes, configuration.max_power // 2,
+        ]) + body))
+
+    if strings:
+        descriptors.append((DescriptorType.STRING, 0, bytes([4, DescriptorType.STRING,
+                                                             *struct.pack("<H", lang_id)])))
+        for string, index in strings.items():
+            encoded = string.encode("utf-16-le")
+            descriptors.append((DescriptorType.STRING, index,
+                                bytes([2 + len(encoded), DescriptorType.STRING]) + encoded))
+
+    if device.bcd_usb >= 0x0200:
+        descriptors.append((DescriptorType.DEVICE_QUALIFIER, 0, bytes([
+            10, DescriptorType.DEVICE_QUALIFIER,
+            *struct.pack("<H", device.bcd_usb),
+            device.cls, device.subclass, device.protocol, device.max_size0,
+            len(device.configurations), 0,
+        ])))
+
+    return descriptors
+
+
+def _pack(descriptors):
+    # Descriptors are packed without padding. A descriptor whose bytes are already present in
+    # the ROM reuses them, and a descriptor may overlap with the end of the previous one.
+    rom = bytearray()
+    descriptor_map = {}
+    for desc_type, desc_index, data in descriptors:
+        offset = rom.find(data)
+        if offset < 0:
+            overlap = min(len(rom), len(data) - 1, 255)
+            while overlap > 0 and not rom.endswith(data[:overlap]):
+                overlap -= 1
+            offset = len(rom) - overlap
+            rom += data[overlap:]
+        descriptor_map.setdefault(int(desc_type), {})[desc_index] = offset, len(data)
+    return descriptor_map, list(rom)
+
+
+_cache = {}
+
+
+def build_descriptors(device, *, lang_id=0x0409):
+    """Build the descriptor ROM of a device.
+
+    Parameters
+    ----------
+    device : :class:`DeviceDescriptor`
+        Device descriptor.
+    lang_id : int
+        Language ID of string descriptors. Defaults to 0x0409 (English, United States).
+
+    Returns
+    -------
+    A tuple `(descriptor_map, rom_init)`, to be given to a :class:`config.ConfigurationFSM`.
+    Results are cached, keyed on a hash of the descriptors.
+    """
+    if not isinstance(device, DeviceDescriptor):
+        raise TypeError("Device must be a DeviceDescriptor, not {!r}".format(device))
+    _check_word("Language ID", lang_id)
+
+    descriptors = _serialize(device, lang_id)
+    key = hashlib.sha256()
+    for desc_type, desc_index, data in descriptors:
+        key.update(bytes([desc_type, desc_index, len(data) >> 8, len(data) & 0xff]))
+        key.update(data)
+    key = key.digest()
+    if key not in _cache:
+        _cache[key] = _pack(descriptors)
+    descriptor_map, rom_init = _cache[key]
+    return ({desc_type: dict(index_map) for desc_type, index_map in descriptor_map.items()},
+            list(rom_init))
@@ -4,7 +4,9 @@ from nmigen.hdl.rec import *
 from .crc import CRC
 from .defs import *
 from .endpoint import *
+from .endpoint import _check_data_width
 from .mux import *
+from .stats import *
 
 
 __all__ = ["Device"]
@@ -21,41 +23,162 @@ class Device(Elaboratable):
         Receive strobe. Asserted by the underlying PHY when it has data to send.
     rx.lst : Signal, in
         Receive last. Asserted when `rx.data` holds the last byte of a packet.
-    rx.data : Signal, in
-        Receive data.
+    rx.data : Signal(data_width), in
+        Receive data. If `data_width` is greater than 8, the PID of a packet is always received
+        alone, in the least significant byte of its own word.
+    rx.be : Signal(data_width // 8), in
+        Receive byte enable. Only present if `data_width` is greater than 8.
+    rx.err : Signal, in
+        Receive error. Asserted with `rx.lst` if the PHY aborted the packet. The packet is then
+        dropped.
     rx.rdy : Signal, out
         Receive ready. Asserted when the device is able to receive data.
     tx.stb : Signal, out
         Transmit strobe. Asserted by the device when it has data to send.
     tx.lst : Signal, out
         Transmit last. Asserted when `tx.data` holds the last byte of a packet.
-    tx.data : Signal, out
-        Transmit data.
+    tx.data : Signal(data_width), out
+        Transmit data. If `data_width` is greater than 8, the PID of a packet is always sent
+        alone, in the least significant byte of its own word.
+    tx.be : Signal(data_width // 8), out
+        Transmit byte enable. Only present if `data_width` is greater than 8.
     tx.rdy : Signal, in
         Transmit ready. Asserted when the underlying PHY is able to receive data.
     addr : Signal, in
         Device address. Provided by the logic controlling endpoint 0.
+    hs : Signal, in
+        High-Speed mode. Asserted when the device operates in High-Speed mode. If asserted, the
+        device replies with NYET to bulk and control OUT transactions after which the endpoint
+        cannot accept another packet. Defaults to 1.
+    halt.ep : Signal(4), in
+        Halt endpoint address. Provided by the logic controlling endpoint 0, which implements the
+        ENDPOINT_HALT feature. Bulk and interrupt endpoints can be halted. The device replies with
+        STALL to the tokens of a halted endpoint.
+    halt.dir : Signal, in
+        Halt endpoint direction. Asserted for an input endpoint.
+    halt.set : Signal, in
+        Halt set. Halts the selected endpoint.
+    halt.clr : Signal, in
+        Halt clear. Clears the halt state of the selected endpoint, and resets its data toggle
+        to DATA0, even if it wasn't halted.
+    halt.status : Signal, out
+        Halt status. Asserted if the selected endpoint is halted.
+    halt.err : Signal, out
+        Halt error. Asserted if the selected endpoint doesn't exist or cannot be halted.
+    sof : Signal, out
+        Start of (micro)frame. Asserted when the device received a SOF packet, or when a SOF
+        packet was missed.
+    sof_missed : Signal, out
+        Missed SOF. Asserted with `sof` when a SOF packet was expected but not received (e.g.
+        because of a bad CRC). Once the device has received two consecutive SOF packets, it
+        measures their interval, and extrapolates up to 3 consecutive missing (micro)frames.
+    frame : Signal(11), out
+        Frame number of the current (micro)frame. Valid when `sof` is asserted, and until the
+        next SOF.
+    microframe : Signal(3), out
+        Microframe index in the current frame. The host sends 8 SOF packets with the same frame
+        number in High-Speed mode. Only valid once the device has seen the frame number change.
+        Always 0 in Full-Speed mode.
+    timestamp : Signal(32), out
+        Free-running timestamp, in clock cycles.
+    sof_timestamp : Signal(32), out
+        Value of `timestamp` when the last SOF packet was received. The interval between two
+        SOF packets measures the clock of the device against the clock of the host.
+
+    Parameters
+    ----------
+    data_width : int
+        Data width, in bits. Optional. Defaults to 8. Must be 8, 16 or 32. Endpoints added to the
+        device must have the same data width.
+    shared_packets : int
+        Number of packets in the shared region of the packet pools. Optional. Endpoints added
+        with `shared=True` draw from this region once their reserved packets are in use.
+    stats : bool
+        Performance counters. Optional. If true, a :class:`stats.DeviceStats` instance is
+        provided as `self.stats`, and counts the events of each endpoint.
+    handshake_timeout : int
+        Handshake timeout, in clock cycles. Optional. After sending a data packet, the device
+        waits this long for a handshake from the host, then gives up. The payload is then sent
+        again on the next IN token. Defaults to 816 bit times (the High-Speed device timeout,
+        see section 7.1.19.2 of the USB 2.0 specification), assuming that the data path runs
+        at the bus rate, plus `phy_latency`.
+    phy_latency : int
+        Round-trip latency of the PHY, in clock cycles. Optional. The handshake timer starts when
+        the last word of a data packet is accepted on `tx`. The packet then has to leave the
+        transmit pipeline of the PHY, and the handshake of the host has to cross its receive
+        pipeline. Only used to compute the default `handshake_timeout`. Defaults to the latency
+        of an :class:`io.ulpi.PHY` with the default FIFO depths.
+    prefetch : bool
+        Reply to IN tokens without a decode cycle. Optional. Endpoint buffers always hold the
+        first word of their next packet in the output register of their memory. If true, the
+        endpoint is also selected while the last byte of an IN token is being received, and the
+        data packet starts in the next cycle. This saves one cycle of turnaround latency, at the
+        cost of a longer combinational path from the token decoder to the endpoint buffers.
     """
-    def __init__(self):
+    def __init__(self, *, data_width=8, shared_packets=0, stats=False, handshake_timeout=None,
+                 phy_latency=None, prefetch=False):
+        _check_data_width(data_width)
+        if phy_latency is None:
+            # The transmit FIFO of the ULPI PHY (32 words) may still be full when the last word
+            # is accepted. Both directions also go through the ULPI transceiver and the PHY chip
+            # (about 25 ULPI clock cycles, or 200 bit times), and the receive FIFO crosses to the
+            # `sync` domain in about 4 cycles.
+            phy_latency = 32 + 200 // data_width + 4
+        if not isinstance(phy_latency, int) or phy_latency < 0:
+            raise ValueError("PHY latency must be a non-negative integer, not {!r}"
+                             .format(phy_latency))
+        if handshake_timeout is None:
+            handshake_timeout = 816 // data_width + phy_latency
+        if not isinstance(handshake_timeout, int) or handshake_timeout <= 0:
+            raise ValueError("Handshake timeout must be a positive integer, not {!r}"
+                             .format(handshake_timeout))
+
+        be_width = data_width // 8 if data_width > 8 else 0
         self.rx = Record([
             ("stb",  1, DIR_FANIN),
             ("lst",  1, DIR_FANIN),
-            ("data", 8, DIR_FANIN),
+            ("data", data_width, DIR_FANIN),
+            ("be",   be_width, DIR_FANIN),
+            ("err",  1, DIR_FANIN),
             ("rdy",  1, DIR_FANOUT),
         ])
         self.tx = Record([
             ("stb",  1, DIR_FANOUT),
             ("lst",  1, DIR_FANOUT),
-            ("data", 8, DIR_FANOUT),
+            ("data", data_width, DIR_FANOUT),
+            ("be",   be_width, DIR_FANOUT),
             ("rdy",  1, DIR_FANIN),
         ])
 
         self.addr = Signal(7)
+        self.hs   = Signal(reset=1)
+
+        self.sof           = Signal()
+        self.sof_missed    = Signal()
+        self.frame         = Signal(11)
+        self.microframe    = Signal(3)
+        self.timestamp     = Signal(32)
+        self.sof_timestamp = Signal(32)
+        self.halt = Record([
+            ("ep",     4, DIR_FANIN),
+            ("dir",    1, DIR_FANIN),
+            ("set",    1, DIR_FANIN),
+            ("clr",    1, DIR_FANIN),
+            ("status", 1, DIR_FANOUT),
+            ("err",    1, DIR_FANOUT),
+        ])
+
+        self.data_width        = data_width
+        self.handshake_timeout = handshake_timeout
+        self.phy_latency       = phy_latency
+        self.prefetch          = prefetch
 
-        self._mux_in  = InputMultiplexer()
-        self._mux_out = OutputMultiplexer()
+        self._mux_in  = InputMultiplexer (data_width=data_width, shared_packets=shared_packets)
+        self._mux_out = OutputMultiplexer(data_width=data_width, shared_packets=shared_packets)
 
-    def add_endpoint(self, ep, *, addr, buffered=False):
+        self.stats = DeviceStats(data_width=data_width) if stats else None
+
+    def add_endpoint(self, ep, *, addr, buffered=False, shared=False, cut_through=False):
         """
         Add an endpoint to the USB device.
 
@@ -65,17 +188,45 @@ class Device(Elaboratable):
             Endpoint interface.
         addr : int
             Endpoint address.
-        buffered : bool
+        buffered : bool or int
             Endpoint buffering. Optional. If true, a double buffer is provided between the
-            the endpoint and the device controller.
+            the endpoint and the device controller. If an integer is given, a ring buffer holding
+            that many packets is provided instead. High-bandwidth isochronous endpoints must be
+            buffered.
+        shared : bool
+            Use the shared packet pool. Optional. If true, the endpoint is not given a buffer of
+            its own. Instead, its packets are stored in a single memory shared by all endpoints
+            of the same direction. `buffered` then gives the number of packets reserved for the
+            endpoint (2 if true).
+        cut_through : bool
+            Cut-through mode. Optional. Output endpoints only. If true, a small FIFO is provided
+            between the device controller and the endpoint. Data is forwarded to the endpoint as
+            soon as it is received. If the packet is invalidated after the endpoint has started
+            to read it, its last entry has both `lst` and `drop` asserted.
         """
         if isinstance(ep, InputEndpoint):
-            self._mux_in .add_endpoint(ep, addr=addr, buffered=buffered)
+            if cut_through:
+                raise ValueError("Cut-through mode is only available for output endpoints")
+            self._mux_in .add_endpoint(ep, addr=addr, buffered=buffered, shared=shared)
         elif isinstance(ep, OutputEndpoint):
-            self._mux_out.add_endpoint(ep, addr=addr, buffered=buffered)
+            self._mux_out.add_endpoint(ep, addr=addr, buffered=buffered, shared=shared,
+                                       cut_through=cut_through)
         else:
             raise TypeError("Endpoint must be an InputEndpoint or an OutputEndpoint, not {!r}"
                             .format(ep))
+        if self.stats is not None:
+            self.stats.add_endpoint(ep, addr=addr)
+
+    def endpoints(self):
+        """
+        Endpoints added to the USB device.
+
+        Returns a list of `(addr, ep)` tuples, sorted by address. Input endpoints come before
+        output endpoints of the same address.
+        """
+        endpoints  = [(addr, ep) for addr, (ep, *_) in self._mux_in ._ep_map.items()]
+        endpoints += [(addr, ep) for addr, (ep, *_) in self._mux_out._ep_map.items()]
+        return sorted(endpoints, key=lambda item: (item[0], isinstance(item[1], OutputEndpoint)))
 
     def elaborate(self, platform):
         m = Module()
@@ -83,9 +234,9 @@ class Device(Elaboratable):
         m.submodules.mux_in  = mux_in  = self._mux_in
         m.submodules.mux_out = mux_out = self._mux_out
 
-        m.submodules.token_sink  = token_sink  = _TokenSink()
-        m.submodules.data_sink   = data_sink   = _DataSink()
-        m.submodules.data_source = data_source = _DataSource()
+        m.submodules.token_sink  = token_sink  = _TokenSink (data_width=self.data_width)
+        m.submodules.data_sink   = data_sink   = _DataSink  (data_width=self.data_width)
+        m.submodules.data_source = data_source = _DataSource(data_width=self.data_width)
 
         rx_pid   = Signal(4)
         rx_pid_r = Signal.like(rx_pid)
@@ -93,7 +244,10 @@ class Device(Elaboratable):
 
         # PIDs are followed by a 4-bit field equal to their one's complement.
         rx_pid_valid = Signal()
-        m.d.comb += rx_pid_valid.eq((rx_pid ^ self.rx.data[4:]).all())
+        m.d.comb += rx_pid_valid.eq((rx_pid ^ self.rx.data[4:8]).all())
+
+        # PIDs are sent alone, in the least significant byte of a word.
+        m.d.comb += self.tx.be.eq(1)
 
         # DATA0 and DATA1 PIDs are alternated between non-isochronous transactions to let the
         # recipient know if it missed a data packet.
@@ -103,11 +257,34 @@ class Device(Elaboratable):
         rx_seq = Array(Signal(16, name="rx_seq"))
         tx_seq = Array(Signal(16, name="tx_seq"))
 
+        # High-bandwidth isochronous OUT transactions use MDATA PIDs for all but the last packet
+        # of a microframe, whose PID (DATA0, DATA1 or DATA2) tells how many packets were sent.
+        # The `rx_mdata[ep]` counter tracks the number of MDATA packets received since the last
+        # SOF. It is set to 3 if the remaining packets of the microframe must be discarded.
+        # See section 5.9.2 of the USB 2.0 specification for details.
+        rx_mdata = Array(Signal(2, name="rx_mdata_{}".format(i)) for i in range(16))
+
         token_dev   = Signal(7)
         token_ep    = Signal(4)
         token_setup = Signal()
+        token_in    = Signal()
+
+        # Halt state of bulk and interrupt endpoints. See section 9.4.5 of the USB 2.0
+        # specification for details.
+        halted_in  = Signal(16)
+        halted_out = Signal(16)
 
         expect_handshake = Signal()
+        handshake_timer  = Signal(range(self.handshake_timeout + 1))
+        handshake_lost   = Signal()
+
+        crc_error = Signal()
+        seq_error = Signal()
+
+        sof_received = Signal()
+        sof_frame    = Signal(11)
+
+        m.d.comb += mux_in.sel.addr.eq(token_ep)
 
         with m.FSM() as fsm:
             with m.State("IDLE"):
@@ -116,7 +293,7 @@ class Device(Elaboratable):
                     with m.If(rx_pid_valid):
                         m.d.sync += rx_pid_r.eq(rx_pid)
                         with m.If(self.rx.lst):
-                            with m.If(PacketID.is_handshake(rx_pid)
+                            with m.If(PacketID.is_handshake(rx_pid) & ~self.rx.err
                                     # Ignore handshake packets if we are not expecting one.
                                     & expect_handshake):
                                 m.next = "RECV-HANDSHAKE"
@@ -146,15 +323,32 @@ class Device(Elaboratable):
                     token_sink.rx.stb .eq(self.rx.stb),
                     token_sink.rx.lst .eq(self.rx.lst),
                     token_sink.rx.data.eq(self.rx.data),
+                    token_sink.rx.be  .eq(self.rx.be),
                     self.rx.rdy.eq(token_sink.rx.rdy),
                 ]
-                with m.If(token_sink.stb):
+                with m.If(token_sink.stb & ~self.rx.err):
                     with m.If(self.rx.lst):
-                        m.d.sync += [
-                            token_dev.eq(token_sink.dev),
-                            token_ep .eq(token_sink.ep),
-                        ]
-                        m.next = "RECV-TOKEN-1"
+                        m.d.sync += token_dev.eq(token_sink.dev)
+                        with m.If(rx_pid_r == PacketID.SOF):
+                            m.d.sync += sof_frame.eq(Cat(token_sink.dev, token_sink.ep))
+                        with m.Elif(token_sink.dev == self.addr):
+                            # The endpoint number is only latched for tokens sent to us, so that
+                            # the current endpoint is not disturbed by SOF packets or by traffic
+                            # to other devices.
+                            m.d.sync += token_ep.eq(token_sink.ep)
+                            # Select the endpoint early, to let the shared packet pool fetch its
+                            # next packet before we reply.
+                            m.d.sync += mux_out.sel.addr.eq(token_sink.ep)
+                            if self.prefetch:
+                                m.d.comb += mux_in.sel.addr.eq(token_sink.ep)
+                        if self.prefetch:
+                            with m.If((rx_pid_r == PacketID.IN) & (token_sink.dev == self.addr)):
+                                m.d.sync += token_in.eq(1)
+                                m.next = "SEND-DATA-0"
+                            with m.Else():
+                                m.next = "RECV-TOKEN-1"
+                        else:
+                            m.next = "RECV-TOKEN-1"
                     with m.Else():
                         m.next = "FLUSH-PACKET"
                 with m.Elif(self.rx.stb & self.rx.lst):
@@ -162,17 +356,12 @@ class Device(Elaboratable):
 
             with m.State("RECV-TOKEN-1"):
                 with m.If(rx_pid_r == PacketID.SOF):
-                    # When a new (micro)frame starts, assume any ongoing transaction has timed out.
-                    m.d.sync += expect_handshake.eq(0)
-                    m.d.comb += [
-                        mux_out.sof.eq(1),
-                        mux_in .sof.eq(1),
-                    ]
+                    m.d.comb += sof_received.eq(1)
                     m.next = "IDLE"
                 with m.Elif(token_dev == self.addr):
+                    m.d.sync += token_in.eq(rx_pid_r == PacketID.IN)
                     with m.Switch(rx_pid_r):
                         with m.Case(PacketID.PING):
-                            m.d.sync += mux_out.sel.addr.eq(token_ep)
                             m.next = "SEND-PONG"
                         with m.Case(PacketID.SETUP):
                             m.d.sync += token_setup.eq(1)
@@ -184,13 +373,10 @@ class Device(Elaboratable):
                                 rx_seq[token_ep].eq(0),
                                 tx_seq[token_ep].eq(1),
                             ]
-                            m.d.sync += mux_out.sel.addr.eq(token_ep)
                             m.next = "RECV-DATA-0"
                         with m.Case(PacketID.OUT):
-                            m.d.sync += mux_out.sel.addr.eq(token_ep)
                             m.next = "RECV-DATA-0"
                         with m.Case(PacketID.IN):
-                            m.d.sync += mux_in .sel.addr.eq(token_ep)
                             m.next = "SEND-DATA-0"
                         with m.Default():
                             # Unknown/unsupported token.
@@ -203,7 +389,9 @@ class Device(Elaboratable):
                 with m.If(mux_out.sel.err):
                     # Invalid endpoint. Abort transaction.
                     m.next = "IDLE"
-                with m.Elif(mux_out.pkt.rdy):
+                with m.Elif(mux_out.sel.stall | halted_out.bit_select(token_ep, 1)):
+                    m.next = "SEND-STALL"
+                with m.Elif(mux_out.sel.avail):
                     m.next = "SEND-ACK"
                 with m.Else():
                     m.next = "SEND-NAK"
@@ -214,6 +402,10 @@ class Device(Elaboratable):
                 with m.If(mux_out.sel.err):
                     # Invalid endpoint. Abort transaction.
                     m.next = "FLUSH-PACKET"
+                with m.Elif(mux_out.sel.stall & ~token_setup | halted_out.bit_select(token_ep, 1)):
+                    # The endpoint refuses OUT transactions. SETUP transactions are still
+                    # accepted by control endpoints, as they start a new control transfer.
+                    m.next = "FLUSH-STALL"
                 with m.Else():
                     m.d.comb += self.rx.rdy.eq(1)
                     with m.If(self.rx.stb):
@@ -224,14 +416,17 @@ class Device(Elaboratable):
                                 with m.If(rx_pid == expected_pid):
                                     m.next = "RECV-DATA-1"
                                 with m.Else():
+                                    m.d.comb += seq_error.eq(1)
                                     m.next = "FLUSH-PACKET"
                             with m.Else():
-                                # FIXME: Data PID sequencing for isochronous transfers (section
-                                # 5.9.2 of the USB 2.0 specification) isn't implemented.
-                                # Be lenient and accept any data PID.
-                                with m.If(PacketID.is_data(rx_pid)):
+                                # The data PID sequence of isochronous transfers is checked at
+                                # the end of the packet, in order to discard the payload of the
+                                # whole microframe.
+                                with m.If(PacketID.is_data(rx_pid) & (rx_mdata[token_ep] != 3)):
+                                    m.d.sync += rx_pid_r.eq(rx_pid)
                                     m.next = "RECV-DATA-1"
                                 with m.Else():
+                                    m.d.comb += seq_error.eq(1)
                                     m.next = "FLUSH-PACKET"
                         with m.Else():
                             m.next = "FLUSH-PACKET"
@@ -242,55 +437,117 @@ class Device(Elaboratable):
                     data_sink.rx.stb .eq(self.rx.stb),
                     data_sink.rx.lst .eq(self.rx.lst),
                     data_sink.rx.data.eq(self.rx.data),
+                    data_sink.rx.be  .eq(self.rx.be),
+                    data_sink.rx.err .eq(self.rx.err),
                     self.rx.rdy.eq(data_sink.rx.rdy),
 
                     mux_out.pkt.stb  .eq(data_sink.stb),
                     mux_out.pkt.lst  .eq(data_sink.lst),
                     mux_out.pkt.data .eq(data_sink.data),
+                    mux_out.pkt.be   .eq(data_sink.be),
                     mux_out.pkt.zlp  .eq(data_sink.zlp),
                     mux_out.pkt.drop .eq(data_sink.drop),
                     mux_out.pkt.setup.eq(token_setup),
                 ]
-                with m.If(mux_out.pkt.stb):
-                    with m.If(~mux_out.pkt.rdy):
-                        m.d.sync += ep_busy.eq(1)
-                    with m.If(mux_out.pkt.lst):
-                        m.d.sync += ep_busy.eq(0)
-                        m.d.sync += token_setup.eq(0)
-                        with m.If(mux_out.pkt.drop):
-                            # CRC check failed. Ignore packet.
-                            m.next = "IDLE"
-                        with m.Elif(mux_out.sel.xfer == Transfer.ISOCHRONOUS):
-                            # Isochronous transactions do not include a handshake.
-                            m.next = "IDLE"
-                        with m.Elif(~mux_out.pkt.rdy | ep_busy):
-                            # Endpoint wasn't able to receive the whole payload.
-                            m.next = "SEND-NAK"
+
+                iso_mdata = Signal()
+                iso_seq_ok = Signal()
+                m.d.comb += iso_mdata.eq((mux_out.sel.xfer == Transfer.ISOCHRONOUS)
+                                         & (rx_pid_r == PacketID.MDATA))
+                with m.Switch(rx_pid_r):
+                    with m.Case(PacketID.MDATA):
+                        m.d.comb += iso_seq_ok.eq(rx_mdata[token_ep] + 1
+                                                  < mux_out.sel.transactions)
+                    with m.Case(PacketID.DATA0):
+                        m.d.comb += iso_seq_ok.eq(rx_mdata[token_ep] == 0)
+                    with m.Case(PacketID.DATA1):
+                        m.d.comb += iso_seq_ok.eq(rx_mdata[token_ep] == 1)
+                    with m.Case(PacketID.DATA2):
+                        m.d.comb += iso_seq_ok.eq(rx_mdata[token_ep] == 2)
+
+                with m.If(mux_out.sel.xfer == Transfer.ISOCHRONOUS):
+                    with m.If(~iso_seq_ok):
+                        # Unexpected data PID. Discard the payload of the whole microframe.
+                        m.d.comb += mux_out.pkt.drop.eq(1)
+                    with m.Elif(iso_mdata):
+                        # More packets will follow. The payload is only terminated (or dropped)
+                        # by the last packet of the microframe.
+                        m.d.comb += [
+                            mux_out.pkt.stb.eq(data_sink.stb
+                                               & ~(data_sink.zlp & ~data_sink.drop)),
+                            mux_out.pkt.lst.eq(data_sink.lst & data_sink.drop),
+                        ]
+
+                with m.If(mux_out.pkt.stb & ~mux_out.pkt.rdy):
+                    m.d.sync += ep_busy.eq(1)
+                with m.If(data_sink.stb & data_sink.lst):
+                    m.d.sync += ep_busy.eq(0)
+                    m.d.sync += token_setup.eq(0)
+                    m.d.comb += crc_error.eq(data_sink.drop)
+                    with m.If(mux_out.sel.xfer == Transfer.ISOCHRONOUS):
+                        m.d.comb += seq_error.eq(~iso_seq_ok & ~data_sink.drop)
+                        with m.If(iso_mdata & iso_seq_ok & ~data_sink.drop):
+                            m.d.sync += rx_mdata[token_ep].eq(rx_mdata[token_ep] + 1)
+                        with m.Elif(iso_mdata):
+                            m.d.sync += rx_mdata[token_ep].eq(3)
+                        with m.Else():
+                            m.d.sync += rx_mdata[token_ep].eq(0)
+                        # Isochronous transactions do not include a handshake.
+                        m.next = "IDLE"
+                    with m.Elif(data_sink.drop):
+                        # CRC check failed. Ignore packet.
+                        m.next = "IDLE"
+                    with m.Elif(~mux_out.pkt.rdy | ep_busy):
+                        # Endpoint wasn't able to receive the whole payload.
+                        m.next = "SEND-NAK"
+                    with m.Else():
+                        # Toggle the receiver-side sequence bit upon receipt of a valid data
+                        # packet.
+                        m.d.sync += rx_seq[token_ep].eq(~rx_seq[token_ep])
+                        with m.If(self.hs & ~token_setup
+                                & ((mux_out.sel.xfer == Transfer.BULK)
+                                   | (mux_out.sel.xfer == Transfer.CONTROL))):
+                            m.next = "RECV-DATA-2"
                         with m.Else():
-                            # Toggle the receiver-side sequence bit upon receipt of a valid data
-                            # packet.
-                            m.d.sync += rx_seq[token_ep].eq(~rx_seq[token_ep])
                             m.next = "SEND-ACK"
 
+            with m.State("RECV-DATA-2"):
+                # The endpoint has now committed the packet. If it cannot accept another one, we
+                # reply with NYET. The host will then send PING tokens until it can.
+                # See section 8.5.1 of the USB 2.0 specification for details.
+                with m.If(mux_out.sel.avail):
+                    m.next = "SEND-ACK"
+                with m.Else():
+                    m.next = "SEND-NYET"
+
             with m.State("SEND-DATA-0"):
                 with m.If(mux_in.sel.err):
                     # Invalid endpoint. Abort transaction.
                     m.next = "IDLE"
+                with m.Elif(mux_in.sel.stall | halted_in.bit_select(token_ep, 1)):
+                    m.next = "SEND-STALL"
                 with m.Elif(mux_in.pkt.stb):
+                    tx_pid = Signal(4)
                     m.d.comb += [
                         self.tx.stb.eq(1),
                         self.tx.lst.eq(0),
+                        self.tx.data[:4].eq( tx_pid),
+                        self.tx.data[4:8].eq(~tx_pid),
                     ]
-                    with m.If(tx_seq[token_ep]):
-                        m.d.comb += [
-                            self.tx.data[:4].eq( PacketID.DATA1),
-                            self.tx.data[4:].eq(~PacketID.DATA1),
-                        ]
+                    with m.If(mux_in.sel.xfer == Transfer.ISOCHRONOUS):
+                        # Isochronous transactions do not use data toggles. The data PID tells
+                        # the number of packets left in the current microframe.
+                        with m.Switch(mux_in.pkt.seq):
+                            with m.Case(0):
+                                m.d.comb += tx_pid.eq(PacketID.DATA0)
+                            with m.Case(1):
+                                m.d.comb += tx_pid.eq(PacketID.DATA1)
+                            with m.Default():
+                                m.d.comb += tx_pid.eq(PacketID.DATA2)
+                    with m.Elif(tx_seq[token_ep]):
+                        m.d.comb += tx_pid.eq(PacketID.DATA1)
                     with m.Else():
-                        m.d.comb += [
-                            self.tx.data[:4].eq( PacketID.DATA0),
-                            self.tx.data[4:].eq(~PacketID.DATA0),
-                        ]
+                        m.d.comb += tx_pid.eq(PacketID.DATA0)
                     with m.If(self.tx.rdy):
                         m.next = "SEND-DATA-1"
                 with m.Else():
@@ -306,11 +563,13 @@ class Device(Elaboratable):
                     data_source.stb .eq(mux_in.pkt.stb),
                     data_source.lst .eq(mux_in.pkt.lst),
                     data_source.data.eq(mux_in.pkt.data),
+                    data_source.be  .eq(mux_in.pkt.be),
                     data_source.zlp .eq(mux_in.pkt.zlp),
                     mux_in.pkt.rdy.eq(data_source.rdy),
                 ]
                 with m.If(self.tx.stb & self.tx.lst & self.tx.rdy):
                     m.d.sync += expect_handshake.eq(1)
+                    m.d.sync += handshake_timer.eq(self.handshake_timeout)
                     m.next = "IDLE"
 
             with m.State("SEND-ACK"):
@@ -318,7 +577,7 @@ class Device(Elaboratable):
                     self.tx.stb.eq(1),
                     self.tx.lst.eq(1),
                     self.tx.data[:4].eq( PacketID.ACK),
-                    self.tx.data[4:].eq(~PacketID.ACK),
+                    self.tx.data[4:8].eq(~PacketID.ACK),
                 ]
                 with m.If(self.tx.rdy):
                     m.next = "IDLE"
@@ -328,7 +587,27 @@ class Device(Elaboratable):
                     self.tx.stb.eq(1),
                     self.tx.lst.eq(1),
                     self.tx.data[:4].eq( PacketID.NAK),
-                    self.tx.data[4:].eq(~PacketID.NAK),
+                    self.tx.data[4:8].eq(~PacketID.NAK),
+                ]
+                with m.If(self.tx.rdy):
+                    m.next = "IDLE"
+
+            with m.State("SEND-NYET"):
+                m.d.comb += [
+                    self.tx.stb.eq(1),
+                    self.tx.lst.eq(1),
+                    self.tx.data[:4].eq( PacketID.NYET),
+                    self.tx.data[4:8].eq(~PacketID.NYET),
+                ]
+                with m.If(self.tx.rdy):
+                    m.next = "IDLE"
+
+            with m.State("SEND-STALL"):
+                m.d.comb += [
+                    self.tx.stb.eq(1),
+                    self.tx.lst.eq(1),
+                    self.tx.data[:4].eq( PacketID.STALL),
+                    self.tx.data[4:8].eq(~PacketID.STALL),
                 ]
                 with m.If(self.tx.rdy):
                     m.next = "IDLE"
@@ -338,15 +617,168 @@ class Device(Elaboratable):
                 with m.If(self.rx.stb & self.rx.lst):
                     m.next = "IDLE"
 
+            with m.State("FLUSH-STALL"):
+                m.d.comb += self.rx.rdy.eq(1)
+                with m.If(self.rx.stb & self.rx.lst):
+                    m.next = "SEND-STALL"
+
+        # The host sends a SOF packet every (micro)frame, i.e. every 1ms in Full-Speed mode and
+        # every 125us in High-Speed mode. If a SOF packet is missed, the device extrapolates the
+        # next (micro)frame from the interval between the last two SOF packets it received.
+        sof_timer   = Signal(20)
+        sof_period  = Signal.like(sof_timer)
+        sof_seen    = Signal()
+        sof_locked  = Signal()
+        sof_missing = Signal(range(4))
+
+        m.d.sync += self.timestamp.eq(self.timestamp + 1)
+        with m.If(sof_timer != 2**len(sof_timer) - 1):
+            m.d.sync += sof_timer.eq(sof_timer + 1)
+
+        with m.If(sof_received):
+            with m.If(sof_seen & (sof_missing == 0)):
+                m.d.sync += [
+                    sof_period.eq(sof_timer + 1),
+                    sof_locked.eq(1),
+                ]
+            m.d.sync += [
+                sof_timer.eq(0),
+                sof_seen.eq(1),
+                sof_missing.eq(0),
+                self.sof_timestamp.eq(self.timestamp),
+            ]
+        with m.Elif(sof_locked & (sof_timer >= sof_period + (sof_period >> 3))
+                    # Wait for the end of the corrupted packet, if any.
+                    & fsm.ongoing("IDLE")):
+            with m.If(sof_missing == 3):
+                # The host stopped sending SOF packets (e.g. the bus is suspended).
+                m.d.sync += [
+                    sof_seen.eq(0),
+                    sof_locked.eq(0),
+                    sof_missing.eq(0),
+                ]
+            with m.Else():
+                m.d.comb += self.sof_missed.eq(1)
+                m.d.sync += [
+                    sof_timer.eq(sof_timer - sof_period),
+                    sof_missing.eq(sof_missing + 1),
+                ]
+
+        frame      = Signal.like(self.frame)
+        microframe = Signal.like(self.microframe)
+        m.d.comb += [
+            self.frame.eq(frame),
+            self.microframe.eq(microframe),
+        ]
+        with m.If(sof_received):
+            m.d.comb += [
+                self.frame.eq(sof_frame),
+                self.microframe.eq(Mux(sof_frame == frame, microframe + 1, 0)),
+            ]
+        with m.Elif(self.sof_missed):
+            with m.If(self.hs):
+                m.d.comb += [
+                    self.frame.eq(frame + (microframe == 7)),
+                    self.microframe.eq(microframe + 1),
+                ]
+            with m.Else():
+                m.d.comb += [
+                    self.frame.eq(frame + 1),
+                    self.microframe.eq(0),
+                ]
+        m.d.sync += [
+            frame.eq(self.frame),
+            microframe.eq(self.microframe),
+        ]
+
+        m.d.comb += [
+            self.sof.eq(sof_received | self.sof_missed),
+            mux_out.sof.eq(self.sof),
+            mux_in .sof.eq(self.sof),
+            mux_out.frame.eq(self.frame),
+            mux_in .frame.eq(self.frame),
+            mux_out.microframe.eq(self.microframe),
+            mux_in .microframe.eq(self.microframe),
+        ]
+        with m.If(self.sof):
+            # When a new (micro)frame starts, assume any ongoing transaction has timed out.
+            m.d.sync += expect_handshake.eq(0)
+            m.d.sync += [ctr.eq(0) for ctr in rx_mdata]
+
+        # If the host doesn't reply to a data packet in time, stop waiting for its handshake.
+        # The endpoint keeps the payload until it is acknowledged, and it will be sent again on the
+        # next IN token.
+        with m.If(fsm.ongoing("IDLE") & expect_handshake & ~self.rx.stb):
+            with m.If(handshake_timer == 0):
+                m.d.comb += handshake_lost.eq(1)
+                m.d.sync += expect_handshake.eq(0)
+            with m.Else():
+                m.d.sync += handshake_timer.eq(handshake_timer - 1)
+
+        m.d.comb += self.halt.err.eq(1)
+        for addr, ep in self.endpoints():
+            if ep.xfer not in {Transfer.BULK, Transfer.INTERRUPT}:
+                continue
+            if isinstance(ep, InputEndpoint):
+                halted, seq, ep_dir = halted_in[addr], tx_seq[addr], 1
+            else:
+                halted, seq, ep_dir = halted_out[addr], rx_seq[addr], 0
+            selected = (self.halt.ep == addr) & (self.halt.dir == ep_dir)
+            m.d.comb += ep.halted.eq(halted)
+            with m.If(selected):
+                m.d.comb += [
+                    self.halt.status.eq(halted),
+                    self.halt.err.eq(0),
+                ]
+            # The data toggle is reset after the FSM updates it, in case the endpoint is being
+            # used while its halt state is cleared.
+            with m.If(selected & self.halt.clr):
+                m.d.sync += [
+                    halted.eq(0),
+                    seq.eq(0),
+                ]
+            with m.Elif(selected & self.halt.set | ep.halt):
+                m.d.sync += halted.eq(1)
+
+        if self.stats is not None:
+            m.submodules.stats = stats = self.stats
+
+            def byte_count(pkt):
+                moved = pkt.stb & pkt.rdy & ~pkt.zlp
+                if self.data_width == 8:
+                    return moved
+                return Mux(moved, sum(pkt.be), 0)
+
+            m.d.comb += [
+                stats.event.ep .eq(token_ep),
+                stats.event.dir.eq(token_in),
+                stats.event.ack.eq(fsm.ongoing("SEND-ACK") & self.tx.rdy
+                                   | fsm.ongoing("RECV-HANDSHAKE") & (rx_pid_r == PacketID.ACK)),
+                stats.event.nak.eq(fsm.ongoing("SEND-NAK") & self.tx.rdy),
+                stats.event.stall.eq(fsm.ongoing("SEND-STALL") & self.tx.rdy),
+                stats.event.crc_error.eq(crc_error),
+                stats.event.seq_error.eq(seq_error),
+                stats.event.timeout.eq(handshake_lost),
+                stats.event.busy.eq(~fsm.ongoing("IDLE")
+                                    & ~fsm.ongoing("RECV-TOKEN-0") & ~fsm.ongoing("RECV-TOKEN-1")
+                                    & ~fsm.ongoing("FLUSH-PACKET")),
+                stats.event.sof.eq(fsm.ongoing("RECV-TOKEN-1") & (rx_pid_r == PacketID.SOF)),
+            ]
+            with m.If(fsm.ongoing("RECV-DATA-1")):
+                m.d.comb += stats.event.bytes.eq(byte_count(mux_out.pkt))
+            with m.Elif(fsm.ongoing("SEND-DATA-1")):
+                m.d.comb += stats.event.bytes.eq(byte_count(mux_in.pkt))
+
         return m
 
 
 class _TokenSink(Elaboratable):
-    def __init__(self):
+    def __init__(self, *, data_width=8):
         self.rx = Record([
             ("stb",  1, DIR_FANIN),
             ("lst",  1, DIR_FANIN),
-            ("data", 8, DIR_FANIN),
+            ("data", data_width, DIR_FANIN),
+            ("be",   data_width // 8 if data_width > 8 else 0, DIR_FANIN),
             ("rdy",  1, DIR_FANOUT),
         ])
         self.stb = Signal()
@@ -354,50 +786,68 @@ class _TokenSink(Elaboratable):
         self.ep  = Signal(4)
         self.crc = Signal(5)
 
+        self.data_width = data_width
+
     def elaborate(self, platform):
         m = Module()
 
         m.submodules.crc = crc = CRC(poly=0b00101, size=5, dw=11, init=0x1f)
 
-        ep_lsb = Signal()
-        ep_msb = Signal(3)
-        m.d.comb += self.ep.eq(Cat(ep_lsb, ep_msb))
-
         m.d.comb += self.rx.rdy.eq(1)
-        with m.If(self.rx.stb):
-            token_msb = Signal()
-            with m.If(~token_msb):
-                m.d.sync += Cat(self.dev, ep_lsb).eq(self.rx.data)
-                m.d.sync += token_msb.eq(1)
-            with m.Else():
-                m.d.comb += Cat(ep_msb, self.crc).eq(self.rx.data)
-                m.d.comb += [
-                    crc.val.eq(Cat(self.dev, self.ep)),
-                    self.stb.eq(crc.res == self.crc),
-                ]
-                m.d.sync += token_msb.eq(0)
+
+        if self.data_width == 8:
+            ep_lsb = Signal()
+            ep_msb = Signal(3)
+            m.d.comb += self.ep.eq(Cat(ep_lsb, ep_msb))
+
+            with m.If(self.rx.stb):
+                token_msb = Signal()
+                with m.If(~token_msb):
+                    m.d.sync += Cat(self.dev, ep_lsb).eq(self.rx.data)
+                    m.d.sync += token_msb.eq(1)
+                with m.Else():
+                    m.d.comb += Cat(ep_msb, self.crc).eq(self.rx.data)
+                    m.d.comb += [
+                        crc.val.eq(Cat(self.dev, self.ep)),
+                        self.stb.eq(crc.res == self.crc),
+                    ]
+                    m.d.sync += token_msb.eq(0)
+        else:
+            # Both bytes of the token are received in the same word.
+            m.d.comb += Cat(self.dev, self.ep, self.crc).eq(self.rx.data)
+            m.d.comb += crc.val.eq(Cat(self.dev, self.ep))
+            with m.If(self.rx.stb):
+                m.d.comb += self.stb.eq(crc.res == self.crc)
 
         return m
 
 
 class _DataSink(Elaboratable):
-    def __init__(self):
+    def __init__(self, *, data_width=8):
         self.rx = Record([
             ("stb",  1, DIR_FANIN),
             ("lst",  1, DIR_FANIN),
-            ("data", 8, DIR_FANIN),
+            ("data", data_width, DIR_FANIN),
+            ("be",   data_width // 8 if data_width > 8 else 0, DIR_FANIN),
+            ("err",  1, DIR_FANIN),
             ("rdy",  1, DIR_FANOUT),
         ])
         self.stb  = Signal()
         self.lst  = Signal()
-        self.data = Signal(8)
+        self.data = Signal(data_width)
+        self.be   = Signal(data_width // 8 if data_width > 8 else 0)
         self.zlp  = Signal()
         self.drop = Signal()
 
+        self.data_width = data_width
+
     def elaborate(self, platform):
+        if self.data_width > 8:
+            return self._elaborate_wide(platform)
+
         m = Module()
 
-        buf_0 = Record([("stb", 1), ("lst", 1), ("data", 8)])
+        buf_0 = Record([("stb", 1), ("lst", 1), ("err", 1), ("data", 8)])
         buf_1 = Record.like(buf_0)
 
         m.submodules.crc = crc = CRC(poly=0b11000000000000101, size=16, dw=8, init=0xffff)
@@ -413,6 +863,7 @@ class _DataSink(Elaboratable):
                 m.d.sync += [
                     buf_0.stb.eq(1),
                     buf_0.lst.eq(self.rx.lst),
+                    buf_0.err.eq(self.rx.err),
                     buf_0.data.eq(self.rx.data),
                     buf_1.eq(buf_0),
                 ]
@@ -430,34 +881,140 @@ class _DataSink(Elaboratable):
                     self.stb.eq(1),
                     self.lst.eq(1),
                     self.zlp.eq(1),
-                    self.drop.eq(Cat(buf_1.data, buf_0.data).any()),
+                    self.drop.eq(Cat(buf_1.data, buf_0.data).any() | buf_0.err),
                 ]
             with m.Else():
                 m.d.comb += [
                     self.stb.eq(self.rx.stb),
                     self.lst.eq(self.rx.lst),
                     self.data.eq(buf_1.data),
-                    self.drop.eq(crc.res != Cat(buf_0.data, self.rx.data)),
+                    self.drop.eq((crc.res != Cat(buf_0.data, self.rx.data)) | self.rx.err),
                 ]
 
         return m
 
+    def _elaborate_wide(self, platform):
+        m = Module()
+
+        n_bytes = self.data_width // 8
+
+        # The last 2 bytes of a packet hold its CRC. Non-last words are always full, so the
+        # output is delayed by one word, until we know whether it holds CRC bytes.
+        buf = Record([("valid", 1), ("data", self.data_width)])
+        # If the last word holds payload bytes, the previous word and the last word must both be
+        # sent. The last word is then held for one more cycle.
+        pend = Record([("valid", 1), ("data", self.data_width), ("be", n_bytes), ("drop", 1)])
+
+        m.submodules.crc = crc = CRC(poly=0b11000000000000101, size=16, dw=self.data_width,
+                                     init=0xffff, byte_enable=True)
+        m.d.comb += [
+            crc.val.eq(self.rx.data),
+            crc.be.eq(self.rx.be),
+            crc.en.eq(self.rx.stb & self.rx.rdy),
+            crc.clr.eq(self.rx.stb & self.rx.rdy & self.rx.lst),
+        ]
+
+        # Running the CRC over the payload and its CRC field leaves a constant residual.
+        crc_ok = Signal()
+        m.d.comb += crc_ok.eq(crc.res == 0x4ffe)
+
+        with m.If(pend.valid):
+            m.d.comb += [
+                self.stb.eq(1),
+                self.lst.eq(1),
+                self.data.eq(pend.data),
+                self.be.eq(pend.be),
+                self.drop.eq(pend.drop),
+            ]
+            m.d.sync += pend.valid.eq(0)
+
+        with m.Else():
+            m.d.comb += self.rx.rdy.eq(1)
+            with m.If(self.rx.stb):
+                with m.If(~self.rx.lst):
+                    m.d.sync += [
+                        buf.valid.eq(1),
+                        buf.data.eq(self.rx.data),
+                    ]
+                    with m.If(buf.valid):
+                        m.d.comb += [
+                            self.stb.eq(1),
+                            self.data.eq(buf.data),
+                            self.be.eq(Repl(1, n_bytes)),
+                        ]
+                with m.Else():
+                    m.d.sync += buf.valid.eq(0)
+                    m.d.comb += self.drop.eq(~crc_ok | self.rx.err)
+
+                    # Number of payload bytes in the last word.
+                    rx_count = Signal(range(n_bytes + 1))
+                    m.d.comb += rx_count.eq(sum(self.rx.be))
+
+                    with m.If(rx_count > 2):
+                        with m.If(buf.valid):
+                            m.d.comb += [
+                                self.stb.eq(1),
+                                self.data.eq(buf.data),
+                                self.be.eq(Repl(1, n_bytes)),
+                                self.drop.eq(0),
+                            ]
+                            m.d.sync += [
+                                pend.valid.eq(1),
+                                pend.data.eq(self.rx.data),
+                                pend.be.eq(self.rx.be[2:]),
+                                pend.drop.eq(~crc_ok | self.rx.err),
+                            ]
+                        with m.Else():
+                            m.d.comb += [
+                                self.stb.eq(1),
+                                self.lst.eq(1),
+                                self.data.eq(self.rx.data),
+                                self.be.eq(self.rx.be[2:]),
+                            ]
+                    with m.Elif(buf.valid):
+                        # The CRC field ends the previous word, or straddles both words.
+                        m.d.comb += [
+                            self.stb.eq(1),
+                            self.lst.eq(1),
+                            self.data.eq(buf.data),
+                            self.be.eq(Mux(rx_count == 2, Repl(1, n_bytes),
+                                           Repl(1, n_bytes - 1))),
+                        ]
+                    with m.Else():
+                        # We received a zero-length packet.
+                        m.d.comb += [
+                            self.stb.eq(1),
+                            self.lst.eq(1),
+                            self.zlp.eq(1),
+                        ]
+                        with m.If(rx_count != 2):
+                            m.d.comb += self.drop.eq(1)
+
+        return m
+
 
 class _DataSource(Elaboratable):
-    def __init__(self):
+    def __init__(self, *, data_width=8):
         self.tx = Record([
             ("stb",  1, DIR_FANOUT),
             ("lst",  1, DIR_FANOUT),
-            ("data", 8, DIR_FANOUT),
+            ("data", data_width, DIR_FANOUT),
+            ("be",   data_width // 8 if data_width > 8 else 0, DIR_FANOUT),
             ("rdy",  1, DIR_FANIN),
         ])
         self.stb  = Signal()
         self.lst  = Signal()
-        self.data = Signal(8)
+        self.data = Signal(data_width)
+        self.be   = Signal(data_width // 8 if data_width > 8 else 0)
         self.zlp  = Signal()
         self.rdy  = Signal()
 
+        self.data_width = data_width
+
     def elaborate(self, platform):
+        if self.data_width > 8:
+            return self._elaborate_wide(platform)
+
         m = Module()
 
         m.submodules.crc = crc = CRC(poly=0b11000000000000101, size=16, dw=8, init=0xffff)
@@ -507,3 +1064,67 @@ class _DataSource(Elaboratable):
                     m.next = "DATA"
 
         return m
+
+    def _elaborate_wide(self, platform):
+        m = Module()
+
+        n_bytes = self.data_width // 8
+
+        m.submodules.crc = crc = CRC(poly=0b11000000000000101, size=16, dw=self.data_width,
+                                     init=0xffff, byte_enable=True)
+        m.d.comb += [
+            crc.val.eq(self.data),
+            crc.be.eq(self.be),
+            crc.en.eq(self.stb & self.rdy),
+            crc.clr.eq(self.stb & self.rdy & self.lst),
+        ]
+
+        # CRC bytes that did not fit in the last word of the payload.
+        crc_tail = Record([("data", 16), ("be", 2)])
+
+        with m.FSM():
+            with m.State("DATA"):
+                m.d.comb += [
+                    self.rdy.eq(self.tx.rdy),
+                    self.tx.stb.eq(self.stb),
+                    self.tx.data.eq(self.data),
+                    self.tx.be.eq(Repl(1, n_bytes)),
+                ]
+                with m.If(self.lst):
+                    with m.If(self.zlp):
+                        # The CRC of an empty payload is 0.
+                        m.d.comb += [
+                            self.tx.lst.eq(1),
+                            self.tx.data.eq(0),
+                            self.tx.be.eq(0b11),
+                        ]
+                    with m.Else():
+                        # Append the CRC to the payload, after its last byte.
+                        with m.Switch(self.be):
+                            for n in range(1, n_bytes + 1):
+                                with m.Case((1 << n) - 1):
+                                    m.d.comb += self.tx.data.eq(Cat(self.data[:8*n], crc.res))
+                                    if n + 2 <= n_bytes:
+                                        m.d.comb += [
+                                            self.tx.lst.eq(1),
+                                            self.tx.be.eq((1 << n + 2) - 1),
+                                        ]
+                                    else:
+                                        with m.If(self.stb & self.rdy):
+                                            m.d.sync += [
+                                                crc_tail.data.eq(crc.res[8*(n_bytes-n):]),
+                                                crc_tail.be.eq(0b01 if n < n_bytes else 0b11),
+                                            ]
+                                            m.next = "CRC"
+
+            with m.State("CRC"):
+                m.d.comb += [
+                    self.tx.stb.eq(1),
+                    self.tx.lst.eq(1),
+                    self.tx.data.eq(crc_tail.data),
+                    self.tx.be.eq(crc_tail.be),
+                ]
+                with m.If(self.tx.rdy):
+                    m.next = "DATA"
+
+        return m
@@ -18,6 +18,62 @@ class Transfer(enum.IntEnum):
     INTERRUPT   = 3
 
 
+def _check_data_width(data_width):
+    if data_width not in {8, 16, 32}:
+        raise ValueError("Data width must be 8, 16 or 32, not {!r}".format(data_width))
+
+
+def _check_max_size(xfer, max_size):
+    if not isinstance(max_size, int) or max_size < 0:
+        raise ValueError("Maximum packet size must be a positive integer, not {!r}"
+                         .format(max_size))
+    if xfer is Transfer.ISOCHRONOUS and max_size > 1024:
+        raise ValueError("Invalid maximum packet size {}; must be lesser than or equal to "
+                         "1024 for an isochronous endpoint".format(max_size))
+    if xfer is Transfer.CONTROL and max_size > 64:
+        raise ValueError("Invalid maximum packet size {}; must be lesser than or equal to "
+                         "64 for a control endpoint".format(max_size))
+    if xfer is Transfer.BULK and max_size > 512:
+        raise ValueError("Invalid maximum packet size {}; must be lesser than or equal to "
+                         "512 for a bulk endpoint".format(max_size))
+    if xfer is Transfer.INTERRUPT and max_size > 1024:
+        raise ValueError("Invalid maximum packet size {}; must be lesser than or equal to "
+                         "1024 for an interrupt endpoint".format(max_size))
+
+
+def _check_transactions(xfer, transactions):
+    if not isinstance(transactions, int) or transactions not in range(1, 4):
+        raise ValueError("Number of transactions per microframe must be 1, 2 or 3, not {!r}"
+                         .format(transactions))
+    if transactions > 1 and xfer not in {Transfer.ISOCHRONOUS, Transfer.INTERRUPT}:
+        raise ValueError("Invalid number of transactions per microframe {}; must be 1 for "
+                         "a {} endpoint".format(transactions, xfer.name.lower()))
+
+
+def _check_interval(xfer, interval):
+    if xfer in {Transfer.ISOCHRONOUS, Transfer.INTERRUPT}:
+        if not isinstance(interval, int) or interval not in range(1, 17):
+            raise ValueError("Interval must be an integer between 1 and 16 for {} endpoint, "
+                             "not {!r}"
+                             .format("an isochronous" if xfer is Transfer.ISOCHRONOUS
+                                     else "an interrupt", interval))
+    elif not isinstance(interval, int) or interval not in range(256):
+        raise ValueError("Interval must be an integer between 0 and 255 for a {} endpoint, "
+                         "not {!r}".format(xfer.name.lower(), interval))
+
+
+def _default_interval(xfer):
+    return 1 if xfer in {Transfer.ISOCHRONOUS, Transfer.INTERRUPT} else 0
+
+
+def _halt_width(xfer):
+    return 1 if xfer in {Transfer.BULK, Transfer.INTERRUPT} else 0
+
+
+def _be_width(data_width):
+    return data_width // 8 if data_width > 8 else 0
+
+
 class _Endpoint(Record):
     _doc_template = """
     {description}
@@ -29,35 +85,43 @@ class _Endpoint(Record):
     max_size : int
         Maximum packet size. We only check this value against upper bounds in High-Speed mode.
         It must also be greater than or equal to the wMaxPacketSize of the endpoint descriptor.
+    transactions : int
+        Number of transactions per microframe. Optional. Defaults to 1. High-bandwidth isochronous
+        and interrupt endpoints may use up to 3 transactions per microframe. The payload of a
+        high-bandwidth isochronous endpoint holds the data of a whole microframe, and is split
+        into `max_size` packets by the device.
+    data_width : int
+        Data width, in bits. Optional. Defaults to 8. Wider data paths (16 or 32 bits) let the
+        device run at a lower clock frequency for the same throughput. They must be used with a
+        device of the same data width.
+    interval : int
+        Polling interval, as the bInterval field of the endpoint descriptor. Optional. Isochronous
+        and interrupt endpoints are polled every ``2 ** (interval - 1)`` microframes, with
+        `interval` between 1 and 16 (defaults to 1). For bulk and control endpoints, it is the
+        maximum NAK rate, between 0 and 255 (defaults to 0). Only used to build descriptors.
     {parameters}
 
     Attributes
     ----------
     {attributes}
     """
-    def __init__(self, layout, xfer, max_size, name=None, src_loc_at=0):
+    def __init__(self, layout, xfer, max_size, transactions=1, data_width=8, interval=None,
+                 name=None, src_loc_at=0):
         if not isinstance(xfer, Transfer):
             raise TypeError("Transfer type must be an instance of Transfer, not {!r}"
                             .format(xfer))
 
-        if not isinstance(max_size, int) or max_size < 0:
-            raise ValueError("Maximum packet size must be a positive integer, not {!r}"
-                             .format(max_size))
-        if xfer is Transfer.ISOCHRONOUS and max_size > 1024:
-            raise ValueError("Invalid maximum packet size {}; must be lesser than or equal to "
-                             "1024 for an isochronous endpoint".format(max_size))
-        if xfer is Transfer.CONTROL and max_size > 64:
-            raise ValueError("Invalid maximum packet size {}; must be lesser than or equal to "
-                             "64 for a control endpoint".format(max_size))
-        if xfer is Transfer.BULK and max_size > 512:
-            raise ValueError("Invalid maximum packet size {}; must be lesser than or equal to "
-                             "512 for a bulk endpoint".format(max_size))
-        if xfer is Transfer.INTERRUPT and max_size > 1024:
-            raise ValueError("Invalid maximum packet size {}; must be lesser than or equal to "
-                             "1024 for an interrupt endpoint".format(max_size))
+        _check_max_size(xfer, max_size)
+        _check_transactions(xfer, transactions)
+        if interval is None:
+            interval = _default_interval(xfer)
+        _check_interval(xfer, interval)
 
         self.xfer     = xfer
         self.max_size = max_size
+        self.transactions = transactions
+        self.data_width   = data_width
+        self.interval     = interval
 
         super().__init__(layout, name=name, src_loc_at=1 + src_loc_at)
 
@@ -80,29 +144,57 @@ class InputEndpoint(_Endpoint):
         Write last. Asserted when `data` holds the last byte of the payload.
     data : Signal, out
         Write data.
+    be : Signal(data_width // 8), out
+        Write byte enable. Only present if `data_width` is greater than 8. Bit `i` is asserted
+        when byte `i` of `data` is valid. Valid bytes must be contiguous, starting from the least
+        significant byte. Only the last word of a payload may be partial.
     zlp : Signal, out
         Write zero-length payload. To send an empty payload, the endpoint must assert `zlp` and
         `lst` at the beginning of the transfer.
+    stall : Signal, out
+        Write stall. Only present if `xfer` is ``Transfer.CONTROL``. While asserted, the device
+        answers IN tokens with a STALL handshake, which ends the current control transfer.
+    halt : Signal, out
+        Halt request. Only present if `xfer` is ``Transfer.BULK`` or ``Transfer.INTERRUPT``.
+        Asserting it for one cycle halts the endpoint, until the host clears its halt state.
     rdy : Signal, in
         Write ready. Asserted when the device is ready to accept data from the endpoint.
     ack : Signal, in
         Write acknowledge. Asserted when the device received an ACK for the previous payload.
         Unused if the endpoint was added to the device with a double buffer. This signal allows
         the endpoint to implement its own buffering mechanism.
+    halted : Signal, in
+        Halt state. Only present if `xfer` is ``Transfer.BULK`` or ``Transfer.INTERRUPT``.
+        Asserted while the endpoint is halted. The device then answers IN tokens with a STALL
+        handshake.
     sof : Signal, in
-        Start of (micro)frame. Asserted when the device received a SOF packet.
+        Start of (micro)frame. Asserted when the device received a SOF packet, or extrapolated
+        a missing one.
+    frame : Signal(11), in
+        Frame number. Valid when `sof` is asserted, and until the next SOF.
+    microframe : Signal(3), in
+        Microframe index in the current frame. See :class:`device.Device`.
     """.strip())
-    def __init__(self, *, xfer, max_size, name=None, src_loc_at=0):
+    def __init__(self, *, xfer, max_size, transactions=1, data_width=8, interval=None,
+                 name=None, src_loc_at=0):
+        _check_data_width(data_width)
         layout = [
             ("stb",  1, DIR_FANOUT),
             ("lst",  1, DIR_FANOUT),
-            ("data", 8, DIR_FANOUT),
+            ("data", data_width, DIR_FANOUT),
+            ("be",   _be_width(data_width), DIR_FANOUT),
             ("zlp",  1, DIR_FANOUT),
+            ("stall", 1 if xfer is Transfer.CONTROL else 0, DIR_FANOUT),
+            ("halt", _halt_width(xfer), DIR_FANOUT),
             ("rdy",  1, DIR_FANIN),
             ("ack",  1, DIR_FANIN),
+            ("halted", _halt_width(xfer), DIR_FANIN),
             ("sof",  1, DIR_FANIN),
+            ("frame", 11, DIR_FANIN),
+            ("microframe", 3, DIR_FANIN),
         ]
-        super().__init__(layout, xfer, max_size, name=name, src_loc_at=1 + src_loc_at)
+        super().__init__(layout, xfer, max_size, transactions, data_width, interval, name=name,
+                         src_loc_at=1 + src_loc_at)
 
 
 class OutputEndpoint(_Endpoint):
@@ -117,12 +209,25 @@ class OutputEndpoint(_Endpoint):
     attributes="""
     rdy : Signal, out
         Read ready. Asserted when the endpoint is ready to accept data from the device.
+    stall : Signal, out
+        Read stall. Only present if `xfer` is ``Transfer.CONTROL``. While asserted, the device
+        answers OUT and PING tokens with a STALL handshake. SETUP packets are still accepted.
+    halt : Signal, out
+        Halt request. Only present if `xfer` is ``Transfer.BULK`` or ``Transfer.INTERRUPT``.
+        Asserting it for one cycle halts the endpoint, until the host clears its halt state.
+    halted : Signal, in
+        Halt state. Only present if `xfer` is ``Transfer.BULK`` or ``Transfer.INTERRUPT``.
+        Asserted while the endpoint is halted. The device then answers OUT and PING tokens with
+        a STALL handshake.
     stb : Signal, in
         Read strobe.
     lst : Signal, in
         Read last. Asserted when `data` holds the last byte of the payload.
     data : Signal, in
         Read data.
+    be : Signal(data_width // 8), in
+        Read byte enable. Only present if `data_width` is greater than 8. Bit `i` is asserted
+        when byte `i` of `data` is valid. Only the last word of a payload may be partial.
     zlp : Signal, in
         Read zero-length. Asserted when the payload is empty. Valid when `lst` is asserted.
     setup : Signal, in
@@ -132,17 +237,31 @@ class OutputEndpoint(_Endpoint):
         Unused if the endpoint was added to the device with a double buffer. This signal allows
         the endpoint to implement its own buffering mechanism.
     sof : Signal, in
-        Start of frame. Asserted when the device received a SOF packet.
+        Start of (micro)frame. Asserted when the device received a SOF packet, or extrapolated
+        a missing one.
+    frame : Signal(11), in
+        Frame number. Valid when `sof` is asserted, and until the next SOF.
+    microframe : Signal(3), in
+        Microframe index in the current frame. See :class:`device.Device`.
     """.strip())
-    def __init__(self, *, xfer, max_size, name=None, src_loc_at=0):
+    def __init__(self, *, xfer, max_size, transactions=1, data_width=8, interval=None,
+                 name=None, src_loc_at=0):
+        _check_data_width(data_width)
         layout = [
             ("rdy",   1, DIR_FANOUT),
+            ("stall", 1 if xfer is Transfer.CONTROL else 0, DIR_FANOUT),
+            ("halt",  _halt_width(xfer), DIR_FANOUT),
             ("stb",   1, DIR_FANIN),
             ("lst",   1, DIR_FANIN),
-            ("data",  8, DIR_FANIN),
+            ("data",  data_width, DIR_FANIN),
+            ("be",    _be_width(data_width), DIR_FANIN),
             ("zlp",   1, DIR_FANIN),
             ("setup", 1 if xfer is Transfer.CONTROL else 0, DIR_FANIN),
             ("drop",  1, DIR_FANIN),
+            ("halted", _halt_width(xfer), DIR_FANIN),
             ("sof",   1, DIR_FANIN),
+            ("frame", 11, DIR_FANIN),
+            ("microframe", 3, DIR_FANIN),
         ]
-        super().__init__(layout, xfer, max_size, name=name, src_loc_at=1 + src_loc_at)
+        super().__init__(layout, xfer, max_size, transactions, data_width, interval, name=name,
+                         src_loc_at=1 + src_loc_at)
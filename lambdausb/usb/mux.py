@@ -2,11 +2,16 @@ from collections import OrderedDict
 
 from nmigen import *
 from nmigen.hdl.rec import *
+from nmigen.lib.coding import PriorityEncoder
 
 from .endpoint import *
+from .endpoint import _check_data_width
 
 
-__all__ = ["DoubleBuffer", "InputMultiplexer", "OutputMultiplexer"]
+__all__ = [
+    "DoubleBuffer", "PacketRing", "PacketPool", "CutThroughBuffer",
+    "InputMultiplexer", "OutputMultiplexer",
+]
 
 
 class DoubleBuffer(Elaboratable):
@@ -16,12 +21,14 @@ class DoubleBuffer(Elaboratable):
         self.w_data = Signal(width)
         self.w_drop = Signal()
         self.w_rdy  = Signal()
+        self.w_avail = Signal()
 
         self.r_stb  = Signal()
         self.r_lst  = Signal()
         self.r_data = Signal(width)
         self.r_rdy  = Signal()
         self.r_ack  = Signal(1 if read_ack else 0)
+        self.r_level = Signal(range(depth + 1))
 
         self.depth = depth
         self.width = width
@@ -51,6 +58,8 @@ class DoubleBuffer(Elaboratable):
 
         bank_lru = Signal()
 
+        m.d.comb += self.w_avail.eq(~banks[0].valid | ~banks[1].valid)
+
         with m.FSM(reset="WRITE-0") as write_fsm:
             with m.State("WAIT"):
                 with m.If(~banks[0].valid):
@@ -60,7 +69,7 @@ class DoubleBuffer(Elaboratable):
 
             for i, bank in enumerate(banks):
                 with m.State("WRITE-{}".format(i)):
-                    w_addr_inc = Signal.like(bank.w_addr, name_suffix="_inc")
+                    w_addr_inc = Signal(range(self.depth + 1), name=bank.w_addr.name + "_inc")
                     m.d.comb += w_addr_inc.eq(bank.w_addr + 1)
                     m.d.comb += [
                         self.w_rdy.eq(1),
@@ -104,11 +113,12 @@ class DoubleBuffer(Elaboratable):
 
             for i, bank in enumerate(banks):
                 with m.State("READ-{}".format(i)):
-                    r_addr_inc = Signal.like(bank.r_addr, name_suffix="_inc")
+                    r_addr_inc = Signal(range(self.depth + 1), name=bank.r_addr.name + "_inc")
                     m.d.comb += r_addr_inc.eq(bank.r_addr + 1)
                     m.d.comb += [
                         self.r_stb.eq(1),
                         self.r_data.eq(bank.r_data),
+                        self.r_level.eq(bank.level),
                     ]
                     with m.If(self.r_rdy):
                         r_done = self.r_ack if self.read_ack else self.r_lst
@@ -128,27 +138,626 @@ class DoubleBuffer(Elaboratable):
         return m
 
 
+class PacketRing(Elaboratable):
+    """Packet ring buffer.
+
+    A ring of `n_packets` slots, each holding a packet of up to `depth` entries. All slots share
+    a single memory. Packets are read in the order they were written. The interface is identical
+    to the one of :class:`DoubleBuffer`.
+    """
+    def __init__(self, *, depth, width, n_packets, read_ack=False):
+        if not isinstance(n_packets, int) or n_packets < 1:
+            raise ValueError("Number of packets must be a positive integer, not {!r}"
+                             .format(n_packets))
+
+        self.w_stb  = Signal()
+        self.w_lst  = Signal()
+        self.w_data = Signal(width)
+        self.w_drop = Signal()
+        self.w_rdy  = Signal()
+        self.w_avail = Signal()
+
+        self.r_stb  = Signal()
+        self.r_lst  = Signal()
+        self.r_data = Signal(width)
+        self.r_rdy  = Signal()
+        self.r_ack  = Signal(1 if read_ack else 0)
+        self.r_level = Signal(range(depth + 1))
+
+        self.depth = depth
+        self.width = width
+        self.n_packets = n_packets
+        self.read_ack = read_ack
+
+    def elaborate(self, platform):
+        m = Module()
+
+        mem = Memory(depth=self.depth * self.n_packets, width=self.width)
+        m.submodules.mem_wp = mem_wp = mem.write_port()
+        m.submodules.mem_rp = mem_rp = mem.read_port(transparent=False)
+        mem_rp.en.reset = 0
+
+        slots = [Record([("valid", 1), ("level", range(self.depth + 1))],
+                        name="slot_{}".format(i))
+                 for i in range(self.n_packets)]
+        slot_valid = Array(slot.valid for slot in slots)
+        slot_level = Array(slot.level for slot in slots)
+
+        w_slot = Signal(range(self.n_packets))
+        w_base = Signal(range(self.depth * self.n_packets))
+        w_addr = Signal(range(self.depth))
+        r_slot = Signal.like(w_slot)
+        r_base = Signal.like(w_base)
+        r_addr = Signal.like(w_addr)
+
+        m.d.comb += [
+            mem_wp.addr.eq(w_base + w_addr),
+            mem_wp.data.eq(self.w_data),
+            mem_rp.addr.eq(r_base + r_addr),
+            self.r_data.eq(mem_rp.data),
+        ]
+
+        m.d.comb += self.w_avail.eq(~slot_valid[w_slot])
+
+        with m.FSM() as write_fsm:
+            with m.State("WRITE"):
+                w_addr_inc = Signal(range(self.depth + 1))
+                m.d.comb += w_addr_inc.eq(w_addr + 1)
+                m.d.comb += [
+                    self.w_rdy.eq(~slot_valid[w_slot]),
+                    mem_wp.en.eq(self.w_stb & self.w_rdy),
+                ]
+                with m.If(self.w_stb & self.w_rdy):
+                    with m.If(self.w_lst):
+                        m.d.sync += w_addr.eq(0)
+                        with m.If(~self.w_drop):
+                            m.d.sync += [
+                                slot_valid[w_slot].eq(1),
+                                slot_level[w_slot].eq(w_addr_inc),
+                            ]
+                            with m.If(w_slot == self.n_packets - 1):
+                                m.d.sync += w_slot.eq(0)
+                                m.d.sync += w_base.eq(0)
+                            with m.Else():
+                                m.d.sync += w_slot.eq(w_slot + 1)
+                                m.d.sync += w_base.eq(w_base + self.depth)
+                    with m.Elif(w_addr_inc == self.depth):
+                        # Overflow. Flush remaining bytes.
+                        m.d.sync += w_addr.eq(0)
+                        m.next = "FLUSH"
+                    with m.Else():
+                        m.d.sync += w_addr.eq(w_addr_inc)
+
+            with m.State("FLUSH"):
+                m.d.comb += self.w_rdy.eq(1)
+                with m.If(self.w_stb & self.w_lst):
+                    m.next = "WRITE"
+
+        with m.FSM() as read_fsm:
+            with m.State("WAIT"):
+                with m.If(slot_valid[r_slot]):
+                    m.d.comb += mem_rp.en.eq(1)
+                    m.d.sync += r_addr.eq(1)
+                    m.d.sync += self.r_lst.eq(slot_level[r_slot] == 1)
+                    m.next = "READ"
+
+            with m.State("READ"):
+                r_addr_inc = Signal(range(self.depth + 1))
+                m.d.comb += r_addr_inc.eq(r_addr + 1)
+                m.d.comb += [
+                    self.r_stb.eq(1),
+                    self.r_level.eq(slot_level[r_slot]),
+                ]
+                with m.If(self.r_rdy):
+                    r_done = self.r_ack if self.read_ack else self.r_lst
+                    with m.If(r_done):
+                        m.d.sync += slot_valid[r_slot].eq(0)
+                        m.d.sync += r_addr.eq(0)
+                        with m.If(r_slot == self.n_packets - 1):
+                            m.d.sync += r_slot.eq(0)
+                            m.d.sync += r_base.eq(0)
+                        with m.Else():
+                            m.d.sync += r_slot.eq(r_slot + 1)
+                            m.d.sync += r_base.eq(r_base + self.depth)
+                        m.next = "WAIT"
+                    with m.Else():
+                        m.d.comb += mem_rp.en.eq(1)
+                        with m.If(r_addr_inc == self.r_level):
+                            m.d.sync += r_addr.eq(0)
+                            m.d.sync += self.r_lst.eq(1)
+                        with m.Else():
+                            m.d.sync += r_addr.eq(r_addr_inc)
+                            m.d.sync += self.r_lst.eq(0)
+
+        return m
+
+
+class PacketPool(Elaboratable):
+    """Shared packet buffer.
+
+    A pool of packet slots, each holding a packet of up to `depth` entries, shared by several
+    packet queues. All slots are stored in a single memory. Each queue is guaranteed to get
+    `reserved[i]` slots, and may draw up to `n_shared` additional slots from a shared region
+    once its reservation is exhausted.
+
+    A packet is written to the queue selected by `w_sel`, and read from the queue selected by
+    `r_sel`. `w_sel` must remain stable while a packet is being written. If `r_sel` changes
+    before a packet is read entirely, the packet is kept in its queue and will be read again
+    from its beginning.
+    """
+    def __init__(self, *, depth, width, reserved, n_shared=0, read_ack=False):
+        reserved = list(reserved)
+        if not reserved:
+            raise ValueError("Packet pool must have at least one queue")
+        for n in reserved:
+            if not isinstance(n, int) or n < 0:
+                raise ValueError("Number of reserved packets must be a non-negative integer, "
+                                 "not {!r}".format(n))
+        if not isinstance(n_shared, int) or n_shared < 0:
+            raise ValueError("Number of shared packets must be a non-negative integer, not {!r}"
+                             .format(n_shared))
+        if sum(reserved) + n_shared == 0:
+            raise ValueError("Packet pool must have at least one slot")
+        if isinstance(read_ack, bool):
+            read_ack = [read_ack] * len(reserved)
+
+        self.w_sel  = Signal(range(len(reserved)))
+        self.w_stb  = Signal()
+        self.w_lst  = Signal()
+        self.w_data = Signal(width)
+        self.w_drop = Signal()
+        self.w_rdy  = Signal()
+        self.w_avail = Signal(len(reserved))
+
+        self.r_sel  = Signal(range(len(reserved)))
+        self.r_stb  = Signal()
+        self.r_lst  = Signal()
+        self.r_data = Signal(width)
+        self.r_rdy  = Signal()
+        self.r_ack  = Signal(1 if any(read_ack) else 0)
+        self.r_level = Signal(range(depth + 1))
+        self.r_avail = Signal(len(reserved))
+
+        self.depth    = depth
+        self.width    = width
+        self.reserved = reserved
+        self.n_shared = n_shared
+        self.n_slots  = sum(reserved) + n_shared
+        self.read_ack = list(read_ack)
+
+    def elaborate(self, platform):
+        m = Module()
+
+        mem = Memory(depth=self.depth * self.n_slots, width=self.width)
+        m.submodules.mem_wp = mem_wp = mem.write_port()
+        m.submodules.mem_rp = mem_rp = mem.read_port(transparent=False)
+        mem_rp.en.reset = 0
+
+        # Slot descriptors. Each queue is a linked list of slots.
+        slot_free  = [Signal(name="slot_{}_free".format(i), reset=1)
+                      for i in range(self.n_slots)]
+        slot_next  = Array(Signal(range(self.n_slots), name="slot_{}_next".format(i))
+                           for i in range(self.n_slots))
+        slot_level = Array(Signal(range(self.depth + 1), name="slot_{}_level".format(i))
+                           for i in range(self.n_slots))
+
+        queues = [Record([("used",  range(self.n_slots + 1)),
+                          ("count", range(self.n_slots + 1)),
+                          ("head",  range(self.n_slots)),
+                          ("tail",  range(self.n_slots))],
+                         name="queue_{}".format(i))
+                  for i in range(len(self.reserved))]
+        q_count = Array(q.count for q in queues)
+        q_head  = Array(q.head  for q in queues)
+        q_tail  = Array(q.tail  for q in queues)
+
+        # Slot allocation
+
+        m.submodules.free_enc = free_enc = PriorityEncoder(self.n_slots)
+        m.d.comb += free_enc.i.eq(Cat(slot_free))
+
+        shared_used = Signal(range(self.n_slots + 1))
+        m.d.comb += shared_used.eq(sum(Mux(q.used > n, q.used - n, 0)
+                                       for q, n in zip(queues, self.reserved)))
+        for i, (q, n) in enumerate(zip(queues, self.reserved)):
+            m.d.comb += [
+                self.w_avail[i].eq((q.used < n) | (shared_used < self.n_shared)),
+                self.r_avail[i].eq(q.count != 0),
+            ]
+
+        # Write port
+
+        alloc  = Signal()
+        w_free = Signal()
+        push   = Signal()
+
+        w_active = Signal()
+        w_slot_r = Signal(range(self.n_slots))
+        w_slot   = Signal(range(self.n_slots))
+        w_addr   = Signal(range(self.depth))
+        m.d.comb += [
+            w_slot.eq(Mux(w_active, w_slot_r, free_enc.o)),
+            mem_wp.addr.eq(w_slot * self.depth + w_addr),
+            mem_wp.data.eq(self.w_data),
+        ]
+
+        with m.FSM() as write_fsm:
+            with m.State("WRITE"):
+                w_addr_inc = Signal(range(self.depth + 1))
+                m.d.comb += w_addr_inc.eq(w_addr + 1)
+                m.d.comb += [
+                    self.w_rdy.eq(w_active | self.w_avail.bit_select(self.w_sel, 1)),
+                    mem_wp.en.eq(self.w_stb & self.w_rdy),
+                ]
+                with m.If(self.w_stb & self.w_rdy):
+                    with m.If(~w_active):
+                        m.d.comb += alloc.eq(1)
+                        m.d.sync += [
+                            w_slot_r.eq(free_enc.o),
+                            w_active.eq(1),
+                        ]
+                    with m.If(self.w_lst):
+                        m.d.sync += w_active.eq(0)
+                        m.d.sync += w_addr.eq(0)
+                        with m.If(self.w_drop):
+                            m.d.comb += [
+                                alloc.eq(0),
+                                w_free.eq(w_active),
+                            ]
+                        with m.Else():
+                            m.d.comb += push.eq(1)
+                            m.d.sync += slot_level[w_slot].eq(w_addr_inc)
+                    with m.Elif(w_addr_inc == self.depth):
+                        # Overflow. Release the slot and flush remaining bytes.
+                        m.d.sync += w_active.eq(0)
+                        m.d.sync += w_addr.eq(0)
+                        m.d.comb += [
+                            alloc.eq(0),
+                            w_free.eq(w_active),
+                        ]
+                        m.next = "FLUSH"
+                    with m.Else():
+                        m.d.sync += w_addr.eq(w_addr_inc)
+
+            with m.State("FLUSH"):
+                m.d.comb += self.w_rdy.eq(1)
+                with m.If(self.w_stb & self.w_lst):
+                    m.next = "WRITE"
+
+        # Read port
+
+        pop = Signal()
+
+        r_cur  = Signal.like(self.r_sel)
+        r_addr = Signal(range(self.depth))
+        r_head = Signal(range(self.n_slots))
+        m.d.comb += [
+            r_head.eq(q_head[r_cur]),
+            self.r_data.eq(mem_rp.data),
+        ]
+
+        with m.FSM() as read_fsm:
+            def fetch():
+                with m.If(q_count[self.r_sel] != 0):
+                    m.d.comb += [
+                        mem_rp.addr.eq(q_head[self.r_sel] * self.depth),
+                        mem_rp.en.eq(1),
+                    ]
+                    m.d.sync += [
+                        r_cur.eq(self.r_sel),
+                        r_addr.eq(1),
+                        self.r_lst.eq(slot_level[q_head[self.r_sel]] == 1),
+                    ]
+                    m.next = "READ"
+                with m.Else():
+                    m.next = "WAIT"
+
+            with m.State("WAIT"):
+                fetch()
+
+            with m.State("READ"):
+                with m.If(self.r_sel != r_cur):
+                    # The reader selected another queue. Fetch its first packet instead.
+                    fetch()
+                with m.Else():
+                    r_addr_inc = Signal(range(self.depth + 1))
+                    m.d.comb += r_addr_inc.eq(r_addr + 1)
+                    m.d.comb += [
+                        self.r_stb.eq(1),
+                        self.r_level.eq(slot_level[r_head]),
+                        mem_rp.addr.eq(r_head * self.depth + r_addr),
+                    ]
+                    with m.If(self.r_rdy):
+                        if any(self.read_ack):
+                            read_ack = Array(Const(x) for x in self.read_ack)[r_cur]
+                            r_done = Mux(read_ack, self.r_ack, self.r_lst)
+                        else:
+                            r_done = self.r_lst
+                        with m.If(r_done):
+                            m.d.comb += pop.eq(1)
+                            m.d.sync += r_addr.eq(0)
+                            m.next = "WAIT"
+                        with m.Else():
+                            m.d.comb += mem_rp.en.eq(1)
+                            with m.If(r_addr_inc == self.r_level):
+                                m.d.sync += r_addr.eq(0)
+                                m.d.sync += self.r_lst.eq(1)
+                            with m.Else():
+                                m.d.sync += r_addr.eq(r_addr_inc)
+                                m.d.sync += self.r_lst.eq(0)
+
+        # Descriptor updates
+
+        for i, slot_free_i in enumerate(slot_free):
+            with m.If(alloc & (free_enc.o == i)):
+                m.d.sync += slot_free_i.eq(0)
+            with m.If(w_free & (w_slot_r == i) | pop & (r_head == i)):
+                m.d.sync += slot_free_i.eq(1)
+
+        with m.If(push & (q_count[self.w_sel] != 0)):
+            m.d.sync += slot_next[q_tail[self.w_sel]].eq(w_slot)
+
+        for i, q in enumerate(queues):
+            push_i  = push   & (self.w_sel == i)
+            alloc_i = alloc  & (self.w_sel == i)
+            free_i  = w_free & (self.w_sel == i)
+            pop_i   = pop    & (r_cur == i)
+
+            m.d.sync += [
+                q.used .eq(q.used  + alloc_i - free_i - pop_i),
+                q.count.eq(q.count + push_i  - pop_i),
+            ]
+            with m.If(push_i):
+                m.d.sync += q.tail.eq(w_slot)
+            with m.If(pop_i):
+                with m.If(q.count == 1):
+                    m.d.sync += q.head.eq(w_slot)
+                with m.Else():
+                    m.d.sync += q.head.eq(slot_next[q.head])
+            with m.Elif(push_i & (q.count == 0)):
+                m.d.sync += q.head.eq(w_slot)
+
+        return m
+
+
+class CutThroughBuffer(Elaboratable):
+    """Cut-through packet buffer.
+
+    A FIFO of `depth` entries. Entries can be read as soon as they are written, before the end of
+    their packet. The packet being written is only committed when its last entry is written
+    without `w_drop`.
+
+    If a packet is dropped, its unread entries are rolled back. If some of its entries were
+    already read, a terminator entry with `r_lst` and `r_drop` asserted (and `r_data` cleared) is
+    appended, so that the reader can discard them.
+
+    If an entry is written while the FIFO is full, `w_rdy` is deasserted and the remaining
+    entries of the packet are refused. The packet is then dropped when its last entry is written.
+
+    As packets are read while they are written, `w_avail` does not wait for room for a whole
+    packet. It is asserted if the FIFO is not full and no packet is being refused, whether or not
+    an entry is being written.
+    """
+    def __init__(self, *, depth, width):
+        if not isinstance(depth, int) or depth < 2 or depth & (depth - 1):
+            raise ValueError("Depth must be a power of 2 greater than 1, not {!r}"
+                             .format(depth))
+
+        self.w_stb  = Signal()
+        self.w_lst  = Signal()
+        self.w_data = Signal(width)
+        self.w_drop = Signal()
+        self.w_rdy  = Signal()
+        self.w_avail = Signal()
+
+        self.r_stb  = Signal()
+        self.r_lst  = Signal()
+        self.r_data = Signal(width)
+        self.r_drop = Signal()
+        self.r_rdy  = Signal()
+
+        self.depth = depth
+        self.width = width
+
+    def elaborate(self, platform):
+        m = Module()
+
+        entry = Record([("data", self.width), ("lst", 1), ("drop", 1)])
+
+        mem = Memory(depth=self.depth, width=len(entry))
+        m.submodules.mem_wp = mem_wp = mem.write_port()
+        m.submodules.mem_rp = mem_rp = mem.read_port(domain="comb")
+
+        # Pointers have an extra wrap-around bit, to tell a full FIFO from an empty one.
+        w_ptr  = Signal(range(2 * self.depth))
+        r_ptr  = Signal.like(w_ptr)
+        w_base = Signal.like(w_ptr)
+        w_fail = Signal()
+
+        level = Signal.like(w_ptr)
+        full  = Signal()
+        m.d.comb += [
+            level.eq(w_ptr - r_ptr),
+            full.eq(level == self.depth),
+            self.w_avail.eq(~full & ~w_fail),
+        ]
+
+        # Read port
+
+        r_entry  = Record.like(entry)
+        r_ptr_next = Signal.like(r_ptr)
+        m.d.comb += [
+            mem_rp.addr.eq(r_ptr[:-1]),
+            r_entry.eq(mem_rp.data),
+            self.r_stb.eq(r_ptr != w_ptr),
+            self.r_lst.eq(r_entry.lst),
+            self.r_data.eq(r_entry.data),
+            self.r_drop.eq(r_entry.drop),
+            r_ptr_next.eq(r_ptr + (self.r_stb & self.r_rdy)),
+        ]
+        m.d.sync += r_ptr.eq(r_ptr_next)
+
+        # Write port
+
+        w_entry = Record.like(entry)
+        m.d.comb += [
+            mem_wp.addr.eq(w_ptr[:-1]),
+            mem_wp.data.eq(w_entry),
+            w_entry.data.eq(self.w_data),
+            w_entry.lst.eq(self.w_lst),
+        ]
+
+        with m.If(self.w_stb):
+            with m.If(self.w_lst):
+                with m.If(self.w_drop | w_fail | full):
+                    # Roll back the packet. If the reader already went past its beginning,
+                    # append a terminator entry to let it discard what it has read.
+                    r_consumed = Signal.like(w_ptr)
+                    w_written  = Signal.like(w_ptr)
+                    m.d.comb += [
+                        r_consumed.eq(r_ptr_next - w_base),
+                        w_written .eq(w_ptr - w_base),
+                    ]
+                    with m.If((r_consumed != 0) & (r_consumed <= w_written)):
+                        m.d.comb += [
+                            mem_wp.addr.eq(r_ptr_next[:-1]),
+                            mem_wp.en.eq(1),
+                            w_entry.data.eq(0),
+                            w_entry.drop.eq(1),
+                        ]
+                        m.d.sync += [
+                            w_ptr .eq(r_ptr_next + 1),
+                            w_base.eq(r_ptr_next + 1),
+                        ]
+                    with m.Else():
+                        m.d.sync += w_ptr.eq(w_base)
+                    m.d.comb += self.w_rdy.eq(~full)
+                with m.Else():
+                    # Commit the packet.
+                    m.d.comb += [
+                        mem_wp.en.eq(1),
+                        self.w_rdy.eq(1),
+                    ]
+                    m.d.sync += [
+                        w_ptr .eq(w_ptr + 1),
+                        w_base.eq(w_ptr + 1),
+                    ]
+                m.d.sync += w_fail.eq(0)
+            with m.Elif(full | w_fail):
+                m.d.sync += w_fail.eq(1)
+            with m.Else():
+                m.d.comb += [
+                    mem_wp.en.eq(1),
+                    self.w_rdy.eq(1),
+                ]
+                m.d.sync += w_ptr.eq(w_ptr + 1)
+
+        return m
+
+
+def _hb_transactions(ep):
+    # Only the payloads of isochronous endpoints span several transactions. High-bandwidth
+    # interrupt endpoints send or receive a distinct payload for each transaction.
+    if ep.xfer is Transfer.ISOCHRONOUS:
+        return ep.transactions
+    return 1
+
+
+def _check_buffered(buffered):
+    if not isinstance(buffered, int):
+        raise TypeError("Endpoint buffering must be a boolean or an integer, not {!r}"
+                        .format(buffered))
+    if not isinstance(buffered, bool) and buffered < 1:
+        raise ValueError("Number of buffered packets must be a positive integer, not {}"
+                         .format(buffered))
+
+
+def _check_endpoint_data_width(ep, data_width):
+    if ep.data_width != data_width:
+        raise ValueError("Endpoint {!r} has a data width of {}, but the multiplexer has a data "
+                         "width of {}".format(ep, ep.data_width, data_width))
+    if _hb_transactions(ep) > 1 and ep.max_size % (data_width // 8) != 0:
+        raise ValueError("Invalid maximum packet size {} for high-bandwidth isochronous "
+                         "endpoint {!r}; must be a multiple of {} bytes"
+                         .format(ep.max_size, ep, data_width // 8))
+
+
+def _check_shared_packets(shared_packets):
+    if not isinstance(shared_packets, int) or shared_packets < 0:
+        raise ValueError("Number of shared packets must be a non-negative integer, not {!r}"
+                         .format(shared_packets))
+
+
+def _check_shared(ep, buffered, shared, shared_packets):
+    if not isinstance(shared, bool):
+        raise TypeError("Endpoint sharing must be a boolean, not {!r}".format(shared))
+    if not shared:
+        return
+    if _hb_transactions(ep) > 1:
+        raise ValueError("High-bandwidth isochronous endpoint {!r} cannot use the shared "
+                         "packet pool".format(ep))
+    if _reserved_packets(buffered) == 0 and shared_packets == 0:
+        raise ValueError("Endpoint {!r} has no reserved packets and the shared packet pool is "
+                         "empty".format(ep))
+
+
+def _reserved_packets(buffered):
+    # A double buffer is replaced by two reserved slots.
+    return 2 if buffered is True else int(buffered)
+
+
+def _word_count(ep, size):
+    # Number of words needed to hold `size` bytes.
+    return -(-size // (ep.data_width // 8))
+
+
+def _make_pool(eps, shared_packets, *, width, read_ack=False):
+    return PacketPool(depth=max(_word_count(ep, ep.max_size) for ep, _ in eps), width=width,
+                      reserved=[_reserved_packets(buffered) for _, buffered in eps],
+                      n_shared=shared_packets,
+                      read_ack=[read_ack and ep.xfer is not Transfer.ISOCHRONOUS
+                                for ep, _ in eps])
+
+
+def _make_buffer(ep, buffered, *, width, read_ack=False):
+    depth = _word_count(ep, ep.max_size * _hb_transactions(ep))
+    if buffered is True:
+        return DoubleBuffer(depth=depth, width=width, read_ack=read_ack)
+    else:
+        return PacketRing(depth=depth, width=width, n_packets=buffered, read_ack=read_ack)
+
+
 class InputMultiplexer(Elaboratable):
-    def __init__(self):
+    def __init__(self, *, data_width=8, shared_packets=0):
+        _check_data_width(data_width)
+        _check_shared_packets(shared_packets)
+
         self.sel = Record([
             ("addr", 4, DIR_FANIN),
             ("xfer", 2, DIR_FANOUT),
+            ("stall", 1, DIR_FANOUT),
             ("err",  1, DIR_FANOUT),
         ])
         self.pkt = Record([
             ("stb",  1, DIR_FANOUT),
             ("lst",  1, DIR_FANOUT),
-            ("data", 8, DIR_FANOUT),
+            ("data", data_width, DIR_FANOUT),
+            ("be",   data_width // 8 if data_width > 8 else 0, DIR_FANOUT),
             ("zlp",  1, DIR_FANOUT),
+            ("seq",  2, DIR_FANOUT),
             ("rdy",  1, DIR_FANIN),
             ("ack",  1, DIR_FANIN),
         ])
         self.sof = Signal()
+        self.frame = Signal(11)
+        self.microframe = Signal(3)
 
         self._ep_map   = OrderedDict()
         self._addr_map = OrderedDict()
+        self._shared_packets = shared_packets
+        self.data_width = data_width
 
-    def add_endpoint(self, ep, *, addr, buffered=False):
+    def add_endpoint(self, ep, *, addr, buffered=False, shared=False):
         if not isinstance(ep, InputEndpoint):
             raise TypeError("Endpoint must be an InputEndpoint, not {!r}"
                              .format(ep))
@@ -167,7 +776,13 @@ class InputMultiplexer(Elaboratable):
         if addr == 0 and ep.xfer is not Transfer.CONTROL:
             raise ValueError("Invalid transfer type {} for endpoint 0; must be CONTROL"
                              .format(Transfer(ep.xfer).name))
-        self._ep_map[addr] = ep, buffered
+        _check_endpoint_data_width(ep, self.data_width)
+        _check_buffered(buffered)
+        if ep.xfer is Transfer.ISOCHRONOUS and ep.transactions > 1 and not buffered:
+            raise ValueError("High-bandwidth isochronous endpoint {!r} must be buffered"
+                             .format(ep))
+        _check_shared(ep, buffered, shared, self._shared_packets)
+        self._ep_map[addr] = ep, buffered, shared
         self._addr_map[ep] = addr
 
     def elaborate(self, platform):
@@ -175,43 +790,131 @@ class InputMultiplexer(Elaboratable):
 
         port_map = OrderedDict({addr: Record.like(self.pkt) for addr in self._ep_map})
 
-        for addr, (ep, buffered) in self._ep_map.items():
+        for addr, (ep, buffered, shared) in self._ep_map.items():
             port = port_map[addr]
-            if buffered:
-                dbuf = DoubleBuffer(depth=ep.max_size, width=port.data.width + port.zlp.width,
+            if shared:
+                # The endpoint is connected to the shared packet pool below.
+                pass
+            elif buffered:
+                dbuf = _make_buffer(ep, buffered, width=len(Cat(port.data, port.be, port.zlp)),
                                     read_ack=ep.xfer is not Transfer.ISOCHRONOUS)
                 m.submodules["dbuf_{}".format(addr)] = dbuf
                 m.d.comb += [
                     dbuf.w_stb.eq(ep.stb),
                     dbuf.w_lst.eq(ep.lst),
-                    dbuf.w_data.eq(Cat(ep.data, ep.zlp)),
+                    dbuf.w_data.eq(Cat(ep.data, ep.be, ep.zlp)),
                     ep.rdy.eq(dbuf.w_rdy),
 
                     port.stb.eq(dbuf.r_stb),
                     port.lst.eq(dbuf.r_lst),
-                    Cat(port.data, port.zlp).eq(dbuf.r_data),
+                    Cat(port.data, port.be, port.zlp).eq(dbuf.r_data),
                     dbuf.r_rdy.eq(port.rdy),
                     dbuf.r_ack.eq(port.ack),
                 ]
+                if _hb_transactions(ep) > 1:
+                    # The payload of a high-bandwidth isochronous endpoint is split into up to
+                    # 3 packets. Their data PIDs (DATA2, DATA1 or DATA0) depend on the number of
+                    # packets left in the microframe. See section 5.9.2 of the USB 2.0 spec.
+                    pkt_size = _word_count(ep, ep.max_size)
+                    tx_ctr = Signal(range(pkt_size), name="tx_ctr_{}".format(addr))
+                    pkt_ctr = Signal(2, name="pkt_ctr_{}".format(addr))
+                    pkt_cnt = Signal(2, name="pkt_cnt_{}".format(addr))
+                    drop = Signal(name="drop_{}".format(addr))
+                    m.d.comb += pkt_cnt.eq(sum(dbuf.r_level > pkt_size * i
+                                               for i in range(1, ep.transactions)))
+                    m.d.comb += [
+                        port.lst.eq(dbuf.r_lst | (tx_ctr == pkt_size - 1)),
+                        port.seq.eq(pkt_cnt - pkt_ctr),
+                    ]
+                    with m.If(drop):
+                        # Discard the rest of the payload of the previous microframe.
+                        m.d.comb += [
+                            port.stb.eq(0),
+                            dbuf.r_rdy.eq(1),
+                        ]
+                        with m.If(dbuf.r_stb & dbuf.r_lst):
+                            m.d.sync += drop.eq(0)
+                    with m.Elif(port.stb & port.rdy):
+                        with m.If(port.lst):
+                            m.d.sync += tx_ctr.eq(0)
+                            m.d.sync += pkt_ctr.eq(Mux(dbuf.r_lst, 0, pkt_ctr + 1))
+                        with m.Else():
+                            m.d.sync += tx_ctr.eq(tx_ctr + 1)
+                    with m.If(self.sof):
+                        # The host did not request every packet of the payload during the
+                        # previous microframe. Its remaining packets are stale.
+                        m.d.sync += [
+                            tx_ctr.eq(0),
+                            pkt_ctr.eq(0),
+                        ]
+                        with m.If((tx_ctr != 0) | (pkt_ctr != 0)):
+                            m.d.sync += drop.eq(1)
             else:
                 m.d.comb += [
                     port.stb.eq(ep.stb),
                     port.lst.eq(ep.lst),
                     port.data.eq(ep.data),
+                    port.be.eq(ep.be),
                     port.zlp.eq(ep.zlp),
                     ep.rdy.eq(port.rdy),
                     ep.ack.eq(port.ack),
                 ]
-            m.d.comb += ep.sof.eq(self.sof)
+            m.d.comb += [
+                ep.sof.eq(self.sof),
+                ep.frame.eq(self.frame),
+                ep.microframe.eq(self.microframe),
+            ]
+
+        pool_map = OrderedDict((addr, (ep, buffered))
+                               for addr, (ep, buffered, shared) in self._ep_map.items()
+                               if shared)
+        if pool_map:
+            pool = _make_pool(pool_map.values(), self._shared_packets,
+                              width=len(Cat(self.pkt.data, self.pkt.be, self.pkt.zlp)),
+                              read_ack=True)
+            m.submodules.pool = pool
+
+            # Endpoints write packets to the pool one at a time. Once an endpoint has been
+            # granted access, it keeps it until the end of its packet.
+            w_busy  = Signal()
+            w_grant = Signal.like(pool.w_sel)
+            m.submodules.w_arbiter = w_arbiter = PriorityEncoder(len(pool_map))
+            m.d.comb += w_arbiter.i.eq(Cat(ep.stb for ep, _ in pool_map.values()) & pool.w_avail)
+            m.d.comb += pool.w_sel.eq(Mux(w_busy, w_grant, w_arbiter.o))
+
+            with m.Switch(pool.w_sel):
+                for i, (ep, _) in enumerate(pool_map.values()):
+                    with m.Case(i):
+                        m.d.comb += [
+                            pool.w_stb.eq(ep.stb & (w_busy | ~w_arbiter.n)),
+                            pool.w_lst.eq(ep.lst),
+                            pool.w_data.eq(Cat(ep.data, ep.be, ep.zlp)),
+                            ep.rdy.eq(pool.w_rdy & (w_busy | ~w_arbiter.n)),
+                        ]
+            with m.If(pool.w_stb & pool.w_rdy):
+                m.d.sync += [
+                    w_busy.eq(~pool.w_lst),
+                    w_grant.eq(pool.w_sel),
+                ]
 
         with m.Switch(self.sel.addr):
             for addr, port in port_map.items():
-                ep, _ = self._ep_map[addr]
+                ep, _, shared = self._ep_map[addr]
                 with m.Case(addr):
-                    m.d.comb += [
-                        self.sel.xfer.eq(ep.xfer),
-                        port.connect(self.pkt),
-                    ]
+                    m.d.comb += self.sel.xfer.eq(ep.xfer)
+                    if ep.xfer is Transfer.CONTROL:
+                        m.d.comb += self.sel.stall.eq(ep.stall)
+                    if shared:
+                        m.d.comb += [
+                            pool.r_sel.eq(list(pool_map).index(addr)),
+                            self.pkt.stb.eq(pool.r_stb),
+                            self.pkt.lst.eq(pool.r_lst),
+                            Cat(self.pkt.data, self.pkt.be, self.pkt.zlp).eq(pool.r_data),
+                            pool.r_rdy.eq(self.pkt.rdy),
+                            pool.r_ack.eq(self.pkt.ack),
+                        ]
+                    else:
+                        m.d.comb += port.connect(self.pkt)
             with m.Default():
                 # Unknown endpoint.
                 m.d.comb += self.sel.err.eq(1)
@@ -220,27 +923,38 @@ class InputMultiplexer(Elaboratable):
 
 
 class OutputMultiplexer(Elaboratable):
-    def __init__(self):
+    def __init__(self, *, data_width=8, shared_packets=0):
+        _check_data_width(data_width)
+        _check_shared_packets(shared_packets)
+
         self.sel = Record([
             ("addr", 4, DIR_FANIN),
             ("xfer", 2, DIR_FANOUT),
+            ("transactions", 2, DIR_FANOUT),
+            ("avail", 1, DIR_FANOUT),
+            ("stall", 1, DIR_FANOUT),
             ("err",  1, DIR_FANOUT),
         ])
         self.pkt = Record([
             ("stb",   1, DIR_FANIN),
             ("lst",   1, DIR_FANIN),
-            ("data",  8, DIR_FANIN),
+            ("data",  data_width, DIR_FANIN),
+            ("be",    data_width // 8 if data_width > 8 else 0, DIR_FANIN),
             ("zlp",   1, DIR_FANIN),
             ("setup", 1, DIR_FANIN),
             ("drop",  1, DIR_FANIN),
             ("rdy",   1, DIR_FANOUT),
         ])
         self.sof = Signal()
+        self.frame = Signal(11)
+        self.microframe = Signal(3)
 
         self._ep_map   = OrderedDict()
         self._addr_map = OrderedDict()
+        self._shared_packets = shared_packets
+        self.data_width = data_width
 
-    def add_endpoint(self, ep, *, addr, buffered=False):
+    def add_endpoint(self, ep, *, addr, buffered=False, shared=False, cut_through=False):
         if not isinstance(ep, OutputEndpoint):
             raise TypeError("Endpoint must be an OutputEndpoint, not {!r}"
                              .format(ep))
@@ -259,19 +973,54 @@ class OutputMultiplexer(Elaboratable):
         if addr == 0 and ep.xfer is not Transfer.CONTROL:
             raise ValueError("Invalid transfer type {} for endpoint 0; must be CONTROL"
                              .format(Transfer(ep.xfer).name))
-        self._ep_map[addr] = ep, buffered
+        _check_endpoint_data_width(ep, self.data_width)
+        _check_buffered(buffered)
+        if ep.xfer is Transfer.ISOCHRONOUS and ep.transactions > 1 and not buffered:
+            raise ValueError("High-bandwidth isochronous endpoint {!r} must be buffered"
+                             .format(ep))
+        _check_shared(ep, buffered, shared, self._shared_packets)
+        if not isinstance(cut_through, bool):
+            raise TypeError("Endpoint cut-through mode must be a boolean, not {!r}"
+                            .format(cut_through))
+        if cut_through and (buffered or shared):
+            raise ValueError("Endpoint {!r} cannot be both buffered and cut-through"
+                             .format(ep))
+        self._ep_map[addr] = ep, buffered, shared, cut_through
         self._addr_map[ep] = addr
 
     def elaborate(self, platform):
         m = Module()
 
         port_map = OrderedDict({addr: Record.like(self.pkt) for addr in self._ep_map})
+        # Asserted if the endpoint can accept a new packet.
+        avail_map = OrderedDict()
 
-        for addr, (ep, buffered) in self._ep_map.items():
+        for addr, (ep, buffered, shared, cut_through) in self._ep_map.items():
             port = port_map[addr]
-            if buffered:
-                dbuf_w_data = Cat(port.data, port.zlp, port.setup)
-                dbuf = DoubleBuffer(depth=ep.max_size, width=len(dbuf_w_data))
+            if shared:
+                # The endpoint is connected to the shared packet pool below.
+                pass
+            elif cut_through:
+                ctbuf_w_data = Cat(port.data, port.be, port.zlp, port.setup)
+                ctbuf = CutThroughBuffer(depth=16, width=len(ctbuf_w_data))
+                m.submodules["ctbuf_{}".format(addr)] = ctbuf
+                m.d.comb += [
+                    ctbuf.w_stb.eq(port.stb),
+                    ctbuf.w_lst.eq(port.lst),
+                    ctbuf.w_data.eq(ctbuf_w_data),
+                    ctbuf.w_drop.eq(port.drop),
+                    port.rdy.eq(ctbuf.w_rdy),
+
+                    ep.stb.eq(ctbuf.r_stb),
+                    ep.lst.eq(ctbuf.r_lst),
+                    Cat(ep.data, ep.be, ep.zlp, ep.setup).eq(ctbuf.r_data),
+                    ep.drop.eq(ctbuf.r_drop),
+                    ctbuf.r_rdy.eq(ep.rdy),
+                ]
+                avail_map[addr] = ctbuf.w_avail
+            elif buffered:
+                dbuf_w_data = Cat(port.data, port.be, port.zlp, port.setup)
+                dbuf = _make_buffer(ep, buffered, width=len(dbuf_w_data))
                 m.submodules["dbuf_{}".format(addr)] = dbuf
                 m.d.comb += [
                     dbuf.w_stb.eq(port.stb),
@@ -282,29 +1031,94 @@ class OutputMultiplexer(Elaboratable):
 
                     ep.stb.eq(dbuf.r_stb),
                     ep.lst.eq(dbuf.r_lst),
-                    Cat(ep.data, ep.zlp, ep.setup).eq(dbuf.r_data),
+                    Cat(ep.data, ep.be, ep.zlp, ep.setup).eq(dbuf.r_data),
                     dbuf.r_rdy.eq(ep.rdy),
                 ]
+                avail_map[addr] = dbuf.w_avail
+                if _hb_transactions(ep) > 1:
+                    with m.If(self.sof):
+                        # Discard the payload of the previous microframe if the device did not
+                        # receive all of its packets.
+                        m.d.comb += [
+                            dbuf.w_stb.eq(1),
+                            dbuf.w_lst.eq(1),
+                            dbuf.w_drop.eq(1),
+                        ]
             else:
                 m.d.comb += [
                     ep.stb.eq(port.stb),
                     ep.lst.eq(port.lst),
                     ep.data.eq(port.data),
+                    ep.be.eq(port.be),
                     ep.zlp.eq(port.zlp),
                     ep.setup.eq(port.setup),
                     ep.drop.eq(port.drop),
                     port.rdy.eq(ep.rdy),
                 ]
-            m.d.comb += ep.sof.eq(self.sof)
+                avail_map[addr] = ep.rdy
+            m.d.comb += [
+                ep.sof.eq(self.sof),
+                ep.frame.eq(self.frame),
+                ep.microframe.eq(self.microframe),
+            ]
+
+        pool_map = OrderedDict((addr, (ep, buffered))
+                               for addr, (ep, buffered, shared, _) in self._ep_map.items()
+                               if shared)
+        if pool_map:
+            pool = _make_pool(pool_map.values(), self._shared_packets,
+                              width=len(Cat(self.pkt.data, self.pkt.be, self.pkt.zlp,
+                                            self.pkt.setup)))
+            m.submodules.pool = pool
+            for i, addr in enumerate(pool_map):
+                avail_map[addr] = pool.w_avail[i]
+
+            # Packets are read from the pool one at a time. Once an endpoint has been granted
+            # access, it keeps it until the end of its packet.
+            r_busy = Signal()
+            m.submodules.r_arbiter = r_arbiter = PriorityEncoder(len(pool_map))
+            m.d.comb += r_arbiter.i.eq(Cat(ep.rdy for ep, _ in pool_map.values()) & pool.r_avail)
+            with m.If(~r_busy & ~r_arbiter.n):
+                m.d.sync += [
+                    r_busy.eq(1),
+                    pool.r_sel.eq(r_arbiter.o),
+                ]
+
+            with m.Switch(pool.r_sel):
+                for i, (ep, _) in enumerate(pool_map.values()):
+                    with m.Case(i):
+                        m.d.comb += [
+                            ep.stb.eq(pool.r_stb & r_busy),
+                            ep.lst.eq(pool.r_lst),
+                            Cat(ep.data, ep.be, ep.zlp, ep.setup).eq(pool.r_data),
+                            pool.r_rdy.eq(ep.rdy & r_busy),
+                        ]
+            with m.If(pool.r_stb & pool.r_rdy & pool.r_lst):
+                m.d.sync += r_busy.eq(0)
 
         with m.Switch(self.sel.addr):
             for addr, port in port_map.items():
-                ep, _ = self._ep_map[addr]
+                ep, _, shared, _ = self._ep_map[addr]
                 with m.Case(addr):
                     m.d.comb += [
                         self.sel.xfer.eq(ep.xfer),
-                        port.connect(self.pkt),
+                        self.sel.transactions.eq(ep.transactions),
+                        self.sel.avail.eq(avail_map[addr]),
                     ]
+                    if ep.xfer is Transfer.CONTROL:
+                        m.d.comb += self.sel.stall.eq(ep.stall)
+                    if shared:
+                        m.d.comb += [
+                            pool.w_sel.eq(list(pool_map).index(addr)),
+                            pool.w_stb.eq(self.pkt.stb),
+                            pool.w_lst.eq(self.pkt.lst),
+                            pool.w_data.eq(Cat(self.pkt.data, self.pkt.be, self.pkt.zlp,
+                                               self.pkt.setup)),
+                            pool.w_drop.eq(self.pkt.drop),
+                            self.pkt.rdy.eq(pool.w_rdy),
+                        ]
+                    else:
+                        m.d.comb += port.connect(self.pkt)
             with m.Default():
                 # Unknown endpoint.
                 m.d.comb += self.sel.err.eq(1)
@@ -0,0 +1,173 @@
+import enum
+
+from nmigen import *
+from nmigen.hdl.rec import *
+
+from .endpoint import *
+
+
+__all__ = ["Counter", "DeviceStats"]
+
+
+class Counter(enum.IntEnum):
+    ACK       = 0
+    NAK       = 1
+    STALL     = 2
+    CRC_ERROR = 3
+    SEQ_ERROR = 4
+    BYTES     = 5
+    BUSY      = 6
+    SOF       = 7
+    TIMEOUT   = 8
+
+
+class DeviceStats(Elaboratable):
+    """Device performance counters.
+
+    Saturating counters of the events seen by the device controller, for each endpoint.
+
+    A counter is selected by `rd.addr`, as `Cat(kind, dir, ep)`, where `kind` is a 4-bit
+    :class:`Counter` value, `dir` is 1 for IN endpoints and 0 for OUT endpoints, and `ep` is the
+    4-bit endpoint address. The SOF counter is global, and can be read at any endpoint address and
+    direction. Counters of endpoints that weren't added read as 0.
+
+    Attributes
+    ----------
+    event.ep : Signal(4), in
+        Endpoint address of the current transaction.
+    event.dir : Signal, in
+        Endpoint direction of the current transaction. 1 for IN, 0 for OUT.
+    event.ack : Signal, in
+        ACK handshake. Sent by the device for OUT transactions, received for IN transactions.
+    event.nak : Signal, in
+        NAK handshake sent.
+    event.stall : Signal, in
+        STALL handshake sent.
+    event.crc_error : Signal, in
+        Data packet dropped for a bad CRC, or because the PHY aborted it.
+    event.seq_error : Signal, in
+        Data packet dropped for an unexpected data PID.
+    event.timeout : Signal, in
+        Handshake timeout. The host didn't acknowledge a data packet in time.
+    event.bytes : Signal(range(data_width // 8 + 1)), in
+        Number of payload bytes moved during this cycle.
+    event.busy : Signal, in
+        Busy cycle. Asserted while the device is processing a transaction.
+    event.sof : Signal, in
+        Start-of-frame packet received.
+    rd.addr : Signal(9), in
+        Read address.
+    rd.data : Signal(width), out
+        Read data. Valid one cycle after `rd.addr`.
+    clr : Signal, in
+        Clear. Resets all counters to 0.
+
+    Parameters
+    ----------
+    width : int
+        Counter width, in bits. Optional. Defaults to 32.
+    data_width : int
+        Data width of the device, in bits. Optional. Defaults to 8.
+    """
+    def __init__(self, *, width=32, data_width=8):
+        if not isinstance(width, int) or width <= 0:
+            raise ValueError("Counter width must be a positive integer, not {!r}".format(width))
+
+        self.event = Record([
+            ("ep",        4, DIR_FANIN),
+            ("dir",       1, DIR_FANIN),
+            ("ack",       1, DIR_FANIN),
+            ("nak",       1, DIR_FANIN),
+            ("stall",     1, DIR_FANIN),
+            ("crc_error", 1, DIR_FANIN),
+            ("seq_error", 1, DIR_FANIN),
+            ("timeout",   1, DIR_FANIN),
+            ("bytes",     range(data_width // 8 + 1), DIR_FANIN),
+            ("busy",      1, DIR_FANIN),
+            ("sof",       1, DIR_FANIN),
+        ])
+        self.rd = Record([
+            ("addr", 9, DIR_FANIN),
+            ("data", width, DIR_FANOUT),
+        ])
+        self.clr = Signal()
+
+        self.width = width
+
+        self._ep_set = set()
+
+    def add_endpoint(self, ep, *, addr):
+        """
+        Add counters for an endpoint.
+
+        Parameters
+        ----------
+        ep : :class:`endpoint.InputEndpoint` or :class:`endpoint.OutputEndpoint`
+            Endpoint interface.
+        addr : int
+            Endpoint address.
+        """
+        if isinstance(ep, InputEndpoint):
+            direction = 1
+        elif isinstance(ep, OutputEndpoint):
+            direction = 0
+        else:
+            raise TypeError("Endpoint must be an InputEndpoint or an OutputEndpoint, not {!r}"
+                            .format(ep))
+        if not isinstance(addr, int):
+            raise TypeError("Endpoint address must be an integer, not {!r}"
+                             .format(addr))
+        if not addr in range(0, 16):
+            raise ValueError("Endpoint address must be between 0 and 15, not {}"
+                             .format(addr))
+        if (addr, direction) in self._ep_set:
+            raise ValueError("Endpoint address {} has already been assigned".format(addr))
+        self._ep_set.add((addr, direction))
+
+    def _counter(self, m, name, inc):
+        ctr = Signal(self.width, name=name)
+        ctr_next = Signal(self.width + 1, name="{}_next".format(name))
+        m.d.comb += ctr_next.eq(ctr + inc)
+        with m.If(self.clr):
+            m.d.sync += ctr.eq(0)
+        with m.Elif(ctr_next[-1]):
+            # Saturate instead of wrapping around.
+            m.d.sync += ctr.eq(2**self.width - 1)
+        with m.Else():
+            m.d.sync += ctr.eq(ctr_next)
+        return ctr
+
+    def elaborate(self, platform):
+        m = Module()
+
+        sof_ctr = self._counter(m, "sof_ctr", self.event.sof)
+
+        rd_data = Signal.like(self.rd.data)
+        m.d.sync += self.rd.data.eq(rd_data)
+
+        with m.If(self.rd.addr[:4] == Counter.SOF):
+            m.d.comb += rd_data.eq(sof_ctr)
+
+        for addr, direction in sorted(self._ep_set):
+            prefix = "ep{}{}".format(addr, "in" if direction else "out")
+            ep_event = Signal(name="{}_event".format(prefix))
+            m.d.comb += ep_event.eq((self.event.ep == addr) & (self.event.dir == direction))
+
+            counters = {
+                Counter.ACK:       self.event.ack,
+                Counter.NAK:       self.event.nak,
+                Counter.STALL:     self.event.stall,
+                Counter.CRC_ERROR: self.event.crc_error,
+                Counter.SEQ_ERROR: self.event.seq_error,
+                Counter.BYTES:     self.event.bytes,
+                Counter.BUSY:      self.event.busy,
+                Counter.TIMEOUT:   self.event.timeout,
+            }
+            for kind, inc in counters.items():
+                name = "{}_{}".format(prefix, kind.name.lower())
+                ctr  = self._counter(m, name, Mux(ep_event, inc, 0))
+                with m.If(self.rd.addr == Cat(Const(kind, 4), Const(direction, 1),
+                                              Const(addr, 4))):
+                    m.d.comb += rd_data.eq(ctr)
+
+        return m
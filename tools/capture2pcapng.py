@@ -0,0 +1,516 @@
+#!/usr/bin/env python3
+"""Convert the capture stream of a lambdaUSB sniffer to a pcapng file.
+
+The capture stream is made of the records of `lambdausb.io.capture.CaptureEngine`, optionally
+compressed by `lambdausb.io.capture.CaptureCompressor`. It is read from a file, a pipe or a USB
+bulk endpoint, and parsed in fixed-size chunks with NumPy: record boundaries are found by
+pointer jumping over the record headers, and compressed records are expanded with segmented
+prefix sums. Packets are written as LINKTYPE_USB_2_0 Enhanced Packet Blocks, with their CRC
+errors and PHY receive errors reported in the `epb_flags` option.
+
+Usage:
+
+    capture2pcapng.py capture.bin capture.pcapng
+    capture2pcapng.py --usb 1209:5a5a --endpoint 0x81 - | wireshark -k -i -
+"""
+
+import argparse
+import fractions
+import struct
+import sys
+import time
+
+import numpy as np
+
+from lambdausb.usb.defs import PacketID
+
+
+__all__ = ["CaptureDecoder", "PcapngWriter"]
+
+
+LINKTYPE_USB_2_0 = 288
+
+# Generator polynomials of the token and data CRCs, as in `lambdausb.usb.crc.CRC`.
+CRC5_POLY  = 0b00101
+CRC16_POLY = 0b11000000000000101
+
+# `epb_flags` link-layer errors.
+EPB_FLAG_CRC_ERROR    = 1 << 24
+EPB_FLAG_SYMBOL_ERROR = 1 << 31
+
+_KIND_PACKET  = 0
+_KIND_EVENT   = 1
+_KIND_WRAP    = 2
+_KIND_COMPACT = 3
+
+_TOKEN_PIDS = [PacketID.OUT, PacketID.IN, PacketID.SOF, PacketID.SETUP, PacketID.PING]
+_DATA_PIDS  = [PacketID.DATA0, PacketID.DATA1, PacketID.DATA2, PacketID.MDATA]
+
+
+def _pid_byte(pid):
+    return pid | (~pid & 0xf) << 4
+
+
+def _reflect(value, width):
+    return int("{:0{}b}".format(value, width)[::-1], 2)
+
+
+def _crc5_table():
+    # CRC5 of every 11-bit token field, in the bit order used on the wire.
+    table = np.empty(2048, dtype=np.uint32)
+    for field in range(2048):
+        crc = 0x1f
+        for i in range(11):
+            if (field >> i & 1) ^ (crc >> 4 & 1):
+                crc = (crc << 1 ^ CRC5_POLY) & 0x1f
+            else:
+                crc = crc << 1 & 0x1f
+        table[field] = _reflect(~crc & 0x1f, 5)
+    return table
+
+
+def _crc16_table():
+    # Byte-wise table of the reflected CRC16.
+    poly  = _reflect(CRC16_POLY & 0xffff, 16)
+    table = np.empty(256, dtype=np.uint32)
+    for byte in range(256):
+        crc = byte
+        for i in range(8):
+            crc = crc >> 1 ^ poly if crc & 1 else crc >> 1
+        table[byte] = crc
+    return table
+
+
+_CRC5_TABLE  = _crc5_table()
+_CRC16_TABLE = _crc16_table()
+# The CRC16 is linear: running it over 2 or 4 bytes only depends on the 16 bits of the CRC
+# register XORed with the first 2 bytes, and on the next 2 bytes.
+_CRC16_TABLE_2 = np.arange(65536, dtype=np.uint32)
+for i in range(2):
+    _CRC16_TABLE_2 = _CRC16_TABLE_2 >> 8 ^ _CRC16_TABLE[_CRC16_TABLE_2 & 0xff]
+_CRC16_TABLE_4 = _CRC16_TABLE_2[_CRC16_TABLE_2]
+# Running the reflected CRC16 over a payload and its CRC field leaves a constant residual.
+_CRC16_RESIDUAL = 0xb001
+
+_TOKEN_PID_BYTES = np.array([_pid_byte(pid) for pid in _TOKEN_PIDS], dtype=np.uint32)
+_DATA_PID_BYTES  = np.array([_pid_byte(pid) for pid in _DATA_PIDS],  dtype=np.uint32)
+_SOF_PID_BYTE    = _pid_byte(PacketID.SOF)
+_NAK_PID_BYTE    = _pid_byte(PacketID.NAK)
+_RUN_PID_BYTES   = np.array([_pid_byte(PacketID.IN), _pid_byte(PacketID.PING)], dtype=np.uint32)
+
+
+# Size of each kind of record, without its payload.
+_RECORD_SIZE = np.array([2, 2, 2, 1], dtype=np.int32)
+
+
+class Packets:
+    """A batch of decoded packets.
+
+    Attributes
+    ----------
+    timestamp : ndarray of uint64
+        Packet timestamps, in capture clock cycles since the start of the capture.
+    length : ndarray of uint32
+        Packet lengths, in bytes.
+    flags : ndarray of uint32
+        `epb_flags` of each packet.
+    start : ndarray of int64
+        Offset of each packet in `words`.
+    words : ndarray of uint32
+        Packet bytes, packed in little-endian order and padded to a whole number of words.
+    """
+    def __init__(self, timestamp, length, flags, start, words):
+        self.timestamp = timestamp
+        self.length    = length
+        self.flags     = flags
+        self.start     = start
+        self.words     = words
+
+    def __len__(self):
+        return len(self.timestamp)
+
+
+class CaptureDecoder:
+    """Streaming capture record decoder.
+
+    Capture data is passed to :meth:`decode` in chunks of any size. Records that span two chunks
+    are kept until the next call. The capture must start with a record header.
+
+    Attributes
+    ----------
+    n_packets : int
+        Number of decoded packets.
+    n_errors : int
+        Number of packets with a CRC, PID or receive error.
+    n_events : int
+        Number of line state events.
+    n_dropped : int
+        Number of records dropped by the sniffer.
+    """
+    def __init__(self):
+        self._rest_bytes = b""
+        self._rest_words = np.empty(0, dtype=np.uint32)
+        # Average record size of the previous chunk, in words.
+        self._record_size = 0
+
+        # Decompressor state. See `lambdausb.io.capture.decompress`.
+        self._prev_ts   = 0
+        self._last_fn   = -1
+        self._run_token = -1
+        self._epoch     = 0
+
+        self.n_packets = 0
+        self.n_errors  = 0
+        self.n_events  = 0
+        self.n_dropped = 0
+
+    @staticmethod
+    def _size(words):
+        # Size of a record, in words, from its header.
+        kind = (words >> 30).astype(np.int32)
+        size = ((words & 0xffff) + 3 >> 2).astype(np.int32)
+        size[kind != _KIND_PACKET] = 0
+        size += _RECORD_SIZE[kind]
+        return size
+
+    def _headers(self, words):
+        # Offsets of the record headers in `words`, and of the first incomplete record.
+        n = len(words)
+        if self._record_size >= 8:
+            # Records are large, walking them is faster than jumping over every word.
+            headers = []
+            offset  = 0
+            while offset < n:
+                headers.append(offset)
+                header = words.item(offset)
+                if header >> 30 == _KIND_COMPACT:
+                    offset += 1
+                elif header >> 30 == _KIND_PACKET:
+                    offset += 2 + ((header & 0xffff) + 3 >> 2)
+                else:
+                    offset += 2
+            headers = np.array(headers, dtype=np.int64)
+        else:
+            jump = np.empty(n + 1, dtype=np.int32)
+            np.minimum(np.arange(n, dtype=np.int32) + self._size(words), n, out=jump[:n])
+            jump[n] = n
+
+            # Pointer jumping: `jump` skips 2**k records, and `headers` holds the first 2**k
+            # records, in order.
+            headers = np.zeros(1, dtype=np.int32)
+            while True:
+                headers = np.concatenate([headers, jump[headers]])
+                if headers[-1] == n:
+                    break
+                jump = jump[jump]
+            headers = headers[headers < n].astype(np.int64)
+        self._record_size = n / max(len(headers), 1)
+
+        complete = headers + self._size(words[headers]) <= n
+        if complete.all():
+            return headers, n
+        return headers[complete], int(headers[~complete][0])
+
+    def decode(self, data):
+        """Decode a chunk of capture data.
+
+        Returns a :class:`Packets` instance.
+        """
+        data = self._rest_bytes + bytes(data)
+        n_bytes = len(data) // 4 * 4
+        self._rest_bytes = data[n_bytes:]
+        words = np.concatenate([self._rest_words,
+                                np.frombuffer(data[:n_bytes], dtype="<u4").astype(np.uint32)])
+
+        headers, end = self._headers(words)
+        self._rest_words = words[end:].copy()
+
+        header  = words[headers]
+        kind    = header >> 30
+        compact = kind == _KIND_COMPACT
+        nak     = compact & (header >> 29 & 1 == 1)
+        raw     = ~compact
+
+        self.n_events  += int(np.count_nonzero(kind == _KIND_EVENT))
+        self.n_dropped += int(np.sum(np.where(raw, header >> 24 & 0x3f, 0)))
+
+        # Expand compressed NAK records into a token and a handshake. Each entry is a record, or
+        # a packet of an expanded record.
+        n_entries = len(headers) + int(np.count_nonzero(nak))
+        record    = np.repeat(np.arange(len(headers)), np.where(nak, 2, 1))
+        second    = np.zeros(n_entries, dtype=bool)
+        second[1:] = record[1:] == record[:-1]
+
+        e_header  = header[record]
+        e_offset  = headers[record]
+        e_kind    = kind[record]
+        e_raw     = raw[record]
+        e_compact = compact[record]
+        e_nak     = nak[record]
+        e_sof     = e_compact & ~e_nak
+
+        raw_ts    = np.zeros(n_entries, dtype=np.int64)
+        raw_ts[e_raw] = words[e_offset[e_raw] + 1]
+        raw_data  = np.zeros(n_entries, dtype=np.uint32)
+        e_length  = np.where(e_kind == _KIND_PACKET, e_header & 0xffff, 0)
+        has_data  = e_raw & (e_kind == _KIND_PACKET) & (e_length > 0)
+        raw_data[has_data] = words[e_offset[has_data] + 2]
+
+        # Timestamps: raw records hold an absolute timestamp, compressed records hold
+        # a difference with the previous entry.
+        delta = np.zeros(n_entries, dtype=np.int64)
+        delta[e_sof] = e_header[e_sof] & 0x7ffffff
+        delta[e_nak & ~second] = e_header[e_nak & ~second] >> 13 & 0xffff
+        delta[e_nak &  second] = e_header[e_nak &  second] & 0x1fff
+        timestamp = self._scan(e_raw, raw_ts, delta, self._prev_ts) & 0xffffffff
+
+        # Timestamps are 32-bit. The sniffer sends a WRAP record when they wrap around, so that
+        # no wrap around goes unnoticed.
+        prev = np.concatenate([[self._prev_ts], timestamp[:-1]])
+        epoch = self._epoch + np.cumsum(timestamp < prev)
+        if n_entries:
+            self._prev_ts = int(timestamp[-1])
+            self._epoch   = int(epoch[-1])
+        timestamp = (epoch.astype(np.uint64) << np.uint64(32)) | timestamp.astype(np.uint64)
+
+        # Frame numbers of SOF packets, and repeated tokens. The decompressor only tracks
+        # packets that the compressor could have compressed.
+        plain   = e_raw & (e_header & 0x3fff0000 == 0) & (e_length == 3) & (raw_data >> 24 == 0)
+        raw_sof = plain & (raw_data & 0xff == _SOF_PID_BYTE)
+        raw_run = plain & np.isin(raw_data & 0xff, _RUN_PID_BYTES)
+
+        fn_raw  = (raw_data >> 8 & 0x7ff).astype(np.int64)
+        fn_inc  = np.where(e_sof, e_header >> 28 & 1, 0).astype(np.int64)
+        fn_ref  = self._fill(raw_sof, fn_raw, self._last_fn)
+        token   = self._fill(raw_run, raw_data.astype(np.int64), self._run_token)
+        if (e_sof & (fn_ref < 0)).any() or (e_nak & (token < 0)).any():
+            raise ValueError("Compressed record without a reference packet")
+        fn = self._scan(raw_sof, fn_raw, fn_inc, self._last_fn) & 0x7ff
+        if n_entries:
+            if fn_ref[-1] >= 0:
+                self._last_fn = int(fn[-1])
+            self._run_token = int(token[-1])
+
+        # Packets, and the words that hold their bytes. Bytes of compressed packets are
+        # appended to the words of the chunk.
+        packet = (e_kind == _KIND_PACKET) | e_compact
+        p_raw  = e_raw[packet]
+        p_len  = np.where(e_sof, 3, np.where(e_nak, np.where(second, 1, 3), e_length))[packet]
+        synth  = np.where(e_sof, _SOF_PID_BYTE | fn << 8 | _CRC5_TABLE[fn] << 19,
+                 np.where(second, _NAK_PID_BYTE, token & 0xffffffff))[packet & e_compact]
+        p_start = np.empty(len(p_len), dtype=np.int64)
+        p_start[p_raw]  = e_offset[packet][p_raw] + 2
+        p_start[~p_raw] = len(words) + np.arange(np.count_nonzero(~p_raw))
+        p_words = np.concatenate([words, synth.astype(np.uint32)])
+
+        p_flags = np.where(e_raw & (e_header >> 16 & 1 == 1), EPB_FLAG_SYMBOL_ERROR, 0)[packet]
+        p_flags = p_flags.astype(np.uint32)
+        p_flags[~self._check(p_words, p_start, p_len)] |= EPB_FLAG_CRC_ERROR
+
+        self.n_packets += len(p_len)
+        self.n_errors  += int(np.count_nonzero(p_flags))
+        return Packets(timestamp[packet], p_len.astype(np.uint32), p_flags, p_start, p_words)
+
+    @staticmethod
+    def _scan(is_abs, value, delta, init):
+        # Running value, set by entries with `is_abs`, and incremented by `delta` otherwise.
+        index  = np.arange(len(value) + 1)
+        is_abs = np.concatenate([[True], is_abs])
+        value  = np.concatenate([[init], value])
+        delta  = np.concatenate([[0], np.where(is_abs[1:], 0, delta)])
+        last   = np.maximum.accumulate(np.where(is_abs, index, 0))
+        total  = np.cumsum(delta)
+        return (value[last] + total - total[last])[1:]
+
+    @staticmethod
+    def _fill(is_set, value, init):
+        # Last value set by an entry with `is_set`.
+        index = np.arange(len(value) + 1)
+        value = np.concatenate([[init], value])
+        last  = np.maximum.accumulate(np.where(np.concatenate([[True], is_set]), index, 0))
+        return value[last][1:]
+
+    @staticmethod
+    def _check(words, start, length):
+        # Check the PID and CRC of each packet.
+        data = words.view(np.uint8)
+        pid  = data[start * 4].astype(np.uint32)
+        ok   = (length > 0) & ((pid & 0xf) == (~pid >> 4 & 0xf))
+
+        token = np.isin(pid, _TOKEN_PID_BYTES)
+        ok &= ~token | (length == 3)
+        is_token = ok & token
+        field = words[start[is_token]]
+        ok[is_token] = _CRC5_TABLE[field >> 8 & 0x7ff] == field >> 19 & 0x1f
+
+        is_data = ok & np.isin(pid, _DATA_PID_BYTES)
+        ok &= ~is_data | (length >= 3)
+        is_data &= length >= 3
+        # Run the CRC of all data packets at once, longest packets first, so that the packets
+        # that are still running are always a prefix of the batch. The CRC starts after the PID,
+        # and is computed 4 bytes at a time.
+        index  = np.flatnonzero(is_data)
+        index  = index[np.argsort(-length[index].astype(np.int64), kind="stable")]
+        start  = start[index]
+        count  = length[index].astype(np.int64) - 1
+        crc    = np.full(len(index), 0xffff, dtype=np.uint32)
+        n_words = count >> 2
+        n = len(index)
+        for i in range(int(n_words[0]) if n else 0):
+            while n_words[n - 1] <= i:
+                n -= 1
+            word = words[start[:n] + i] >> 8 | words[start[:n] + i + 1] << 24
+            crc[:n] ^= word
+            crc[:n] = _CRC16_TABLE_4[crc[:n] & 0xffff] ^ _CRC16_TABLE_2[crc[:n] >> 16]
+        offset = start * 4 + 1 + n_words * 4
+        for i in range(3):
+            rest = count - n_words * 4 > i
+            byte = data[offset[rest] + i]
+            crc[rest] = crc[rest] >> 8 ^ _CRC16_TABLE[(crc[rest] ^ byte) & 0xff]
+        ok[index] = crc == _CRC16_RESIDUAL
+        return ok
+
+
+class PcapngWriter:
+    """Streaming pcapng writer, with a single LINKTYPE_USB_2_0 interface.
+
+    Parameters
+    ----------
+    file : binary file
+        Output file.
+    clock : int
+        Frequency of the capture clock, in Hz. Timestamps are written in nanoseconds.
+    """
+    def __init__(self, file, *, clock=60_000_000):
+        self.file  = file
+        self.scale = fractions.Fraction(10**9, clock)
+
+        options = b"lambdaUSB capture2pcapng"
+        options = (struct.pack("<HH", 4, len(options)) + options
+                   + bytes(-len(options) % 4) + struct.pack("<HH", 0, 0))
+        # Section Header Block.
+        self._write_block(0x0a0d0d0a, struct.pack("<IHHq", 0x1a2b3c4d, 1, 0, -1) + options)
+        # Interface Description Block, with if_tsresol = 9 (nanoseconds).
+        self._write_block(0x00000001, struct.pack("<HHI", LINKTYPE_USB_2_0, 0, 0)
+                          + struct.pack("<HHB3x", 9, 1, 9) + struct.pack("<HH", 0, 0))
+
+    def _write_block(self, block_type, body):
+        length = 12 + len(body)
+        self.file.write(struct.pack("<II", block_type, length) + body
+                        + struct.pack("<I", length))
+
+    def write(self, packets):
+        """Write a :class:`Packets` batch as Enhanced Packet Blocks."""
+        if not len(packets):
+            return
+        n_words = (packets.length.astype(np.int64) + 3) >> 2
+        # Block header (7 words), packet data, epb_flags (2 words), end of options and block
+        # length (2 words).
+        size = 11 + n_words
+        base = np.concatenate([[0], np.cumsum(size)[:-1]])
+        out  = np.empty(int(size.sum()), dtype=np.uint32)
+
+        timestamp = (packets.timestamp * np.uint64(self.scale.numerator)
+                     // np.uint64(self.scale.denominator))
+        out[base + 0] = 6
+        out[base + 1] = size * 4
+        out[base + 2] = 0
+        out[base + 3] = timestamp >> np.uint64(32)
+        out[base + 4] = timestamp & np.uint64(0xffffffff)
+        out[base + 5] = packets.length
+        out[base + 6] = packets.length
+
+        first = np.repeat(base + 7 - np.concatenate([[0], np.cumsum(n_words)[:-1]]), n_words)
+        src   = np.repeat(packets.start - np.concatenate([[0], np.cumsum(n_words)[:-1]]),
+                          n_words)
+        index = np.arange(int(n_words.sum()))
+        out[first + index] = packets.words[src + index]
+
+        # Clear the padding bytes of the last data word.
+        tail = (packets.length & 3) != 0
+        mask = (np.uint64(1) << (packets.length[tail].astype(np.uint64) & np.uint64(3))
+                * np.uint64(8)) - np.uint64(1)
+        out[(base + 6 + n_words)[tail]] &= mask.astype(np.uint32)
+
+        end = base + 7 + n_words
+        out[end + 0] = 2 | 4 << 16
+        out[end + 1] = packets.flags
+        out[end + 2] = 0
+        out[end + 3] = size * 4
+        self.file.write(out.astype("<u4").tobytes())
+
+
+def _read_file(file, chunk_size):
+    while True:
+        data = file.read(chunk_size)
+        if not data:
+            return
+        yield data
+
+
+def _read_usb(vid_pid, endpoint, chunk_size):
+    try:
+        import usb.core
+    except ImportError:
+        raise SystemExit("pyusb is required to capture from a USB device")
+    vid, pid = (int(value, 16) for value in vid_pid.split(":"))
+    dev = usb.core.find(idVendor=vid, idProduct=pid)
+    if dev is None:
+        raise SystemExit("Device {:04x}:{:04x} was not found".format(vid, pid))
+    dev.set_configuration()
+    while True:
+        try:
+            yield dev.read(endpoint, chunk_size, timeout=100)
+        except usb.core.USBTimeoutError:
+            continue
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert a lambdaUSB capture to pcapng.")
+    parser.add_argument("input", nargs="?", default="-",
+                        help="capture file, or '-' for the standard input")
+    parser.add_argument("output", nargs="?", default="-",
+                        help="pcapng file, or '-' for the standard output")
+    parser.add_argument("--usb", metavar="VID:PID",
+                        help="capture from the bulk endpoint of a USB device")
+    parser.add_argument("--endpoint", type=lambda value: int(value, 0), default=0x81,
+                        help="bulk IN endpoint address (default: 0x81)")
+    parser.add_argument("--clock", type=int, default=60_000_000,
+                        help="capture clock frequency, in Hz (default: 60 MHz)")
+    parser.add_argument("--chunk-size", type=int, default=1 << 20,
+                        help="read size, in bytes (default: 1 MiB)")
+    parser.add_argument("-q", "--quiet", action="store_true",
+                        help="do not print statistics")
+    args = parser.parse_args()
+
+    if args.usb is not None:
+        chunks = _read_usb(args.usb, args.endpoint, args.chunk_size)
+    elif args.input == "-":
+        chunks = _read_file(sys.stdin.buffer, args.chunk_size)
+    else:
+        chunks = _read_file(open(args.input, "rb"), args.chunk_size)
+    output = sys.stdout.buffer if args.output == "-" else open(args.output, "wb")
+
+    decoder = CaptureDecoder()
+    writer  = PcapngWriter(output, clock=args.clock)
+    n_bytes = 0
+    start   = time.perf_counter()
+    try:
+        for chunk in chunks:
+            writer.write(decoder.decode(chunk))
+            n_bytes += len(chunk)
+    except KeyboardInterrupt:
+        pass
+    output.flush()
+    seconds = time.perf_counter() - start
+
+    if not args.quiet:
+        print("{} packets ({} with errors), {} events, {} dropped records; "
+              "{:.1f} MB in {:.2f} s ({:.1f} MB/s)"
+              .format(decoder.n_packets, decoder.n_errors, decoder.n_events, decoder.n_dropped,
+                      n_bytes / 1e6, seconds, n_bytes / 1e6 / max(seconds, 1e-9)),
+              file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()